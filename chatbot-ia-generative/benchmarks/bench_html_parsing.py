@@ -0,0 +1,174 @@
+"""
+Benchmark du parsing des pages scrapées par MultiSearchService
+
+Pour chaque fixture HTML (``google_news.html``, ``bing_news.html``,
+``news_site.html``), gonflée à une taille réaliste (``--page-kb`` de
+balisage annexe : navigation, scripts, pied de page, et ``--items`` éléments
+de résultat), compare le temps de parsing médian et le pic mémoire
+(``tracemalloc``) de :
+
+- ``full``          : ancien chemin, ``BeautifulSoup(html, 'html.parser')`` puis ``find_all``
+- ``strained``      : ``parse_items`` (``SoupStrainer``) avec ``html.parser``
+- ``strained_lxml`` : idem avec ``lxml`` (si installé)
+- ``early_stop``    : lecture en flux par ``AsyncScraper.fetch`` (morceaux de
+  ``--chunk-kb``), arrêtée après ``max_results`` éléments, puis ``parse_items``
+
+Usage :
+    python -m benchmarks.bench_html_parsing --iterations 50 --page-kb 400
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_backend.settings')
+django.setup()
+
+import httpx  # noqa: E402
+from bs4 import BeautifulSoup  # noqa: E402
+
+from benchmarks.fixture_replay import load_fixture  # noqa: E402
+from chat.services.multi_search import ARTICLE_ITEMS, BING_ITEMS, GOOGLE_ITEMS  # noqa: E402
+from chat.services.scraping import HTML_PARSER, AsyncScraper, parse_items  # noqa: E402
+
+PAGES = {
+    'google': ('google_news.html', GOOGLE_ITEMS),
+    'bing': ('bing_news.html', BING_ITEMS),
+    'news_site': ('news_site.html', ARTICLE_ITEMS),
+}
+
+_FILLER = (
+    '<div class="nav-block"><ul><li><a href="/a">Lien</a></li><li><a href="/b">Autre lien</a></li></ul>'
+    '<span class="label">Texte annexe de la page</span><img src="/i.png" alt=""></div>\n'
+)
+
+
+def inflate(html: str, selector, page_kb: int, items: int) -> str:
+    """Page réaliste : balisage annexe autour de ``items`` éléments de résultat"""
+    body_start = html.index('<body>') + len('<body>')
+    body_end = html.rindex('</body>')
+    body = html[body_start:body_end]
+    found = [m.start() for m in re.finditer(selector.marker.pattern.decode(), body, re.IGNORECASE)]
+    first, last = found[0], body.rfind('</' + selector.tag + '>') + len(selector.tag) + 3
+    item_block = body[first:last]
+    repeated = (item_block * (items // len(found) + 1))
+    # Coupe nette sur une ouverture d'élément
+    cuts = [m.start() for m in re.finditer(selector.marker.pattern.decode(), repeated, re.IGNORECASE)]
+    repeated = repeated[:cuts[items]] if len(cuts) > items else repeated
+
+    filler = _FILLER * max(1, page_kb * 1024 // len(_FILLER) // 2)
+    script = '<script>' + 'var x=1;' * 2000 + '</script>\n'
+    return (
+        html[:body_start] + filler + body[:first] + repeated + body[last:]
+        + filler + script + html[body_end:]
+    )
+
+
+def _full_parse(html: str, selector) -> List:
+    soup = BeautifulSoup(html, 'html.parser')
+    if selector.css_class:
+        return soup.find_all(selector.tag, {'class': selector.css_class})
+    return soup.find_all(selector.tag)
+
+
+def _early_stop_parse(scraper: AsyncScraper, selector, max_results: int) -> Callable[[], List]:
+    def run():
+        page = scraper.run(scraper.fetch('https://bench.local/page', selectors=(selector,), max_results=max_results))
+        run.bytes_read = page.bytes_read
+        return parse_items(page.text, (selector,), limit=max_results)
+    run.bytes_read = 0
+    return run
+
+
+def _streaming_transport(html: str, chunk_size: int) -> httpx.MockTransport:
+    data = html.encode('utf-8')
+
+    async def body():
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    def handler(request):
+        return httpx.Response(200, headers={'content-type': 'text/html; charset=utf-8'}, content=body())
+
+    return httpx.MockTransport(handler)
+
+
+def _measure(func: Callable[[], List], iterations: int) -> Dict[str, float]:
+    func()  # échauffement
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        items = func()
+        samples.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'median_ms': statistics.median(samples) * 1000,
+        'peak_kb': peak / 1024,
+        'items': len(items),
+    }
+
+
+def run(iterations: int, page_kb: int, items: int, max_results: int, chunk_kb: int) -> Dict[str, Dict]:
+    results = {}
+    for name, (fixture, selector) in PAGES.items():
+        html = inflate(load_fixture(fixture), selector, page_kb, items)
+        scraper = AsyncScraper(transport=_streaming_transport(html, chunk_kb * 1024))
+        strategies = {
+            'full': lambda: _full_parse(html, selector)[:max_results],
+            'strained': lambda: parse_items(html, (selector,), limit=max_results, parser='html.parser'),
+        }
+        if HTML_PARSER == 'lxml':
+            strategies['strained_lxml'] = lambda: parse_items(html, (selector,), limit=max_results, parser='lxml')
+        early_stop = _early_stop_parse(scraper, selector, max_results)
+        strategies['early_stop'] = early_stop
+
+        page_results = {'page_kb': len(html.encode('utf-8')) / 1024}
+        try:
+            for strategy, func in strategies.items():
+                page_results[strategy] = _measure(func, iterations)
+        finally:
+            scraper.close()
+        page_results['early_stop']['bytes_read_kb'] = early_stop.bytes_read / 1024
+        results[name] = page_results
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Temps de parsing et pic mémoire par page scrapée")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--page-kb", type=int, default=400, help="Balisage annexe ajouté à chaque page")
+    parser.add_argument("--items", type=int, default=20, help="Éléments de résultat par page")
+    parser.add_argument("--max-results", type=int, default=5)
+    parser.add_argument("--chunk-kb", type=int, default=16, help="Taille des morceaux lus en flux")
+    parser.add_argument("--output", help="Fichier JSON de sortie")
+    args = parser.parse_args()
+
+    results = run(args.iterations, args.page_kb, args.items, args.max_results, args.chunk_kb)
+    for name, page in results.items():
+        print(f"{name} ({page['page_kb']:.0f} Ko)")
+        for strategy, stats in page.items():
+            if strategy == 'page_kb':
+                continue
+            extra = f" read={stats['bytes_read_kb']:.0f}Ko" if 'bytes_read_kb' in stats else ''
+            print(
+                f"  {strategy:>14}: median={stats['median_ms']:.2f}ms peak={stats['peak_kb']:.0f}Ko "
+                f"items={stats['items']}{extra}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
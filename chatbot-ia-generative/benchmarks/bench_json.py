@@ -0,0 +1,195 @@
+"""
+Benchmark du JSON sur les chemins chauds : sérialisation, rendu, parsing, SSE
+
+Une base SQLite temporaire est remplie de ``--conversations`` conversations
+de ``--messages`` messages (réponses longues avec résultats de recherche et
+sources, comme en production), puis on compare le temps médian de :
+
+- ``serialize`` : ``ConversationSerializer(many=True).data``, messages via
+  les champs DRF (``drf``) ou le chemin rapide ``MessageListSerializer`` (``fast``)
+- ``render``    : ``JSONRenderer`` de DRF contre ``FastJSONRenderer`` (orjson)
+- ``parse``     : ``JSONParser`` contre ``FastJSONParser`` sur la charge rendue
+- ``sse``       : décodage de ``--sse-lines`` événements SSE (``decode`` +
+  ``json.loads`` contre ``fast_json.loads`` sur les octets)
+- ``endpoint``  : ``GET /api/v1/conversations/`` de bout en bout (requêtes SQL comprises)
+
+Les sorties des deux chemins sont comparées : le rapport signale toute différence.
+
+Usage :
+    python -m benchmarks.bench_json --conversations 50 --messages 40
+    python -m benchmarks.bench_json --iterations 5 --output bench_json.json
+"""
+import argparse
+import io
+import json
+import statistics
+import time
+from datetime import datetime
+from typing import Callable, Dict
+from unittest import mock
+
+# En premier : configure Django (django.setup) pour les imports suivants
+from benchmarks.bench_pipeline import _git_revision, _setup_database
+
+from django.test import Client
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from benchmarks.fixture_replay import load_fixture
+from chat import fast_json
+from chat.models import Conversation, Message
+from chat.renderers import FastJSONParser, FastJSONRenderer
+from chat.serializers import ConversationSerializer, MessageSerializer
+from chat.views import ConversationListView
+
+
+class _DRFMessageSerializer(MessageSerializer):
+    """Sous-classe : ``MessageListSerializer`` garde le chemin DRF"""
+
+
+class _DRFConversationSerializer(ConversationSerializer):
+    messages = _DRFMessageSerializer(many=True, read_only=True)
+
+
+def populate(conversations: int, messages: int) -> int:
+    """Conversations réalistes : questions courtes, réponses longues avec sources"""
+    news = load_fixture('serpapi_news.json')['news_results']
+    answer = load_fixture('llm_answer.json')['choices'][0]['message']['content']
+    search_results = [
+        {'title': n.get('title'), 'url': n.get('link'), 'content': n.get('snippet'), 'source': n.get('source')}
+        for n in news
+    ]
+    sources = [{'title': r['title'], 'url': r['url']} for r in search_results[:5]]
+    for c in range(conversations):
+        conversation = Conversation.objects.create()
+        Message.objects.bulk_create([
+            Message(conversation=conversation, role='user', content=f"Question {c}-{m} : quoi de neuf en IA ?")
+            if m % 2 == 0 else
+            Message(conversation=conversation, role='assistant', content=answer,
+                    search_results=search_results, sources=sources)
+            for m in range(messages)
+        ])
+    return Message.objects.count()
+
+
+def _median_ms(func: Callable, iterations: int) -> float:
+    func()  # échauffement
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return round(statistics.median(samples) * 1000, 2)
+
+
+def _compare(name: str, baseline: Callable, fast: Callable, iterations: int) -> Dict:
+    result = {'baseline_ms': _median_ms(baseline, iterations), 'fast_ms': _median_ms(fast, iterations)}
+    result['speedup'] = round(result['baseline_ms'] / result['fast_ms'], 2) if result['fast_ms'] else None
+    print(f"{name:<10} {result['baseline_ms']:>10.1f} ms {result['fast_ms']:>10.1f} ms   ×{result['speedup']}")
+    return result
+
+
+def _sse_lines(count: int):
+    """Flux SSE d'une génération : un chunk ``delta`` par token"""
+    chunk = {
+        'id': 'cmpl-bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'bench',
+        'choices': [{'index': 0, 'delta': {'content': ' token'}, 'finish_reason': None}],
+    }
+    return [b'data: ' + json.dumps(chunk).encode() for _ in range(count)] + [b'data: [DONE]']
+
+
+def _sse_stdlib(lines):
+    tokens = 0
+    for line in lines:
+        line_str = line.decode('utf-8')
+        if not line_str.startswith('data: ') or line_str[6:] == '[DONE]':
+            continue
+        tokens += bool(json.loads(line_str[6:])['choices'][0]['delta'].get('content'))
+    return tokens
+
+
+def _sse_fast(lines):
+    tokens = 0
+    for line in lines:
+        if not line.startswith(b'data: ') or line[6:] == b'[DONE]':
+            continue
+        tokens += bool(fast_json.loads(line[6:])['choices'][0]['delta'].get('content'))
+    return tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=40, help="messages par conversation")
+    parser.add_argument('--sse-lines', type=int, default=2000)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--output', help="fichier JSON du rapport")
+    args = parser.parse_args()
+
+    _setup_database()
+    ConversationListView.throttle_classes = []
+    message_count = populate(args.conversations, args.messages)
+    queryset = Conversation.objects.prefetch_related('messages')
+    conversations = list(queryset)
+
+    drf_data = _DRFConversationSerializer(conversations, many=True).data
+    fast_data = ConversationSerializer(conversations, many=True).data
+    drf_bytes = JSONRenderer().render(drf_data)
+    fast_bytes = FastJSONRenderer().render(fast_data)
+    lines = _sse_lines(args.sse_lines)
+
+    print(f"orjson : {'oui' if fast_json.HAS_ORJSON else 'non (repli sur la bibliothèque standard)'}")
+    print(f"charge : {len(drf_bytes) / 1e6:.2f} Mo, {message_count} messages\n")
+    print("étape        référence       rapide   gain")
+    client = Client()
+    results = {
+        'serialize': _compare(
+            'serialize',
+            lambda: _DRFConversationSerializer(conversations, many=True).data,
+            lambda: ConversationSerializer(conversations, many=True).data,
+            args.iterations,
+        ),
+        'render': _compare(
+            'render', lambda: JSONRenderer().render(drf_data), lambda: FastJSONRenderer().render(fast_data),
+            args.iterations,
+        ),
+        'parse': _compare(
+            'parse',
+            lambda: JSONParser().parse(io.BytesIO(drf_bytes)),
+            lambda: FastJSONParser().parse(io.BytesIO(drf_bytes)),
+            args.iterations,
+        ),
+        'sse': _compare('sse', lambda: _sse_stdlib(lines), lambda: _sse_fast(lines), args.iterations),
+    }
+    # Bout en bout : chemin DRF complet (sous-classes, sans orjson) contre la configuration servie
+    with mock.patch('chat.views.ConversationSerializer', _DRFConversationSerializer), \
+            mock.patch.object(fast_json, 'HAS_ORJSON', False):
+        baseline_ms = _median_ms(lambda: client.get('/api/v1/conversations/'), args.iterations)
+    fast_ms = _median_ms(lambda: client.get('/api/v1/conversations/'), args.iterations)
+    results['endpoint'] = {
+        'baseline_ms': baseline_ms, 'fast_ms': fast_ms,
+        'speedup': round(baseline_ms / fast_ms, 2) if fast_ms else None,
+    }
+    print(f"{'endpoint':<10} {baseline_ms:>10.1f} ms {fast_ms:>10.1f} ms   ×{results['endpoint']['speedup']}")
+
+    report = {
+        'meta': {
+            'git': _git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'args': vars(args),
+            'orjson': fast_json.HAS_ORJSON,
+        },
+        'payload': {'bytes': len(drf_bytes), 'messages': message_count},
+        'identical_output': drf_data == fast_data and json.loads(drf_bytes) == json.loads(fast_bytes),
+        'results': results,
+    }
+    if not report['identical_output']:
+        print("\n⚠️ Sorties différentes entre le chemin DRF et le chemin rapide")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Benchmark du coût du logging par requête
+
+Rejoue la partie la plus bavarde d'un tour de chat (``SerpAPIService.search``
+sur une réponse SerpAPI figée puis ``ChatAPIView._filter_by_date``) sous
+plusieurs configurations de logging et mesure le temps passé dans le thread
+de requête. Le surcoût est la différence avec la même charge, logging coupé.
+
+Configurations :
+- ``legacy_sync``  : anciens logs (8 lignes f-string par résultat + bannières),
+  handler ``StreamHandler`` synchrone, comme avec ``basicConfig``
+- ``sync_json``    : logs actuels, formateur JSON, écriture synchrone
+- ``queue_json``   : logs actuels, ``QueueListenerHandler`` (configuration par défaut)
+- ``queue_debug``  : idem au niveau DEBUG, logs par résultat échantillonnés
+
+Usage :
+    python -m benchmarks.bench_logging --requests 500 --io-latency-ms 0.5
+
+``--io-latency-ms`` simule un disque ou un collecteur lent à chaque écriture.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_backend.settings')
+django.setup()
+
+from chat.logging_utils import JsonFormatter, QueueListenerHandler, RequestIdFilter, SamplingFilter  # noqa: E402
+from chat.services.serpapi_service import SerpAPIService  # noqa: E402
+from chat.views import ChatAPIView  # noqa: E402
+
+CURRENT_DATE = datetime(2025, 1, 15, 12, 0)
+
+
+class _Sink:
+    """Flux de sortie jetable avec une latence d'écriture configurable"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def flush(self):
+        pass
+
+
+class _FixtureSerpAPIService(SerpAPIService):
+    """SerpAPIService sur une réponse figée (aucun appel réseau, aucun crédit)"""
+
+    def _execute_search(self, params, cancel_token=None):
+        return {
+            'organic_results': [
+                {
+                    'title': f"Annonce modèle de langage #{i} : nouvelles capacités",
+                    'link': f"https://news{i % 4}.example.com/article/{i}",
+                    'snippet': "OpenAI, Google et Anthropic annoncent de nouveaux modèles. " * 4,
+                }
+                for i in range(10)
+            ]
+        }
+
+
+def _legacy_result_logs(logger: logging.Logger, results: List[Dict]):
+    """Reproduit les anciens logs par résultat de SerpAPIService.search"""
+    logger.info("\n" + "🌎" * 40)
+    logger.info("🎯 RÉSULTATS SERPAPI")
+    logger.info("🌎" * 40)
+    for i, r in enumerate(results):
+        logger.info(f"\n📌 Résultat {i+1}:")
+        logger.info(f"   📝 Titre: {r['title']}")
+        logger.info(f"   🌐 URL: {r['url']}")
+        logger.info(f"   🏢 Source: {r['source']}")
+        logger.info(f"   📅 Date: {r.get('date', 'N/A')}")
+        logger.info(f"   📊 Score: {r.get('relevance_score', 0):.1%}")
+        logger.info(f"   🏷️ Tags: {', '.join(r.get('tags', []))}")
+        logger.info(f"   💬 Contenu: {r['content'][:200]}...")
+    logger.info("🌎" * 40 + "\n")
+    for r in results:
+        logger.info(f"✅ Résultat inclus: {r['title'][:50]}... - Date: {r.get('date')}")
+
+
+def _one_request(service: SerpAPIService, view: ChatAPIView, legacy: bool):
+    results = service.search("latest AI model announcements", search_type='general', use_cache=False)
+    for i, r in enumerate(results):
+        r['date_parsed'] = CURRENT_DATE - timedelta(days=i % 10)
+    if legacy:
+        _legacy_result_logs(logging.getLogger('chat.services.serpapi_service'), results)
+    view._filter_by_date(results, 'recent', CURRENT_DATE)
+
+
+def _install(config: str, sink: _Sink) -> logging.Handler:
+    """Remplace les handlers racine par ceux de la configuration mesurée"""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    if config in ('queue_json', 'queue_debug'):
+        handler = QueueListenerHandler(json_format=True)
+        handler.listener.handlers[0].setStream(sink)
+    else:
+        handler = logging.StreamHandler(sink)
+        handler.addFilter(RequestIdFilter())
+        if config == 'legacy_sync':
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+        else:
+            handler.setFormatter(JsonFormatter())
+    handler.addFilter(SamplingFilter(0.1))
+
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG if config == 'queue_debug' else logging.INFO)
+    logging.getLogger('chat').setLevel(logging.NOTSET)
+    return handler
+
+
+def _measure(count: int, legacy: bool) -> List[float]:
+    service = _FixtureSerpAPIService()
+    view = ChatAPIView()
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        _one_request(service, view, legacy)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _summary(samples: List[float], baseline: float) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "mean_us": statistics.mean(ordered) * 1e6,
+        "p95_us": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1e6,
+        "overhead_us": (statistics.mean(ordered) - baseline) * 1e6,
+    }
+
+
+def run(count: int, io_latency: float) -> Dict[str, Dict[str, float]]:
+    # Référence : même charge, logging coupé
+    logging.disable(logging.CRITICAL)
+    baseline = statistics.mean(_measure(count, legacy=False))
+    logging.disable(logging.NOTSET)
+
+    results = {"disabled": {"mean_us": baseline * 1e6, "p95_us": 0.0, "overhead_us": 0.0}}
+    for config in ("legacy_sync", "sync_json", "queue_json", "queue_debug"):
+        sink = _Sink(io_latency)
+        handler = _install(config, sink)
+        samples = _measure(count, legacy=config == 'legacy_sync')
+        drain_start = time.perf_counter()
+        handler.close()
+        results[config] = _summary(samples, baseline)
+        results[config]["lines_per_request"] = sink.writes / count
+        results[config]["drain_ms"] = (time.perf_counter() - drain_start) * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Surcoût du logging par requête")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--io-latency-ms", type=float, default=0.0)
+    parser.add_argument("--output", help="Fichier JSON de sortie")
+    args = parser.parse_args()
+
+    results = run(args.requests, args.io_latency_ms / 1000)
+    for config, stats in results.items():
+        print(
+            f"{config:>12}: mean={stats['mean_us']:.0f}µs overhead={stats['overhead_us']:.0f}µs "
+            f"lines/req={stats.get('lines_per_request', 0):.1f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
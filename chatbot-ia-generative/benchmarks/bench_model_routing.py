@@ -0,0 +1,231 @@
+"""
+Benchmark du routage des modèles : latence moyenne et coût par politique
+
+Rejoue le même mélange de trafic (conversations de plusieurs tours, prompts
+courts, longs documents à résumer, recherches web) sous chaque politique :
+``openrouter`` et ``vllm`` (interrupteur manuel) puis ``auto``
+(``chat.services.model_router``).
+
+Les appels amont sont rejoués depuis les fixtures (``FixtureReplay``) avec
+un modèle de coût réaliste pour le routage : temps de traitement du prompt
+(``--prefill``, vLLM sur CPU bien plus lent qu'OpenRouter) et générations
+vLLM simultanées limitées (``--vllm-slots``).
+
+Coût :
+- OpenRouter : tokens de prompt et de complétion × prix par million
+  (``--openrouter-prompt-price``, ``--openrouter-completion-price``) ;
+- vLLM : secondes de génération nominales (hors ``--latency-scale``) ×
+  ``--vllm-cost-per-hour`` / 3600.
+
+Usage :
+    python -m benchmarks.bench_model_routing --conversations 20 --concurrency 4
+    python -m benchmarks.bench_model_routing --latency-scale 0.1 --policies openrouter auto
+"""
+import argparse
+import json
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+
+# En premier : configure Django (django.setup) pour les imports suivants
+from benchmarks.bench_pipeline import CHAT_URL, _git_revision, _latency_summary, _parse_latency, _setup_database
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client
+
+from benchmarks.fixture_replay import FixtureReplay, load_fixture
+from chat import metrics
+from chat.services import model_router
+from chat.views import ChatAPIView
+
+POLICIES = ('openrouter', 'vllm', 'auto')
+# Traitement du prompt, en tokens/s (vLLM sur CPU)
+DEFAULT_PREFILL = {'openrouter': 4000.0, 'vllm': 150.0}
+
+
+def _long_document() -> str:
+    """Document collé par l'utilisateur (~1 100 tokens, sous la limite de 5 000 caractères
+    du sérialiseur) : au-delà de ``ROUTING_LOCAL_MAX_INPUT_TOKENS``"""
+    articles = load_fixture('serpapi_news.json')['news_results']
+    lines = [f"{a.get('title', '')} — {a.get('snippet', '')}" for a in articles]
+    text = "\n".join(lines)
+    return "\n".join([text] * (4500 // max(1, len(text)) + 1))[:4500]
+
+
+def build_traffic(conversations: int, max_turns: int, search_ratio: float, long_ratio: float, seed: int) -> List[List[Dict]]:
+    """Conversations à rejouer : liste de tours (type, message) par conversation"""
+    rng = random.Random(seed)
+    messages = load_fixture('messages.json')
+    document = _long_document()
+    traffic = []
+    for c in range(conversations):
+        turns = []
+        for t in range(rng.randint(1, max_turns)):
+            draw = rng.random()
+            if draw < search_ratio:
+                kind, message = 'search', rng.choice(messages['search'])
+            elif draw < search_ratio + long_ratio:
+                kind, message = 'long', f"Résume ce document en cinq points :\n{document}"
+            else:
+                kind, message = 'chat', rng.choice(messages['chat'])
+            turns.append({'kind': kind, 'message': message, 'tag': f"{c}-{t}"})
+        traffic.append(turns)
+    return traffic
+
+
+def _run_conversation(client: Client, turns: List[Dict], policy: str) -> List[Dict]:
+    results = []
+    conversation_id = None
+    for turn in turns:
+        # Message unique par politique : caches de réécriture et de recherche contournés
+        payload = {'message': f"{turn['message']} (#{policy}-{turn['tag']})"}
+        if conversation_id:
+            payload['conversation_id'] = conversation_id
+        start = time.perf_counter()
+        response = client.post(CHAT_URL, payload, content_type='application/json')
+        latency = time.perf_counter() - start
+        body = response.json() if response.status_code == 200 else {}
+        conversation_id = body.get('conversation_id', conversation_id)
+        results.append({
+            'kind': turn['kind'],
+            'status': response.status_code,
+            'latency': latency,
+            'provider': (body.get('routing') or {}).get('provider'),
+        })
+    return results
+
+
+def _routing_counts() -> Dict[str, int]:
+    return {f"{labels['provider']}:{labels['reason']}": int(value) for labels, value in metrics.MODEL_ROUTING.samples()}
+
+
+def _cost(usage: Dict[str, Dict[str, float]], args) -> Dict[str, float]:
+    openrouter = usage.get('openrouter', {})
+    openrouter_usd = (
+        openrouter.get('prompt_tokens', 0) * args.openrouter_prompt_price
+        + openrouter.get('completion_tokens', 0) * args.openrouter_completion_price
+    ) / 1e6
+    vllm_usd = usage.get('vllm', {}).get('seconds', 0.0) * args.vllm_cost_per_hour / 3600
+    return {
+        'openrouter_usd': round(openrouter_usd, 6),
+        'vllm_usd': round(vllm_usd, 6),
+        'total_usd': round(openrouter_usd + vllm_usd, 6),
+    }
+
+
+def run_policy(policy: str, traffic: List[List[Dict]], args) -> Dict:
+    cache.clear()
+    cache.set(model_router.SELECTED_MODEL_CACHE_KEY, policy, timeout=None)
+    # Statistiques vivantes du routeur remises à zéro entre politiques
+    model_router._model_router = None
+    routing_before = _routing_counts()
+
+    replay = FixtureReplay(
+        latency=_parse_latency(args.latency),
+        scale=args.latency_scale,
+        jitter=args.jitter,
+        seed=args.seed,
+        prefill_tokens_per_second=DEFAULT_PREFILL if args.prefill else None,
+        max_concurrency={'vllm': args.vllm_slots},
+    )
+    local = threading.local()
+
+    def worker(turns):
+        if not hasattr(local, 'client'):
+            local.client = Client()
+        try:
+            return _run_conversation(local.client, turns, policy)
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    with replay, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = [r for conversation in pool.map(worker, traffic) for r in conversation]
+    wall = time.perf_counter() - start
+
+    ok = [r for r in results if r['status'] == 200]
+    routing_after = _routing_counts()
+    cost = _cost(replay.usage, args)
+    return {
+        'turns': len(results),
+        'errors': len(results) - len(ok),
+        'wall_s': round(wall, 2),
+        'latency': _latency_summary([r['latency'] for r in ok]),
+        'latency_by_kind': {
+            kind: _latency_summary([r['latency'] for r in ok if r['kind'] == kind])
+            for kind in sorted({r['kind'] for r in ok})
+        },
+        'llm_calls': {p: replay.calls.get(p, 0) for p in ('vllm', 'openrouter')},
+        'routing': {
+            key: count - routing_before.get(key, 0)
+            for key, count in sorted(routing_after.items()) if count - routing_before.get(key, 0)
+        },
+        'usage': {
+            provider: {name: round(value, 1) for name, value in usage.items()}
+            for provider, usage in sorted(replay.usage.items())
+        },
+        'cost': dict(cost, per_1k_turns_usd=round(cost['total_usd'] / max(1, len(ok)) * 1000, 4)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--policies', nargs='+', choices=POLICIES, default=list(POLICIES))
+    parser.add_argument('--conversations', type=int, default=20)
+    parser.add_argument('--max-turns', type=int, default=4, help="tours maximum par conversation")
+    parser.add_argument('--search-ratio', type=float, default=0.3)
+    parser.add_argument('--long-ratio', type=float, default=0.15, help="proportion de longs documents à résumer")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--vllm-slots', type=int, default=2, help="générations vLLM simultanées")
+    parser.add_argument('--no-prefill', dest='prefill', action='store_false',
+                        help="ne pas modéliser le temps de traitement du prompt")
+    parser.add_argument('--latency-scale', type=float, default=1.0)
+    parser.add_argument('--latency', action='append', default=[], metavar='PROVIDER=SECONDS')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--openrouter-prompt-price', type=float, default=0.2, help="USD par million de tokens")
+    parser.add_argument('--openrouter-completion-price', type=float, default=0.6, help="USD par million de tokens")
+    parser.add_argument('--vllm-cost-per-hour', type=float, default=0.05,
+                        help="USD par heure de génération locale (coût marginal, machine déjà provisionnée)")
+    parser.add_argument('--output', help="fichier JSON du rapport")
+    args = parser.parse_args()
+
+    _setup_database()
+    settings.LOCAL_INDEX_DIR = tempfile.mkdtemp(prefix='bench_local_index_')
+    settings.LOCAL_INDEX_ENABLED = False
+    settings.ANSWER_CACHE_ENABLED = False
+    settings.SEARCH_CACHE_FRESHNESS_MINUTES = 0
+    settings.SERVER_TIMING_HEADER = False
+    ChatAPIView.throttle_classes = []
+
+    traffic = build_traffic(args.conversations, args.max_turns, args.search_ratio, args.long_ratio, args.seed)
+    kinds = [turn['kind'] for conversation in traffic for turn in conversation]
+    report = {
+        'meta': {
+            'git': _git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'args': vars(args),
+        },
+        'traffic': {kind: kinds.count(kind) for kind in sorted(set(kinds))},
+        'policies': {policy: run_policy(policy, traffic, args) for policy in args.policies},
+    }
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    print("\npolitique    latence moy.   p95        coût / 1000 tours")
+    for policy, result in report['policies'].items():
+        print(f"{policy:<12} {result['latency']['mean_ms']:>9.0f} ms {result['latency']['p95_ms']:>7.0f} ms"
+              f"   {result['cost']['per_1k_turns_usd']:.4f} $")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
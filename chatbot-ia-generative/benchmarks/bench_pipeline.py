@@ -0,0 +1,394 @@
+"""
+Benchmark hors ligne du pipeline de chat complet (POST /api/v1/chat/)
+
+Toutes les dépendances réseau sont rejouées depuis ``benchmarks/fixtures``
+(voir ``benchmarks.fixture_replay``) avec une latence injectée
+configurable : aucun crédit SerpAPI ni token OpenRouter n'est consommé et
+les résultats sont comparables d'un commit à l'autre.
+
+Mesures :
+- latence par tour (p50 / p95 / p99), globale et par type de tour
+  (``search`` avec réécriture + SerpAPI + synthèse, ``chat`` sans recherche)
+- débit (tours/s) au niveau de concurrence demandé
+- requêtes SQL par tour, durées par étape, taux de hit des caches
+- mémoire par tour (pic et mémoire retenue, passe séquentielle tracemalloc)
+
+Usage :
+    python -m benchmarks.bench_pipeline --turns 200 --concurrency 8
+    python -m benchmarks.bench_pipeline --latency-scale 0 --output bench.json
+    python -m benchmarks.bench_pipeline --baseline bench.json
+
+``--latency-scale 0`` supprime toute attente amont : seul reste le coût
+propre du backend (Django, ORM, sérialisation, parsing).
+
+``--speculative`` active la recherche spéculative pendant la réécriture
+(``SPECULATIVE_SEARCH_ENABLED``) ; le rapport indique combien de
+spéculations ont été gardées ou jetées.
+
+``--pipelined`` démarre la génération finale sans attendre toute la
+recherche (``PIPELINED_GENERATION_ENABLED``, budget ``--search-budget-ms``) ;
+le rapport indique le déclencheur de chaque génération (top_k, deadline,
+complete) et le nombre de résultats arrivés trop tard.
+
+``--deadline-seconds`` fixe le budget de bout en bout d'un tour
+(``CHAT_DEADLINE_SECONDS``) ; le rapport compte les étapes dégradées.
+
+``--mock-llm`` envoie les appels LLM sur le réseau local vers deux
+``MockLLMServer`` (vLLM et OpenRouter) au lieu de les rejouer en mémoire :
+clients HTTP, streaming SSE et pannes injectées (``--llm-error-rate``,
+``--llm-rate-limit-rate``) sont alors réellement exercés.
+"""
+import argparse
+import gc
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_backend.settings')
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+
+from benchmarks.fixture_replay import FixtureReplay, load_fixture, percentile  # noqa: E402
+from benchmarks.mock_llm_server import MockLLMServer  # noqa: E402
+from chat import metrics  # noqa: E402
+from chat.views import ChatAPIView  # noqa: E402
+
+CHAT_URL = '/api/v1/chat/'
+
+
+def _setup_database() -> str:
+    """Base de test SQLite dans un fichier temporaire (partagée entre threads)"""
+    db_path = os.path.join(tempfile.mkdtemp(prefix='bench_pipeline_'), 'bench.sqlite3')
+    connection.settings_dict['TEST']['NAME'] = db_path
+    connection.settings_dict.setdefault('OPTIONS', {})['timeout'] = 30
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    return db_path
+
+
+def _build_plan(turns: int, scenario: str, cold: bool) -> List[Dict]:
+    """Liste des tours à jouer : (type, message)"""
+    messages = load_fixture('messages.json')
+    kinds = {'search': ['search'], 'chat': ['chat'], 'mixed': ['search', 'chat']}[scenario]
+    plan = []
+    for i in range(turns):
+        kind = kinds[i % len(kinds)]
+        pool = messages[kind]
+        message = pool[(i // len(kinds)) % len(pool)]
+        if cold:
+            # Message unique : contourne le cache de réécriture
+            message = f"{message} (#{i})"
+        plan.append({'kind': kind, 'message': message})
+    return plan
+
+
+def _run_turn(client: Client, turn: Dict) -> Dict:
+    timings, token = metrics.start_stage_timings()
+    start = time.perf_counter()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post(CHAT_URL, {'message': turn['message']}, content_type='application/json')
+    finally:
+        metrics.reset_stage_timings(token)
+    return {
+        'kind': turn['kind'],
+        'status': response.status_code,
+        'latency': time.perf_counter() - start,
+        'queries': len(queries),
+        'stages': dict(timings),
+    }
+
+
+def _run_load(plan: List[Dict], concurrency: int) -> Dict:
+    """Joue le plan avec ``concurrency`` clients en parallèle"""
+    local = threading.local()
+
+    def worker(turn):
+        if not hasattr(local, 'client'):
+            local.client = Client()
+        try:
+            return _run_turn(local.client, turn)
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(worker, plan))
+    return {'results': results, 'wall': time.perf_counter() - start}
+
+
+def _measure_memory(plan: List[Dict], turns: int) -> Dict:
+    """Pic et mémoire retenue par tour, tours joués séquentiellement"""
+    if not turns:
+        return {}
+    client = Client()
+    _run_turn(client, plan[0])  # imports et caches de premier appel hors mesure
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for turn in plan[:turns]:
+            gc.collect()
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            _run_turn(client, turn)
+            gc.collect()
+            after, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(after - before)
+    finally:
+        tracemalloc.stop()
+    return {
+        'turns': len(peaks),
+        'peak_kib_mean': round(statistics.mean(peaks) / 1024, 1),
+        'peak_kib_max': round(max(peaks) / 1024, 1),
+        'retained_kib_mean': round(statistics.mean(retained) / 1024, 1),
+    }
+
+
+def _latency_summary(samples: List[float]) -> Dict:
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.mean(samples) * 1000, 1) if samples else 0.0,
+        'p50_ms': round(percentile(samples, 50) * 1000, 1),
+        'p95_ms': round(percentile(samples, 95) * 1000, 1),
+        'p99_ms': round(percentile(samples, 99) * 1000, 1),
+    }
+
+
+def _cache_hit_rates() -> Dict:
+    rates = {}
+    lookups: Dict[str, Dict[str, float]] = {}
+    for labels, value in metrics.CACHE_LOOKUPS.samples():
+        lookups.setdefault(labels['cache'], {})[labels['result']] = value
+    for name, counts in lookups.items():
+        total = counts.get('hit', 0) + counts.get('miss', 0)
+        rates[name] = round(counts.get('hit', 0) / total, 3) if total else 0.0
+    return rates
+
+
+def _speculation_stats() -> Dict:
+    outcomes = {labels['outcome']: int(value) for labels, value in metrics.SPECULATIVE_SEARCHES.samples()}
+    total = sum(outcomes.values())
+    return dict(outcomes, total=total, kept_rate=round(outcomes.get('kept', 0) / total, 3) if total else 0.0)
+
+
+def _pipeline_stats() -> Dict:
+    triggers = {labels['trigger']: int(value) for labels, value in metrics.PIPELINED_GENERATIONS.samples()}
+    late = {labels['policy']: int(value) for labels, value in metrics.PIPELINE_LATE_RESULTS.samples()}
+    return {'triggers': triggers, 'late_results': late}
+
+
+def _degraded_stats() -> Dict:
+    return {labels['stage']: int(value) for labels, value in metrics.DEGRADED_STAGES.samples()}
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(load: Dict, memory: Dict, replay: FixtureReplay, args) -> Dict:
+    results = load['results']
+    ok = [r for r in results if r['status'] == 200]
+    by_kind = {}
+    for kind in sorted({r['kind'] for r in ok}):
+        by_kind[kind] = _latency_summary([r['latency'] for r in ok if r['kind'] == kind])
+
+    stages: Dict[str, List[float]] = {}
+    for r in ok:
+        for stage, seconds in r['stages'].items():
+            stages.setdefault(stage, []).append(seconds)
+    queries = [r['queries'] for r in ok]
+
+    return {
+        'meta': {
+            'git': _git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'args': vars(args),
+        },
+        'turns': len(results),
+        'errors': len(results) - len(ok),
+        'concurrency': args.concurrency,
+        'throughput_rps': round(len(ok) / load['wall'], 2) if load['wall'] else 0.0,
+        'latency': _latency_summary([r['latency'] for r in ok]),
+        'latency_by_kind': by_kind,
+        'db_queries': {
+            'mean': round(statistics.mean(queries), 1) if queries else 0.0,
+            'max': max(queries) if queries else 0,
+        },
+        'stages_ms': {
+            stage: {'mean': round(statistics.mean(v) * 1000, 1), 'p95': round(percentile(v, 95) * 1000, 1)}
+            for stage, v in sorted(stages.items())
+        },
+        'cache_hit_rate': _cache_hit_rates(),
+        'speculation': _speculation_stats(),
+        'pipeline': _pipeline_stats(),
+        'degraded_stages': _degraded_stats(),
+        'upstream_calls': dict(sorted(replay.calls.items())),
+        'memory': memory,
+    }
+
+
+def _compare(report: Dict, baseline: Dict) -> List[str]:
+    """Écarts relatifs avec un rapport précédent (latence, débit, SQL, mémoire)"""
+    def delta(new, old):
+        if not old:
+            return 'n/a'
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    lines = []
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        lines.append(f"latency.{key}: {baseline['latency'][key]} -> {report['latency'][key]} "
+                     f"({delta(report['latency'][key], baseline['latency'][key])})")
+    lines.append(f"throughput_rps: {baseline['throughput_rps']} -> {report['throughput_rps']} "
+                 f"({delta(report['throughput_rps'], baseline['throughput_rps'])})")
+    lines.append(f"db_queries.mean: {baseline['db_queries']['mean']} -> {report['db_queries']['mean']} "
+                 f"({delta(report['db_queries']['mean'], baseline['db_queries']['mean'])})")
+    old_mem = baseline.get('memory', {}).get('peak_kib_mean')
+    new_mem = report.get('memory', {}).get('peak_kib_mean')
+    if old_mem and new_mem:
+        lines.append(f"memory.peak_kib_mean: {old_mem} -> {new_mem} ({delta(new_mem, old_mem)})")
+    return lines
+
+
+def _start_mock_servers(stack: ExitStack, replay: FixtureReplay, args) -> Dict[str, MockLLMServer]:
+    """Un MockLLMServer par fournisseur, calé sur les latences du rejeu"""
+    servers = {}
+    for provider in ('vllm', 'openrouter'):
+        tps = replay.tokens_per_second[provider]
+        servers[provider] = stack.enter_context(MockLLMServer(
+            ttft=replay.latency[provider] * args.latency_scale,
+            tokens_per_second=tps / args.latency_scale if args.latency_scale else 0.0,
+            max_concurrency=args.llm_max_concurrency if provider == 'vllm' else 0,
+            error_rate=args.llm_error_rate if provider == 'vllm' else 0.0,
+            rate_limit_rate=args.llm_rate_limit_rate if provider == 'openrouter' else 0.0,
+            seed=args.seed,
+        ))
+    settings.VLLM_BASE_URL = servers['vllm'].url
+    settings.OPENROUTER_BASE_URL = f"{servers['openrouter'].url}/v1"
+    return servers
+
+
+def _parse_latency(values: List[str]) -> Dict[str, float]:
+    latency = {}
+    for value in values:
+        provider, _, seconds = value.partition('=')
+        latency[provider] = float(seconds)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--scenario', choices=['mixed', 'search', 'chat'], default='mixed')
+    parser.add_argument('--model', choices=['openrouter', 'vllm'], default='openrouter')
+    parser.add_argument('--cold', action='store_true',
+                        help="caches de recherche et de réécriture contournés à chaque tour")
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help="multiplicateur des latences amont (0 = aucune attente)")
+    parser.add_argument('--latency', action='append', default=[], metavar='PROVIDER=SECONDS',
+                        help="délai avant premier octet (serpapi, openrouter, vllm, scrape)")
+    parser.add_argument('--tokens-per-second', action='append', default=[], metavar='PROVIDER=TPS')
+    parser.add_argument('--speculative', action='store_true',
+                        help="recherche spéculative pendant la réécriture LLM")
+    parser.add_argument('--speculation-threshold', type=float,
+                        help="couverture minimale des mots-clés réécrits pour garder la spéculation (défaut : réglage)")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="génération finale démarrée sur les premiers résultats de recherche")
+    parser.add_argument('--search-budget-ms', type=int,
+                        help="attente maximale de la recherche en mode pipeline (défaut : réglage)")
+    parser.add_argument('--deadline-seconds', type=float,
+                        help="budget de bout en bout d'un tour (défaut : réglage, 0 = sans borne)")
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mock-llm', action='store_true',
+                        help="appels LLM servis par MockLLMServer (HTTP local) plutôt que rejoués")
+    parser.add_argument('--llm-max-concurrency', type=int, default=0,
+                        help="générations simultanées du mock vLLM (0 = illimité)")
+    parser.add_argument('--llm-error-rate', type=float, default=0.0,
+                        help="proportion de 503 injectés par le mock vLLM (bascule vers OpenRouter)")
+    parser.add_argument('--llm-rate-limit-rate', type=float, default=0.0,
+                        help="proportion de 429 injectés par le mock OpenRouter")
+    parser.add_argument('--memory-turns', type=int, default=20,
+                        help="tours de la passe mémoire séquentielle (0 pour la sauter)")
+    parser.add_argument('--output', help="fichier JSON du rapport")
+    parser.add_argument('--baseline', help="rapport JSON précédent à comparer")
+    args = parser.parse_args()
+
+    _setup_database()
+    settings.LOCAL_INDEX_DIR = tempfile.mkdtemp(prefix='bench_local_index_')
+    cache.clear()
+    cache.set('selected_llm_model', args.model, timeout=None)
+    settings.SERVER_TIMING_HEADER = False
+    if args.cold:
+        settings.SEARCH_CACHE_FRESHNESS_MINUTES = 0
+    settings.SPECULATIVE_SEARCH_ENABLED = args.speculative
+    if args.speculation_threshold is not None:
+        settings.SPECULATIVE_SEARCH_MIN_COVERAGE = args.speculation_threshold
+    settings.PIPELINED_GENERATION_ENABLED = args.pipelined
+    if args.deadline_seconds is not None:
+        settings.CHAT_DEADLINE_SECONDS = args.deadline_seconds
+    if args.search_budget_ms is not None:
+        settings.PIPELINED_SEARCH_BUDGET_MS = args.search_budget_ms
+    # Le throttling anonyme (10/min) fausserait la mesure
+    ChatAPIView.throttle_classes = []
+
+    replay = FixtureReplay(
+        latency=_parse_latency(args.latency),
+        tokens_per_second=_parse_latency(args.tokens_per_second),
+        scale=args.latency_scale,
+        jitter=args.jitter,
+        seed=args.seed,
+        replay_llm=not args.mock_llm,
+    )
+    plan = _build_plan(args.turns, args.scenario, args.cold)
+
+    with ExitStack() as stack:
+        mock_servers = {}
+        if args.mock_llm:
+            mock_servers = _start_mock_servers(stack, replay, args)
+        stack.enter_context(replay)
+        load = _run_load(plan, args.concurrency)
+        report = build_report(load, {}, replay, args)
+        report['memory'] = _measure_memory(plan, args.memory_turns)
+        if mock_servers:
+            report['mock_llm'] = {name: server.stats() for name, server in mock_servers.items()}
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\nComparaison avec {args.baseline} ({baseline['meta'].get('git')}):")
+        for line in _compare(report, baseline):
+            print(f"  {line}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
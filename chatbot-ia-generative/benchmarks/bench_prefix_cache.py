@@ -0,0 +1,129 @@
+"""
+Benchmark du cache de préfixe vLLM : temps jusqu'au premier token (TTFT)
+
+Compare deux dispositions du prompt de synthèse finale :
+- ``static`` : instructions statiques en message system, date/contexte/question
+  à la fin du message user (disposition actuelle de ``chat.services.prompts``)
+- ``legacy`` : date, semaine et requête interpolées en tête du prompt système
+  (ancienne disposition, le préfixe change à chaque requête)
+
+Usage :
+    python -m benchmarks.bench_prefix_cache --base-url http://localhost:8080 --requests 20
+
+vLLM doit être lancé avec ``--enable-prefix-caching`` pour observer un gain.
+"""
+import argparse
+import json
+import statistics
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import requests
+
+from chat.services.prompts import FINAL_RESPONSE_SYSTEM_PROMPT, build_final_response_messages
+
+
+def _fake_context(index: int) -> str:
+    """Contexte de recherche synthétique (volatil, différent à chaque requête)"""
+    blocks = []
+    for i in range(1, 4):
+        blocks.append(f"""
+=== RÉSULTAT {i} ===
+📰 TITRE: Annonce IA #{index}-{i}
+🌐 SOURCE: example.com
+📅 DATE DE PUBLICATION: {index % 28 + 1:02d}/01/2025
+🔗 URL: https://example.com/{index}/{i}
+📝 CONTENU:
+Nouvelle annonce numéro {index}-{i} concernant un modèle de langage.
+{'=' * 60}""")
+    return "\n".join(blocks)
+
+
+def _legacy_messages(user_query: str, context: str, search_query: str, current_date: datetime) -> List[Dict]:
+    """Reproduit l'ancienne disposition : parties volatiles en tête du prompt système"""
+    first_line, rest = FINAL_RESPONSE_SYSTEM_PROMPT.split("\n", 1)
+    date_info = f"""
+📅 DATE ACTUELLE: {current_date.strftime('%d/%m/%Y')}
+📅 SEMAINE: {current_date.isocalendar()[1]} de {current_date.year}
+⏰ PÉRIODE DEMANDÉE: recent
+🔍 REQUÊTE DE RECHERCHE UTILISÉE: "{search_query}"
+"""
+    system_prompt = f"{first_line}\n{date_info}{rest}\n\n📰 RÉSULTATS DE RECHERCHE:\n{context}"
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_query}
+    ]
+
+
+def measure_ttft(base_url: str, model: str, messages: List[Dict], timeout: float) -> float:
+    """Envoie une requête en streaming et retourne le délai jusqu'au premier token (s)"""
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": 0.0,
+        "max_tokens": 16,
+        "stream": True
+    }
+    start = time.perf_counter()
+    with requests.post(f"{base_url}/v1/chat/completions", json=payload, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line or not line.startswith(b"data: "):
+                continue
+            data = line[6:]
+            if data == b"[DONE]":
+                break
+            delta = json.loads(data)["choices"][0].get("delta", {})
+            if delta.get("content"):
+                return time.perf_counter() - start
+    return time.perf_counter() - start
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "mean_ms": statistics.mean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+    }
+
+
+def run(base_url: str, model: str, count: int, timeout: float) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for layout in ("legacy", "static"):
+        samples = []
+        for i in range(count):
+            current_date = datetime(2025, 1, 1) + timedelta(days=i)
+            user_query = f"Quelles sont les dernières annonces IA (variante {i}) ?"
+            search_query = f"latest AI announcements variant {i}"
+            context = _fake_context(i)
+            if layout == "static":
+                messages = build_final_response_messages(user_query, context, search_query, "recent", current_date)
+            else:
+                messages = _legacy_messages(user_query, context, search_query, current_date)
+            samples.append(measure_ttft(base_url, model, messages, timeout))
+        results[layout] = _summary(samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TTFT avec et sans préfixe statique")
+    parser.add_argument("--base-url", default="http://localhost:8080")
+    parser.add_argument("--model", default="microsoft/Phi-3-mini-4k-instruct")
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--output", help="Fichier JSON de sortie")
+    args = parser.parse_args()
+
+    results = run(args.base_url, args.model, args.requests, args.timeout)
+    for layout, stats in results.items():
+        print(f"{layout:>7}: mean={stats['mean_ms']:.1f}ms p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmark du micro-batching des réécritures de requête
+
+``--users`` utilisateurs simultanés enchaînent chacun ``--rewrites``
+réécritures (questions uniques : le cache de réécriture ne sert pas), avec
+et sans ``REWRITE_BATCHING_ENABLED``, pour chaque fournisseur demandé.
+
+Les appels LLM sont rejoués (``FixtureReplay``) avec une capacité bornée :
+- vLLM : ``VLLM_MAX_NUM_SEQS`` séquences simultanées (``--max-num-seqs``) ;
+- OpenRouter : ``--openrouter-concurrency`` requêtes simultanées tolérées
+  par clé (au-delà, la limite de débit fait attendre).
+
+Mesures : débit (réécritures/s), latence p50 / p95 par réécriture, appels
+LLM envoyés et taille moyenne des lots.
+
+Usage :
+    python -m benchmarks.bench_rewrite_batching --users 50 --rewrites 4
+    python -m benchmarks.bench_rewrite_batching --providers openrouter --latency-scale 0.2
+"""
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+
+# En premier : configure Django (django.setup) pour les imports suivants
+from benchmarks.bench_pipeline import _git_revision, _latency_summary
+
+from django.conf import settings
+from django.core.cache import cache
+
+from benchmarks.fixture_replay import FixtureReplay, load_fixture
+from chat import metrics
+from chat.services import rewrite_batcher
+from chat.services.intelligent_search import IntelligentSearchService
+from chat.services.model_router import SELECTED_MODEL_CACHE_KEY
+
+
+def _batch_sizes(provider: str):
+    return metrics.REWRITE_BATCH_SIZE.totals(provider=provider)
+
+
+def run(provider: str, batching: bool, args) -> Dict:
+    cache.clear()
+    cache.set(SELECTED_MODEL_CACHE_KEY, provider, timeout=None)
+    settings.REWRITE_BATCHING_ENABLED = batching
+    # Batcher neuf : réglages courants, exécuteurs vides
+    rewrite_batcher._rewrite_batcher = None
+    sizes_before = _batch_sizes(provider)
+
+    questions = load_fixture('messages.json')['search']
+    replay = FixtureReplay(
+        scale=args.latency_scale,
+        jitter=args.jitter,
+        seed=args.seed,
+        max_concurrency={'vllm': settings.VLLM_MAX_NUM_SEQS, 'openrouter': args.openrouter_concurrency},
+    )
+    barrier = threading.Barrier(args.users)
+
+    def user(index: int) -> List[float]:
+        service = IntelligentSearchService()
+        latencies = []
+        barrier.wait()
+        for n in range(args.rewrites):
+            question = f"{questions[(index + n) % len(questions)]} (#{provider}-{batching}-{index}-{n})"
+            start = time.perf_counter()
+            service._generate_search_query(question, None, datetime.now())
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    with replay, ThreadPoolExecutor(max_workers=args.users) as pool:
+        start = time.perf_counter()
+        latencies = [latency for user_latencies in pool.map(user, range(args.users)) for latency in user_latencies]
+        wall = time.perf_counter() - start
+
+    total, count = _batch_sizes(provider)
+    batched_total, batches = total - sizes_before[0], count - sizes_before[1]
+    return {
+        'rewrites': len(latencies),
+        'wall_s': round(wall, 2),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else 0.0,
+        'latency': _latency_summary(latencies),
+        'llm_calls': replay.calls.get(provider, 0),
+        'mean_batch_size': round(batched_total / batches, 2) if batches else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--providers', nargs='+', choices=['vllm', 'openrouter'], default=['vllm', 'openrouter'])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rewrites', type=int, default=4, help="réécritures par utilisateur")
+    parser.add_argument('--openrouter-concurrency', type=int, default=4)
+    parser.add_argument('--window-ms', type=float, help="fenêtre de regroupement (défaut : réglage)")
+    parser.add_argument('--max-batch', type=int, help="taille maximale d'un lot (défaut : réglage)")
+    parser.add_argument('--latency-scale', type=float, default=1.0)
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="fichier JSON du rapport")
+    args = parser.parse_args()
+
+    if args.window_ms is not None:
+        settings.REWRITE_BATCH_WINDOW_MS = args.window_ms
+    if args.max_batch is not None:
+        settings.REWRITE_BATCH_MAX_SIZE = args.max_batch
+
+    results = {}
+    for provider in args.providers:
+        unbatched, batched = run(provider, False, args), run(provider, True, args)
+        results[provider] = {
+            'unbatched': unbatched,
+            'batched': batched,
+            'throughput_gain': round(batched['throughput_rps'] / unbatched['throughput_rps'], 2)
+            if unbatched['throughput_rps'] else None,
+        }
+
+    report = {
+        'meta': {
+            'git': _git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'args': vars(args),
+            'vllm_max_num_seqs': settings.VLLM_MAX_NUM_SEQS,
+            'window_ms': settings.REWRITE_BATCH_WINDOW_MS,
+            'max_batch': settings.REWRITE_BATCH_MAX_SIZE,
+        },
+        'results': results,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+"""
+Rejeu hors ligne des appels amont du pipeline de chat à partir de fixtures
+
+``FixtureReplay`` remplace, le temps d'un bloc ``with`` :
+- ``GoogleSearch`` de SerpAPI (JSON ``serpapi_news.json`` / ``serpapi_organic.json``) ;
+- le transport de ``requests`` (vLLM) ;
+- le client asynchrone des scrapers Google / Bing / sites d'actualités ;
+- le module ``httpx`` vu par ``OpenRouterOptimizedService``.
+
+Les réponses LLM sont servies en JSON ou en SSE selon ``stream`` ; la
+réécriture de requête (prompt système ``SEARCH_QUERY_SYSTEM_PROMPT``)
+reçoit ``llm_rewrite.json`` (répétée par question pour une réécriture
+groupée), les réponses de synthèse ``llm_answer.json`` et les
+conversations simples ``llm_chat.json``.
+
+Latence injectée, par fournisseur : délai avant le premier octet
+(``latency``), puis débit de génération (``tokens_per_second``) pour les
+LLM. ``scale`` multiplie toutes les attentes, ``jitter`` les fait varier
+de ±x % avec un tirage reproductible (``seed``).
+
+Optionnellement, ``prefill_tokens_per_second`` ajoute au délai du premier
+token le traitement du prompt (≈ 4 caractères par token) et
+``max_concurrency`` limite les générations simultanées d'un fournisseur
+(vLLM sur CPU : les requêtes suivantes attendent leur tour). Tokens de
+prompt, de complétion et secondes de génération nominales sont comptés par
+fournisseur (``usage``).
+
+Avec ``replay_llm=False``, les appels LLM partent réellement sur le réseau,
+typiquement vers ``benchmarks.mock_llm_server`` : seuls SerpAPI et les
+scrapers restent rejoués.
+"""
+import asyncio
+import copy
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from unittest import mock
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
+
+# Délai avant le premier octet, en secondes
+DEFAULT_LATENCY = {
+    'serpapi': 0.9,
+    'openrouter': 0.8,
+    'vllm': 1.5,
+    'scrape': 0.4,
+}
+DEFAULT_TOKENS_PER_SECOND = {
+    'openrouter': 60.0,
+    'vllm': 15.0,  # vLLM sur CPU
+}
+
+
+def load_fixture(name: str):
+    path = FIXTURES_DIR / name
+    if path.suffix == '.json':
+        return json.loads(path.read_text(encoding='utf-8'))
+    return path.read_text(encoding='utf-8')
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Percentile au rang le plus proche (0 si aucune mesure)"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def split_tokens(text: str) -> List[str]:
+    """Découpe approximative en tokens (un mot et son espace)"""
+    tokens, current = [], ''
+    for char in text:
+        current += char
+        if char in ' \n':
+            tokens.append(current)
+            current = ''
+    if current:
+        tokens.append(current)
+    return tokens
+
+
+def load_completion_fixtures() -> Dict[str, Dict]:
+    return {
+        'rewrite': load_fixture('llm_rewrite.json'),
+        'answer': load_fixture('llm_answer.json'),
+        'chat': load_fixture('llm_chat.json'),
+    }
+
+
+def _packed_rewrite_completion(rewrite: Dict, questions: int) -> Dict:
+    """Réécriture groupée : la réécriture enregistrée répétée pour chaque question numérotée"""
+    item = json.loads(rewrite['choices'][0]['message']['content'])
+    content = json.dumps([dict(item, id=i) for i in range(1, questions + 1)], ensure_ascii=False)
+    fixture = copy.deepcopy(rewrite)
+    fixture['choices'][0]['message']['content'] = content
+    usage = rewrite['usage']
+    fixture['usage'] = {
+        'prompt_tokens': usage['prompt_tokens'] + 20 * (questions - 1),
+        'completion_tokens': usage['completion_tokens'] * questions,
+        'total_tokens': usage['prompt_tokens'] + 20 * (questions - 1) + usage['completion_tokens'] * questions,
+    }
+    return fixture
+
+
+def select_completion(payload: Dict, fixtures: Dict[str, Dict]) -> Dict:
+    """Complétion enregistrée correspondant au type d'appel LLM du pipeline"""
+    from chat.services.prompts import SEARCH_QUERY_BATCH_SYSTEM_PROMPT, SEARCH_QUERY_SYSTEM_PROMPT
+
+    messages = payload.get('messages') or []
+    system = messages[0].get('content', '') if messages and messages[0].get('role') == 'system' else ''
+    if system == SEARCH_QUERY_SYSTEM_PROMPT:
+        return fixtures['rewrite']
+    if system == SEARCH_QUERY_BATCH_SYSTEM_PROMPT:
+        questions = sum(1 for line in messages[-1]['content'].splitlines() if line.startswith('Question '))
+        return _packed_rewrite_completion(fixtures['rewrite'], questions)
+    # Réponse de synthèse quand des résultats de recherche sont dans le prompt
+    if any('RÉSULTAT' in (m.get('content') or '') for m in messages):
+        return fixtures['answer']
+    return fixtures['chat']
+
+
+class _ThrottledStream(io.RawIOBase):
+    """Corps de réponse lu morceau par morceau, avec attente avant chaque morceau"""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buffer = b''
+        self._closed = threading.Event()
+
+    def readable(self):
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._buffer and not self._closed.is_set():
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        # Fermeture depuis un autre thread (annulation) : arrêter la lecture
+        self._closed.set()
+        super().close()
+
+
+class FixtureReplay:
+    """Contexte qui sert toutes les dépendances réseau depuis les fixtures"""
+
+    def __init__(
+        self,
+        latency: Optional[Dict[str, float]] = None,
+        tokens_per_second: Optional[Dict[str, float]] = None,
+        scale: float = 1.0,
+        jitter: float = 0.0,
+        seed: int = 0,
+        vllm_base_url: Optional[str] = None,
+        replay_llm: bool = True,
+        prefill_tokens_per_second: Optional[Dict[str, float]] = None,
+        max_concurrency: Optional[Dict[str, int]] = None,
+    ):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.tokens_per_second = dict(DEFAULT_TOKENS_PER_SECOND, **(tokens_per_second or {}))
+        self.scale = scale
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.vllm_base_url = vllm_base_url
+        self.replay_llm = replay_llm
+        self.prefill_tokens_per_second = dict(prefill_tokens_per_second or {})
+        self._slots = {
+            provider: threading.BoundedSemaphore(slots)
+            for provider, slots in (max_concurrency or {}).items() if slots
+        }
+        self.calls: Dict[str, int] = {}
+        self.usage: Dict[str, Dict[str, float]] = {}
+        self._calls_lock = threading.Lock()
+        self._patches = []
+
+        self.serpapi_news = load_fixture('serpapi_news.json')
+        self.serpapi_organic = load_fixture('serpapi_organic.json')
+        self.llm_fixtures = load_completion_fixtures()
+        self.html = {
+            'google': load_fixture('google_news.html'),
+            'bing': load_fixture('bing_news.html'),
+            'news_site': load_fixture('news_site.html'),
+        }
+
+    # -- Latence -------------------------------------------------------------
+
+    def _delay(self, seconds: float) -> float:
+        if self.jitter:
+            with self._rng_lock:
+                seconds *= self._rng.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(0.0, seconds * self.scale)
+
+    def _count_call(self, provider: str) -> float:
+        with self._calls_lock:
+            self.calls[provider] = self.calls.get(provider, 0) + 1
+        return self._delay(self.latency.get(provider, 0.0))
+
+    def _wait(self, provider: str):
+        time.sleep(self._count_call(provider))
+
+    # -- Réponses ------------------------------------------------------------
+
+    def serpapi_response(self, params: Dict, timeout: Optional[float] = None) -> Dict:
+        delay = self._count_call('serpapi')
+        if timeout is not None and delay > timeout:
+            # Comme requests : l'appel échoue à l'expiration du timeout
+            time.sleep(timeout)
+            raise requests.Timeout(f"SerpAPI rejoué : {delay:.2f}s > timeout {timeout:.2f}s")
+        time.sleep(delay)
+        fixture = self.serpapi_news if params.get('tbm') == 'nws' else self.serpapi_organic
+        return copy.deepcopy(fixture)
+
+    def completion_response(self, provider: str, payload: Dict) -> Tuple[int, Dict[str, str], Iterator[bytes]]:
+        """(status, en-têtes, morceaux du corps) d'un /chat/completions"""
+        fixture = select_completion(payload, self.llm_fixtures)
+        content = fixture['choices'][0]['message']['content']
+        tokens = split_tokens(content)
+        per_token = 1.0 / self.tokens_per_second.get(provider, 50.0)
+        prompt_tokens = sum(len(m.get('content') or '') for m in payload.get('messages') or []) // 4
+        ttft = self.latency.get(provider, 0.0)
+        prefill = self.prefill_tokens_per_second.get(provider)
+        if prefill:
+            ttft += prompt_tokens / prefill
+        slot = self._slots.get(provider)
+
+        with self._calls_lock:
+            self.calls[provider] = self.calls.get(provider, 0) + 1
+            usage = self.usage.setdefault(provider, {'prompt_tokens': 0, 'completion_tokens': 0, 'seconds': 0.0})
+            usage['prompt_tokens'] += prompt_tokens
+            usage['completion_tokens'] += len(tokens)
+            usage['seconds'] += ttft + per_token * len(tokens)
+
+        if not payload.get('stream'):
+            def body():
+                if slot:
+                    slot.acquire()
+                try:
+                    time.sleep(self._delay(ttft + per_token * len(tokens)))
+                finally:
+                    if slot:
+                        slot.release()
+                yield json.dumps(fixture).encode('utf-8')
+            return 200, {'content-type': 'application/json'}, body()
+
+        def generate():
+            time.sleep(self._delay(ttft))
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(self._delay(per_token))
+                chunk = {
+                    'id': fixture['id'], 'object': 'chat.completion.chunk', 'model': fixture['model'],
+                    'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n".encode('utf-8')
+
+        def sse():
+            if slot:
+                slot.acquire()
+            try:
+                yield from generate()
+            finally:
+                if slot:
+                    slot.release()
+            if (payload.get('stream_options') or {}).get('include_usage'):
+                usage_chunk = {'id': fixture['id'], 'object': 'chat.completion.chunk', 'choices': [], 'usage': fixture['usage']}
+                yield f"data: {json.dumps(usage_chunk)}\n\n".encode('utf-8')
+            yield b"data: [DONE]\n\n"
+        return 200, {'content-type': 'text/event-stream'}, sse()
+
+    def http_response(self, method: str, url: str, body: Optional[bytes]) -> Tuple[int, Dict[str, str], Iterator[bytes]]:
+        """Routage d'une requête HTTP sortante vers la fixture correspondante"""
+        if url.rstrip('/').endswith('/health'):
+            return 200, {}, iter([b''])
+        if url.rstrip('/').endswith('/v1/models'):
+            models = {'object': 'list', 'data': [{'id': self.llm_fixtures['chat']['model'], 'object': 'model'}]}
+            return 200, {'content-type': 'application/json'}, iter([json.dumps(models).encode()])
+        if url.split('?')[0].endswith('/chat/completions'):
+            provider = 'vllm' if self.vllm_base_url and url.startswith(self.vllm_base_url) else 'openrouter'
+            return self.completion_response(provider, json.loads(body or b'{}'))
+
+        self._wait('scrape')
+        return self.scrape_response(url)
+
+    def scrape_response(self, url: str) -> Tuple[int, Dict[str, str], Iterator[bytes]]:
+        if 'google.com' in url:
+            html = self.html['google']
+        elif 'bing.com' in url:
+            html = self.html['bing']
+        else:
+            html = self.html['news_site']
+        return 200, {'content-type': 'text/html; charset=utf-8'}, iter([html.encode('utf-8')])
+
+    # -- Adaptateurs requests / httpx / SerpAPI ------------------------------
+
+    @staticmethod
+    def _is_llm_url(url: str) -> bool:
+        path = url.split('?')[0].rstrip('/')
+        return path.endswith(('/health', '/v1/models', '/chat/completions'))
+
+    def _requests_send(self, adapter, request, stream=False, **kwargs):
+        if not self.replay_llm and self._is_llm_url(request.url):
+            return self._original_send(adapter, request, stream=stream, **kwargs)
+        status, headers, chunks = self.http_response(request.method, request.url, request.body)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        response.raw = _ThrottledStream(chunks)
+        response.connection = adapter
+        if not stream:
+            response.content  # noqa: B018 - lecture complète comme le ferait requests
+        return response
+
+    def _httpx_handler(self, request: httpx.Request) -> httpx.Response:
+        status, headers, chunks = self.http_response(request.method, str(request.url), request.content)
+        return httpx.Response(status, headers=headers, content=chunks)
+
+    def _httpx_module(self):
+        """Remplaçant du module httpx pour OpenRouterOptimizedService"""
+        replay = self
+        transport = httpx.MockTransport(self._httpx_handler)
+
+        class _ReplayHttpx:
+            TimeoutException = httpx.TimeoutException
+
+            @staticmethod
+            def Client(**kwargs):
+                kwargs.pop('transport', None)
+                return httpx.Client(transport=transport, **kwargs)
+
+            @staticmethod
+            def post(url, **kwargs):
+                timeout = kwargs.pop('timeout', None)
+                with httpx.Client(transport=transport, timeout=timeout) as client:
+                    return client.post(url, **kwargs)
+
+            def __getattr__(self, name):
+                return getattr(httpx, name)
+
+        _ReplayHttpx.replay = replay
+        return _ReplayHttpx()
+
+    async def _scrape_handler(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self._count_call('scrape'))
+        status, headers, chunks = self.scrape_response(str(request.url))
+        body = b''.join(chunks)
+        # Pages figées : validateur stable, requêtes conditionnelles servies en 304
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if request.headers.get('if-none-match') == etag:
+            return httpx.Response(304, headers={'etag': etag})
+        return httpx.Response(status, headers=dict(headers, etag=etag), content=body)
+
+    def _google_search_class(self):
+        replay = self
+
+        class _ReplayGoogleSearch:
+            def __init__(self, params):
+                self.params = params
+                self.timeout = 60000  # défaut du client serpapi
+
+            def get_dict(self):
+                return replay.serpapi_response(self.params, self.timeout)
+
+        return _ReplayGoogleSearch
+
+    def __enter__(self):
+        if self.vllm_base_url is None:
+            from django.conf import settings
+            self.vllm_base_url = getattr(settings, 'VLLM_BASE_URL', 'http://localhost:8000')
+
+        replay = self
+        self._original_send = HTTPAdapter.send
+        self._patches = [
+            mock.patch('chat.services.serpapi_service.GoogleSearch', self._google_search_class()),
+            mock.patch.object(HTTPAdapter, 'send', lambda adapter, request, **kw: replay._requests_send(adapter, request, **kw)),
+        ]
+        if self.replay_llm:
+            self._patches.append(mock.patch('chat.services.openrouter_optimized.httpx', self._httpx_module()))
+        from chat.services.scraping import AsyncScraper
+        self._scraper = AsyncScraper(transport=httpx.MockTransport(self._scrape_handler))
+        self._patches.append(mock.patch('chat.services.multi_search.get_scraper', lambda: self._scraper))
+        for patcher in self._patches:
+            patcher.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for patcher in reversed(self._patches):
+            patcher.stop()
+        self._patches = []
+        self._scraper.close()
+        return False
@@ -0,0 +1,341 @@
+"""
+Serveur LLM factice compatible OpenAI (vLLM / OpenRouter) pour les tests de charge
+
+Endpoints :
+- ``GET  /health``                      200 (vLLM)
+- ``GET  /v1/models``                   modèle servi
+- ``POST /v1/chat/completions``         JSON ou SSE (``stream``), ``usage`` en fin
+  de flux si ``stream_options.include_usage``
+- ``GET  /stats``                       compteurs du serveur (JSON)
+
+Le contenu des réponses vient des fixtures de ``benchmarks/fixtures`` (même
+choix que ``FixtureReplay`` : réécriture, synthèse ou conversation), tronqué
+à ``max_tokens``. Le comportement temporel est configurable :
+
+- ``ttft`` : délai avant le premier token (s)
+- ``tokens_per_second`` : débit de génération par requête
+- ``max_concurrency`` : générations simultanées ; au-delà, ``overflow='queue'``
+  fait attendre la requête (ordonnanceur vLLM), ``overflow='reject'`` répond
+  429 (OpenRouter)
+- ``rate_limit_rate`` / ``error_rate`` : proportion de 429 et de 5xx
+  (``error_status``) injectés, tirage reproductible (``seed``)
+
+Usage :
+    python -m benchmarks.mock_llm_server --port 8080 --ttft 1.5 --tokens-per-second 15
+    VLLM_BASE_URL=http://localhost:8080 \\
+    OPENROUTER_BASE_URL=http://localhost:8081/v1 python manage.py runserver
+
+En test ou en benchmark, ``with MockLLMServer(...) as server:`` démarre le
+serveur sur un port libre dans un thread (``server.url``).
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from benchmarks.fixture_replay import load_completion_fixtures, select_completion, split_tokens
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.0 : le flux SSE se termine à la fermeture de la connexion
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self) -> 'MockLLMServer':
+        return self.server.mock
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/health':
+            self._send_json(200, {})
+        elif path == '/v1/models':
+            self._send_json(200, {'object': 'list', 'data': [{'id': self.mock.model, 'object': 'model', 'owned_by': 'mock'}]})
+        elif path == '/stats':
+            self._send_json(200, self.mock.stats())
+        else:
+            self._send_json(404, {'error': {'message': f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if not path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f"Unknown path {self.path}"}})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError:
+            self._send_json(400, {'error': {'message': 'Invalid JSON body'}})
+            return
+        self.mock._handle_completion(self, payload)
+
+    def _send_json(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockLLMServer:
+    """Serveur OpenAI-compatible au comportement temporel et aux pannes configurables"""
+
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        model: str = 'mock-llm',
+        ttft: float = 0.2,
+        tokens_per_second: float = 50.0,
+        max_concurrency: int = 0,
+        overflow: str = 'queue',
+        rate_limit_rate: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        seed: int = 0,
+    ):
+        if overflow not in ('queue', 'reject'):
+            raise ValueError("overflow doit valoir 'queue' ou 'reject'")
+        self.host = host
+        self.port = port
+        self.model = model
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.max_concurrency = max_concurrency
+        self.overflow = overflow
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fixtures = load_completion_fixtures()
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._httpd: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self.reset_stats()
+
+    # -- Cycle de vie --------------------------------------------------------
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> 'MockLLMServer':
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='mock-llm-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    # -- Statistiques --------------------------------------------------------
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {
+                'requests': 0,
+                'completed': 0,
+                'streamed': 0,
+                'rate_limited': 0,
+                'errors': 0,
+                'rejected': 0,
+                'disconnected': 0,
+                'completion_tokens': 0,
+                'in_flight': 0,
+                'max_in_flight': 0,
+                'queued': 0,
+                'max_queued': 0,
+            }
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, key: str, amount: int = 1):
+        with self._lock:
+            self._stats[key] += amount
+
+    # -- Complétions ---------------------------------------------------------
+
+    def _draw_fault(self) -> Optional[int]:
+        """Code d'erreur injecté pour cette requête, ou None"""
+        with self._lock:
+            draw = self._rng.random()
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            return self.error_status
+        return None
+
+    def _acquire_slot(self) -> bool:
+        if self._slots is None:
+            return True
+        if self._slots.acquire(blocking=False):
+            return True
+        if self.overflow == 'reject':
+            return False
+        with self._lock:
+            self._stats['queued'] += 1
+            self._stats['max_queued'] = max(self._stats['max_queued'], self._stats['queued'])
+        self._slots.acquire()
+        self._count('queued', -1)
+        return True
+
+    def _handle_completion(self, handler: _Handler, payload: Dict):
+        self._count('requests')
+
+        fault = self._draw_fault()
+        if fault == 429:
+            self._count('rate_limited')
+            handler._send_json(429, {'error': {'message': 'Rate limit exceeded', 'code': 429}}, {'Retry-After': '1'})
+            return
+        if fault:
+            self._count('errors')
+            handler._send_json(fault, {'error': {'message': 'Upstream unavailable', 'code': fault}})
+            return
+
+        if not self._acquire_slot():
+            self._count('rejected')
+            handler._send_json(429, {'error': {'message': 'Too many concurrent requests', 'code': 429}}, {'Retry-After': '1'})
+            return
+
+        with self._lock:
+            self._stats['in_flight'] += 1
+            self._stats['max_in_flight'] = max(self._stats['max_in_flight'], self._stats['in_flight'])
+        try:
+            if payload.get('stream'):
+                self._stream_completion(handler, payload)
+            else:
+                self._json_completion(handler, payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client parti (annulation) : la génération s'arrête, la capacité est libérée
+            self._count('disconnected')
+        finally:
+            self._count('in_flight', -1)
+            if self._slots is not None:
+                self._slots.release()
+
+    def _completion_tokens(self, payload: Dict):
+        fixture = select_completion(payload, self.fixtures)
+        tokens = split_tokens(fixture['choices'][0]['message']['content'])
+        max_tokens = payload.get('max_tokens')
+        finish_reason = 'stop'
+        if max_tokens and len(tokens) > max_tokens:
+            tokens, finish_reason = tokens[:max_tokens], 'length'
+        usage = {
+            'prompt_tokens': fixture['usage']['prompt_tokens'],
+            'completion_tokens': len(tokens),
+            'total_tokens': fixture['usage']['prompt_tokens'] + len(tokens),
+        }
+        return tokens, finish_reason, usage
+
+    def _token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def _json_completion(self, handler: _Handler, payload: Dict):
+        tokens, finish_reason, usage = self._completion_tokens(payload)
+        time.sleep(self.ttft + self._token_delay() * max(0, len(tokens) - 1))
+        # Compté avant l'envoi : le client peut lire les stats dès la réponse reçue
+        self._count('completed')
+        self._count('completion_tokens', len(tokens))
+        handler._send_json(200, {
+            'id': f"chatcmpl-mock-{time.time_ns()}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model') or self.model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': ''.join(tokens)},
+                'finish_reason': finish_reason,
+            }],
+            'usage': usage,
+        })
+
+    def _stream_completion(self, handler: _Handler, payload: Dict):
+        tokens, finish_reason, usage = self._completion_tokens(payload)
+        completion_id = f"chatcmpl-mock-{time.time_ns()}"
+        model = payload.get('model') or self.model
+
+        def event(data) -> bytes:
+            return f"data: {json.dumps(data) if isinstance(data, dict) else data}\n\n".encode('utf-8')
+
+        def chunk(delta: Dict, finish: Optional[str] = None) -> bytes:
+            return event({
+                'id': completion_id, 'object': 'chat.completion.chunk', 'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}],
+            })
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.end_headers()
+
+        time.sleep(self.ttft)
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(self._token_delay())
+            handler.wfile.write(chunk({'content': token}))
+            handler.wfile.flush()
+            self._count('completion_tokens')
+        handler.wfile.write(chunk({}, finish_reason))
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            handler.wfile.write(event({'id': completion_id, 'object': 'chat.completion.chunk', 'model': model,
+                                       'choices': [], 'usage': usage}))
+        self._count('completed')
+        self._count('streamed')
+        handler.wfile.write(event('[DONE]'))
+        handler.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model', default='mock-llm')
+    parser.add_argument('--ttft', type=float, default=0.2)
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--max-concurrency', type=int, default=0, help="0 = illimité")
+    parser.add_argument('--overflow', choices=['queue', 'reject'], default='queue')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockLLMServer(**vars(args)).start()
+    print(f"Mock LLM sur {server.url} (Ctrl+C pour arrêter)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(json.dumps(server.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,23 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+
+
+def _is_server_process() -> bool:
+    """Vrai pour un processus qui sert des requêtes (pas migrate, test, ni le parent de l'autoreload)"""
+    if os.path.basename(sys.argv[0]) == 'manage.py':
+        return len(sys.argv) > 1 and sys.argv[1] == 'runserver' and os.environ.get('RUN_MAIN') == 'true'
+    return True
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from . import signals  # noqa: F401  (compteur de messages des conversations)
+        if settings.SEARCH_PREFETCH_ENABLED and _is_server_process():
+            from .services.prefetch import start_prefetcher
+            start_prefetcher()
@@ -0,0 +1,166 @@
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+import asyncio
+import logging
+import math
+import uuid
+from typing import Optional
+
+from . import fast_json
+from .logging_utils import request_id_var
+from .models import Conversation
+from .services.cancellation import CancellationToken, ChatCancelled
+from .services.job_queue import get_job_queue, job_group_name
+from .throttling import check_chat_turn, websocket_ident
+from .views import ChatAPIView
+
+logger = logging.getLogger(__name__)
+
+
+class FastJsonWebsocketConsumer(AsyncJsonWebsocketConsumer):
+    """Consumer JSON dont les messages passent par ``chat.fast_json`` (un envoi par token)"""
+
+    @classmethod
+    async def decode_json(cls, text_data):
+        return fast_json.loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content):
+        return fast_json.dumps_str(content)
+
+
+class ChatConsumer(FastJsonWebsocketConsumer):
+    """Chat sur WebSocket : une socket par conversation.
+    
+    Messages client :
+        {"type": "message", "message": "..."}  -> lance un tour de chat
+        {"type": "cancel"}                      -> annule le tour en cours
+    
+    Événements serveur : "conversation" (id créé au premier message),
+    "progress" (rewriting, searching, sources_ready, generating), "token",
+    "done", "cancelled" et "error" ("retry_after" en secondes si le tour
+    dépasse le budget ``chat``/``chat_search`` partagé avec ``POST /chat/``).
+    """
+    
+    async def connect(self):
+        kwargs = self.scope['url_route']['kwargs']
+        self.conversation_id = str(kwargs['conversation_id']) if kwargs.get('conversation_id') else None
+        self.cancel_token = None
+        self.turn_task = None
+        await self.accept()
+    
+    async def disconnect(self, code):
+        # Client parti : libérer la capacité vLLM/OpenRouter
+        if self.cancel_token:
+            self.cancel_token.cancel('disconnected')
+    
+    async def receive_json(self, content, **kwargs):
+        message_type = content.get('type')
+        
+        if message_type == 'cancel':
+            if self.cancel_token:
+                self.cancel_token.cancel('cancelled')
+            return
+        
+        if message_type != 'message':
+            await self.send_json({'type': 'error', 'error': f"Type de message inconnu: {message_type}"})
+            return
+        
+        message = (content.get('message') or '').strip()
+        if not message or len(message) > 5000:
+            await self.send_json({'type': 'error', 'error': 'Invalid message'})
+            return
+        
+        search_budget_ms = content.get('search_budget_ms')
+        if search_budget_ms is not None and not (
+            isinstance(search_budget_ms, int) and 0 <= search_budget_ms <= 30000
+        ):
+            await self.send_json({'type': 'error', 'error': 'Invalid search_budget_ms'})
+            return
+        
+        if self.turn_task and not self.turn_task.done():
+            await self.send_json({'type': 'error', 'error': 'Un tour de chat est déjà en cours'})
+            return
+        
+        # Même budget par tour que ChatTurnRateThrottle (appel Redis : hors de la boucle)
+        wait = await sync_to_async(check_chat_turn, thread_sensitive=False)(
+            websocket_ident(self.scope), ChatAPIView()._requires_search(message)
+        )
+        if wait is not None:
+            await self.send_json({'type': 'error', 'error': 'Request was throttled', 'retry_after': math.ceil(wait)})
+            return
+        
+        # Une socket = une conversation, créée au premier message si besoin
+        if not self.conversation_id:
+            conversation = await database_sync_to_async(Conversation.objects.create)()
+            self.conversation_id = str(conversation.id)
+            await self.send_json({'type': 'conversation', 'conversation_id': self.conversation_id})
+        
+        self.cancel_token = CancellationToken()
+        self.turn_task = asyncio.ensure_future(self._run_turn(message, self.cancel_token, search_budget_ms))
+    
+    async def _run_turn(self, message: str, cancel_token: CancellationToken, search_budget_ms: Optional[int] = None):
+        try:
+            result = await sync_to_async(self._handle_chat, thread_sensitive=False)(
+                message, cancel_token, search_budget_ms
+            )
+        except ChatCancelled:
+            await self._safe_send({'type': 'cancelled', 'reason': cancel_token.reason})
+            return
+        except ValidationError as e:
+            await self._safe_send({'type': 'error', 'error': ' '.join(e.messages)})
+            return
+        except Exception as e:
+            logger.error("WebSocket chat error: %s", e)
+            await self._safe_send({'type': 'error', 'error': 'An error occurred while processing your request'})
+            return
+        
+        await self._safe_send({'type': 'done', **result})
+    
+    def _handle_chat(self, message: str, cancel_token: CancellationToken, search_budget_ms: Optional[int] = None):
+        """Exécuté dans un thread : les callbacks repassent sur la boucle via async_to_sync."""
+        send = async_to_sync(self._safe_send)
+        # Un request-id par tour pour corréler les logs du pipeline
+        request_id_var.set(uuid.uuid4().hex)
+        try:
+            return ChatAPIView().handle_chat(
+                message,
+                self.conversation_id,
+                on_progress=lambda stage, data: send({'type': 'progress', 'stage': stage, **data}),
+                on_token=lambda token: send({'type': 'token', 'content': token}),
+                cancel_token=cancel_token,
+                search_budget_ms=search_budget_ms
+            )
+        finally:
+            close_old_connections()
+    
+    async def _safe_send(self, payload):
+        try:
+            await self.send_json(payload)
+        except Exception:
+            # Socket déjà fermée : le tour sera annulé par disconnect()
+            pass
+
+class JobConsumer(FastJsonWebsocketConsumer):
+    """Pousse l'état d'un travail de chat asynchrone au client (alternative au polling)."""
+    
+    async def connect(self):
+        self.job_id = str(self.scope['url_route']['kwargs']['job_id'])
+        self.group_name = job_group_name(self.job_id)
+        
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        
+        # Envoyer l'état courant : le travail a pu se terminer avant la connexion
+        job = await sync_to_async(get_job_queue().get)(self.job_id)
+        if job:
+            await self.send_json(job)
+    
+    async def disconnect(self, code):
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+    
+    async def job_update(self, event):
+        await self.send_json(event['job'])
@@ -0,0 +1,43 @@
+"""
+JSON rapide : orjson si installé, sinon la bibliothèque standard
+
+orjson est optionnel (``pip install orjson``) : mêmes appels et même
+``JSONDecodeError`` (``orjson.JSONDecodeError`` en hérite) dans les deux
+cas. Utilisé par les renderer/parser DRF (``chat.renderers``), le décodage
+des flux SSE des LLM et la sérialisation des événements WebSocket.
+"""
+import json
+from typing import Any, Union
+
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dépendance optionnelle
+    orjson = None
+
+HAS_ORJSON = orjson is not None
+JSONDecodeError = json.JSONDecodeError
+
+# Objets qu'orjson ne sait pas sérialiser seul (Decimal, chaînes paresseuses, QuerySet...)
+# et dates, laissées à DRF pour garder son format (millisecondes, suffixe Z)
+_drf_encoder = JSONEncoder()
+_ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME) if orjson is not None else 0
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    """Décode du JSON (bytes ou str : pas de décodage UTF-8 préalable avec orjson)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode en JSON compact UTF-8 (non ASCII conservé), comme ``JSONRenderer`` de DRF"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_drf_encoder.default, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps_str(obj: Any) -> str:
+    return dumps(obj).decode('utf-8')
@@ -0,0 +1,101 @@
+"""
+Logging structuré : formateur JSON, corrélation par request-id,
+échantillonnage des logs par résultat et handler non bloquant.
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from datetime import datetime, timezone
+
+from chat.tracing import current_span
+
+# Identifiant de la requête en cours (propagé aux threads via contextvars)
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+# Attributs standards d'un LogRecord : tout le reste vient de ``extra=``
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+class RequestIdFilter(logging.Filter):
+    """Ajoute ``record.request_id`` (et ``trace_id`` si une trace est en cours) depuis le contexte courant"""
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = request_id_var.get()
+            trace_id = current_span().trace_id
+            if trace_id:
+                record.trace_id = trace_id
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Ne laisse passer qu'une fraction des logs marqués ``extra={'sampled': True}``
+
+    Utilisé pour les logs par résultat (recherche, filtrage par date) qui
+    seraient trop volumineux s'ils étaient tous émis.
+    """
+
+    def __init__(self, rate: float = 0.1):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'sampled', False):
+            return random.random() < self.rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Une ligne JSON par log, avec le request-id et les champs ``extra``"""
+
+    def format(self, record):
+        payload = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', '-'),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and not key.startswith('_'):
+                payload[key] = value
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc_info'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class QueueListenerHandler(logging.handlers.QueueHandler):
+    """Handler non bloquant : le thread de requête ne fait qu'enfiler le record,
+    un thread ``QueueListener`` se charge du formatage et des écritures."""
+
+    def __init__(self, json_format: bool = True, text_format: str = '%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s'):
+        super().__init__(queue.SimpleQueue())
+        target = logging.StreamHandler()
+        target.setFormatter(JsonFormatter() if json_format else logging.Formatter(text_format))
+        # Le request-id doit être lu dans le thread émetteur, avant la mise en file
+        self.addFilter(RequestIdFilter())
+        self.listener = logging.handlers.QueueListener(self.queue, target, respect_handler_level=False)
+        self.listener.start()
+        self._listening = True
+
+    def close(self):
+        # Appelé par logging.shutdown() : vider la file avant de quitter
+        if self._listening:
+            self._listening = False
+            self.listener.stop()
+        super().close()
+
+    def prepare(self, record):
+        # Fusionner les arguments ici mais laisser le formatage au listener
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
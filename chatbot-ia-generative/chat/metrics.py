@@ -0,0 +1,392 @@
+"""
+Métriques applicatives en mémoire (compteurs, jauges et histogrammes thread-safe par processus)
+
+Exposées au format texte Prometheus par ``render_prometheus()`` (endpoint
+``/metrics``). Les durées par étape d'un tour de chat sont aussi collectées
+par requête pour l'en-tête ``Server-Timing``. Étapes et appels amont ouvrent
+chacun un span (voir ``chat.tracing``).
+"""
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from chat import tracing
+from chat.services.cancellation import ChatCancelled
+
+
+class _Metric:
+    """Base commune : nom, documentation, labels et verrou"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[Tuple[Dict[str, str], float]]:
+        with self._lock:
+            return [(dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(labels)} {_format_value(value)}" for labels, value in self.samples()]
+
+
+class Counter(_Metric):
+    """Compteur monotone avec labels, au format des compteurs Prometheus"""
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Valeur instantanée (profondeur de file, travaux en cours...)"""
+
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Histogramme cumulatif à buckets fixes (secondes par défaut)"""
+
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._observations: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._observations.get(key)
+            if state is None:
+                # [compte par bucket..., somme, nombre]
+                state = self._observations[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels) -> float:
+        with self._lock:
+            state = self._observations.get(self._key(labels))
+            return state[-1] if state else 0
+
+    def totals(self, **labels) -> Tuple[float, float]:
+        """(somme, nombre) des observations, pour des moyennes sur fenêtre par différence"""
+        with self._lock:
+            state = self._observations.get(self._key(labels))
+            return (state[-2], state[-1]) if state else (0.0, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = [(dict(zip(self.labelnames, key)), list(state)) for key, state in self._observations.items()]
+        lines = []
+        for labels, state in snapshot:
+            cumulative = 0.0
+            for bound, bucket_count in zip(self.buckets, state):
+                cumulative += bucket_count
+                le = '+Inf' if math.isinf(bound) else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le=le))} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {_format_value(state[-1])}")
+        return lines
+
+
+class RecentAverage:
+    """Moyenne récente d'un histogramme : moyenne de chaque fenêtre entre deux
+    ``update()``, lissée (EWMA) ; sans observation dans la fenêtre, elle s'estompe"""
+
+    def __init__(self, histogram: Histogram, alpha: float = 0.5, **labels):
+        self.histogram = histogram
+        self.alpha = alpha
+        self.labels = labels
+        self.value: Optional[float] = None
+        self._last = histogram.totals(**labels)
+
+    def update(self) -> Optional[float]:
+        total, count = self.histogram.totals(**self.labels)
+        last_total, last_count = self._last
+        self._last = (total, count)
+        if count > last_count:
+            window = (total - last_total) / (count - last_count)
+            self.value = window if self.value is None else (1 - self.alpha) * self.value + self.alpha * window
+        elif self.value is not None:
+            self.value *= 1 - self.alpha
+        return self.value
+
+
+REGISTRY: List[_Metric] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def render_prometheus() -> str:
+    """Toutes les métriques du registre au format d'exposition texte Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Annulation : capacité amont récupérée quand le client part ou annule
+CANCELLED_GENERATIONS = Counter(
+    'chat_cancelled_generations_total',
+    'Générations LLM interrompues par une annulation ou une déconnexion client',
+    ['provider', 'reason']
+)
+RECLAIMED_TOKENS = Counter(
+    'chat_reclaimed_tokens_total',
+    'Tokens non générés grâce à l\'annulation (max_tokens moins tokens déjà produits)',
+    ['provider']
+)
+CANCELLED_SEARCH_CALLS = Counter(
+    'chat_cancelled_search_calls_total',
+    'Appels SerpAPI évités car le tour de chat était annulé',
+)
+SPECULATIVE_SEARCHES = Counter(
+    'chat_speculative_searches_total',
+    'Recherches spéculatives lancées pendant la réécriture (kept / discarded / empty / timeout / failed)',
+    ['outcome']
+)
+PIPELINED_GENERATIONS = Counter(
+    'chat_pipelined_generations_total',
+    'Générations finales démarrées avant la fin de la recherche (top_k / deadline / complete)',
+    ['trigger']
+)
+PIPELINE_LATE_RESULTS = Counter(
+    'chat_pipeline_late_results_total',
+    'Résultats de recherche arrivés pendant la génération (attached / dropped)',
+    ['policy']
+)
+
+DEGRADED_STAGES = Counter(
+    'chat_degraded_stages_total',
+    'Étapes sautées ou tronquées faute de budget de temps (rewrite, search, search_fallback, llm)',
+    ['stage']
+)
+
+# Fournisseurs amont (vllm, openrouter, serpapi, scrapers)
+PROVIDER_CALLS = Counter(
+    'chat_provider_calls_total',
+    'Appels aux fournisseurs amont',
+    ['provider']
+)
+PROVIDER_ERRORS = Counter(
+    'chat_provider_errors_total',
+    'Appels amont en erreur (http_<code>, timeout, exception)',
+    ['provider', 'kind']
+)
+PROVIDER_RATE_LIMITED = Counter(
+    'chat_provider_rate_limited_total',
+    'Réponses 429 des fournisseurs amont',
+    ['provider']
+)
+PROVIDER_TOKENS = Counter(
+    'chat_provider_tokens_total',
+    'Tokens consommés par fournisseur (prompt / completion)',
+    ['provider', 'type']
+)
+PROVIDER_LATENCY = Histogram(
+    'chat_provider_latency_seconds',
+    'Durée des appels amont',
+    ['provider']
+)
+CACHE_LOOKUPS = Counter(
+    'chat_cache_lookups_total',
+    'Consultations des caches applicatifs (hit / miss)',
+    ['cache', 'result']
+)
+
+# Étapes d'un tour de chat
+STAGE_DURATION = Histogram(
+    'chat_stage_duration_seconds',
+    'Durée de chaque étape d\'un tour de chat (rewrite, search, date_filter, llm, db...)',
+    ['stage']
+)
+
+# Mode dégradé sous charge (voir chat.services.load_policy)
+LOAD_LEVEL = Gauge('chat_load_level', 'Niveau de dégradation courant (0 = normal)')
+LOAD_TRANSITIONS = Counter(
+    'chat_load_transitions_total',
+    'Changements de niveau de dégradation (up / down / manual)',
+    ['direction']
+)
+
+# Routage automatique des modèles (voir chat.services.model_router)
+MODEL_ROUTING = Counter(
+    'chat_model_routing_total',
+    'Décisions du routeur de modèles (manual, simple, complex, context, vllm_unavailable, vllm_slow, queue_busy)',
+    ['provider', 'reason']
+)
+
+# Micro-batching des réécritures (voir chat.services.rewrite_batcher)
+REWRITE_BATCH_SIZE = Histogram(
+    'chat_rewrite_batch_size',
+    'Réécritures regroupées par lot',
+    ['provider'],
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+REWRITE_PACKED_RESULTS = Counter(
+    'chat_rewrite_packed_total',
+    'Appels OpenRouter groupés (ok / partial / failed : questions relancées individuellement)',
+    ['outcome']
+)
+
+# Contrôle d'admission vLLM (voir chat.services.vllm_admission)
+VLLM_IN_FLIGHT = Gauge('chat_vllm_in_flight', 'Appels vLLM en cours depuis ce processus')
+VLLM_QUEUE_DEPTH = Gauge('chat_vllm_queue_depth', 'Appels vLLM en attente d\'une place')
+VLLM_QUEUE_WAIT = Histogram('chat_vllm_queue_wait_seconds', 'Attente d\'une place vLLM avant l\'appel')
+VLLM_QUEUE_TIMEOUTS = Counter(
+    'chat_vllm_queue_timeouts_total',
+    'Appels vLLM abandonnés faute de place (bascule vers OpenRouter)'
+)
+
+THROTTLE_DECISIONS = Counter(
+    'chat_throttle_decisions_total',
+    'Décisions de limitation de débit (backend redis, ou local si Redis est injoignable)',
+    ['scope', 'outcome', 'backend']
+)
+
+# File de travaux asynchrones (mise à jour au moment du scrape)
+JOB_QUEUE_DEPTH = Gauge('chat_job_queue_depth', 'Travaux de chat en attente')
+JOB_QUEUE_RUNNING = Gauge('chat_job_queue_running', 'Travaux de chat en cours d\'exécution')
+
+
+def record_cancellation(provider: str, reason: str, max_tokens: int, generated_tokens: int):
+    """Comptabilise une génération interrompue et les tokens économisés"""
+    CANCELLED_GENERATIONS.inc(provider=provider, reason=reason or 'cancelled')
+    RECLAIMED_TOKENS.inc(max(0, max_tokens - generated_tokens), provider=provider)
+
+
+def record_cache_lookup(cache_name: str, hit: bool):
+    CACHE_LOOKUPS.inc(cache=cache_name, result='hit' if hit else 'miss')
+
+
+class provider_call:
+    """Mesure un appel amont : ``with provider_call('openrouter') as call: ...``
+
+    Renseigner ``call.status_code`` et ``call.usage`` (format OpenAI) pendant
+    l'appel, ou ``call.error_kind`` pour une erreur applicative sans code HTTP ;
+    les exceptions sont comptées comme erreurs, sauf l'annulation. L'appel est
+    tracé dans un span client ``call.span`` (attributs libres pour l'appelant).
+    """
+
+    def __init__(self, provider: str, **span_attributes):
+        self.provider = provider
+        self.span_attributes = span_attributes
+        self.status_code: Optional[int] = None
+        self.error_kind: Optional[str] = None
+        self.usage: Optional[Dict] = None
+        self.completion_tokens = 0
+
+    def __enter__(self):
+        self._span_context = tracing.span(
+            self.provider, kind=tracing.SPAN_KIND_CLIENT, provider=self.provider, **self.span_attributes
+        )
+        self.span = self._span_context.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        PROVIDER_CALLS.inc(provider=self.provider)
+        PROVIDER_LATENCY.observe(time.perf_counter() - self._start, provider=self.provider)
+
+        error_kind = None
+        if self.status_code == 429:
+            PROVIDER_RATE_LIMITED.inc(provider=self.provider)
+        if self.status_code is not None and self.status_code >= 400:
+            error_kind = f'http_{self.status_code}'
+        elif self.error_kind:
+            error_kind = self.error_kind
+        elif exc_type is not None and not issubclass(exc_type, (ChatCancelled, GeneratorExit)):
+            error_kind = 'timeout' if 'timeout' in exc_type.__name__.lower() else 'exception'
+        if error_kind:
+            PROVIDER_ERRORS.inc(provider=self.provider, kind=error_kind)
+
+        usage = self.usage or {}
+        completion = usage.get('completion_tokens') or self.completion_tokens
+        if usage.get('prompt_tokens'):
+            PROVIDER_TOKENS.inc(usage['prompt_tokens'], provider=self.provider, type='prompt')
+        if completion:
+            PROVIDER_TOKENS.inc(completion, provider=self.provider, type='completion')
+
+        self.span.set_attributes({
+            'http.status_code': self.status_code,
+            'error.kind': error_kind,
+            'llm.usage.prompt_tokens': usage.get('prompt_tokens'),
+            'llm.usage.completion_tokens': completion or None,
+        })
+        if error_kind and exc_type is None:
+            self.span.set_error(error_kind)
+        return self._span_context.__exit__(exc_type, exc, tb)
+
+
+# Durées par étape de la requête en cours (pour l'en-tête Server-Timing)
+_stage_timings: contextvars.ContextVar = contextvars.ContextVar('stage_timings', default=None)
+
+
+def start_stage_timings() -> Tuple[Dict[str, float], contextvars.Token]:
+    """Ouvre la collecte des durées d'étapes pour la requête courante"""
+    timings: Dict[str, float] = {}
+    return timings, _stage_timings.set(timings)
+
+
+def reset_stage_timings(token: contextvars.Token):
+    _stage_timings.reset(token)
+
+
+@contextmanager
+def timed_stage(stage: str, span_name: Optional[str] = None):
+    """Chronomètre une étape : histogramme global, cumul dans la requête courante
+    et span ``chat.<stage>`` (ou ``span_name``) ; le span est renvoyé pour y
+    ajouter des attributs."""
+    start = time.perf_counter()
+    try:
+        with tracing.span(span_name or f"chat.{stage}") as stage_span:
+            yield stage_span
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage=stage)
+        timings = _stage_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
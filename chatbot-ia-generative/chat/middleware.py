@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import re
+import uuid
+from typing import Optional, Sequence
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - dépendance optionnelle
+    brotli = None
+
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+from .logging_utils import request_id_var
+from .tracing import reset_remote_parent, set_remote_parent
+from .metrics import reset_stage_timings, start_stage_timings
+from .services.cancellation import CancellationToken
+
+logger = logging.getLogger(__name__)
+
+
+class DisconnectCancellationMiddleware:
+    """ASGI middleware that cancels the request's work when the HTTP client disconnects.
+
+    A ``CancellationToken`` is placed in ``scope['cancel_token']`` (reachable
+    from views as ``request.scope``). Once the request body has been read,
+    a watcher waits for ``http.disconnect``: if it arrives before the
+    response is complete, the token is cancelled and the services abort
+    their upstream LLM and search calls.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        token = CancellationToken()
+        scope = dict(scope, cancel_token=token)
+        body_received = asyncio.Event()
+        disconnected = asyncio.Event()
+        response_complete = False
+
+        async def wrapped_receive():
+            if body_received.is_set():
+                # The watcher owns the upstream receive channel from here on:
+                # every later read waits for the disconnect, as ASGI servers do
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                token.cancel('disconnected')
+                disconnected.set()
+            elif not message.get('more_body', False):
+                body_received.set()
+            return message
+
+        async def wrapped_send(message):
+            nonlocal response_complete
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                response_complete = True
+            await send(message)
+
+        async def watch_disconnect():
+            await body_received.wait()
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            if not response_complete:
+                logger.info("🔌 Client déconnecté avant la réponse: %s", scope.get('path'))
+                token.cancel('disconnected')
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await self.app(scope, wrapped_receive, wrapped_send)
+        finally:
+            watcher.cancel()
+
+
+class RequestIdMiddleware:
+    """Django middleware that correlates every log line of a request.
+
+    Reuses the caller's ``X-Request-ID`` header when it looks sane, otherwise
+    generates one. The id is stored in a context variable read by the
+    ``RequestIdFilter`` and echoed back in the response header.
+    """
+
+    header = 'X-Request-ID'
+    _valid = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        incoming = request.headers.get(self.header, '')
+        request_id = incoming if self._valid.match(incoming) else uuid.uuid4().hex
+        request.request_id = request_id
+        reset_token = request_id_var.set(request_id)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_id_var.reset(reset_token)
+        response[self.header] = request_id
+        return response
+
+
+class ServerTimingMiddleware:
+    """Django middleware reporting per-stage durations in a ``Server-Timing`` header.
+
+    Stages are recorded by ``chat.metrics.timed_stage`` during the request;
+    enabled with the ``SERVER_TIMING_HEADER`` setting.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'SERVER_TIMING_HEADER', False)
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+
+        timings, reset_token = start_stage_timings()
+        try:
+            response = self.get_response(request)
+        finally:
+            reset_stage_timings(reset_token)
+        if timings:
+            response['Server-Timing'] = ', '.join(
+                f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+            )
+        return response
+
+
+class TraceContextMiddleware:
+    """Django middleware attaching the request's spans to an incoming W3C ``traceparent``."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reset_token = set_remote_parent(request.headers.get('traceparent'))
+        try:
+            return self.get_response(request)
+        finally:
+            if reset_token is not None:
+                reset_remote_parent(reset_token)
+
+
+def negotiate_encoding(accept_encoding: str, available: Sequence[str]) -> Optional[str]:
+    """Best coding of ``available`` for an ``Accept-Encoding`` header (q-values, ``*``).
+
+    Ties go to the first coding of ``available``; ``None`` means identity.
+    """
+    weights = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        match = re.search(r'q\s*=\s*([0-9.]+)', params)
+        if match:
+            try:
+                q = float(match.group(1))
+            except ValueError:
+                q = 0.0
+        weights[coding] = q
+    best, best_q = None, 0.0
+    for coding in available:
+        q = weights.get(coding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Django middleware compressing responses with brotli or gzip.
+
+    The coding follows the client's ``Accept-Encoding`` preferences. Brotli
+    (``pip install brotli``, quality ``RESPONSE_BROTLI_QUALITY``) is offered
+    only when installed and for non-streaming responses; gzip is Django's
+    ``GZipMiddleware`` (BREACH padding, weak ETags, ``Vary``).
+    """
+
+    def process_response(self, request, response):
+        if response.has_header('Content-Encoding'):
+            return response
+        if not response.streaming and len(response.content) < 200:
+            return response
+
+        available = ('gzip',) if brotli is None or response.streaming else ('br', 'gzip')
+        encoding = negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), available)
+        if encoding == 'gzip':
+            return super().process_response(request, response)
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if encoding != 'br':
+            return response
+        compressed = brotli.compress(response.content, quality=settings.RESPONSE_BROTLI_QUALITY)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response.headers['Content-Length'] = str(len(compressed))
+        # Representation differs from the uncompressed one: the ETag becomes weak
+        if response.has_header('ETag'):
+            response.headers['ETag'] = re.sub(r'^"', 'W/"', response.headers['ETag'])
+        response.headers['Content-Encoding'] = 'br'
+        return response
@@ -0,0 +1,35 @@
+"""
+Compteur de messages dénormalisé sur Conversation (ETags des conversations)
+
+Sous SQLite, ``AddField`` reconstruit ``chat_conversation`` seulement :
+``chat_message`` et ses triggers FTS (0002) ne sont pas touchés.
+"""
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_messages(apps, schema_editor):
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    counts = (
+        Message.objects.filter(conversation=OuterRef('pk'))
+        .order_by().values('conversation').annotate(count=Count('*')).values('count')
+    )
+    Conversation.objects.update(message_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_fulltext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+"""
+Processus propriétaire de chaque travail (reprise après redémarrage)
+
+Sous SQLite, ``AddField`` reconstruit ``chat_chatjob`` seulement.
+"""
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatjob',
+            name='worker',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
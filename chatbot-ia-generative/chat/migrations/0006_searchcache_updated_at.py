@@ -0,0 +1,23 @@
+"""
+Date de mise à jour des entrées SearchCache (curseur de l'index local)
+
+``update_or_create`` rafraîchit une entrée sur place : l'identifiant ne
+suffit pas à retrouver les entrées modifiées depuis la dernière
+synchronisation. Les lignes existantes prennent la date de la migration.
+"""
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chatjob_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchcache',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -1,17 +1,40 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import F
 from django.utils import timezone
 import uuid
 
 
+def conversation_etag(updated_at, message_count: int) -> str:
+    """Version d'une conversation : change à chaque message ajouté ou supprimé"""
+    return f"{updated_at.timestamp():.6f}-{message_count}"
+
+
 class Conversation(models.Model):
     """Model to store conversation sessions."""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
+    # Dénormalisé (touch, chat.signals) : ETag des conversations sans lire chat_message
+    message_count = models.PositiveIntegerField(default=0)
     
     class Meta:
         ordering = ['-updated_at']
     
+    def etag(self) -> str:
+        return conversation_etag(self.updated_at, self.message_count)
+    
+    def touch(self, added: int = 0):
+        """Count ``added`` new messages and bump ``updated_at`` in a single UPDATE.
+
+        Called once per chat turn for both messages; code creating messages
+        outside ``ChatAPIView`` must call it too (deletions are counted by
+        ``chat.signals``).
+        """
+        Conversation.objects.filter(pk=self.pk).update(
+            message_count=F('message_count') + added, updated_at=timezone.now()
+        )
+    
     def __str__(self):
         return f"Conversation {self.id} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
 
@@ -50,6 +73,8 @@ class SearchCache(models.Model):
     query = models.CharField(max_length=500, unique=True)
     results = models.JSONField()
     created_at = models.DateTimeField(default=timezone.now)
+    # Curseur de synchronisation de l'index local (entrées rafraîchies sur place)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     
     class Meta:
         ordering = ['-created_at']
@@ -61,3 +86,53 @@ class SearchCache(models.Model):
     
     def __str__(self):
         return f"Search: {self.query[:50]}..."
+
+
+class ChatJob(models.Model):
+    """Model to persist async chat jobs (visible from every worker, kept across restarts)."""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='jobs',
+        null=True,
+        blank=True
+    )
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    queue_position = models.PositiveIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Processus qui exécute le travail (machine:pid:jeton), voir ChatJobQueue.fail_stale_jobs
+    worker = models.CharField(max_length=100, blank=True)
+    
+    def to_dict(self) -> dict:
+        """État renvoyé par l'endpoint de polling et diffusé aux WebSockets"""
+        job = {
+            'job_id': str(self.id),
+            'status': self.status,
+            'conversation_id': str(self.conversation_id) if self.conversation_id else None,
+            'queue_position': self.queue_position,
+            'created_at': self.created_at.isoformat(),
+        }
+        if self.started_at:
+            job['started_at'] = self.started_at.isoformat()
+        if self.status == 'completed':
+            job['result'] = self.result
+        elif self.status == 'failed':
+            job['error'] = self.error
+        if self.finished_at:
+            job['finished_at'] = self.finished_at.isoformat()
+        return job
+    
+    def __str__(self):
+        return f"Job {self.id} ({self.status})"
@@ -0,0 +1,45 @@
+"""
+Renderer et parser JSON de l'API basés sur ``chat.fast_json`` (orjson)
+
+Même sortie que ``JSONRenderer`` de DRF (compacte, UTF-8, U+2028/U+2029
+échappés) ; sans orjson, ou pour une sortie indentée (``indent=`` dans
+l'en-tête Accept, API navigable), les classes DRF font le travail.
+"""
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from . import fast_json
+
+
+class FastJSONRenderer(JSONRenderer):
+    """``JSONRenderer`` via orjson : les listes de conversations font plusieurs Mo"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if not fast_json.HAS_ORJSON or indent is not None or self.ensure_ascii:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = fast_json.dumps(data)
+        # Comme DRF : sortie sous-ensemble strict de JavaScript
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+class FastJSONParser(JSONParser):
+    """``JSONParser`` via orjson (corps UTF-8 décodé en une fois)"""
+
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if not fast_json.HAS_ORJSON or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return fast_json.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
@@ -0,0 +1,8 @@
+from django.urls import path
+from .consumers import ChatConsumer, JobConsumer
+
+websocket_urlpatterns = [
+    path('ws/chat/', ChatConsumer.as_asgi()),
+    path('ws/chat/<uuid:conversation_id>/', ChatConsumer.as_asgi()),
+    path('ws/jobs/<uuid:job_id>/', JobConsumer.as_asgi()),
+]
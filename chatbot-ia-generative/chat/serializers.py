@@ -1,12 +1,59 @@
-from rest_framework import serializers
+from django.db import models
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
 from .models import Conversation, Message
 
 
+def _datetime_formatter(field: serializers.DateTimeField):
+    """``field.to_representation`` avec le fuseau résolu une fois pour toute une liste"""
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+    if field_timezone is None or not isinstance(output_format, str) or output_format.lower() != ISO_8601:
+        return field.to_representation
+
+    def to_representation(value):
+        if not value or timezone.is_naive(value):
+            return field.to_representation(value)
+        value = value.astimezone(field_timezone).isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+    return to_representation
+
+
+class MessageListSerializer(serializers.ListSerializer):
+    """Sortie en masse des messages sans la mécanique des champs DRF.
+
+    Un dict par message construit directement depuis les attributs du
+    modèle (la date garde le format du champ DRF) : même résultat que
+    ``MessageSerializer``, trois fois plus rapide sur les longues
+    conversations. Les sous-classes gardent le chemin DRF.
+    """
+
+    def to_representation(self, data):
+        if type(self.child) is not MessageSerializer:
+            return super().to_representation(data)
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        created_at = _datetime_formatter(self.child.fields['created_at'])
+        return [
+            {
+                'id': str(message.id),
+                'role': message.role,
+                'content': message.content,
+                'created_at': created_at(message.created_at),
+                'search_results': message.search_results,
+                'sources': message.sources,
+            }
+            for message in iterable
+        ]
+
+
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = ['id', 'role', 'content', 'created_at', 'search_results', 'sources']
         read_only_fields = ['id', 'created_at']
+        list_serializer_class = MessageListSerializer
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -20,4 +67,18 @@ class ConversationSerializer(serializers.ModelSerializer):
 
 class ChatRequestSerializer(serializers.Serializer):
     message = serializers.CharField(max_length=5000)
-    conversation_id = serializers.UUIDField(required=False, allow_null=True)
\ No newline at end of file
+    conversation_id = serializers.UUIDField(required=False, allow_null=True)
+    # Mode travail : réponse immédiate avec un job_id, résultat par polling ou WebSocket
+    async_mode = serializers.BooleanField(required=False, default=False)
+    # Génération en pipeline : attente maximale des résultats de recherche avant la réponse
+    search_budget_ms = serializers.IntegerField(required=False, allow_null=True, min_value=0, max_value=30000)
+    # Budget de temps de bout en bout du tour (défaut : CHAT_DEADLINE_SECONDS) ;
+    # en mode travail, compté à partir de la prise en charge par un worker
+    deadline_ms = serializers.IntegerField(required=False, allow_null=True, min_value=1000, max_value=300000)
+
+class HistorySearchQuerySerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=200, trim_whitespace=True)
+    page = serializers.IntegerField(required=False, default=1, min_value=1)
+    page_size = serializers.IntegerField(required=False, default=20, min_value=1, max_value=50)
+    conversation_id = serializers.UUIDField(required=False)
+    role = serializers.ChoiceField(choices=['user', 'assistant'], required=False)
@@ -0,0 +1,179 @@
+"""
+Cache de réponses pour les premiers tours de chat sans recherche
+
+Les questions simples (définitions, explications) reviennent souvent d'un
+utilisateur à l'autre et coûtent chacune un appel LLM complet. Seuls les
+premiers tours sans historique sont cachés : la réponse ne dépend alors que
+du prompt, du modèle et de la température, qui forment la clé.
+
+Recherche exacte sur le prompt normalisé, puis, si
+``ANSWER_CACHE_SIMILARITY_THRESHOLD`` > 0 et avec un vrai modèle
+d'embedding (``EMBEDDING_BACKEND='sentence_transformers'``), recherche par
+similarité parmi les entrées du même modèle et de la même température. Le
+hachage ne distingue pas « TCP et UDP » de « HTTP et UDP » : avec lui, le
+cache reste en correspondance exacte. Éviction LRU au-delà de
+``ANSWER_CACHE_MAX_ENTRIES`` et expiration après ``ANSWER_CACHE_TTL``.
+
+Cache local au processus, comme le cache Django par défaut (LocMem).
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+
+from chat.metrics import record_cache_lookup
+from .embeddings import VectorIndex, get_embedder
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Minuscules, espaces et ponctuation finale uniformisés"""
+    text = unicodedata.normalize('NFC', prompt).lower()
+    text = _WHITESPACE.sub(' ', text).strip()
+    return text.rstrip(' ?!.').strip()
+
+
+class AnswerCache:
+    """Cache LRU + TTL de réponses LLM, avec recherche par similarité optionnelle"""
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_seconds: int = 86400,
+        similarity_threshold: float = 0.0,
+        embedder=None
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._embedder = embedder
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        # Un index par (modèle, température) : pas de réponse croisée entre modèles
+        self._indexes: Dict[Tuple[str, float], VectorIndex] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def embedder(self):
+        if self._embedder is None:
+            self._embedder = get_embedder()
+        return self._embedder
+
+    @staticmethod
+    def _key(normalized: str, model: str, temperature: float) -> str:
+        raw = f"{model}|{temperature:.2f}|{normalized}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, prompt: str, model: str, temperature: float) -> Optional[Dict]:
+        """Réponse cachée (``response``, ``match``, ``similarity``) ou None"""
+        normalized = normalize_prompt(prompt)
+        key = self._key(normalized, model, temperature)
+        vector = None
+        if self.similarity_threshold > 0:
+            vector = self.embedder.embed(normalized)
+
+        with self._lock:
+            hit = self._lookup(key, model, temperature, vector)
+        record_cache_lookup('answer', hit is not None)
+        return hit
+
+    def _lookup(self, key: str, model: str, temperature: float, vector) -> Optional[Dict]:
+        entry = self._fresh_entry(key)
+        if entry is not None:
+            return self._hit(key, entry, 'exact', 1.0)
+
+        index = self._indexes.get((model, temperature))
+        if vector is None or index is None:
+            return None
+        for candidate, score in index.search(vector, k=3, min_score=self.similarity_threshold):
+            entry = self._fresh_entry(candidate)
+            if entry is not None:
+                return self._hit(candidate, entry, 'semantic', score)
+        return None
+
+    def _fresh_entry(self, key: str) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry['created_at'] > self.ttl_seconds:
+            self._evict(key)
+            return None
+        return entry
+
+    def _hit(self, key: str, entry: Dict, match: str, similarity: float) -> Dict:
+        self._entries.move_to_end(key)
+        entry['hits'] += 1
+        return {
+            'response': entry['response'],
+            'match': match,
+            'similarity': round(similarity, 3),
+            'age_seconds': int(time.time() - entry['created_at']),
+        }
+
+    def set(self, prompt: str, model: str, temperature: float, response: str):
+        normalized = normalize_prompt(prompt)
+        key = self._key(normalized, model, temperature)
+        vector = self.embedder.embed(normalized) if self.similarity_threshold > 0 else None
+
+        with self._lock:
+            self._entries[key] = {
+                'response': response,
+                'model': model,
+                'temperature': temperature,
+                'created_at': time.time(),
+                'hits': 0,
+            }
+            self._entries.move_to_end(key)
+            if vector is not None:
+                index = self._indexes.get((model, temperature))
+                if index is None:
+                    index = self._indexes[(model, temperature)] = VectorIndex(self.embedder.dim)
+                index.add(key, vector)
+            while len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        index = self._indexes.get((entry['model'], entry['temperature']))
+        if index is not None:
+            index.remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._indexes.clear()
+
+
+_answer_cache: Optional[AnswerCache] = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """Cache de réponses du processus, configuré par les settings ANSWER_CACHE_*"""
+    global _answer_cache
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                threshold = settings.ANSWER_CACHE_SIMILARITY_THRESHOLD
+                if threshold > 0 and get_embedder().name != 'sentence_transformers':
+                    logger.warning("⚠️ Recherche sémantique du cache de réponses désactivée (embeddings par hachage)")
+                    threshold = 0.0
+                _answer_cache = AnswerCache(
+                    max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+                    ttl_seconds=settings.ANSWER_CACHE_TTL,
+                    similarity_threshold=threshold,
+                )
+    return _answer_cache
@@ -0,0 +1,66 @@
+"""
+Annulation coopérative d'un tour de chat
+
+Un ``CancellationToken`` est partagé entre la couche de transport (WebSocket,
+requête HTTP) et les services : ceux-ci le consultent entre deux étapes ou
+deux chunks de streaming, et enregistrent des callbacks (fermeture de la
+connexion amont) exécutés dès l'annulation.
+"""
+import logging
+import threading
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class ChatCancelled(Exception):
+    """Levée quand le tour de chat a été annulé par le client."""
+
+
+class CancellationToken:
+    """Jeton d'annulation thread-safe avec callbacks"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.reason = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = 'cancelled'):
+        """Annule et exécute les callbacks enregistrés (une seule fois)"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug("Callback d'annulation en erreur: %s", e)
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Enregistre un callback ; retourne une fonction pour le désenregistrer"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+
+                def unregister():
+                    with self._lock:
+                        if callback in self._callbacks:
+                            self._callbacks.remove(callback)
+                return unregister
+
+        # Déjà annulé : exécuter immédiatement
+        callback()
+        return lambda: None
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise ChatCancelled(self.reason)
@@ -0,0 +1,120 @@
+"""
+Budget de temps de bout en bout d'un tour de chat
+
+Le ``Deadline`` est créé à l'entrée de la requête (``ChatAPIView.post``,
+consumer WebSocket) ou à la prise en charge d'un travail asynchrone par un
+worker, et passé à chaque service : un appel amont prend
+``min(son propre timeout, temps restant)`` et une étape qui n'a plus le
+temps de s'exécuter est sautée ou dégradée. Les étapes dégradées sont
+renvoyées au client (``degraded_stages``).
+"""
+import logging
+import math
+import threading
+import time
+from typing import List, Optional
+
+from django.conf import settings
+
+from chat import tracing
+from chat.metrics import DEGRADED_STAGES
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+    """Levée quand un appel amont est sauté faute de temps restant."""
+
+
+class Deadline:
+    """Échéance d'un tour de chat ; sans budget, aucune borne n'est appliquée"""
+
+    def __init__(self, budget_seconds: Optional[float] = None, _parent: Optional['Deadline'] = None,
+                 _expires_at: Optional[float] = None, _report: bool = True):
+        self.budget_seconds = budget_seconds
+        if _expires_at is not None:
+            self._expires_at = _expires_at
+        elif budget_seconds is not None:
+            self._expires_at = time.monotonic() + budget_seconds
+        else:
+            self._expires_at = None
+        self._parent = _parent
+        self._report = _report
+        self._degraded: List[str] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, budget_ms: Optional[int] = None, job: bool = False) -> 'Deadline':
+        """Budget demandé par le client, sinon ``CHAT_DEADLINE_SECONDS``
+        (``CHAT_JOB_DEADLINE_SECONDS`` pour un travail asynchrone ; 0 = sans borne)"""
+        if budget_ms is not None:
+            return cls(budget_ms / 1000)
+        return cls((settings.CHAT_JOB_DEADLINE_SECONDS if job else settings.CHAT_DEADLINE_SECONDS) or None)
+
+    @property
+    def bounded(self) -> bool:
+        return self._expires_at is not None
+
+    def remaining(self) -> float:
+        """Secondes restantes (infini sans budget)"""
+        if self._expires_at is None:
+            return math.inf
+        return max(0.0, self._expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def allows(self, seconds: float) -> bool:
+        """Reste-t-il au moins ``seconds`` secondes ?"""
+        return self.remaining() >= seconds
+
+    def timeout(self, own: Optional[float] = None) -> Optional[float]:
+        """Timeout d'un appel : ``min(own, temps restant)``, None si aucun des deux n'est borné"""
+        remaining = self.remaining()
+        if math.isinf(remaining):
+            return own
+        # Jamais 0 : httpx et requests l'interprètent comme « pas d'attente » ou lèvent
+        remaining = max(remaining, 0.001)
+        return remaining if own is None else min(own, remaining)
+
+    def check(self, stage: str, min_seconds: Optional[float] = None):
+        """Lève DeadlineExceeded (et note l'étape dégradée) s'il reste moins de ``min_seconds``"""
+        if min_seconds is None:
+            min_seconds = settings.DEADLINE_MIN_CALL_SECONDS
+        if not self.allows(min_seconds):
+            self.degrade(stage)
+            raise DeadlineExceeded(f"Étape {stage} sautée : {self.remaining():.2f}s restantes")
+
+    def reserve(self, seconds: float, report: bool = True) -> 'Deadline':
+        """
+        Échéance avancée de ``seconds`` (temps gardé pour les étapes suivantes).
+        Les dégradations remontent au parent ; avec ``report=False`` elles restent
+        locales (travail spéculatif dont le résultat peut être jeté).
+        """
+        return Deadline(
+            self.budget_seconds,
+            _parent=self if report else None,
+            _expires_at=None if self._expires_at is None else self._expires_at - seconds,
+            _report=report
+        )
+
+    def degrade(self, stage: str):
+        """Note une étape sautée ou tronquée faute de temps"""
+        with self._lock:
+            if stage in self._degraded:
+                return
+            self._degraded.append(stage)
+        if self._parent is not None:
+            self._parent.degrade(stage)
+            return
+        if not self._report:
+            return
+        DEGRADED_STAGES.inc(stage=stage)
+        tracing.current_span().set_attribute('deadline.degraded', ','.join(self.degraded_stages))
+        logger.warning("⏳ Étape %s dégradée (échéance) : %.2fs restantes", stage, self.remaining())
+
+    @property
+    def degraded_stages(self) -> List[str]:
+        with self._lock:
+            return list(self._degraded)
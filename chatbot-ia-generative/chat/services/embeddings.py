@@ -0,0 +1,174 @@
+"""
+Embeddings de texte et index cosinus en mémoire
+
+Deux encodeurs :
+- ``SentenceTransformerEmbedder`` : petit modèle local (``EMBEDDING_MODEL``),
+  si ``sentence-transformers`` est installé ;
+- ``HashingEmbedder`` : hachage de mots et de trigrammes de caractères, sans
+  dépendance ni modèle à télécharger. Proche voisin lexical plutôt que
+  sémantique, mais suffisant pour retrouver une question reformulée.
+
+``VectorIndex`` fait une recherche exacte (force brute) par produit scalaire
+sur des vecteurs normalisés ; NumPy est utilisé s'il est disponible, sinon
+le calcul se fait en pur Python (quelques milliers de vecteurs au plus).
+"""
+import logging
+import math
+import re
+import threading
+import zlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+try:
+    import numpy as np
+except ImportError:  # NumPy est optionnel
+    np = None
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector] if norm else vector
+
+
+class HashingEmbedder:
+    """Vecteur creux haché (mots + trigrammes de caractères), normalisé L2"""
+
+    name = 'hashing'
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = _WORD.findall(text.lower())
+        features = [f"w:{w}" for w in words]
+        for word in words:
+            padded = f"#{word}#"
+            features.extend(f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2))
+        return features
+
+    def embed(self, text: str):
+        vector = [0.0] * self.dim
+        for feature in self._features(text):
+            h = zlib.crc32(feature.encode('utf-8'))
+            # Bit de signe indépendant de l'indice : limite le biais des collisions
+            vector[h % self.dim] += -1.0 if h & 0x80000000 else 1.0
+        vector = _normalize(vector)
+        return np.asarray(vector, dtype=np.float32) if np is not None else vector
+
+
+class SentenceTransformerEmbedder:
+    """Petit modèle d'embedding local (chargé au premier appel)"""
+
+    name = 'sentence_transformers'
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name
+        self._model = SentenceTransformer(model_name)
+        self.dim = self._model.get_sentence_embedding_dimension()
+
+    def embed(self, text: str):
+        vector = self._model.encode(text, normalize_embeddings=True)
+        return vector.astype(np.float32) if np is not None else [float(v) for v in vector]
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder():
+    """Encodeur du processus selon ``EMBEDDING_BACKEND`` (repli sur le hachage)"""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                backend = getattr(settings, 'EMBEDDING_BACKEND', 'hashing')
+                if backend == 'sentence_transformers':
+                    try:
+                        _embedder = SentenceTransformerEmbedder(settings.EMBEDDING_MODEL)
+                        logger.info("🧠 Modèle d'embedding chargé: %s", settings.EMBEDDING_MODEL)
+                    except Exception as e:
+                        logger.warning("⚠️ Modèle d'embedding indisponible (%s), repli sur le hachage", e)
+                if _embedder is None:
+                    _embedder = HashingEmbedder(getattr(settings, 'EMBEDDING_DIM', 256))
+    return _embedder
+
+
+class VectorIndex:
+    """Index cosinus exact : clé -> vecteur normalisé"""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._keys: List[str] = []
+        self._positions: Dict[str, int] = {}
+        if np is not None:
+            self._matrix = np.zeros((16, dim), dtype=np.float32)
+        else:
+            self._rows: List[Sequence[float]] = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key: str):
+        return key in self._positions
+
+    def add(self, key: str, vector):
+        position = self._positions.get(key)
+        if position is None:
+            position = len(self._keys)
+            self._keys.append(key)
+            self._positions[key] = position
+            if np is not None:
+                if position >= len(self._matrix):
+                    grown = np.zeros((len(self._matrix) * 2, self.dim), dtype=np.float32)
+                    grown[:position] = self._matrix[:position]
+                    self._matrix = grown
+            else:
+                self._rows.append(vector)
+        if np is not None:
+            self._matrix[position] = vector
+        else:
+            self._rows[position] = vector
+
+    def remove(self, key: str):
+        """Retire une clé en déplaçant la dernière ligne à sa place"""
+        position = self._positions.pop(key, None)
+        if position is None:
+            return
+        last = len(self._keys) - 1
+        last_key = self._keys.pop()
+        if position != last:
+            self._keys[position] = last_key
+            self._positions[last_key] = position
+            if np is not None:
+                self._matrix[position] = self._matrix[last]
+            else:
+                self._rows[position] = self._rows[last]
+        if np is None:
+            self._rows.pop()
+
+    def search(self, vector, k: int = 1, min_score: float = -1.0) -> List[Tuple[str, float]]:
+        """Les ``k`` clés les plus proches (score cosinus décroissant)"""
+        n = len(self._keys)
+        if not n:
+            return []
+        if np is not None:
+            scores = self._matrix[:n] @ vector
+            if k < n:
+                top = np.argpartition(-scores, k)[:k]
+            else:
+                top = np.arange(n)
+            ranked = sorted(((self._keys[i], float(scores[i])) for i in top), key=lambda item: -item[1])
+        else:
+            ranked = sorted(
+                ((key, sum(a * b for a, b in zip(row, vector))) for key, row in zip(self._keys, self._rows)),
+                key=lambda item: -item[1]
+            )[:k]
+        return [(key, score) for key, score in ranked if score >= min_score]
@@ -0,0 +1,197 @@
+"""
+Recherche plein texte dans l'historique des conversations
+
+S'appuie sur l'index créé par la migration ``0002_message_fulltext`` :
+FTS5 (classement BM25, ``snippet()``) sous SQLite, ``tsvector`` + GIN
+(``ts_rank_cd``, ``ts_headline``) sous PostgreSQL. Sur un autre moteur, ou si
+l'index est absent, repli sur ``content__icontains`` (parcours complet).
+
+Les extraits entourent les termes trouvés de ``<mark>`` / ``</mark>`` ; le
+reste du texte n'est pas échappé, c'est au client de le faire.
+"""
+import logging
+import re
+import uuid
+from typing import Dict, List, Optional
+
+from django.db import DatabaseError, connection
+
+from chat.models import Message
+
+logger = logging.getLogger(__name__)
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_END = '</mark>'
+SNIPPET_ELLIPSIS = '…'
+
+
+def fts5_query(text: str) -> Optional[str]:
+    """Requête FTS5 sûre : chaque terme entre guillemets (ET implicite), préfixe sur le dernier"""
+    terms = _TERM.findall(text)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'  # Recherche au fil de la frappe
+    return ' '.join(quoted)
+
+
+class HistorySearchService:
+    """Recherche classée, avec extraits et pagination, dans Message.content"""
+
+    SNIPPET_TOKENS = 16
+
+    def __init__(self):
+        self.backend = connection.vendor if connection.vendor in ('sqlite', 'postgresql') else 'icontains'
+
+    def search(
+        self,
+        query: str,
+        page: int = 1,
+        page_size: int = 20,
+        conversation_id: Optional[str] = None,
+        role: Optional[str] = None
+    ) -> Dict:
+        offset = (page - 1) * page_size
+        filters, params = self._filters(conversation_id, role)
+        try:
+            if self.backend == 'sqlite':
+                total, rows = self._search_sqlite(query, filters, params, page_size, offset)
+            elif self.backend == 'postgresql':
+                total, rows = self._search_postgres(query, filters, params, page_size, offset)
+            else:
+                total, rows = self._search_icontains(query, conversation_id, role, page_size, offset)
+        except DatabaseError as e:
+            # Index plein texte absent (migration non appliquée) : parcours complet
+            logger.warning("⚠️ Index plein texte indisponible (%s), repli sur icontains", e)
+            self.backend = 'icontains'
+            total, rows = self._search_icontains(query, conversation_id, role, page_size, offset)
+
+        return {
+            'query': query,
+            'backend': self.backend,
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+            'has_next': offset + len(rows) < total,
+            'results': rows,
+        }
+
+    @staticmethod
+    def _filters(conversation_id: Optional[str], role: Optional[str]):
+        filters, params = [], []
+        if conversation_id:
+            filters.append('m.conversation_id = %s')
+            # Les UUID sont stockés sans tirets sous SQLite
+            params.append(str(conversation_id).replace('-', '') if connection.vendor == 'sqlite' else str(conversation_id))
+        if role:
+            filters.append('m.role = %s')
+            params.append(role)
+        return ''.join(f' AND {f}' for f in filters), params
+
+    def _search_sqlite(self, query: str, filters: str, params: List, limit: int, offset: int):
+        match = fts5_query(query)
+        if not match:
+            return 0, []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT count(*)
+                FROM chat_message_fts f JOIN chat_message m ON m.rowid = f.rowid
+                WHERE chat_message_fts MATCH %s{filters}
+                """,
+                [match, *params]
+            )
+            total = cursor.fetchone()[0]
+            if not total or offset >= total:
+                return total, []
+            cursor.execute(
+                f"""
+                SELECT m.id, m.conversation_id, m.role, m.created_at,
+                       snippet(chat_message_fts, 0, %s, %s, %s, %s),
+                       bm25(chat_message_fts) AS rank
+                FROM chat_message_fts f JOIN chat_message m ON m.rowid = f.rowid
+                WHERE chat_message_fts MATCH %s{filters}
+                ORDER BY rank
+                LIMIT %s OFFSET %s
+                """,
+                [HIGHLIGHT_START, HIGHLIGHT_END, SNIPPET_ELLIPSIS, self.SNIPPET_TOKENS,
+                 match, *params, limit, offset]
+            )
+            rows = cursor.fetchall()
+        # bm25() est négatif, plus petit = plus pertinent
+        return total, self._rows(rows, score=lambda rank: round(-rank, 4))
+
+    def _search_postgres(self, query: str, filters: str, params: List, limit: int, offset: int):
+        if not _TERM.search(query):
+            return 0, []
+        headline_options = (
+            f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, "
+            f"MaxWords={self.SNIPPET_TOKENS}, MinWords=5, FragmentDelimiter={SNIPPET_ELLIPSIS}, MaxFragments=2"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT count(*)
+                FROM chat_message m
+                WHERE m.search_vector @@ websearch_to_tsquery('simple', %s){filters}
+                """,
+                [query, *params]
+            )
+            total = cursor.fetchone()[0]
+            if not total or offset >= total:
+                return total, []
+            cursor.execute(
+                f"""
+                SELECT m.id, m.conversation_id, m.role, m.created_at,
+                       ts_headline('simple', m.content, q, %s),
+                       ts_rank_cd(m.search_vector, q) AS rank
+                FROM chat_message m, websearch_to_tsquery('simple', %s) q
+                WHERE m.search_vector @@ q{filters}
+                ORDER BY rank DESC, m.created_at DESC
+                LIMIT %s OFFSET %s
+                """,
+                [headline_options, query, *params, limit, offset]
+            )
+            rows = cursor.fetchall()
+        return total, self._rows(rows, score=lambda rank: round(float(rank), 4))
+
+    def _search_icontains(self, query: str, conversation_id, role, limit: int, offset: int):
+        messages = Message.objects.filter(content__icontains=query)
+        if conversation_id:
+            messages = messages.filter(conversation_id=conversation_id)
+        if role:
+            messages = messages.filter(role=role)
+        total = messages.count()
+        rows = [
+            (m.id, m.conversation_id, m.role, m.created_at, self._manual_snippet(m.content, query), None)
+            for m in messages.order_by('-created_at')[offset:offset + limit]
+        ]
+        return total, self._rows(rows, score=lambda rank: None)
+
+    def _manual_snippet(self, content: str, query: str, width: int = 80) -> str:
+        position = content.lower().find(query.lower())
+        if position < 0:
+            return content[:2 * width]
+        start, end = max(0, position - width), position + len(query) + width
+        snippet = (
+            content[start:position] + HIGHLIGHT_START + content[position:position + len(query)]
+            + HIGHLIGHT_END + content[position + len(query):end]
+        )
+        return (SNIPPET_ELLIPSIS if start else '') + snippet + (SNIPPET_ELLIPSIS if end < len(content) else '')
+
+    @staticmethod
+    def _rows(rows, score) -> List[Dict]:
+        results = []
+        for message_id, conversation_id, role, created_at, snippet, rank in rows:
+            results.append({
+                # SQLite stocke les UUID en hexadécimal sans tirets
+                'message_id': str(uuid.UUID(str(message_id))),
+                'conversation_id': str(uuid.UUID(str(conversation_id))),
+                'role': role,
+                'created_at': created_at,
+                'snippet': snippet,
+                'score': score(rank),
+            })
+        return results
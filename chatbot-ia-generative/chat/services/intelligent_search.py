@@ -1,21 +1,226 @@
 """
 Service de recherche intelligent avec génération de requête par LLM
 """
-import httpx
+import contextvars
+import hashlib
 import json
 import logging
-from typing import List, Dict, Optional, Tuple, Any
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from datetime import datetime, timedelta
 from django.conf import settings
+from django.db import close_old_connections
+
+from chat import fast_json, tracing
+from chat.metrics import (
+    PIPELINE_LATE_RESULTS, PIPELINED_GENERATIONS, SPECULATIVE_SEARCHES, record_cache_lookup, timed_stage
+)
 
 from .serpapi_service import SerpAPIService
+from .local_index import get_local_index
 from .multi_search import MultiSearchService
 from .vllm_service import VLLMService
 from .openrouter_optimized import OpenRouterOptimizedService
+from .prompts import build_search_query_messages, build_final_response_messages
+from .cancellation import CancellationToken, ChatCancelled
+from .deadline import Deadline
+from .load_policy import current_load_level
+from .model_router import get_model_router
+from .rewrite_batcher import REWRITE_MAX_TOKENS, get_rewrite_batcher
 from django.core.cache import cache
 
 logger = logging.getLogger(__name__)
 
+# Mots sans valeur de recherche (FR / EN, sans accents) ignorés dans la comparaison des requêtes
+_QUERY_STOP_WORDS = {
+    'de', 'du', 'le', 'la', 'en', 'et', 'ou', 'un', 'au', 'les', 'des', 'une', 'est', 'sont',
+    'quels', 'quelles', 'quel', 'quelle', 'que', 'qui', 'pour', 'avec', 'dans', 'sur', 'par',
+    'cette', 'ces', 'ont', 'ete', 'moi', 'of', 'in', 'on', 'to', 'is', 'an', 'the', 'and', 'for',
+    'with', 'what', 'are', 'about', 'from', 'this', 'that', 'find', 'how',
+}
+# Termes de fraîcheur ajoutés à toute requête d'actualité (_extract_query_from_text) :
+# communs aux deux requêtes comparées, ils gonfleraient la similarité
+_QUERY_FRESHNESS_WORDS = {
+    '2024', '2025', 'new', 'latest', 'recent', 'recently', 'today', 'announced', 'week',
+    'dernier', 'derniere', 'recemment', 'nouveaute', 'semaine', 'annonce',
+}
+# Entreprises ajoutées par _extract_query_from_text à toute requête sur l'IA
+AI_COMPANIES = ['OpenAI', 'Anthropic', 'Google', 'Meta', 'Microsoft']
+
+
+def query_keywords(query: str, ignore: Set[str] = frozenset()) -> Set[str]:
+    """Mots-clés normalisés d'une requête : minuscules, sans accents ni pluriel en -s"""
+    text = unicodedata.normalize('NFKD', (query or '').lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    keywords = set()
+    for word in re.findall(r'\w+', text):
+        if len(word) < 2 or word in _QUERY_STOP_WORDS:
+            continue
+        word = word[:-1] if word.endswith('s') and len(word) > 3 else word
+        word = 'ai' if word == 'ia' else word
+        if word not in _QUERY_FRESHNESS_WORDS and word not in ignore:
+            keywords.add(word)
+    return keywords
+
+
+def keyword_coverage(query: str, reference: str, ignore: Set[str] = frozenset()) -> float:
+    """Part des mots-clés de ``reference`` présents dans ``query``"""
+    expected = query_keywords(reference, ignore)
+    if not expected:
+        return 0.0
+    return len(query_keywords(query, ignore) & expected) / len(expected)
+
+
+_search_executor: Optional[ThreadPoolExecutor] = None
+_search_executor_lock = threading.Lock()
+
+
+def _get_search_executor() -> ThreadPoolExecutor:
+    global _search_executor
+    if _search_executor is None:
+        with _search_executor_lock:
+            if _search_executor is None:
+                _search_executor = ThreadPoolExecutor(
+                    max_workers=settings.SEARCH_BACKGROUND_WORKERS, thread_name_prefix='background-search'
+                )
+    return _search_executor
+
+
+class SpeculativeSearch:
+    """Recherche heuristique lancée en parallèle de la réécriture LLM"""
+
+    def __init__(
+        self,
+        query: str,
+        search_type: str,
+        future: Future,
+        cancel_token: CancellationToken,
+        unregister,
+        ignore: Set[str] = frozenset(),
+        deadline: Optional[Deadline] = None
+    ):
+        self.query = query
+        self.search_type = search_type
+        # Termes ajoutés par l'heuristique et absents de la question : hors comparaison
+        self.ignore = ignore
+        self.future = future
+        self.cancel_token = cancel_token
+        # Dégradations locales : reportées sur le tour seulement si les résultats sont gardés
+        self.deadline = deadline or Deadline()
+        self._unregister = unregister
+
+    def similarity(self, search_query: str, search_type: str) -> float:
+        """Part des mots-clés de la requête réécrite couverte par la requête heuristique ;
+        0 si la stratégie SerpAPI diffère"""
+        if search_type != self.search_type:
+            return 0.0
+        return keyword_coverage(self.query, search_query, self.ignore)
+
+    def discard(self):
+        """Interrompt les sous-requêtes restantes (les crédits déjà consommés sont perdus)"""
+        if not self.future.done():
+            self.cancel_token.cancel('speculation_discarded')
+        self.release()
+
+    def release(self):
+        if self._unregister:
+            self._unregister()
+            self._unregister = None
+
+
+class PipelinedSearch:
+    """
+    Recherche en cours dont les résultats arrivent sous-requête par sous-requête :
+    la génération finale démarre sur les premiers résultats fiables
+    """
+
+    def __init__(self, top_k: int, min_score: float, budget_ms: int):
+        self.top_k = top_k
+        self.min_score = min_score
+        self.budget_ms = budget_ms
+        self.trigger: Optional[str] = None
+        self.waited_ms = 0
+        self._partial: Dict[str, Dict] = {}
+        self._final: Optional[List[Dict]] = None
+        self._error: Optional[BaseException] = None
+        self._initial_urls: Set[str] = set()
+        self._condition = threading.Condition()
+
+    def add(self, results: List[Dict]):
+        """Lot de résultats d'une sous-requête (appelé depuis le thread de recherche)"""
+        with self._condition:
+            for result in results:
+                self._partial.setdefault(result.get('url') or result.get('title', ''), result)
+            self._condition.notify_all()
+
+    def finish(self, results: Optional[List[Dict]]):
+        """Résultat complet (filtré par date) de la recherche"""
+        with self._condition:
+            self._final = list(results or [])
+            self._condition.notify_all()
+
+    def fail(self, error: BaseException):
+        with self._condition:
+            self._error = error
+            self._final = []
+            self._condition.notify_all()
+
+    @property
+    def finished(self) -> bool:
+        return self._final is not None
+
+    def _confident(self) -> int:
+        return sum(1 for r in self._partial.values() if r.get('relevance_score', 0) >= self.min_score)
+
+    def _snapshot(self) -> List[Dict]:
+        # Copies : le filtrage par date ajuste les scores sur place
+        if self._final is not None:
+            return [dict(r) for r in self._final]
+        ordered = sorted(self._partial.values(), key=lambda r: r.get('relevance_score', 0), reverse=True)
+        return [dict(r) for r in ordered]
+
+    def wait_initial(self, max_wait: Optional[float] = None) -> List[Dict]:
+        """
+        Attend le top-k fiable, la fin de la recherche ou l'échéance du budget,
+        puis renvoie les résultats disponibles (``max_wait`` : échéance du tour)
+        """
+        start = time.monotonic()
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.finished or self._confident() >= self.top_k,
+                timeout=self.budget_ms / 1000
+            )
+            if not self.finished and not self._partial:
+                # Budget écoulé sans aucun résultat : une réponse sans source ne vaut rien
+                remaining = None if max_wait is None else max(0.0, max_wait - (time.monotonic() - start))
+                self._condition.wait_for(lambda: self.finished or bool(self._partial), timeout=remaining)
+            if self._error is not None:
+                raise self._error
+            
+            if self.finished:
+                self.trigger = 'complete'
+            elif self._confident() >= self.top_k:
+                self.trigger = 'top_k'
+            else:
+                self.trigger = 'deadline'
+            results = self._snapshot()
+        
+        self.waited_ms = int((time.monotonic() - start) * 1000)
+        return results
+
+    def mark_used(self, results: List[Dict]):
+        """Résultats passés au LLM : ne seront pas comptés comme tardifs"""
+        self._initial_urls = {r.get('url') for r in results}
+
+    def late_results(self) -> List[Dict]:
+        """Résultats arrivés après le démarrage de la génération (sans attendre la fin)"""
+        with self._condition:
+            return [r for r in self._snapshot() if r.get('url') not in self._initial_urls]
+
 
 class IntelligentSearchService:
     """Service de recherche intelligent qui utilise le LLM pour optimiser les requêtes"""
@@ -28,6 +233,9 @@ class IntelligentSearchService:
         # Services LLM
         self.vllm_service = VLLMService()
         self.openrouter_service = OpenRouterOptimizedService()
+        self.model_router = get_model_router()
+        # Routage de la dernière synthèse (renvoyé dans le résultat)
+        self.last_routing = None
         
         # Configuration OpenRouter pour les cas où on en a encore besoin
         self.api_key = settings.OPENROUTER_API_KEY
@@ -44,138 +252,429 @@ class IntelligentSearchService:
         self,
         user_query: str,
         time_constraint: Optional[str] = None,
-        current_date: Optional[datetime] = None
+        current_date: Optional[datetime] = None,
+        on_progress: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        search_budget_ms: Optional[int] = None,
+        deadline: Optional[Deadline] = None
     ) -> Dict[str, Any]:
         """
         Traite la requête utilisateur en 2 étapes :
         1. Génère une requête de recherche optimisée
         2. Effectue la recherche et génère la réponse
+        
+        ``on_progress(stage, data)`` est appelé à chaque étape ("rewriting",
+        "searching", "sources_ready", "generating") et ``on_token`` reçoit la
+        réponse finale au fil de la génération. ``cancel_token`` est vérifié
+        entre les étapes.
+        
+        ``search_budget_ms`` active la génération en pipeline pour cette requête
+        (sinon ``PIPELINED_SEARCH_BUDGET_MS`` si ``PIPELINED_GENERATION_ENABLED``) :
+        la réponse démarre dès le top-k fiable ou à l'échéance du budget, les
+        résultats tardifs deviennent des sources supplémentaires (``late_sources``).
+        
+        ``deadline`` borne le tour : la réécriture et la recherche laissent
+        ``DEADLINE_LLM_RESERVE_SECONDS`` à la génération, une étape sans temps
+        restant est sautée ou tronquée (``degraded_stages`` du résultat).
         """
+        def progress(stage: str, **data):
+            if on_progress:
+                on_progress(stage, data)
         
+        deadline = deadline or Deadline()
+        # Temps gardé pour la génération finale, puis pour la recherche pendant la réécriture
+        search_deadline = deadline.reserve(settings.DEADLINE_LLM_RESERVE_SECONDS)
+        rewrite_deadline = search_deadline.reserve(settings.DEADLINE_SEARCH_RESERVE_SECONDS)
+        speculation = None
         try:
             # Étape 1: Générer la requête de recherche optimale
-            search_query_data = self._generate_search_query(
-                user_query, 
-                time_constraint, 
-                current_date
+            progress('rewriting')
+            speculation = self._start_speculative_search(
+                user_query, time_constraint, current_date, cancel_token, search_deadline
             )
+            with timed_stage('rewrite'):
+                search_query_data = self._generate_search_query(
+                    user_query, 
+                    time_constraint, 
+                    current_date,
+                    deadline=rewrite_deadline
+                )
             
             if not search_query_data.get('search_query'):
                 logger.warning("❌ Pas de requête de recherche générée")
                 return {
                     'response': "Je n'ai pas pu comprendre votre demande. Pouvez-vous reformuler?",
                     'sources': [],
-                    'search_query': None
+                    'search_query': None,
+                    'degraded_stages': deadline.degraded_stages
                 }
             
             search_query = search_query_data['search_query']
             search_type = search_query_data.get('search_type', 'news')
             
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
             
-            # Étape 2: Effectuer la recherche
-            search_results = self._perform_smart_search(
-                search_query, 
-                search_type,
-                time_constraint,
-                current_date
-            )
-            
-            # Étape 3: Générer la réponse finale avec le contexte
-            final_response = self._generate_final_response(
-                user_query,
-                search_results,
-                search_query,
-                current_date,
-                time_constraint
-            )
+            # Étape 2: Effectuer la recherche (ou reprendre la recherche spéculative)
+            progress('searching', search_query=search_query, search_type=search_type)
+            search_results = self._take_speculative_results(speculation, search_query, search_type, search_deadline)
+            pipeline = None
+            if search_results is None:
+                budget_ms = self._search_budget_ms(search_budget_ms)
+                if budget_ms is None:
+                    search_results = self._perform_smart_search(
+                        search_query, 
+                        search_type,
+                        time_constraint,
+                        current_date,
+                        cancel_token=cancel_token,
+                        deadline=search_deadline
+                    )
+                else:
+                    # Le budget du pipeline ne dépasse pas l'échéance de la recherche
+                    budget_ms = int(min(budget_ms, search_deadline.remaining() * 1000))
+                    pipeline = self._start_pipelined_search(
+                        search_query, search_type, time_constraint, current_date, cancel_token, budget_ms,
+                        search_deadline
+                    )
+                    search_results = self._wait_pipelined_results(
+                        pipeline, time_constraint, current_date, search_deadline
+                    )
             
             # Préparer les sources
-            sources = []
-            if search_results:
-                sources = [
-                    {
-                        'title': r.get('title', ''),
-                        'url': r.get('url', ''),
-                        'date': r.get('date', ''),
-                        'relevance_score': r.get('relevance_score', 0.5)
-                    }
-                    for r in search_results[:5]  # Top 5 sources
-                ]
+            sources = self._build_sources(search_results)
+            progress('sources_ready', sources=sources)
             
-            return {
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            
+            # Étape 3: Générer la réponse finale avec le contexte
+            progress('generating')
+            with timed_stage('llm'):
+                final_response = self._generate_final_response(
+                    user_query,
+                    search_results,
+                    search_query,
+                    current_date,
+                    time_constraint,
+                    on_token=on_token,
+                    cancel_token=cancel_token,
+                    deadline=deadline
+                )
+            
+            result = {
                 'response': final_response,
                 'sources': sources,
                 'search_query': search_query,
                 'search_type': search_type
             }
+            if self.last_routing:
+                result['routing'] = self.last_routing.as_dict()
+            if pipeline:
+                late_sources = self._late_sources(pipeline)
+                if late_sources:
+                    progress('late_sources', sources=late_sources)
+                result['sources'] = sources + late_sources
+                result['late_sources'] = late_sources
+                result['pipeline'] = {
+                    'trigger': pipeline.trigger,
+                    'budget_ms': pipeline.budget_ms,
+                    'waited_ms': pipeline.waited_ms,
+                    'late_results': settings.PIPELINED_LATE_RESULTS,
+                }
+            result['degraded_stages'] = deadline.degraded_stages
+            return result
             
+        except ChatCancelled:
+            raise
         except Exception as e:
-            logger.error(f"Erreur recherche intelligente: {str(e)}", exc_info=True)
+            logger.error("Erreur recherche intelligente: %s", e, exc_info=True)
             return {
                 'response': "Une erreur s'est produite lors du traitement de votre demande.",
                 'sources': [],
-                'error': str(e)
+                'error': str(e),
+                'degraded_stages': deadline.degraded_stages
             }
+        finally:
+            if speculation:
+                speculation.discard()
+    
+    def _start_speculative_search(
+        self,
+        user_query: str,
+        time_constraint: Optional[str],
+        current_date: Optional[datetime],
+        cancel_token: Optional[CancellationToken],
+        deadline: Optional[Deadline] = None
+    ) -> Optional[SpeculativeSearch]:
+        """
+        Lance la recherche sur la requête heuristique pendant la réécriture LLM
+        (inutile si la réécriture est déjà en cache)
+        """
+        if not settings.SPECULATIVE_SEARCH_ENABLED:
+            return None
+        if cache.get(self._rewrite_cache_key(user_query, current_date)):
+            return None
+        
+        query = self._extract_query_from_text(user_query)
+        search_type = self.serpapi_service.analyze_query_intent(user_query)['type']
+        token = CancellationToken()
+        # Annulation du tour : la spéculation s'arrête aussi
+        unregister = cancel_token.on_cancel(lambda: token.cancel(cancel_token.reason)) if cancel_token else None
+        speculation_deadline = (deadline or Deadline()).reserve(0, report=False)
+        
+        def run():
+            try:
+                return self._perform_smart_search(
+                    query, search_type, time_constraint, current_date,
+                    cancel_token=token, deadline=speculation_deadline
+                )
+            finally:
+                close_old_connections()
+        
+        # Contexte copié : span parent, request-id et durées d'étapes du tour
+        context = contextvars.copy_context()
+        future = _get_search_executor().submit(context.run, run)
+        logger.info("🔮 Recherche spéculative lancée: %.60s (%s)", query, search_type)
+        ignore = {company.lower() for company in AI_COMPANIES} - query_keywords(user_query)
+        return SpeculativeSearch(query, search_type, future, token, unregister, ignore, speculation_deadline)
+    
+    def _take_speculative_results(
+        self,
+        speculation: Optional[SpeculativeSearch],
+        search_query: str,
+        search_type: str,
+        deadline: Optional[Deadline] = None
+    ) -> Optional[List[Dict]]:
+        """
+        Résultats spéculatifs si la requête réécrite est assez proche, sinon None
+        """
+        if speculation is None:
+            return None
+        similarity = speculation.similarity(search_query, search_type)
+        span = tracing.current_span()
+        span.set_attribute('search.speculation_similarity', round(similarity, 3))
+        
+        if similarity < settings.SPECULATIVE_SEARCH_MIN_COVERAGE:
+            outcome, results = 'discarded', None
+            speculation.discard()
+        else:
+            try:
+                # Borné par l'échéance du tour, comme un appel direct
+                results = speculation.future.result(timeout=(deadline or Deadline()).timeout(30.0))
+                outcome = 'kept' if results else 'empty'
+            except TimeoutError:
+                logger.warning("⏱️ Recherche spéculative trop lente, abandonnée")
+                speculation.discard()
+                outcome, results = 'timeout', None
+            except ChatCancelled:
+                speculation.release()
+                raise
+            except Exception as e:
+                logger.error("Erreur recherche spéculative: %s", e)
+                outcome, results = 'failed', None
+            speculation.release()
+            if results and deadline:
+                # Résultats gardés : leurs étapes tronquées comptent pour le tour
+                for stage in speculation.deadline.degraded_stages:
+                    deadline.degrade(stage)
+        
+        SPECULATIVE_SEARCHES.inc(outcome=outcome)
+        span.set_attribute('search.speculation', outcome)
+        logger.info(
+            "🔮 Spéculation %s (couverture %.2f): '%.50s' vs '%.50s'",
+            outcome, similarity, speculation.query, search_query
+        )
+        return results or None
+    
+    def _search_budget_ms(self, requested: Optional[int]) -> Optional[int]:
+        """Budget de recherche du mode pipeline, None pour attendre toute la recherche"""
+        if requested is not None:
+            return requested
+        if settings.PIPELINED_GENERATION_ENABLED:
+            return settings.PIPELINED_SEARCH_BUDGET_MS
+        return None
+    
+    def _start_pipelined_search(
+        self,
+        search_query: str,
+        search_type: str,
+        time_constraint: Optional[str],
+        current_date: Optional[datetime],
+        cancel_token: Optional[CancellationToken],
+        budget_ms: int,
+        deadline: Optional[Deadline] = None
+    ) -> PipelinedSearch:
+        """
+        Lance la recherche en arrière-plan ; ses sous-requêtes remontent leurs
+        résultats au fil de l'eau (cache et index local alimentés à la fin)
+        """
+        pipeline = PipelinedSearch(settings.PIPELINED_TOP_K, settings.PIPELINED_MIN_SCORE, budget_ms)
+        
+        def run():
+            try:
+                pipeline.finish(self._perform_smart_search(
+                    search_query,
+                    search_type,
+                    time_constraint,
+                    current_date,
+                    cancel_token=cancel_token,
+                    on_partial=pipeline.add,
+                    deadline=deadline
+                ))
+            except BaseException as e:
+                pipeline.fail(e)
+            finally:
+                close_old_connections()
+        
+        context = contextvars.copy_context()
+        _get_search_executor().submit(context.run, run)
+        return pipeline
+    
+    def _wait_pipelined_results(
+        self,
+        pipeline: PipelinedSearch,
+        time_constraint: Optional[str],
+        current_date: Optional[datetime],
+        deadline: Optional[Deadline] = None
+    ) -> List[Dict]:
+        """Résultats disponibles au déclenchement de la génération"""
+        deadline = deadline or Deadline()
+        with timed_stage('search_wait') as wait_span:
+            results = pipeline.wait_initial(deadline.timeout())
+            if not results and not pipeline.finished:
+                deadline.degrade('search')
+            wait_span.set_attributes({
+                'pipeline.trigger': pipeline.trigger,
+                'pipeline.budget_ms': pipeline.budget_ms,
+                'pipeline.results': len(results),
+            })
+        
+        # Résultats partiels : le filtre par date n'a pas encore été appliqué
+        if not pipeline.finished:
+            results = self._apply_time_constraint(results, time_constraint, current_date)
+        pipeline.mark_used(results[:10])  # _format_search_context garde 10 résultats
+        
+        PIPELINED_GENERATIONS.inc(trigger=pipeline.trigger)
+        logger.info(
+            "⏩ Génération en pipeline (%s) après %d ms : %d résultats",
+            pipeline.trigger, pipeline.waited_ms, len(results)
+        )
+        return results
+    
+    def _late_sources(self, pipeline: PipelinedSearch) -> List[Dict]:
+        """Résultats arrivés pendant la génération, en sources supplémentaires ou ignorés"""
+        late = pipeline.late_results()
+        if not late:
+            return []
+        if settings.PIPELINED_LATE_RESULTS != 'attach':
+            PIPELINE_LATE_RESULTS.inc(len(late), policy='dropped')
+            return []
+        PIPELINE_LATE_RESULTS.inc(len(late), policy='attached')
+        return [dict(source, late=True) for source in self._build_sources(late)]
+    
+    def _build_sources(self, search_results: List[Dict]) -> List[Dict]:
+        """Top 5 sources affichées dans le panneau latéral"""
+        if not search_results:
+            return []
+        return [
+            {
+                'title': r.get('title', ''),
+                'url': r.get('url', ''),
+                'date': r.get('date', ''),
+                'relevance_score': r.get('relevance_score', 0.5)
+            }
+            for r in search_results[:5]
+        ]
+    
+    def _rewrite_cache_key(self, user_query: str, current_date: Optional[datetime]) -> str:
+        """Clé du cache de réécriture : question normalisée + jour (la date entre dans le prompt)"""
+        normalized = ' '.join(user_query.lower().split())
+        day = (current_date or datetime.now()).strftime('%Y-%m-%d')
+        digest = hashlib.md5(f"{normalized}|{day}".encode('utf-8')).hexdigest()
+        return f"search_rewrite:{digest}"
     
     def _generate_search_query(
         self,
         user_query: str,
         time_constraint: Optional[str],
-        current_date: Optional[datetime]
+        current_date: Optional[datetime],
+        deadline: Optional[Deadline] = None
+    ) -> Dict[str, str]:
+        """
+        Génère la requête de recherche, en réutilisant une réécriture LLM récente
+        (heuristique si l'échéance ne laisse pas le temps d'appeler le LLM)
+        """
+        deadline = deadline or Deadline()
+        cache_key = self._rewrite_cache_key(user_query, current_date)
+        cached = cache.get(cache_key)
+        if not cached and settings.SEARCH_PREFETCH_ENABLED:
+            # Réécriture publiée par le préchargeur (éventuellement depuis un autre worker)
+            from .prefetch import lookup_prefetched_rewrite
+            cached = lookup_prefetched_rewrite(cache_key)
+            if cached:
+                cache.set(cache_key, cached, timeout=settings.SEARCH_REWRITE_CACHE_TTL)
+        record_cache_lookup('rewrite', bool(cached))
+        span = tracing.current_span()
+        span.set_attribute('cache.hit', bool(cached))
+        if cached:
+            logger.info("📦 Requête de recherche réécrite depuis le cache")
+            span.set_attributes({'search.query': cached.get('search_query'), 'search.type': cached.get('search_type')})
+            return cached
+        
+        if current_load_level().skip_rewrite:
+            logger.info("📉 Réécriture LLM sautée (mode dégradé), requête heuristique")
+            search_data = None
+        elif deadline.allows(settings.DEADLINE_MIN_CALL_SECONDS):
+            search_data = self._rewrite_search_query(user_query, time_constraint, current_date, deadline)
+        else:
+            deadline.degrade('rewrite')
+            search_data = None
+        if not search_data:
+            search_data = {
+                'search_query': self._extract_query_from_text(user_query),
+                'search_type': 'general'
+            }
+        
+        # Ne mettre en cache que les réécritures produites par le LLM (pas les fallbacks)
+        if search_data.get('rewritten_by') and search_data.get('search_query'):
+            cache.set(cache_key, search_data, timeout=settings.SEARCH_REWRITE_CACHE_TTL)
+        
+        span.set_attributes({
+            'search.query': search_data.get('search_query'),
+            'search.type': search_data.get('search_type'),
+            'search.rewritten_by': search_data.get('rewritten_by', 'fallback'),
+        })
+        
+        return search_data
+    
+    def _rewrite_search_query(
+        self,
+        user_query: str,
+        time_constraint: Optional[str],
+        current_date: Optional[datetime],
+        deadline: Optional[Deadline] = None
     ) -> Dict[str, str]:
         """
         Utilise le LLM pour générer une requête de recherche optimale
         """
-        # Informations temporelles
-        date_info = ""
-        if current_date:
-            date_info = f"\nDate actuelle: {current_date.strftime('%d/%m/%Y')} (Semaine {current_date.isocalendar()[1]})"
-            if time_constraint:
-                date_info += f"\nContrainte temporelle: {time_constraint}"
-        
-        # Prompt pour générer la requête
-        system_prompt = f"""Tu es un expert en recherche web. Ta tâche est d'analyser la question de l'utilisateur et de générer LA MEILLEURE requête de recherche possible pour obtenir des informations pertinentes et actuelles.
-{date_info}
-
-INSTRUCTIONS:
-1. Analyse la question pour identifier les concepts clés
-2. Détermine s'il s'agit d'une recherche d'actualités, technique, ou générale
-3. Génère une requête de recherche OPTIMISÉE qui maximisera la pertinence des résultats
-4. Pour les actualités, ajoute des mots-clés temporels pertinents (2025, latest, announced, etc.)
-5. Pour les sujets techniques, ajoute des termes spécifiques
-6. Utilise des opérateurs de recherche si nécessaire (OR, "guillemets", etc.)
-
-IMPORTANT: 
-- La requête doit être EN ANGLAIS pour de meilleurs résultats
-- Elle doit être concise mais précise
-- Pour l'IA générative, privilégie les noms d'entreprises et de modèles spécifiques
-- Pour les actualités récentes, ajoute TOUJOURS des termes temporels (today, this week, latest, announced)
-- Inclus des noms de sociétés clés: OpenAI, Anthropic, Google, Meta, Microsoft
-
-Réponds UNIQUEMENT avec un JSON structuré. Assure-toi que ta réponse est un JSON valide et rien d'autre:
-{{
-  "search_query": "la requête de recherche optimisée en anglais",
-  "search_type": "news|technical|general",
-  "keywords": ["mot1", "mot2", "mot3"],
-  "reasoning": "explication courte de ta stratégie"
-}}
-
-IMPORTANT: Ta réponse doit être SEULEMENT le JSON, sans texte avant ou après."""
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Question de l'utilisateur: {user_query}"}
-        ]
+        deadline = deadline or Deadline()
+        # Préfixe statique en system, date et question en fin de message user
+        messages = build_search_query_messages(user_query, time_constraint, current_date)
         
         try:
-            # Utiliser le modèle sélectionné dans le cache
-            selected_model = cache.get('selected_llm_model', 'openrouter')
-            logger.info(f"🔎 Génération requête recherche avec: {selected_model}")
+            # Modèle choisi ou routé (réécriture : tâche courte), fournisseur rapide en mode dégradé
+            routing = self.model_router.route(user_query)
+            selected_model = current_load_level().route(routing.provider)
+            logger.info("🔎 Génération requête recherche avec: %s (%s)", selected_model, routing.reason)
             
             if selected_model == 'vllm' and self.vllm_service.is_available():
-                # Utiliser vLLM
-                prompt = f"{system_prompt}\n\nUser: {messages[1]['content']}"
-                response = self.vllm_service.generate_response(prompt=prompt)
+                # Utiliser vLLM avec de vrais rôles system/user
+                if settings.REWRITE_BATCHING_ENABLED:
+                    response = self._batched_rewrite('vllm', user_query, time_constraint, current_date, deadline)
+                else:
+                    response = self.vllm_service.generate_response(messages=messages, deadline=deadline)
                 if response['success']:
                     response_text = response['response']
                     try:
@@ -185,7 +684,8 @@ IMPORTANT: Ta réponse doit être SEULEMENT le JSON, sans texte avant ou après.
                             start = response_text.find('{')
                             end = response_text.rfind('}') + 1
                             json_str = response_text[start:end]
-                            search_data = json.loads(json_str)
+                            search_data = fast_json.loads(json_str)
+                            search_data['rewritten_by'] = 'vllm'
                             return search_data
                     except json.JSONDecodeError:
                         logger.warning("❌ JSON invalide de vLLM, fallback")
@@ -198,21 +698,19 @@ IMPORTANT: Ta réponse doit être SEULEMENT le JSON, sans texte avant ou après.
             
             # Si OpenRouter ou si vLLM a échoué
             if selected_model == 'openrouter':
-                response = httpx.post(
-                    f"{self.base_url}/chat/completions",
-                    headers=self.headers,
-                    json={
-                        "model": self.model,
-                        "messages": messages,
-                        "temperature": 0.3,
-                        "max_tokens": 200
-                    },
-                    timeout=15.0
-                )
+                if settings.REWRITE_BATCHING_ENABLED:
+                    completion = self._batched_rewrite('openrouter', user_query, time_constraint, current_date, deadline)
+                else:
+                    completion = self.openrouter_service.chat_completion(
+                        messages,
+                        temperature=0.3,
+                        max_tokens=REWRITE_MAX_TOKENS,
+                        timeout=15.0,
+                        deadline=deadline
+                    )
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    content = result['choices'][0]['message']['content']
+                if completion['status_code'] == 200:
+                    content = completion['content']
                     
                     # Parser le JSON
                     try:
@@ -223,34 +721,50 @@ IMPORTANT: Ta réponse doit être SEULEMENT le JSON, sans texte avant ou après.
                             start = content.find('{') 
                             end = content.rfind('}') + 1
                             json_str = content[start:end]
-                            search_data = json.loads(json_str)
+                            search_data = fast_json.loads(json_str)
+                            search_data['rewritten_by'] = 'openrouter'
                             return search_data
                         else:
                             raise json.JSONDecodeError("No JSON found", content, 0)
                     except json.JSONDecodeError as e:
                         # Fallback: extraire la requête du texte
-                        logger.warning(f"❌ Erreur parsing JSON: {e}")
-                        logger.warning(f"❌ Contenu reçu: {content[:200]}...")
+                        logger.warning("❌ Erreur parsing JSON: %s", e)
+                        logger.warning("❌ Contenu reçu: %s...", content[:200])
                         return {
                             'search_query': self._extract_query_from_text(user_query),
                             'search_type': 'general'
                         }
-                elif response.status_code == 429:
+                elif completion['status_code'] == 429:
                     logger.warning("⚠️ Limite OpenRouter atteinte (429) - Utilisation requête basique")
                     return {
                         'search_query': self._extract_query_from_text(user_query),
                         'search_type': 'general'
                     }
                 else:
-                    logger.error(f"Erreur API: {response.status_code}")
+                    logger.error("Erreur API: %s", completion['status_code'])
                     # Utiliser la requête originale en cas d'erreur
                     return {'search_query': user_query, 'search_type': 'general'}
                 
         except Exception as e:
-            logger.error(f"Erreur génération requête: {e}")
+            logger.error("Erreur génération requête: %s", e)
+            if deadline.expired:
+                deadline.degrade('rewrite')
             # Fallback: utiliser la requête originale
             return {'search_query': user_query, 'search_type': 'general'}
     
+    def _batched_rewrite(
+        self,
+        provider: str,
+        user_query: str,
+        time_constraint: Optional[str],
+        current_date: Optional[datetime],
+        deadline: Deadline
+    ) -> Dict:
+        """Réécriture via le micro-batcher (résultat au format de l'appel direct)"""
+        future = get_rewrite_batcher().submit(provider, user_query, time_constraint, current_date, deadline)
+        # Fenêtre de regroupement + appel : borné par l'échéance comme un appel direct
+        return future.result(timeout=deadline.timeout(30.0))
+    
     def _extract_query_from_text(self, text: str) -> str:
         """Extrait une requête de recherche optimisée du texte"""
         text_lower = text.lower()
@@ -288,7 +802,7 @@ IMPORTANT: Ta réponse doit être SEULEMENT le JSON, sans texte avant ou après.
         
         # Ajouter des noms d'entreprises pour l'IA
         if 'generative' in query or 'ai' in query:
-            filtered.extend(['OpenAI', 'Anthropic', 'Google', 'Meta', 'Microsoft'])
+            filtered.extend(AI_COMPANIES)
         
         # Construire la requête finale
         final_query = ' '.join(filtered)
@@ -300,46 +814,141 @@ IMPORTANT: Ta réponse doit être SEULEMENT le JSON, sans texte avant ou après.
         search_query: str,
         search_type: str,
         time_constraint: Optional[str],
-        current_date: Optional[datetime]
+        current_date: Optional[datetime],
+        cancel_token: Optional[CancellationToken] = None,
+        on_partial: Optional[Callable[[List[Dict]], None]] = None,
+        deadline: Optional[Deadline] = None
     ) -> List[Dict]:
         """
         Effectue la recherche avec la requête optimisée
+        
+        ``on_partial`` reçoit les résultats SerpAPI sous-requête par sous-requête
+        (génération en pipeline)
         """
         
         try:
-            # Utiliser SerpAPI en priorité SANS cache pour les nouvelles recherches
-            results = self.serpapi_service.search(
-                query=search_query,
-                search_type=search_type,
-                use_cache=False  # Forcer une nouvelle recherche
-            )
-            
-            # Si pas de résultats, essayer MultiSearch
-            if not results:
-                logger.warning("⚠️ Pas de résultats SerpAPI, essai MultiSearch")
-                results = self.multi_search.search(search_query)
-            
-            # Filtrer par date si nécessaire
-            # MAIS garder les résultats sans date si on n'a rien de mieux
-            if time_constraint and results:
-                filtered_results = self._filter_by_date(
-                    results,
-                    time_constraint,
-                    current_date
-                )
-                # Si le filtrage supprime tout, garder les résultats originaux
-                if not filtered_results and results:
-                    logger.warning("⚠️ Aucun résultat avec date récente, utilisation des résultats sans date")
-                    results = results[:5]  # Garder les 5 premiers
+            # Utiliser SerpAPI en priorité, cache accepté seulement s'il est frais
+            # (entrées réchauffées par le préchargeur de tendances)
+            with timed_stage('search') as search_span:
+                # Documents déjà payés d'abord : SerpAPI seulement si la couverture manque
+                results = self._search_local_index(search_query, time_constraint, current_date)
+                if results:
+                    search_span.set_attribute('search.source', 'local_index')
                 else:
-                    results = filtered_results
+                    results = self.serpapi_service.search(
+                        query=search_query,
+                        search_type=search_type,
+                        max_cache_age_hours=settings.SEARCH_CACHE_FRESHNESS_MINUTES / 60,
+                        cancel_token=cancel_token,
+                        on_partial=on_partial,
+                        deadline=deadline
+                    )
+                    
+                    # Si pas de résultats, essayer MultiSearch
+                    if not results:
+                        logger.warning("⚠️ Pas de résultats SerpAPI, essai MultiSearch")
+                        results = self.multi_search.search(search_query, deadline)
+                        search_span.set_attribute('search.fallback', 'multi_search')
+                    self._index_results(results)
+                search_span.set_attribute('search.results', len(results or []))
             
-            return results
+            return self._apply_time_constraint(results, time_constraint, current_date)
             
+        except ChatCancelled:
+            raise
         except Exception as e:
-            logger.error(f"Erreur recherche: {e}")
+            logger.error("Erreur recherche: %s", e)
             return []
     
+    def _apply_time_constraint(
+        self,
+        results: List[Dict],
+        time_constraint: Optional[str],
+        current_date: Optional[datetime]
+    ) -> List[Dict]:
+        """
+        Filtre par date si nécessaire, MAIS garde les résultats sans date si on n'a rien de mieux
+        """
+        if not (time_constraint and results):
+            return results
+        
+        with timed_stage('date_filter') as filter_span:
+            filtered_results = self._filter_by_date(
+                results,
+                time_constraint,
+                current_date
+            )
+            filter_span.set_attributes({
+                'filter.time_constraint': time_constraint,
+                'filter.kept': len(filtered_results),
+                'filter.input': len(results),
+            })
+        # Si le filtrage supprime tout, garder les résultats originaux
+        if not filtered_results:
+            logger.warning("⚠️ Aucun résultat avec date récente, utilisation des résultats sans date")
+            return results[:5]  # Garder les 5 premiers
+        return filtered_results
+    
+    def _search_local_index(
+        self,
+        search_query: str,
+        time_constraint: Optional[str],
+        current_date: Optional[datetime]
+    ) -> Optional[List[Dict]]:
+        """
+        Résultats de l'index local s'ils couvrent la requête, sinon None
+        """
+        if not settings.LOCAL_INDEX_ENABLED:
+            return None
+        try:
+            index = get_local_index()
+            index.maybe_sync(settings.LOCAL_INDEX_SYNC_INTERVAL)
+            hits = index.search(
+                search_query,
+                k=settings.MAX_SEARCH_RESULTS * 2,
+                min_score=settings.LOCAL_INDEX_MIN_SCORE,
+                max_age_hours=settings.LOCAL_INDEX_MAX_AGE_HOURS
+            )
+            hits = self._keyword_matches(search_query, hits)
+            # La période demandée s'applique avant de juger la couverture
+            if time_constraint and hits:
+                hits = self._filter_by_date(hits, time_constraint, current_date)
+        except Exception as e:
+            logger.error("Erreur index local: %s", e)
+            return None
+        
+        covered = len(hits) >= settings.LOCAL_INDEX_MIN_RESULTS
+        record_cache_lookup('local_index', covered)
+        if covered:
+            logger.info("📚 %d documents locaux pour: %.50s (SerpAPI évité)", len(hits), search_query)
+            return hits
+        return None
+    
+    @staticmethod
+    def _keyword_matches(search_query: str, hits: List[Dict]) -> List[Dict]:
+        """
+        Garde les documents qui contiennent assez de mots-clés de la requête :
+        la similarité d'embedding seule rapproche des actualités sans rapport
+        (même vocabulaire « IA, modèle, annonce »)
+        """
+        keywords = query_keywords(search_query)
+        if not keywords:
+            return hits
+        return [
+            hit for hit in hits
+            if len(keywords & query_keywords(f"{hit.get('title', '')} {hit.get('content', '')}")) / len(keywords)
+            >= settings.LOCAL_INDEX_MIN_KEYWORD_OVERLAP
+        ]
+    
+    def _index_results(self, results: Optional[List[Dict]]):
+        """Ajoute les résultats d'une recherche live à l'index local"""
+        if not (settings.LOCAL_INDEX_ENABLED and results):
+            return
+        try:
+            get_local_index().add_documents(results)
+        except Exception as e:
+            logger.error("Erreur indexation locale: %s", e)
+    
     def _filter_by_date(
         self,
         results: List[Dict],
@@ -393,92 +1002,107 @@ IMPORTANT: Ta réponse doit être SEULEMENT le JSON, sans texte avant ou après.
         search_results: List[Dict],
         search_query: str,
         current_date: Optional[datetime],
-        time_constraint: Optional[str]
+        time_constraint: Optional[str],
+        on_token: Optional[Callable[[str], None]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        deadline: Optional[Deadline] = None
     ) -> str:
         """
         Génère la réponse finale en utilisant les résultats de recherche
+        (liste des sources si l'échéance ne laisse plus le temps au LLM)
         """
         if not search_results:
             return f"Je n'ai pas trouvé d'informations récentes pour votre recherche \"{search_query}\". Essayez de reformuler votre question ou de préciser ce que vous cherchez."
         
+        deadline = deadline or Deadline()
+        if not deadline.allows(settings.DEADLINE_MIN_CALL_SECONDS):
+            deadline.degrade('llm')
+            return self._sources_digest(search_results, search_query, on_token)
+        
         # Formater le contexte
         context = self._format_search_context(search_results)
         
-        # Informations temporelles
-        date_info = ""
-        if current_date:
-            date_info = f"""
-📅 DATE ACTUELLE: {current_date.strftime('%d/%m/%Y')}
-📅 SEMAINE: {current_date.isocalendar()[1]} de {current_date.year}
-⏰ PÉRIODE DEMANDÉE: {time_constraint or 'Non spécifiée'}
-🔍 REQUÊTE DE RECHERCHE UTILISÉE: "{search_query}"
-"""
-        
-        # Prompt pour la réponse finale
-        system_prompt = f"""Tu es un assistant IA expert qui répond aux questions en utilisant EXCLUSIVEMENT les informations des résultats de recherche fournis.
-{date_info}
-
-🔴 RÈGLES ABSOLUES:
-1. Tu DOIS baser ta réponse UNIQUEMENT sur le contexte ci-dessous
-2. Tu DOIS citer chaque information avec [Source: Titre de l'article]
-3. Si une information n'est pas dans le contexte, dis "Cette information n'est pas disponible dans les sources trouvées"
-4. Structure ta réponse de manière claire et organisée
-5. Termine TOUJOURS par une section "📚 Sources consultées:" avec les titres et URLs
-
-📰 RÉSULTATS DE RECHERCHE (UTILISE UNIQUEMENT CES INFORMATIONS):
-{context}
-
-⚠️ NE PAS inventer ou utiliser des connaissances non présentes dans le contexte ci-dessus."""
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_query}
-        ]
+        # Instructions statiques d'abord, parties volatiles (date, contexte, question) à la fin
+        messages = build_final_response_messages(
+            user_query,
+            context,
+            search_query,
+            time_constraint,
+            current_date
+        )
         
         try:
-            # Utiliser le modèle sélectionné dans le cache
-            selected_model = cache.get('selected_llm_model', 'openrouter')
-            logger.info(f"🔍 Génération réponse recherche avec: {selected_model}")
+            # Modèle choisi ou routé (synthèse à long contexte), fournisseur rapide en mode dégradé
+            load_level = current_load_level()
+            self.last_routing = self.model_router.route(user_query, requires_search=True, context=context)
+            selected_model = load_level.route(self.last_routing.provider)
+            logger.info("🔍 Génération réponse recherche avec: %s (%s)", selected_model, self.last_routing.reason)
             
             if selected_model == 'vllm' and self.vllm_service.is_available():
-                # Utiliser vLLM
-                prompt = f"{system_prompt}\n\nQuestion: {user_query}"
-                response = self.vllm_service.generate_response(prompt=prompt)
+                # Utiliser vLLM avec de vrais rôles system/user
+                response = self.vllm_service.generate_response(
+                    messages=messages,
+                    on_token=on_token,
+                    cancel_token=cancel_token,
+                    deadline=deadline
+                )
                 if response['success']:
                     return response['response']
                 else:
-                    logger.error(f"Erreur vLLM: {response['error']}")
+                    logger.error("Erreur vLLM: %s", response['error'])
                     # Fallback vers OpenRouter
                     selected_model = 'openrouter'
             
             # Si OpenRouter ou si vLLM a échoué
             if selected_model == 'openrouter':
-                response = httpx.post(
-                    f"{self.base_url}/chat/completions",
-                    headers=self.headers,
-                    json={
-                        "model": self.model,
-                        "messages": messages,
-                        "temperature": 0.3,
-                        "max_tokens": 2000
-                    },
-                    timeout=30.0
+                completion = self.openrouter_service.chat_completion(
+                    messages,
+                    temperature=0.3,
+                    max_tokens=load_level.max_tokens(2000),
+                    timeout=30.0,
+                    on_token=on_token,
+                    cancel_token=cancel_token,
+                    deadline=deadline
                 )
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    return result['choices'][0]['message']['content']
-                elif response.status_code == 429:
+                if completion['status_code'] == 200:
+                    return completion['content']
+                elif completion['status_code'] == 429:
                     logger.error("⚠️ Limite de taux OpenRouter atteinte (429)")
                     return "⚠️ Limite de requêtes OpenRouter atteinte. Veuillez patienter quelques minutes ou utiliser vLLM local."
                 else:
-                    logger.error(f"Erreur génération réponse: {response.status_code}")
-                    return f"Erreur OpenRouter ({response.status_code}). Essayez vLLM local ou réessayez plus tard."
+                    logger.error("Erreur génération réponse: %s", completion['status_code'])
+                    return f"Erreur OpenRouter ({completion['status_code']}). Essayez vLLM local ou réessayez plus tard."
                 
+        except ChatCancelled:
+            raise
         except Exception as e:
-            logger.error(f"Erreur réponse finale: {e}")
+            logger.error("Erreur réponse finale: %s", e)
+            if deadline.expired:
+                deadline.degrade('llm')
+                return self._sources_digest(search_results, search_query, on_token)
             return "Une erreur s'est produite lors de la génération de la réponse."
     
+    def _sources_digest(
+        self,
+        search_results: List[Dict],
+        search_query: str,
+        on_token: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """Réponse dégradée : les sources trouvées, sans synthèse du LLM"""
+        lines = [
+            f"⏳ Le temps de réponse est écoulé avant la rédaction de la synthèse. "
+            f"Voici les sources trouvées pour \"{search_query}\" :",
+            ""
+        ]
+        for result in search_results[:5]:
+            date = f" ({result['date']})" if result.get('date') else ''
+            lines.append(f"- [{result.get('title', 'Sans titre')}]({result.get('url', '#')}){date}")
+        digest = "\n".join(lines)
+        if on_token:
+            on_token(digest)
+        return digest
+    
     def _format_search_context(self, search_results: List[Dict]) -> str:
         """Formate les résultats pour le contexte"""
         formatted = []
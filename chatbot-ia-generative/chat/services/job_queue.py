@@ -0,0 +1,212 @@
+"""
+File de travaux bornée pour les générations longues (vLLM sur CPU)
+
+``POST /chat/`` en mode asynchrone renvoie immédiatement un identifiant de
+travail ; la génération tourne dans un pool de threads borné. L'état est
+persisté dans ``ChatJob`` (le polling peut arriver sur n'importe quel
+worker, les résultats survivent à un redémarrage ; purge après
+``result_ttl``) et chaque transition est diffusée sur la couche Channels
+(groupe ``chat_job_<id>``).
+
+Admission : ``max_pending`` borne les travaux en attente de tout le service
+(comptés dans ``ChatJob``), pas ceux d'un seul worker ; deux admissions
+simultanées peuvent dépasser la borne d'un travail. Le pool de threads, lui,
+est propre à chaque worker.
+
+Un travail appartient au processus qui l'exécute (``ChatJob.worker``). Au
+démarrage de la file, les travaux ``queued``/``running`` d'un processus
+disparu de la même machine (ou d'une incarnation précédente de ce processus)
+passent en ``failed`` : sans cela, leurs clients attendraient indéfiniment.
+"""
+import contextvars
+import logging
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Callable, Dict, Optional
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from chat.models import ChatJob
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """Levée quand la file a atteint sa profondeur maximale (contrôle d'admission)."""
+
+
+def job_group_name(job_id: str) -> str:
+    return f"chat_job_{job_id}"
+
+
+class ChatJobQueue:
+    """Pool de workers borné avec contrôle d'admission et métriques de profondeur"""
+
+    def __init__(self, max_workers: int, max_pending: int, result_ttl: int = 3600):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat-job')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._counters = {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0}
+        # Machine, pid et jeton propre à cette file (un pid peut être réutilisé après redémarrage)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def submit(self, func: Callable[..., Dict], *args, conversation_id: Optional[str] = None, **kwargs) -> Dict:
+        """Admet un travail dans la file ou lève JobQueueFull"""
+        self._purge_expired()
+        pending = ChatJob.objects.filter(status='queued').count()  # Tous workers confondus
+        with self._lock:
+            if pending >= self.max_pending:
+                self._counters['rejected'] += 1
+                raise JobQueueFull(f"File pleine ({pending} travaux en attente)")
+            self._pending += 1
+            self._counters['submitted'] += 1
+            position = self._pending
+
+        try:
+            job = ChatJob.objects.create(
+                conversation_id=conversation_id, queue_position=position, worker=self.worker_id
+            )
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        queued = job.to_dict()  # avant que le worker ne modifie l'instance
+        # Copier le contexte pour conserver le request-id dans les logs du worker
+        context = contextvars.copy_context()
+        self._executor.submit(context.run, self._run, job, func, args, kwargs)
+        logger.info("📥 Travail %s admis (position %s)", job.id, position)
+        return queued
+
+    def _run(self, job: ChatJob, func: Callable[..., Dict], args: tuple, kwargs: Dict):
+        with self._lock:
+            self._pending -= 1
+            self._running += 1
+
+        job.status, job.queue_position, job.started_at = 'running', 0, timezone.now()
+        self._store(job, 'status', 'queue_position', 'started_at')
+
+        try:
+            job.result = func(*args, **kwargs)
+            job.status = 'completed'
+        except Exception as e:
+            logger.error("Erreur travail %s: %s", job.id, e)
+            job.status, job.error = 'failed', str(e)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+        with self._lock:
+            self._counters[job.status] += 1
+        job.finished_at = timezone.now()
+        self._store(job, 'status', 'result', 'error', 'finished_at')
+        close_old_connections()
+
+    def _store(self, job: ChatJob, *fields: str):
+        """Enregistre la transition puis la diffuse"""
+        try:
+            job.save(update_fields=fields)
+        except Exception as e:
+            logger.error("Enregistrement du travail %s impossible: %s", job.id, e)
+        self._notify(job.to_dict())
+
+    def fail_stale_jobs(self) -> int:
+        """Passe en ``failed`` les travaux inachevés des processus disparus de cette machine"""
+        host = socket.gethostname()
+        stale = []
+        unfinished = ChatJob.objects.filter(status__in=['queued', 'running']).values_list('id', 'worker')
+        for job_id, worker in unfinished:
+            worker_host, _, rest = worker.partition(':')
+            pid = rest.partition(':')[0]
+            if not worker:
+                stale.append(job_id)  # Antérieur au suivi des workers
+            elif worker_host == host and worker != self.worker_id and pid.isdigit() \
+                    and (int(pid) == os.getpid() or not _process_alive(int(pid))):
+                stale.append(job_id)
+        if not stale:
+            return 0
+        ChatJob.objects.filter(id__in=stale, status__in=['queued', 'running']).update(
+            status='failed', error='Travail interrompu par le redémarrage du serveur', finished_at=timezone.now()
+        )
+        for job in ChatJob.objects.filter(id__in=stale):
+            self._notify(job.to_dict())
+        logger.warning("⚠️ %s travaux interrompus par un redémarrage passés en échec", len(stale))
+        return len(stale)
+
+    def _purge_expired(self):
+        ChatJob.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=self.result_ttl)).delete()
+
+    def _notify(self, job: Dict):
+        """Diffuse l'état du travail aux WebSockets abonnés (best effort)"""
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        try:
+            async_to_sync(channel_layer.group_send)(
+                job_group_name(job['job_id']),
+                {'type': 'job.update', 'job': job}
+            )
+        except Exception as e:
+            logger.warning("Diffusion Channels impossible pour %s: %s", job['job_id'], e)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """État du travail (quel que soit le worker qui l'exécute), None si inconnu ou expiré"""
+        cutoff = timezone.now() - timedelta(seconds=self.result_ttl)
+        try:
+            job = ChatJob.objects.filter(pk=job_id, created_at__gte=cutoff).first()
+        except ValidationError:
+            return None
+        return job.to_dict() if job else None
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'queue_depth': self._pending,
+                'running': self._running,
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                **self._counters,
+            }
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Processus d'un autre utilisateur
+    return True
+
+
+_job_queue: Optional[ChatJobQueue] = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> ChatJobQueue:
+    """File unique du processus, dimensionnée par les settings"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = ChatJobQueue(
+                max_workers=settings.CHAT_JOB_WORKERS,
+                max_pending=settings.CHAT_JOB_MAX_PENDING,
+                result_ttl=settings.CHAT_JOB_RESULT_TTL
+            )
+            try:
+                _job_queue.fail_stale_jobs()
+            except Exception as e:
+                logger.error("Reprise des travaux interrompus impossible: %s", e)
+        return _job_queue
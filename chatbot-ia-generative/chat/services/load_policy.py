@@ -0,0 +1,243 @@
+"""
+Mode dégradé sous charge
+
+La politique lit les métriques du processus (profondeur de la file de
+travaux, latence récente de vLLM) et en déduit une pression ; au-delà des
+seuils ``LOAD_POLICY_THRESHOLDS``, le niveau de dégradation monte d'un cran
+par évaluation :
+
+1. ``no_rewrite``    : pas de réécriture LLM de la requête (heuristique)
+2. ``lean_search``   : moins de résultats (``LOAD_REDUCED_SEARCH_RESULTS``),
+   pas de sous-requête web complémentaire dans la stratégie actualités
+3. ``short_answers`` : ``max_tokens`` réduit (``LOAD_MAX_TOKENS_FACTOR``)
+4. ``fast_provider`` : génération routée vers le fournisseur le plus rapide
+
+Les niveaux sont cumulatifs. La redescente est progressive elle aussi, avec
+hystérésis (``LOAD_POLICY_RECOVERY_RATIO``) et délai minimal par niveau
+(``LOAD_POLICY_COOLDOWN``). Un niveau peut être forcé depuis l'endpoint
+d'administration : il est stocké dans Redis pour s'appliquer à tous les
+workers (Redis injoignable : repli sur le cache Django, donc sur le seul
+worker qui a reçu la commande le temps de la panne).
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from chat.metrics import LOAD_LEVEL, LOAD_TRANSITIONS, PROVIDER_LATENCY, RecentAverage
+
+from .job_queue import get_job_queue
+from .shared_state import SharedStateUnavailable, get_shared_redis
+
+logger = logging.getLogger(__name__)
+
+LEVEL_NAMES = ('normal', 'no_rewrite', 'lean_search', 'short_answers', 'fast_provider')
+MAX_LEVEL = len(LEVEL_NAMES) - 1
+OVERRIDE_CACHE_KEY = 'load_policy_override'
+LLM_PROVIDERS = ('vllm', 'openrouter')
+
+
+class LoadLevel:
+    """Réglages effectifs d'un niveau de dégradation"""
+
+    def __init__(self, level: int, fast_provider: str = 'openrouter', manual: bool = False):
+        self.level = level
+        self.name = LEVEL_NAMES[level]
+        self.manual = manual
+        self.skip_rewrite = level >= 1
+        self.skip_web_fallback = level >= 2
+        self.short_answers = level >= 3
+        self.fast_provider = fast_provider if level >= 4 else None
+
+    def search_results(self, default: int) -> int:
+        if self.level >= 2:
+            return min(default, settings.LOAD_REDUCED_SEARCH_RESULTS)
+        return default
+
+    def max_tokens(self, default: int) -> int:
+        if self.short_answers:
+            return max(64, int(default * settings.LOAD_MAX_TOKENS_FACTOR))
+        return default
+
+    def route(self, selected_model: str) -> str:
+        """Fournisseur LLM effectif pour le modèle choisi"""
+        return self.fast_provider or selected_model
+
+    def as_dict(self) -> Dict:
+        return {
+            'level': self.level,
+            'name': self.name,
+            'manual': self.manual,
+            'skip_rewrite': self.skip_rewrite,
+            'skip_web_fallback': self.skip_web_fallback,
+            'search_results': self.search_results(settings.MAX_SEARCH_RESULTS),
+            'max_tokens_factor': settings.LOAD_MAX_TOKENS_FACTOR if self.short_answers else 1.0,
+            'fast_provider': self.fast_provider,
+        }
+
+
+class LoadPolicy:
+    """Niveau de dégradation piloté par les métriques, avec hystérésis"""
+
+    def __init__(
+        self,
+        thresholds=(1.0, 1.5, 2.0, 3.0),
+        recovery_ratio: float = 0.7,
+        cooldown: float = 30.0,
+        interval: float = 5.0,
+        signals: Optional[Callable[[], Dict[str, float]]] = None
+    ):
+        self.thresholds = tuple(sorted(thresholds))[:MAX_LEVEL]
+        self.recovery_ratio = recovery_ratio
+        self.cooldown = cooldown
+        self.interval = interval
+        self.level = 0
+        self.pressure = 0.0
+        self.signals: Dict[str, float] = {}
+        self._read_signals = signals or self._live_signals
+        self._changed_at = time.monotonic()
+        self._evaluated_at: Optional[float] = None
+        self._latency = {provider: RecentAverage(PROVIDER_LATENCY, provider=provider) for provider in LLM_PROVIDERS}
+        self._lock = threading.Lock()
+
+    # -- Signaux -------------------------------------------------------------
+
+    def _live_signals(self) -> Dict[str, float]:
+        queue = get_job_queue().metrics()
+        signals = {'queue_ratio': queue['queue_depth'] / max(1, queue['max_pending'])}
+        for provider in LLM_PROVIDERS:
+            # Latence moyenne des appels depuis la dernière évaluation, lissée
+            latency = self._latency[provider].update()
+            if latency is not None:
+                signals[f'{provider}_latency'] = latency
+        return signals
+
+    def _pressure(self, signals: Dict[str, float]) -> float:
+        """1.0 = charge nominale : file à LOAD_QUEUE_TARGET_RATIO ou vLLM à LOAD_VLLM_LATENCY_TARGET"""
+        return max(
+            signals.get('queue_ratio', 0.0) / settings.LOAD_QUEUE_TARGET_RATIO,
+            signals.get('vllm_latency', 0.0) / settings.LOAD_VLLM_LATENCY_TARGET,
+        )
+
+    def _fast_provider(self) -> str:
+        """OpenRouter par défaut ; vLLM seulement s'il est mesuré plus rapide"""
+        vllm, openrouter = self._latency['vllm'].value, self._latency['openrouter'].value
+        if vllm is not None and openrouter is not None and vllm < openrouter:
+            return 'vllm'
+        return 'openrouter'
+
+    # -- Évaluation ----------------------------------------------------------
+
+    def evaluate(self, now: Optional[float] = None, force: bool = False) -> int:
+        """Relit les signaux (au plus une fois par ``interval``) et ajuste le niveau d'un cran"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not force and self._evaluated_at is not None and now - self._evaluated_at < self.interval:
+                return self.level
+            self._evaluated_at = now
+            self.signals = self._read_signals()
+            self.pressure = self._pressure(self.signals)
+            target = sum(1 for threshold in self.thresholds if self.pressure >= threshold)
+
+            if target > self.level:
+                self._transition(self.level + 1, 'up', now)
+            elif (
+                target < self.level
+                and self.pressure < self.thresholds[self.level - 1] * self.recovery_ratio
+                and now - self._changed_at >= self.cooldown
+            ):
+                self._transition(self.level - 1, 'down', now)
+            return self.level
+
+    def _transition(self, level: int, direction: str, now: float):
+        previous, self.level, self._changed_at = self.level, level, now
+        LOAD_TRANSITIONS.inc(direction=direction)
+        LOAD_LEVEL.set(level)
+        details = ', '.join(f"{name}={value:.2f}" for name, value in sorted(self.signals.items()))
+        log = logger.warning if direction == 'up' else logger.info
+        log(
+            "%s Mode dégradé : %s → %s (pression %.2f : %s)",
+            '📉' if direction == 'up' else '📈',
+            LEVEL_NAMES[previous], LEVEL_NAMES[level], self.pressure, details or 'aucun signal'
+        )
+
+    def current(self) -> LoadLevel:
+        """Niveau effectif : forcé par l'administration, sinon automatique (si activé)"""
+        override = self._override()
+        if override is not None:
+            return LoadLevel(override, self._fast_provider(), manual=True)
+        if settings.LOAD_POLICY_ENABLED:
+            self.evaluate()
+        return LoadLevel(self.level, self._fast_provider())
+
+    def set_override(self, level: Optional[int]):
+        """Force un niveau (None : retour au mode automatique)"""
+        previous = self._override()
+        self._store_override(level)
+        if level is not None:
+            LOAD_LEVEL.set(level)
+        LOAD_TRANSITIONS.inc(direction='manual')
+        logger.warning(
+            "🛠️ Mode dégradé forcé : %s → %s",
+            'auto' if previous is None else LEVEL_NAMES[previous],
+            'auto' if level is None else LEVEL_NAMES[level]
+        )
+
+    def _override(self) -> Optional[int]:
+        try:
+            level = get_shared_redis().run(lambda r: r.get(OVERRIDE_CACHE_KEY))
+        except SharedStateUnavailable:
+            return cache.get(OVERRIDE_CACHE_KEY)
+        return None if level is None else int(level)
+
+    def _store_override(self, level: Optional[int]):
+        try:
+            if level is None:
+                get_shared_redis().run(lambda r: r.delete(OVERRIDE_CACHE_KEY))
+            else:
+                get_shared_redis().run(lambda r: r.set(OVERRIDE_CACHE_KEY, level))
+        except SharedStateUnavailable:
+            if level is None:
+                cache.delete(OVERRIDE_CACHE_KEY)
+            else:
+                cache.set(OVERRIDE_CACHE_KEY, level, timeout=None)
+
+    def status(self) -> Dict:
+        effective = self.current()
+        return {
+            'enabled': settings.LOAD_POLICY_ENABLED,
+            'mode': 'manual' if effective.manual else 'auto',
+            'automatic_level': self.level,
+            'pressure': round(self.pressure, 3),
+            'signals': {name: round(value, 3) for name, value in self.signals.items()},
+            'thresholds': list(self.thresholds),
+            'effective': effective.as_dict(),
+            'levels': list(LEVEL_NAMES),
+        }
+
+
+_load_policy: Optional[LoadPolicy] = None
+_load_policy_lock = threading.Lock()
+
+
+def get_load_policy() -> LoadPolicy:
+    """Politique unique du processus, réglée par les settings"""
+    global _load_policy
+    if _load_policy is None:
+        with _load_policy_lock:
+            if _load_policy is None:
+                _load_policy = LoadPolicy(
+                    thresholds=settings.LOAD_POLICY_THRESHOLDS,
+                    recovery_ratio=settings.LOAD_POLICY_RECOVERY_RATIO,
+                    cooldown=settings.LOAD_POLICY_COOLDOWN,
+                    interval=settings.LOAD_POLICY_INTERVAL,
+                )
+    return _load_policy
+
+
+def current_load_level() -> LoadLevel:
+    """Réglages du niveau de dégradation courant"""
+    return get_load_policy().current()
@@ -0,0 +1,502 @@
+"""
+Index local des résultats de recherche déjà payés (RAG local)
+
+Chaque ligne ``SearchCache.results`` et ``Message.search_results`` contient
+des titres et extraits obtenus au prix d'un crédit SerpAPI. Cet index les
+rend interrogeables par similarité d'embedding (voir
+``chat.services.embeddings``) : ``_perform_smart_search`` le consulte avant
+SerpAPI et répond avec les documents locaux s'ils couvrent la requête
+(assez de documents assez proches) et sont assez récents.
+
+Stockage sur disque dans ``LOCAL_INDEX_DIR``, en ajout seul :
+- ``vectors.f32`` : enregistrements (identifiant uint64, vecteur float32),
+  mappés en mémoire (``numpy.memmap``) si NumPy est disponible, sinon lus
+  en pur Python ;
+- ``docs.jsonl``  : métadonnées des documents, avec le même identifiant ;
+- ``state.json``  : format, encodeur, dimension et curseurs de synchronisation.
+
+Les fichiers sont partagés par tous les workers Daphne/Gunicorn : chaque
+ajout, relecture, synchronisation ou compactage se fait sous un verrou
+``fcntl`` (``index.lock``), et chaque processus relit à la volée ce que les
+autres ont ajouté. Vecteurs et documents sont joints par identifiant, pas
+par position : un vecteur sans document (écriture interrompue) est ignoré.
+Sans ``fcntl`` (Windows), un seul processus doit écrire dans l'index.
+
+Un document est identifié par son URL : une nouvelle version ajoute un
+enregistrement et masque l'ancienne ; les fichiers sont compactés (réécrits
+puis remplacés) quand les versions masquées dominent. L'index est alimenté
+directement après chaque recherche live et rattrapé depuis la base
+(``sync``, en arrière-plan) au premier usage puis périodiquement ; les
+entrées SearchCache rafraîchies sur place sont retrouvées par ``updated_at``.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .embeddings import get_embedder
+
+try:
+    import numpy as np
+except ImportError:  # NumPy est optionnel
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Windows : pas de verrou entre processus
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Identifiant d'un enregistrement de vectors.f32 (ordre natif, comme les float32)
+ID_FORMAT = '=Q'
+ID_SIZE = struct.calcsize(ID_FORMAT)
+
+
+def _parse_datetime(value) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.fromisoformat(str(value))
+        except ValueError:
+            return None
+    # Les dates SerpAPI sont naïves (heure locale) : tout comparer en naïf local
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+class LocalSearchIndex:
+    """Index vectoriel sur disque des résultats de recherche, par URL"""
+
+    VECTORS_FILE = 'vectors.f32'
+    DOCS_FILE = 'docs.jsonl'
+    STATE_FILE = 'state.json'
+    LOCK_FILE = 'index.lock'
+
+    # Enregistrements identifiés (format 1 : vecteurs indexés par position)
+    FORMAT = 2
+
+    # Compactage quand plus de la moitié des enregistrements sont masqués
+    COMPACT_MIN_ROWS = 1000
+
+    # Relecture d'une marge avant les curseurs : lignes validées après une ligne plus récente
+    SYNC_OVERLAP = timedelta(seconds=30)
+
+    def __init__(self, directory: str, embedder=None):
+        self.directory = str(directory)
+        self.embedder = embedder or get_embedder()
+        self.dim = self.embedder.dim
+        self._record_size = ID_SIZE + 4 * self.dim
+        self._record_dtype = np.dtype([('id', np.uint64), ('vector', np.float32, (self.dim,))]) \
+            if np is not None else None
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = open(self._path(self.LOCK_FILE), 'a') if fcntl is not None else None
+        self._sync_thread: Optional[threading.Thread] = None
+        self._load()
+
+    # -- Persistance ---------------------------------------------------------
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _file_lock(self):
+        """Verrou du processus et verrou ``fcntl`` partagé par les workers (réentrant)"""
+        with self._lock:
+            if self._lock_depth == 0 and self._lock_file is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _empty_state(self) -> Dict:
+        return {
+            'format': self.FORMAT,
+            'embedder': self.embedder.name,
+            'dim': self.dim,
+            'search_cache_updated_at': None,
+            'message_created_at': None,
+            'last_sync': 0,
+        }
+
+    def _read_state(self) -> Optional[Dict]:
+        """État sur disque, ou None s'il manque ou ne correspond pas à l'encodeur"""
+        try:
+            with open(self._path(self.STATE_FILE), encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if (state.get('format'), state.get('dim'), state.get('embedder')) != (self.FORMAT, self.dim, self.embedder.name):
+            return None
+        return state
+
+    def _load(self):
+        with self._file_lock():
+            state = self._read_state()
+            if state is None:
+                # Encodeur ou format changé : les vecteurs existants ne sont plus utilisables
+                self._state = self._empty_state()
+                self._rewrite([], b'')
+            else:
+                self._state = state
+                self._clear()
+                self._read_new()
+        logger.info("📚 Index local chargé: %s documents", len(self))
+
+    def _clear(self):
+        """Oublie l'état en mémoire (avant relecture complète des fichiers)"""
+        self._docs: Dict[int, Dict] = {}  # version courante de chaque URL, par identifiant
+        self._url_ids: Dict[str, int] = {}
+        self._ids = array('Q')  # sans NumPy : identifiant et vecteur de chaque enregistrement
+        self._rows = array('f')
+        self._matrix = None
+        self._docs_offset = 0
+        self._vectors_offset = 0
+        self._files = None
+
+    def _stat(self):
+        """(inode, taille) des deux fichiers : détecte ajouts et remplacements"""
+        stats = []
+        for name in (self.DOCS_FILE, self.VECTORS_FILE):
+            try:
+                st = os.stat(self._path(name))
+                stats.append((st.st_ino, st.st_size))
+            except FileNotFoundError:
+                stats.append((0, 0))
+        return tuple(stats)
+
+    def _read_new(self):
+        """Lit ce qui a été ajouté depuis la dernière lecture (sous le verrou de fichiers)
+
+        Sous le verrou, une ligne ou un enregistrement incomplet en fin de
+        fichier ne peut venir que d'une écriture interrompue : il est tronqué.
+        """
+        path = self._path(self.DOCS_FILE)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size > self._docs_offset:
+            with open(path, 'rb') as f:
+                f.seek(self._docs_offset)
+                data = f.read(size - self._docs_offset)
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                logger.warning("⚠️ Index local : ligne de document incomplète tronquée")
+                os.truncate(path, self._docs_offset + end)
+            for line in data[:end].splitlines():
+                try:
+                    self._add_doc(json.loads(line))
+                except (json.JSONDecodeError, KeyError):
+                    logger.warning("⚠️ Index local : ligne de document illisible ignorée")
+            self._docs_offset += end
+
+        path = self._path(self.VECTORS_FILE)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        torn = (size - self._vectors_offset) % self._record_size
+        if torn:
+            logger.warning("⚠️ Index local : enregistrement de vecteur incomplet tronqué")
+            size -= torn
+            os.truncate(path, size)
+        if size > self._vectors_offset:
+            if np is None:
+                with open(path, 'rb') as f:
+                    f.seek(self._vectors_offset)
+                    data = f.read(size - self._vectors_offset)
+                for offset in range(0, len(data), self._record_size):
+                    self._ids.append(struct.unpack_from(ID_FORMAT, data, offset)[0])
+                    self._rows.frombytes(data[offset + ID_SIZE:offset + self._record_size])
+            self._vectors_offset = size
+        self._files = self._stat()
+
+    def _add_doc(self, doc: Dict):
+        previous = self._url_ids.get(doc['url'])
+        if previous is not None:
+            self._docs.pop(previous, None)  # ancienne version masquée
+        self._docs[doc['id']] = doc
+        self._url_ids[doc['url']] = doc['id']
+
+    def _refresh(self):
+        """Prend en compte les écritures des autres workers (ajouts ou compactage)"""
+        if self._stat() == self._files:
+            return
+        with self._file_lock():
+            (docs_inode, docs_size), (vectors_inode, vectors_size) = self._stat()
+            replaced = self._files is None or (docs_inode, vectors_inode) != (self._files[0][0], self._files[1][0])
+            if replaced or docs_size < self._docs_offset or vectors_size < self._vectors_offset:
+                self._clear()
+            self._read_new()
+
+    def _replace(self, name: str, data: bytes):
+        """Écrit un fichier complet (temporaire puis ``os.replace``, atomique pour les lecteurs)"""
+        tmp_path = self._path(f"{name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(name))
+
+    def _rewrite(self, docs: List[Dict], records: bytes):
+        """Réécrit les fichiers (remise à zéro, compactage) puis les relit"""
+        self._replace(self.VECTORS_FILE, records)
+        self._replace(self.DOCS_FILE, ''.join(json.dumps(doc, ensure_ascii=False) + '\n' for doc in docs).encode('utf-8'))
+        self._save_state()
+        self._clear()
+        self._read_new()
+
+    def _save_state(self):
+        self._replace(self.STATE_FILE, json.dumps(self._state).encode('utf-8'))
+
+    def _row_count(self) -> int:
+        return self._vectors_offset // self._record_size
+
+    def _vectors(self):
+        """Enregistrements (id, vecteur) mappés en mémoire, rouverts quand l'index grandit"""
+        n = self._row_count()
+        if self._matrix is None or self._matrix.shape[0] != n:
+            self._matrix = np.memmap(self._path(self.VECTORS_FILE), dtype=self._record_dtype, mode='r', shape=(n,))
+        return self._matrix
+
+    def _pack(self, doc_id: int, vector) -> bytes:
+        return struct.pack(ID_FORMAT, doc_id) + array('f', (float(v) for v in vector)).tobytes()
+
+    # -- Alimentation --------------------------------------------------------
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._url_ids)
+
+    def _current(self, url: str) -> Optional[Dict]:
+        doc_id = self._url_ids.get(url)
+        return self._docs.get(doc_id) if doc_id is not None else None
+
+    def add_documents(self, results: Iterable[Dict]) -> int:
+        """Indexe des résultats au format SerpAPIService ; retourne le nombre d'enregistrements ajoutés"""
+        now = datetime.now()
+        pending: Dict[str, Dict] = {}
+        with self._lock:
+            self._refresh()
+            for result in results or []:
+                url = result.get('url') or result.get('link')
+                if not url:
+                    continue
+                doc = {
+                    'url': url,
+                    'title': result.get('title', ''),
+                    'content': result.get('content') or result.get('snippet') or '',
+                    'source': result.get('source', ''),
+                    'date': result.get('date', ''),
+                    'date_parsed': result.get('date_parsed'),
+                    'indexed_at': now.isoformat(),
+                }
+                current = pending.get(url) or self._current(url)
+                if current and not self._is_update(current, doc, now):
+                    continue
+                pending[url] = doc
+        if not pending:
+            return 0
+
+        # Encodage hors du verrou de fichiers : les autres workers ne l'attendent pas
+        vectors = {url: self.embedder.embed(f"{doc['title']}\n{doc['content']}") for url, doc in pending.items()}
+
+        with self._file_lock():
+            self._refresh()  # Un autre worker a pu indexer les mêmes URL entre-temps
+            records, lines = [], []
+            for url, doc in pending.items():
+                current = self._current(url)
+                if current and not self._is_update(current, doc, now):
+                    continue
+                doc['id'] = uuid.uuid4().int >> 64
+                records.append(self._pack(doc['id'], vectors[url]))
+                lines.append(json.dumps(doc, ensure_ascii=False) + '\n')
+            if not records:
+                return 0
+            # Vecteurs d'abord : une interruption laisse au pire des vecteurs sans document, ignorés
+            with open(self._path(self.VECTORS_FILE), 'ab') as f:
+                f.write(b''.join(records))
+            with open(self._path(self.DOCS_FILE), 'a', encoding='utf-8') as f:
+                f.write(''.join(lines))
+            self._read_new()
+        return len(records)
+
+    @staticmethod
+    def _is_update(current: Dict, doc: Dict, now: datetime) -> bool:
+        """Nouvelle version si le résultat a changé (sans perdre d'extrait) ou a été revu plus tard"""
+        if not doc['content'] and current.get('content'):
+            return False
+        if (doc['title'], doc['content']) != (current.get('title'), current.get('content')):
+            return True  # Extrait enrichi ou résultat rafraîchi par une nouvelle recherche
+        indexed_at = _parse_datetime(current.get('indexed_at'))
+        # Revu dans une nouvelle recherche : rafraîchit sa date d'indexation (au plus 1 fois/h)
+        return indexed_at is None or now - indexed_at > timedelta(hours=1)
+
+    def sync(self) -> int:
+        """Rattrape les lignes SearchCache (créées ou rafraîchies) et Message écrites depuis la dernière synchronisation
+
+        Lectures en base et encodage se font hors du verrou de fichiers :
+        ``add_documents`` ne le prend que pour ajouter, la fin de la
+        synchronisation pour avancer les curseurs et compacter.
+        """
+        from chat.models import Message, SearchCache
+
+        with self._file_lock():
+            # Curseurs avancés par les autres workers
+            self._state = self._read_state() or self._state
+            search_cache_since = self._state.get('search_cache_updated_at')
+            message_since = self._state.get('message_created_at')
+
+        added = 0
+        entries = SearchCache.objects.order_by('updated_at')
+        if search_cache_since:
+            entries = entries.filter(updated_at__gte=datetime.fromisoformat(search_cache_since) - self.SYNC_OVERLAP)
+        for entry in entries.iterator():
+            if isinstance(entry.results, list):
+                added += self.add_documents(entry.results)
+            search_cache_since = entry.updated_at.isoformat()
+
+        messages = Message.objects.filter(role='assistant', search_results__isnull=False).order_by('created_at')
+        if message_since:
+            messages = messages.filter(created_at__gte=datetime.fromisoformat(message_since) - self.SYNC_OVERLAP)
+        for message in messages.iterator():
+            if isinstance(message.search_results, list):
+                added += self.add_documents(message.search_results)
+            message_since = message.created_at.isoformat()
+
+        with self._file_lock():
+            state = self._read_state() or self._state
+            for key, value in (('search_cache_updated_at', search_cache_since), ('message_created_at', message_since)):
+                state[key] = max(filter(None, (state.get(key), value)), key=datetime.fromisoformat, default=None)
+            state['last_sync'] = time.time()
+            self._state = state
+            self._save_state()
+            self._maybe_compact()
+        if added:
+            logger.info("📚 Index local synchronisé: %s documents ajoutés (%s au total)", added, len(self))
+        return added
+
+    def maybe_sync(self, interval: float):
+        """Lance en arrière-plan une synchronisation si la dernière (de n'importe quel worker)
+        date de plus de ``interval`` secondes : la requête qui la déclenche ne l'attend pas"""
+        if time.time() - self._state['last_sync'] < interval:
+            return
+        with self._lock:
+            if self._sync_thread is not None and self._sync_thread.is_alive():
+                return
+            with self._file_lock():
+                self._state = self._read_state() or self._state
+                if time.time() - self._state['last_sync'] < interval:
+                    return
+                # Réservée : les autres workers ne lancent pas la même synchronisation
+                self._state['last_sync'] = time.time()
+                self._save_state()
+            self._sync_thread = threading.Thread(target=self._background_sync, name='local-index-sync', daemon=True)
+            self._sync_thread.start()
+
+    def _background_sync(self):
+        try:
+            self.sync()
+        except Exception as e:
+            logger.error("Erreur synchronisation de l'index local: %s", e)
+        finally:
+            close_old_connections()
+
+    def _maybe_compact(self):
+        self._refresh()  # Sous le verrou de fichiers : état complet avant réécriture
+        total, live = self._row_count(), len(self._docs)
+        if total < self.COMPACT_MIN_ROWS or live * 2 > total:
+            return
+        # Versions courantes seulement : masquées et vecteurs sans document disparaissent
+        if np is not None:
+            matrix = self._vectors()
+            live_ids = np.fromiter(self._docs.keys(), dtype=np.uint64, count=live)
+            records = matrix[np.isin(matrix['id'], live_ids)].tobytes()
+        else:
+            dim = self.dim
+            records = b''.join(
+                self._pack(doc_id, self._rows[row * dim:(row + 1) * dim])
+                for row, doc_id in enumerate(self._ids) if doc_id in self._docs
+            )
+        self._rewrite(list(self._docs.values()), records)
+        logger.info("🗜️ Index local compacté: %s -> %s enregistrements", total, self._row_count())
+
+    # -- Recherche -----------------------------------------------------------
+
+    def search(
+        self,
+        query: str,
+        k: int = 5,
+        min_score: float = 0.0,
+        max_age_hours: Optional[float] = None
+    ) -> List[Dict]:
+        """Documents les plus proches de la requête, au format des résultats SerpAPI
+
+        ``max_age_hours`` écarte les documents indexés (vus dans une recherche
+        live) depuis plus longtemps.
+        """
+        vector = self.embedder.embed(query)
+        oldest = datetime.now() - timedelta(hours=max_age_hours) if max_age_hours else None
+
+        with self._lock:
+            self._refresh()
+            n = self._row_count()
+            if not n:
+                return []
+            if np is not None:
+                matrix = self._vectors()
+                scores = matrix['vector'] @ vector
+                ids = matrix['id']
+                ranked = ((int(ids[row]), float(scores[row])) for row in np.argsort(-scores))
+            else:
+                dim = self.dim
+                rows = self._rows
+                scores = [
+                    sum(a * b for a, b in zip(rows[row * dim:(row + 1) * dim], vector))
+                    for row in range(n)
+                ]
+                ranked = sorted(zip(self._ids, scores), key=lambda item: -item[1])
+
+            hits = []
+            for doc_id, score in ranked:
+                if score < min_score or len(hits) >= k:
+                    break
+                doc = self._docs.get(doc_id)
+                if doc is None:
+                    continue  # ancienne version masquée, ou vecteur sans document
+                if oldest and (_parse_datetime(doc.get('indexed_at')) or oldest) < oldest:
+                    continue
+                hits.append(dict(
+                    {key: doc[key] for key in ('title', 'url', 'content', 'source', 'date', 'date_parsed')},
+                    relevance_score=round(score, 3),
+                    origin='local_index',
+                ))
+        return hits
+
+
+_local_index: Optional[LocalSearchIndex] = None
+_local_index_lock = threading.Lock()
+
+
+def get_local_index() -> LocalSearchIndex:
+    """Index local du processus (``LOCAL_INDEX_DIR``)"""
+    global _local_index
+    if _local_index is None:
+        with _local_index_lock:
+            if _local_index is None:
+                _local_index = LocalSearchIndex(settings.LOCAL_INDEX_DIR)
+    return _local_index
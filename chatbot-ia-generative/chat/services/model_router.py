@@ -0,0 +1,185 @@
+"""
+Routage automatique des requêtes entre vLLM local et OpenRouter
+
+Le modèle sélectionné (``set-model``) reste un interrupteur manuel, commun à
+tous les workers via Redis (repli sur le cache Django si Redis est
+injoignable) ; en mode
+``auto``, chaque appel LLM est routé selon un classifieur à base de
+caractéristiques peu coûteuses :
+
+- taille estimée de l'entrée (prompt + historique + contexte de recherche),
+  rapportée à ``ROUTING_LOCAL_MAX_INPUT_TOKENS`` (prefill lent de Phi-3 sur CPU) ;
+- synthèse de recherche ou non (``ROUTING_SEARCH_WEIGHT``) ;
+- nombre de messages d'historique (``ROUTING_HISTORY_WEIGHT`` chacun).
+
+Une complexité < 1 désigne le modèle local (Phi-3 via ``VLLMService``), sinon
+le modèle 32B d'OpenRouter. Les statistiques vivantes ont le dernier mot sur
+une requête simple : vLLM indisponible, latence récente au-delà de
+``ROUTING_VLLM_MAX_LATENCY`` ou file de travaux au-delà de
+``ROUTING_QUEUE_SPILL_RATIO`` renvoient vers OpenRouter.
+"""
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from chat import tracing
+from chat.metrics import MODEL_ROUTING, PROVIDER_LATENCY, RecentAverage
+
+from .job_queue import get_job_queue
+from .shared_state import SharedStateUnavailable, get_shared_redis
+from .vllm_service import VLLMService
+
+logger = logging.getLogger(__name__)
+
+SELECTED_MODEL_CACHE_KEY = 'selected_llm_model'
+ROUTING_MODES = ('auto', 'vllm', 'openrouter')
+
+
+def get_selected_model() -> str:
+    """Modèle choisi via ``set-model`` : vllm, openrouter ou auto (défaut ``LLM_ROUTING_DEFAULT``)"""
+    try:
+        model = get_shared_redis().run(lambda r: r.get(SELECTED_MODEL_CACHE_KEY))
+    except SharedStateUnavailable:
+        model = cache.get(SELECTED_MODEL_CACHE_KEY)
+    return model or settings.LLM_ROUTING_DEFAULT
+
+
+def set_selected_model(model: str):
+    """Enregistre le choix de ``set-model`` pour tous les workers"""
+    try:
+        get_shared_redis().run(lambda r: r.set(SELECTED_MODEL_CACHE_KEY, model))
+    except SharedStateUnavailable:
+        cache.set(SELECTED_MODEL_CACHE_KEY, model, timeout=None)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimation grossière (≈ 4 caractères par token), suffisante pour router"""
+    return len(text or '') // 4
+
+
+class RoutingDecision:
+    """Fournisseur retenu pour un appel LLM, et pourquoi"""
+
+    def __init__(self, provider: str, reason: str, complexity: Optional[float] = None,
+                 features: Optional[Dict] = None):
+        self.provider = provider
+        self.reason = reason
+        self.complexity = complexity
+        self.features = features or {}
+
+    def as_dict(self) -> Dict:
+        return {
+            'provider': self.provider,
+            'reason': self.reason,
+            'complexity': None if self.complexity is None else round(self.complexity, 3),
+            'features': self.features,
+        }
+
+
+class ModelRouter:
+    """Choisit vLLM ou OpenRouter pour chaque appel quand le mode ``auto`` est actif"""
+
+    def __init__(self, vllm_service: Optional[VLLMService] = None, stats_interval: Optional[float] = None):
+        self.vllm_service = vllm_service or VLLMService()
+        self.stats_interval = settings.ROUTING_STATS_INTERVAL if stats_interval is None else stats_interval
+        self._vllm_latency = RecentAverage(PROVIDER_LATENCY, provider='vllm')
+        self._vllm_available = True
+        self._queue_ratio = 0.0
+        self._stats_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    # -- Caractéristiques ----------------------------------------------------
+
+    def features(self, prompt: str, requires_search: bool = False, history=None, context: str = '') -> Dict:
+        history = history or []
+        history_chars = sum(len(message.get('content') or '') for message in history)
+        return {
+            'input_tokens': estimate_tokens(prompt) + estimate_tokens(context) + history_chars // 4,
+            'search': requires_search,
+            'history_messages': len(history),
+        }
+
+    def complexity(self, features: Dict) -> float:
+        """< 1 : à la portée du modèle local"""
+        return (
+            features['input_tokens'] / settings.ROUTING_LOCAL_MAX_INPUT_TOKENS
+            + (settings.ROUTING_SEARCH_WEIGHT if features['search'] else 0.0)
+            + features['history_messages'] * settings.ROUTING_HISTORY_WEIGHT
+        )
+
+    # -- Statistiques vivantes -----------------------------------------------
+
+    def _refresh_stats(self):
+        """Santé et latence de vLLM, file de travaux (au plus une fois par ``stats_interval``)"""
+        now = time.monotonic()
+        with self._lock:
+            if self._stats_at is not None and now - self._stats_at < self.stats_interval:
+                return
+            self._stats_at = now
+            self._vllm_latency.update()
+            queue = get_job_queue().metrics()
+            self._queue_ratio = queue['queue_depth'] / max(1, queue['max_pending'])
+        # Hors verrou : le health check est un appel réseau
+        self._vllm_available = self.vllm_service.is_available()
+
+    def live_stats(self) -> Dict:
+        self._refresh_stats()
+        return {
+            'vllm_available': self._vllm_available,
+            'vllm_latency': self._vllm_latency.value,
+            'queue_ratio': self._queue_ratio,
+        }
+
+    # -- Décision ------------------------------------------------------------
+
+    def route(self, prompt: str, requires_search: bool = False, history=None, context: str = '') -> RoutingDecision:
+        """Fournisseur pour un appel ; le choix manuel de ``set-model`` reste prioritaire"""
+        selected = get_selected_model()
+        if selected != 'auto':
+            decision = RoutingDecision(selected, 'manual')
+        else:
+            decision = self._auto_route(self.features(prompt, requires_search, history, context))
+        MODEL_ROUTING.inc(provider=decision.provider, reason=decision.reason)
+        tracing.current_span().set_attributes({'routing.provider': decision.provider, 'routing.reason': decision.reason})
+        return decision
+
+    def _auto_route(self, features: Dict) -> RoutingDecision:
+        complexity = self.complexity(features)
+        if features['input_tokens'] > settings.ROUTING_LOCAL_MAX_INPUT_TOKENS:
+            decision = RoutingDecision('openrouter', 'context', complexity, features)
+        elif complexity >= 1.0:
+            decision = RoutingDecision('openrouter', 'complex', complexity, features)
+        else:
+            stats = self.live_stats()
+            if not stats['vllm_available']:
+                reason = 'vllm_unavailable'
+            elif (stats['vllm_latency'] or 0.0) > settings.ROUTING_VLLM_MAX_LATENCY:
+                reason = 'vllm_slow'
+            elif stats['queue_ratio'] > settings.ROUTING_QUEUE_SPILL_RATIO:
+                reason = 'queue_busy'
+            else:
+                reason = 'simple'
+            decision = RoutingDecision('vllm' if reason == 'simple' else 'openrouter', reason, complexity, features)
+        logger.info(
+            "🧭 Routage auto → %s (%s, complexité %.2f, ~%d tokens)",
+            decision.provider, decision.reason, complexity, features['input_tokens']
+        )
+        return decision
+
+
+_model_router: Optional[ModelRouter] = None
+_model_router_lock = threading.Lock()
+
+
+def get_model_router() -> ModelRouter:
+    """Routeur unique du processus (statistiques partagées entre requêtes)"""
+    global _model_router
+    if _model_router is None:
+        with _model_router_lock:
+            if _model_router is None:
+                _model_router = ModelRouter()
+    return _model_router
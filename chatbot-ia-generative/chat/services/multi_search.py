@@ -1,89 +1,118 @@
-import requests
-from typing import List, Dict
+import asyncio
+import functools
+from typing import List, Dict, Optional
 import logging
-import json
-from bs4 import BeautifulSoup
-import time
 from django.conf import settings
 
+from .deadline import Deadline
+from .load_policy import current_load_level
+from .scraping import ItemSelector, get_page_cache, get_scraper, parse_items
+
 logger = logging.getLogger(__name__)
 
-# Configure colored logs
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+GOOGLE_ITEMS = ItemSelector('div', 'SoaBEf')
+BING_ITEMS = ItemSelector('div', 'news-card')
+ARTICLE_ITEMS = ItemSelector('article')
+
+# Sites tech qui publient souvent des actualités IA
+NEWS_SITES = [
+    {
+        'name': 'TechCrunch AI',
+        'url': 'https://techcrunch.com/category/artificial-intelligence/',
+    },
+    {
+        'name': 'The Verge AI',
+        'url': 'https://www.theverge.com/ai-artificial-intelligence',
+    }
+]
+NEWS_ARTICLES_PER_SITE = 2
 
 
 class MultiSearchService:
     """Robust search service that tries multiple methods."""
     
     def __init__(self):
-        self.max_results = settings.MAX_SEARCH_RESULTS
+        self._max_results = settings.MAX_SEARCH_RESULTS
+    
+    @property
+    def max_results(self) -> int:
+        """MAX_SEARCH_RESULTS, réduit en mode dégradé"""
+        return current_load_level().search_results(self._max_results)
     
-    def search(self, query: str) -> List[Dict]:
+    @property
+    def scraper(self):
+        return get_scraper()
+    
+    def search(self, query: str, deadline: Optional[Deadline] = None) -> List[Dict]:
         """
         Try multiple search methods in order of preference.
+        
+        ``deadline`` bounds each scrape; methods left without time are skipped.
         """
-        logger.info(f"\n🌍 RECHERCHE WEB MULTI-SOURCE")
-        logger.info(f"🔍 Query: '{query}'")
+        deadline = deadline or Deadline()
+        logger.info("🌍 RECHERCHE WEB MULTI-SOURCE")
+        logger.info("🔍 Query: '%s'", query)
         
         # Method 1: Try Google search scraping (most reliable)
-        logger.info(f"\n1️⃣ Tentative Google Search...")
-        results = self._google_search_scrape(query)
+        logger.info("1️⃣ Tentative Google Search...")
+        results = self._google_search_scrape(query, deadline)
         if results:
-            logger.info(f"✅ Google Search réussi: {len(results)} résultats")
+            logger.info("✅ Google Search réussi: %s résultats", len(results))
             return results
-        logger.warning(f"❌ Google Search échoué")
+        logger.warning("❌ Google Search échoué")
         
         # Method 2: Try Bing search scraping
-        logger.info(f"\n2️⃣ Tentative Bing Search...")
-        results = self._bing_search_scrape(query)
+        logger.info("2️⃣ Tentative Bing Search...")
+        results = self._bing_search_scrape(query, deadline)
         if results:
-            logger.info(f"✅ Bing Search réussi: {len(results)} résultats")
+            logger.info("✅ Bing Search réussi: %s résultats", len(results))
             return results
-        logger.warning(f"❌ Bing Search échoué")
+        logger.warning("❌ Bing Search échoué")
         
         # Method 3: Try direct news sites
-        logger.info(f"\n3️⃣ Tentative sites d'actualités directs...")
-        results = self._direct_news_search(query)
+        logger.info("3️⃣ Tentative sites d'actualités directs...")
+        results = self._direct_news_search(query, deadline)
         if results:
-            logger.info(f"✅ Recherche directe réussie: {len(results)} résultats")
+            logger.info("✅ Recherche directe réussie: %s résultats", len(results))
             return results
-        logger.warning(f"❌ Recherche directe échouée")
+        logger.warning("❌ Recherche directe échouée")
         
         # If all fail, return mock data for demo
-        logger.warning(f"\n⚠️ TOUTES LES MÉTHODES ONT ÉCHOUÉ - Utilisation des données de démo")
+        logger.warning("⚠️ TOUTES LES MÉTHODES ONT ÉCHOUÉ - Utilisation des données de démo")
         return self._get_demo_results(query)
     
-    def _google_search_scrape(self, query: str) -> List[Dict]:
+    def _has_time(self, deadline: Deadline) -> bool:
+        """Assez de temps pour un scrape ? Sinon la méthode est sautée"""
+        if deadline.allows(settings.DEADLINE_MIN_CALL_SECONDS):
+            return True
+        deadline.degrade('search_fallback')
+        return False
+    
+    def _google_search_scrape(self, query: str, deadline: Optional[Deadline] = None) -> List[Dict]:
         """Scrape Google search results."""
+        deadline = deadline or Deadline()
+        if not self._has_time(deadline):
+            return []
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            
             params = {
                 'q': query + ' latest news 2025',
                 'tbm': 'nws',  # News search
                 'tbs': 'qdr:w'  # Last week
             }
             
-            logger.info(f"   🌐 Requête vers Google Search...")
-            response = requests.get(
-                'https://www.google.com/search',
-                headers=headers,
-                params=params,
-                timeout=5
-            )
-            logger.info(f"   📡 Status code: {response.status_code}")
+            logger.info("   🌐 Requête vers Google Search...")
+            # Cartes d'actualité Google, à défaut balises <article>
+            selectors = (GOOGLE_ITEMS, ARTICLE_ITEMS)
+            page = self.scraper.run(self.scraper.fetch(
+                'https://www.google.com/search', provider='google_scrape', params=params,
+                selectors=selectors, max_results=self.max_results, timeout=deadline.timeout(5)
+            ), timeout=deadline.timeout())
+            logger.info("   📡 Status code: %s", page.status_code)
             
-            if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
+            if page.ok:
                 results = []
-                
-                # Find news articles
-                articles = soup.find_all('div', {'class': 'SoaBEf'}) or soup.find_all('article')
+                items = parse_items(page.text, selectors)
+                articles = [item for item in items if GOOGLE_ITEMS.matches(item.name, item.attrs)] or items
                 
                 for article in articles[:self.max_results]:
                     title_elem = article.find('h3') or article.find('a')
@@ -98,45 +127,38 @@ class MultiSearchService:
                         })
                 
                 if results:
-                    logger.info(f"   ✅ Extraction réussie: {len(results)} articles trouvés")
+                    logger.info("   ✅ Extraction réussie: %s articles trouvés", len(results))
                     for i, r in enumerate(results[:3]):
-                        logger.info(f"     {i+1}. {r['title'][:60]}...")
+                        logger.debug("     %d. %.60s...", i + 1, r['title'], extra={'sampled': True})
                     return results
                 else:
-                    logger.warning(f"   ⚠️ Aucun article extrait du HTML")
+                    logger.warning("   ⚠️ Aucun article extrait du HTML")
                     
         except Exception as e:
-            logger.error(f"   ❌ Erreur Google scrape: {str(e)}")
+            logger.error("   ❌ Erreur Google scrape: %s", e)
         
         return []
     
-    def _bing_search_scrape(self, query: str) -> List[Dict]:
+    def _bing_search_scrape(self, query: str, deadline: Optional[Deadline] = None) -> List[Dict]:
         """Scrape Bing search results."""
+        deadline = deadline or Deadline()
+        if not self._has_time(deadline):
+            return []
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-            
             params = {
                 'q': query + ' latest AI news 2025',
                 'filters': 'ex1:"ez1"'  # Recent results
             }
             
-            response = requests.get(
-                'https://www.bing.com/news/search',
-                headers=headers,
-                params=params,
-                timeout=5
-            )
+            page = self.scraper.run(self.scraper.fetch(
+                'https://www.bing.com/news/search', provider='bing_scrape', params=params,
+                selectors=(BING_ITEMS,), max_results=self.max_results, timeout=deadline.timeout(5)
+            ), timeout=deadline.timeout())
             
-            if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
+            if page.ok:
                 results = []
                 
-                # Find news cards
-                news_cards = soup.find_all('div', {'class': 'news-card'})
-                
-                for card in news_cards[:self.max_results]:
+                for card in parse_items(page.text, (BING_ITEMS,), limit=self.max_results):
                     title_elem = card.find('a', {'class': 'title'})
                     snippet_elem = card.find('div', {'class': 'snippet'})
                     
@@ -148,59 +170,79 @@ class MultiSearchService:
                         })
                 
                 if results:
-                    logger.info(f"   ✅ Bing: {len(results)} résultats trouvés")
+                    logger.info("   ✅ Bing: %s résultats trouvés", len(results))
                     return results
                     
         except Exception as e:
-            logger.error(f"   ❌ Erreur Bing: {str(e)}")
+            logger.error("   ❌ Erreur Bing: %s", e)
         
         return []
     
-    def _direct_news_search(self, query: str) -> List[Dict]:
+    def _direct_news_search(self, query: str, deadline: Optional[Deadline] = None) -> List[Dict]:
         """Search directly on news sites."""
+        deadline = deadline or Deadline()
+        if not self._has_time(deadline):
+            return []
         results = []
-        logger.info(f"   📰 Recherche sur sites tech spécialisés...")
+        logger.info("   📰 Recherche sur sites tech spécialisés...")
         
-        # Tech news sites that often have AI news
-        news_sites = [
-            {
-                'name': 'TechCrunch AI',
-                'url': 'https://techcrunch.com/category/artificial-intelligence/',
-                'selector': 'article'
-            },
-            {
-                'name': 'The Verge AI',
-                'url': 'https://www.theverge.com/ai-artificial-intelligence',
-                'selector': 'article'
-            }
-        ]
+        # Tous les sites en parallèle sur le client partagé
+        async def fetch_all():
+            return await asyncio.gather(
+                *(self._news_site_articles(site, deadline.timeout(3)) for site in NEWS_SITES), return_exceptions=True
+            )
         
-        for site in news_sites:
-            try:
-                response = requests.get(site['url'], timeout=3)
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    articles = soup.find_all(site['selector'], limit=2)
-                    
-                    for article in articles:
-                        title = article.find('h2') or article.find('h3')
-                        link = article.find('a', href=True)
-                        
-                        if title and link:
-                            results.append({
-                                'title': title.get_text(strip=True),
-                                'url': link['href'] if link['href'].startswith('http') else site['url'] + link['href'],
-                                'content': f"From {site['name']}: Latest AI news and developments"
-                            })
-                            
-            except Exception as e:
-                logger.error(f"Direct news search error for {site['name']}: {str(e)}")
+        try:
+            site_articles = self.scraper.run(fetch_all(), timeout=deadline.timeout())
+        except Exception as e:
+            logger.error("Direct news search error: %s", e)
+            return []
+        
+        for site, articles in zip(NEWS_SITES, site_articles):
+            if isinstance(articles, Exception):
+                logger.error("Direct news search error for %s: %s", site['name'], articles)
+                continue
+            # Copies : la liste analysée reste en cache, les résultats sont enrichis en aval
+            results.extend(dict(article) for article in articles)
         
         return results[:self.max_results]
     
+    async def _news_site_articles(self, site: Dict, timeout: Optional[float] = 3) -> List[Dict]:
+        """Articles d'un site ; page inchangée (304 ou encore fraîche) : analyse en cache"""
+        page_cache = get_page_cache()
+        fetch = functools.partial(
+            self.scraper.fetch, site['url'], provider='news_sites', selectors=(ARTICLE_ITEMS,),
+            max_results=NEWS_ARTICLES_PER_SITE, timeout=timeout
+        )
+        page = await fetch(cache=page_cache)
+        if page.not_modified:
+            articles = page_cache.get_parsed(page.url, page.body_hash)
+            if articles is not None:
+                logger.debug("   ♻️ %s inchangé, articles en cache", site['name'])
+                return articles
+            # Analyse évincée entre-temps : relecture complète
+            page = await fetch()
+        if not page.ok:
+            return []
+        
+        articles = []
+        for article in parse_items(page.text, (ARTICLE_ITEMS,), limit=NEWS_ARTICLES_PER_SITE):
+            title = article.find('h2') or article.find('h3')
+            link = article.find('a', href=True)
+            
+            if title and link:
+                articles.append({
+                    'title': title.get_text(strip=True),
+                    'url': link['href'] if link['href'].startswith('http') else site['url'] + link['href'],
+                    'content': f"From {site['name']}: Latest AI news and developments"
+                })
+        if page.body_hash:
+            page_cache.set_parsed(page.url, page.body_hash, articles)
+        return articles
+    
     def _get_demo_results(self, query: str) -> List[Dict]:
         """Return demo results for testing."""
-        logger.info(f"   🎭 Génération de résultats de démonstration")
+        logger.info("   🎭 Génération de résultats de démonstration")
         if 'ia' in query.lower() or 'ai' in query.lower():
             return [
                 {
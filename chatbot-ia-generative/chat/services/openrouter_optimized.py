@@ -2,12 +2,19 @@
 Service OpenRouter optimisé avec gestion stricte du contexte
 """
 import httpx
-import json
 import logging
-from typing import List, Dict, Optional, Any
+from typing import Any, Callable, Dict, List, Optional
 from datetime import datetime, timedelta
 from django.conf import settings
 
+from chat import fast_json
+from chat.metrics import provider_call, record_cancellation
+from chat.tracing import inject_trace_headers
+from .cancellation import CancellationToken, ChatCancelled
+from .deadline import Deadline
+from .load_policy import current_load_level
+from .prompts import CHAT_SYSTEM_PROMPT
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,6 +25,9 @@ class OpenRouterOptimizedService:
         self.api_key = settings.OPENROUTER_API_KEY
         self.base_url = settings.OPENROUTER_BASE_URL
         self.model = settings.OPENROUTER_MODEL
+        self.chat_temperature = 0.3  # Plus bas pour plus de précision
+        # Code HTTP du dernier generate_response (None si aucune réponse)
+        self.last_status_code: Optional[int] = None
         
         
         self.headers = {
@@ -27,19 +37,139 @@ class OpenRouterOptimizedService:
             "X-Title": "AI Chatbot with Search"
         }
     
+    def chat_completion(
+        self,
+        messages: List[Dict],
+        temperature: float = 0.3,
+        max_tokens: int = 2000,
+        timeout: float = 30.0,
+        on_token: Optional[Callable[[str], None]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        deadline: Optional[Deadline] = None,
+        **extra: Any
+    ) -> Dict[str, Any]:
+        """
+        Appel bas niveau à /chat/completions.
+        
+        Retourne ``status_code``, ``content`` et ``usage``. Avec ``on_token`` ou
+        ``cancel_token``, la réponse est lue en streaming et la connexion est
+        fermée dès l'annulation. ``deadline`` borne ``timeout`` au temps restant
+        du tour et tronque le streaming à l'échéance.
+        """
+        deadline = deadline or Deadline()
+        span_attributes = {'llm.model': self.model, 'llm.max_tokens': max_tokens, 'llm.stream': bool(on_token or cancel_token)}
+        with provider_call('openrouter', **span_attributes) as call:
+            result = self._completion_request(
+                messages, temperature, max_tokens, deadline.timeout(timeout), on_token, cancel_token, deadline, **extra
+            )
+            call.status_code = result['status_code']
+            call.usage = result.get('usage')
+            return result
+    
+    def _completion_request(
+        self,
+        messages: List[Dict],
+        temperature: float,
+        max_tokens: int,
+        timeout: float,
+        on_token: Optional[Callable[[str], None]],
+        cancel_token: Optional[CancellationToken],
+        deadline: Deadline,
+        **extra: Any
+    ) -> Dict[str, Any]:
+        data = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            **extra
+        }
+        
+        if not (on_token or cancel_token):
+            response = httpx.post(
+                f"{self.base_url}/chat/completions",
+                headers=inject_trace_headers(self.headers),
+                json=dict(data, stream=False),
+                timeout=timeout
+            )
+            if response.status_code != 200:
+                return {'status_code': response.status_code, 'content': None, 'error': response.text, 'usage': {}}
+            result = fast_json.loads(response.content)
+            return {
+                'status_code': 200,
+                'content': result['choices'][0]['message']['content'],
+                'usage': result.get('usage', {})
+            }
+        
+        chunks = []
+        usage = {}
+        with httpx.Client(timeout=timeout) as client:
+            # Fermer le client depuis le thread d'annulation coupe la connexion amont
+            unregister = cancel_token.on_cancel(client.close) if cancel_token else (lambda: None)
+            try:
+                with client.stream(
+                    "POST",
+                    f"{self.base_url}/chat/completions",
+                    headers=inject_trace_headers(self.headers),
+                    json=dict(data, stream=True, stream_options={'include_usage': True})
+                ) as response:
+                    if response.status_code != 200:
+                        response.read()
+                        return {'status_code': response.status_code, 'content': None, 'error': response.text, 'usage': {}}
+                    
+                    for line in response.iter_lines():
+                        if cancel_token and cancel_token.cancelled:
+                            break
+                        if deadline.expired:
+                            # Échéance du tour : réponse tronquée plutôt que perdue
+                            deadline.degrade('llm')
+                            break
+                        if not line.startswith('data: '):
+                            continue
+                        data_str = line[6:]
+                        if data_str == '[DONE]':
+                            break
+                        try:
+                            chunk = fast_json.loads(data_str)
+                        except fast_json.JSONDecodeError:
+                            continue
+                        # Le dernier chunk porte l'usage (stream_options.include_usage)
+                        usage = chunk.get('usage') or usage
+                        choices = chunk.get('choices') or []
+                        token = choices[0].get('delta', {}).get('content') if choices else None
+                        if token:
+                            chunks.append(token)
+                            if on_token:
+                                on_token(token)
+            except Exception:
+                if not (cancel_token and cancel_token.cancelled):
+                    raise
+            finally:
+                unregister()
+        
+        if cancel_token and cancel_token.cancelled:
+            record_cancellation('openrouter', cancel_token.reason, max_tokens, len(chunks))
+            logger.info("🛑 Génération OpenRouter annulée après %s tokens", len(chunks))
+            cancel_token.raise_if_cancelled()
+        return {'status_code': 200, 'content': "".join(chunks), 'usage': usage or {'completion_tokens': len(chunks)}}
+    
     def generate_response(
         self, 
         query: str, 
         search_results: Optional[List[Dict]] = None,
         current_date: Optional[datetime] = None,
         time_constraint: Optional[str] = None,
-        conversation_history: Optional[List[Dict]] = None
+        conversation_history: Optional[List[Dict]] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        deadline: Optional[Deadline] = None
     ) -> str:
         """
         Génère une réponse en utilisant OpenRouter avec contexte de recherche forcé
         """
-        logger.info(f"\n🤖 OPENROUTER - Génération de réponse")
-        logger.info(f"📊 Modèle: {self.model}")
+        logger.info("🤖 OPENROUTER - Génération de réponse")
+        self.last_status_code = None
+        logger.info("📊 Modèle: %s", self.model)
         
         try:
             messages = []
@@ -65,7 +195,7 @@ class OpenRouterOptimizedService:
                 # Prompt système simple sans recherche
                 messages.append({
                     "role": "system",
-                    "content": "Tu es un assistant IA utile et amical. Réponds de manière claire et concise en français."
+                    "content": CHAT_SYSTEM_PROMPT
                 })
             
             # Ajouter la question de l'utilisateur
@@ -75,58 +205,53 @@ class OpenRouterOptimizedService:
             })
             
             # Log pour debug
-            logger.info(f"📝 Nombre de messages: {len(messages)}")
+            logger.info("📝 Nombre de messages: %s", len(messages))
             if search_results:
-                logger.info(f"🔍 Contexte de recherche: {len(search_results)} résultats")
-            
-            # Préparer la requête
-            data = {
-                "model": self.model,
-                "messages": messages,
-                "temperature": 0.3,  # Plus bas pour plus de précision
-                "max_tokens": 2000,
-                "top_p": 0.9,
-                "frequency_penalty": 0.2,
-                "presence_penalty": 0.1,
-                "stream": False
-            }
+                logger.info("🔍 Contexte de recherche: %s résultats", len(search_results))
             
             # Faire la requête API
-            response = httpx.post(
-                f"{self.base_url}/chat/completions",
-                headers=self.headers,
-                json=data,
-                timeout=30.0
+            completion = self.chat_completion(
+                messages,
+                temperature=self.chat_temperature,
+                max_tokens=current_load_level().max_tokens(2000),
+                timeout=30.0,
+                on_token=on_token,
+                cancel_token=cancel_token,
+                deadline=deadline,
+                top_p=0.9,
+                frequency_penalty=0.2,
+                presence_penalty=0.1
             )
+            status_code = completion['status_code']
+            self.last_status_code = status_code
             
-            logger.info(f"📡 Status code: {response.status_code}")
+            logger.info("📡 Status code: %s", status_code)
             
-            if response.status_code == 200:
-                result = response.json()
-                ai_response = result['choices'][0]['message']['content']
-                
+            if status_code == 200:
                 # Nettoyer la réponse pour supprimer toute section de sources ajoutée
-                ai_response = self._clean_response(ai_response)
+                ai_response = self._clean_response(completion['content'])
                 return ai_response
             else:
-                error_detail = response.text
-                logger.error(f"OpenRouter error: {response.status_code} - {error_detail}")
+                error_detail = completion.get('error')
+                logger.error("OpenRouter error: %s - %s", status_code, error_detail)
                 
                 # Détails spécifiques selon le code d'erreur
-                if response.status_code == 401:
+                if status_code == 401:
                     logger.error("❌ Erreur d'authentification - Vérifiez votre clé API OpenRouter")
-                elif response.status_code == 429:
+                elif status_code == 429:
                     logger.error("❌ Limite de taux dépassée - Attendez avant de réessayer")
-                elif response.status_code == 400:
-                    logger.error(f"❌ Requête invalide - Détails: {error_detail}")
+                elif status_code == 400:
+                    logger.error("❌ Requête invalide - Détails: %s", error_detail)
                 
-                return f"Désolé, une erreur s'est produite lors de la génération de la réponse. (Code: {response.status_code})"
+                return f"Désolé, une erreur s'est produite lors de la génération de la réponse. (Code: {status_code})"
                 
+        except ChatCancelled:
+            raise
         except httpx.TimeoutException:
             logger.error("OpenRouter timeout")
             return "Le service met trop de temps à répondre. Veuillez réessayer."
         except Exception as e:
-            logger.error(f"OpenRouter error: {str(e)}")
+            logger.error("OpenRouter error: %s", e)
             return f"Erreur lors de la génération: {str(e)}"
     
     def _create_system_prompt_with_context(
@@ -223,7 +348,7 @@ CONTENU: {content}
         
         has_enough_citations = citation_count >= min_citations or urls_mentioned
         
-        logger.info(f"📊 Validation citations: {citation_count} citations, URLs: {urls_mentioned}")
+        logger.info("📊 Validation citations: %s citations, URLs: %s", citation_count, urls_mentioned)
         
         return has_enough_citations
     
@@ -251,7 +376,7 @@ CONTENU: {content}
             match = re.search(pattern, cleaned, re.IGNORECASE | re.DOTALL)
             if match:
                 cleaned = cleaned[:match.start()]
-                logger.info(f"✂️ Section sources supprimée")
+                logger.info("✂️ Section sources supprimée")
                 break
         
         # Supprimer aussi les citations [Source: ...] et les remplacer par des numéros si nécessaire
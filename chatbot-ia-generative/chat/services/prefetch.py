@@ -0,0 +1,222 @@
+"""
+Préchargement en arrière-plan des recherches sur les sujets tendances
+
+Un seul préchargeur actif pour tout le déploiement : chaque worker démarre
+le sien, mais seul le détenteur du verrou Redis ``search_prefetch:leader``
+fait un cycle (le budget de crédits est lui aussi dans Redis).
+
+Les questions types passent par le même chemin qu'une question
+d'utilisateur (réécriture LLM puis recherche). La réécriture est publiée
+dans Redis sous la clé du cache de réécriture : la même question posée sur
+n'importe quel worker retrouve la même requête, donc l'entrée préchargée
+de ``SearchCache``. Taux de réussite : ``chat_cache_lookups_total{cache="search_prefetch"}``.
+Les titres tendances sont cherchés tels quels : une requête réécrite ne
+les retrouve presque jamais, d'où ``SEARCH_PREFETCH_TRENDING`` désactivé par défaut.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from chat.metrics import record_cache_lookup
+from .serpapi_service import SerpAPIService, SerpAPICreditBudget
+from .intelligent_search import IntelligentSearchService
+from .shared_state import SharedStateUnavailable, get_shared_redis
+
+logger = logging.getLogger(__name__)
+
+LEADER_KEY = 'search_prefetch:leader'
+REWRITE_KEY_PREFIX = 'search_prefetch:'
+
+# Renouvelle le verrou s'il est à nous, sinon le prend s'il est libre
+_ACQUIRE_LEADER_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+_RELEASE_LEADER_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def publish_rewrite(rewrite_cache_key: str, search_data: Dict, ttl: int):
+    """Rend une réécriture préchargée visible de tous les workers"""
+    value = json.dumps(search_data, ensure_ascii=False)
+    try:
+        get_shared_redis().run(lambda r: r.set(REWRITE_KEY_PREFIX + rewrite_cache_key, value, ex=ttl))
+    except SharedStateUnavailable:
+        pass
+
+
+def lookup_prefetched_rewrite(rewrite_cache_key: str) -> Optional[Dict]:
+    """Réécriture publiée par le préchargeur pour cette question, s'il y en a une"""
+    try:
+        value = get_shared_redis().run(lambda r: r.get(REWRITE_KEY_PREFIX + rewrite_cache_key))
+    except SharedStateUnavailable:
+        return None
+    record_cache_lookup('search_prefetch', value is not None)
+    return json.loads(value) if value else None
+
+
+class TrendingPrefetcher:
+    """Worker périodique qui réchauffe le cache de recherche (et de réécriture)
+    pour les questions types et les sujets tendances, dans un budget SerpAPI horaire."""
+
+    def __init__(
+        self,
+        interval: Optional[int] = None,
+        credits_per_hour: Optional[int] = None,
+        warm_rewrites: Optional[bool] = None,
+        templates: Optional[List[str]] = None,
+        trending: Optional[bool] = None
+    ):
+        self.interval = interval or settings.SEARCH_PREFETCH_INTERVAL
+        self.warm_rewrites = settings.SEARCH_PREFETCH_WARM_REWRITES if warm_rewrites is None else warm_rewrites
+        self.templates = settings.SEARCH_PREFETCH_TEMPLATES if templates is None else templates
+        self.trending = settings.SEARCH_PREFETCH_TRENDING if trending is None else trending
+        self.budget = SerpAPICreditBudget(
+            credits_per_hour or settings.SEARCH_PREFETCH_CREDITS_PER_HOUR,
+            scope='prefetch'
+        )
+        self.serpapi_service = SerpAPIService(credit_budget=self.budget)
+        self.freshness_hours = settings.SEARCH_CACHE_FRESHNESS_MINUTES / 60
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._leader_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def start(self):
+        """Démarre le worker dans un thread daemon"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='search-prefetcher', daemon=True)
+        self._thread.start()
+        logger.info("🔥 Préchargeur de recherches démarré (intervalle %ss, budget %s crédits/h)",
+                    self.interval, self.budget.credits_per_hour)
+
+    def stop(self):
+        self._stop.set()
+        try:
+            get_shared_redis().run(
+                lambda r: r.eval(_RELEASE_LEADER_SCRIPT, 1, LEADER_KEY, self._leader_id)
+            )
+        except SharedStateUnavailable:
+            pass
+
+    def is_leader(self) -> bool:
+        """Prend ou renouvelle le verrou du préchargeur (valable deux intervalles)"""
+        ttl_ms = int(self.interval * 2 * 1000)
+        try:
+            return bool(get_shared_redis().run(
+                lambda r: r.eval(_ACQUIRE_LEADER_SCRIPT, 1, LEADER_KEY, self._leader_id, ttl_ms)
+            ))
+        except SharedStateUnavailable:
+            # Sans Redis, impossible de savoir si un autre worker précharge : on s'abstient
+            logger.warning("⚠️ Préchargement sauté : verrou Redis indisponible")
+            return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.is_leader():
+                    self.run_once()
+            except Exception as e:
+                logger.error("Erreur préchargement: %s", e)
+            finally:
+                close_old_connections()
+            self._stop.wait(self.interval)
+
+    def _has_budget(self) -> bool:
+        return self.budget.remaining() >= SerpAPIService.MAX_CREDITS_PER_SEARCH
+
+    def run_once(self) -> Dict[str, int]:
+        """Un cycle de préchargement : questions types puis sujets tendances"""
+        stats = {'questions': 0, 'topics': 0}
+        current_date = datetime.now()
+
+        for question in self.templates:
+            if not self._has_budget():
+                logger.info("💳 Budget SerpAPI de préchargement atteint")
+                return stats
+            self._warm_question(question, current_date)
+            stats['questions'] += 1
+
+        # get_trending_topics coûte 1 crédit, puis une recherche news par sujet
+        if not self.trending or self.budget.remaining() <= SerpAPIService.MAX_CREDITS_PER_SEARCH:
+            return stats
+        topics = self.serpapi_service.get_trending_topics()
+        topics.sort(key=lambda t: t.get('trend') != 'hot')
+
+        for topic in topics:
+            if not self._has_budget():
+                logger.info("💳 Budget SerpAPI de préchargement atteint")
+                break
+            if not topic.get('title'):
+                continue
+            self.serpapi_service.search(
+                query=topic['title'],
+                search_type='news',
+                max_cache_age_hours=self.freshness_hours
+            )
+            stats['topics'] += 1
+
+        logger.info("🔥 Préchargement terminé: %s questions, %s sujets, %s crédits restants",
+                    stats['questions'], stats['topics'], self.budget.remaining())
+        return stats
+
+    def _warm_question(self, question: str, current_date: datetime):
+        """Réchauffe le même chemin que la question d'un utilisateur (réécriture puis recherche)"""
+        # Import local : la contrainte temporelle est extraite par la vue de chat
+        from chat.views import ChatAPIView
+
+        intelligent_search = IntelligentSearchService()
+        intelligent_search.serpapi_service = self.serpapi_service
+
+        if self.warm_rewrites:
+            time_constraint = ChatAPIView()._extract_time_constraint(question)
+            search_data = intelligent_search._generate_search_query(question, time_constraint, current_date)
+            if search_data.get('rewritten_by'):
+                publish_rewrite(
+                    intelligent_search._rewrite_cache_key(question, current_date),
+                    search_data,
+                    settings.SEARCH_REWRITE_CACHE_TTL
+                )
+        else:
+            search_data = {
+                'search_query': intelligent_search._extract_query_from_text(question),
+                'search_type': 'news'
+            }
+
+        self.serpapi_service.search(
+            query=search_data['search_query'],
+            search_type=search_data.get('search_type', 'news'),
+            max_cache_age_hours=self.freshness_hours
+        )
+
+
+_prefetcher: Optional[TrendingPrefetcher] = None
+
+
+def start_prefetcher() -> TrendingPrefetcher:
+    """Démarre le préchargeur unique du processus"""
+    global _prefetcher
+    if _prefetcher is None:
+        _prefetcher = TrendingPrefetcher()
+    _prefetcher.start()
+    return _prefetcher
@@ -0,0 +1,150 @@
+"""
+Gabarits de prompts organisés pour le cache de préfixe de vLLM
+
+Les instructions statiques sont placées en tête (message ``system``) et ne
+changent jamais d'une requête à l'autre : vLLM (``--enable-prefix-caching``)
+peut ainsi réutiliser les blocs KV déjà calculés. Tout ce qui est volatil
+(date, semaine, requête, contexte de recherche, question) va à la fin, dans
+le message ``user``.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+
+SEARCH_QUERY_SYSTEM_PROMPT = """Tu es un expert en recherche web. Ta tâche est d'analyser la question de l'utilisateur et de générer LA MEILLEURE requête de recherche possible pour obtenir des informations pertinentes et actuelles.
+
+INSTRUCTIONS:
+1. Analyse la question pour identifier les concepts clés
+2. Détermine s'il s'agit d'une recherche d'actualités, technique, ou générale
+3. Génère une requête de recherche OPTIMISÉE qui maximisera la pertinence des résultats
+4. Pour les actualités, ajoute des mots-clés temporels pertinents (2025, latest, announced, etc.)
+5. Pour les sujets techniques, ajoute des termes spécifiques
+6. Utilise des opérateurs de recherche si nécessaire (OR, "guillemets", etc.)
+
+IMPORTANT:
+- La requête doit être EN ANGLAIS pour de meilleurs résultats
+- Elle doit être concise mais précise
+- Pour l'IA générative, privilégie les noms d'entreprises et de modèles spécifiques
+- Pour les actualités récentes, ajoute TOUJOURS des termes temporels (today, this week, latest, announced)
+- Inclus des noms de sociétés clés: OpenAI, Anthropic, Google, Meta, Microsoft
+- La date actuelle et la contrainte temporelle sont fournies avec la question
+
+Réponds UNIQUEMENT avec un JSON structuré. Assure-toi que ta réponse est un JSON valide et rien d'autre:
+{
+  "search_query": "la requête de recherche optimisée en anglais",
+  "search_type": "news|technical|general",
+  "keywords": ["mot1", "mot2", "mot3"],
+  "reasoning": "explication courte de ta stratégie"
+}
+
+IMPORTANT: Ta réponse doit être SEULEMENT le JSON, sans texte avant ou après."""
+
+
+# Réécriture groupée (OpenRouter) : mêmes règles, plusieurs questions numérotées
+# dans un seul appel, réponse en tableau JSON
+SEARCH_QUERY_BATCH_SYSTEM_PROMPT = SEARCH_QUERY_SYSTEM_PROMPT.split("Réponds UNIQUEMENT")[0] + """Plusieurs questions numérotées te sont soumises, chacune avec sa propre contrainte temporelle éventuelle.
+Réponds UNIQUEMENT avec un tableau JSON valide contenant un objet par question, dans le même ordre :
+[
+  {
+    "id": 1,
+    "search_query": "la requête de recherche optimisée en anglais",
+    "search_type": "news|technical|general",
+    "keywords": ["mot1", "mot2", "mot3"],
+    "reasoning": "explication courte de ta stratégie"
+  }
+]
+
+IMPORTANT: Ta réponse doit être SEULEMENT le tableau JSON, sans texte avant ou après."""
+
+
+FINAL_RESPONSE_SYSTEM_PROMPT = """Tu es un assistant IA expert qui répond aux questions en utilisant EXCLUSIVEMENT les informations des résultats de recherche fournis.
+
+🔴 RÈGLES ABSOLUES:
+1. Tu DOIS baser ta réponse UNIQUEMENT sur les résultats de recherche fournis avec la question
+2. Tu DOIS citer chaque information avec [Source: Titre de l'article]
+3. Si une information n'est pas dans le contexte, dis "Cette information n'est pas disponible dans les sources trouvées"
+4. Structure ta réponse de manière claire et organisée
+5. Termine TOUJOURS par une section "📚 Sources consultées:" avec les titres et URLs
+
+⚠️ NE PAS inventer ou utiliser des connaissances non présentes dans les résultats de recherche."""
+
+
+CHAT_SYSTEM_PROMPT = "Tu es un assistant IA utile et amical. Réponds de manière claire et concise en français."
+
+
+def build_search_query_messages(
+    user_query: str,
+    time_constraint: Optional[str] = None,
+    current_date: Optional[datetime] = None
+) -> List[Dict[str, str]]:
+    """Messages pour la réécriture de requête : préfixe statique, date et question à la fin"""
+    volatile = []
+    if current_date:
+        volatile.append(f"Date actuelle: {current_date.strftime('%d/%m/%Y')} (Semaine {current_date.isocalendar()[1]})")
+        if time_constraint:
+            volatile.append(f"Contrainte temporelle: {time_constraint}")
+    volatile.append(f"Question de l'utilisateur: {user_query}")
+
+    return [
+        {"role": "system", "content": SEARCH_QUERY_SYSTEM_PROMPT},
+        {"role": "user", "content": "\n".join(volatile)}
+    ]
+
+
+def build_search_query_batch_messages(
+    questions: List[Tuple[str, Optional[str]]],
+    current_date: Optional[datetime] = None
+) -> List[Dict[str, str]]:
+    """Messages pour une réécriture groupée : (question, contrainte temporelle) numérotées à partir de 1"""
+    volatile = []
+    if current_date:
+        volatile.append(f"Date actuelle: {current_date.strftime('%d/%m/%Y')} (Semaine {current_date.isocalendar()[1]})")
+    for i, (user_query, time_constraint) in enumerate(questions, 1):
+        constraint = f" [Contrainte temporelle: {time_constraint}]" if time_constraint else ""
+        volatile.append(f"Question {i}: {user_query}{constraint}")
+
+    return [
+        {"role": "system", "content": SEARCH_QUERY_BATCH_SYSTEM_PROMPT},
+        {"role": "user", "content": "\n".join(volatile)}
+    ]
+
+
+def build_final_response_messages(
+    user_query: str,
+    context: str,
+    search_query: str,
+    time_constraint: Optional[str] = None,
+    current_date: Optional[datetime] = None
+) -> List[Dict[str, str]]:
+    """Messages pour la synthèse finale : instructions statiques, puis date, contexte et question"""
+    date_info = ""
+    if current_date:
+        date_info = f"""📅 DATE ACTUELLE: {current_date.strftime('%d/%m/%Y')}
+📅 SEMAINE: {current_date.isocalendar()[1]} de {current_date.year}
+⏰ PÉRIODE DEMANDÉE: {time_constraint or 'Non spécifiée'}
+🔍 REQUÊTE DE RECHERCHE UTILISÉE: "{search_query}"
+
+"""
+
+    user_content = f"""{date_info}📰 RÉSULTATS DE RECHERCHE (UTILISE UNIQUEMENT CES INFORMATIONS):
+{context}
+
+Question: {user_query}"""
+
+    return [
+        {"role": "system", "content": FINAL_RESPONSE_SYSTEM_PROMPT},
+        {"role": "user", "content": user_content}
+    ]
+
+
+def build_chat_messages(
+    message_text: str,
+    conversation_history: Optional[List[Dict]] = None
+) -> List[Dict[str, str]]:
+    """Messages pour une conversation sans recherche : système statique, historique, question"""
+    messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
+    for msg in conversation_history or []:
+        if msg['role'] in ['user', 'assistant']:
+            messages.append({"role": msg['role'], "content": msg['content']})
+    messages.append({"role": "user", "content": message_text})
+    return messages
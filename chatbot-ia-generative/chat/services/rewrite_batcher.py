@@ -0,0 +1,223 @@
+"""
+Micro-batching des réécritures de requête
+
+Les réécritures sont petites, fréquentes et indépendantes. Le batcher
+regroupe celles qui arrivent dans une fenêtre de ``REWRITE_BATCH_WINDOW_MS``
+(au plus ``REWRITE_BATCH_MAX_SIZE``) puis :
+
+- vLLM : les envoie simultanément, avec au plus ``VLLM_MAX_NUM_SEQS``
+  réécritures en vol (le ``--max-num-seqs`` du serveur) : le batching
+  continu de vLLM reste plein sans que sa file d'attente ne grossisse ;
+- OpenRouter : les regroupe dans un seul prompt (questions numérotées,
+  réponse en tableau JSON). Les questions absentes ou illisibles dans la
+  réponse sont relancées individuellement.
+
+Chaque appelant reçoit un ``Future`` dont le résultat a la forme de l'appel
+direct : ``generate_response`` pour vLLM, ``chat_completion`` pour OpenRouter.
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+from chat.metrics import REWRITE_BATCH_SIZE, REWRITE_PACKED_RESULTS
+
+from .deadline import Deadline
+from .openrouter_optimized import OpenRouterOptimizedService
+from .prompts import build_search_query_batch_messages, build_search_query_messages
+from .vllm_service import VLLMService
+
+logger = logging.getLogger(__name__)
+
+REWRITE_MAX_TOKENS = 200
+# Tokens de réponse par question dans un appel groupé
+PACKED_MAX_TOKENS_PER_QUESTION = 120
+
+
+class RewriteRequest:
+    """Réécriture en attente d'envoi"""
+
+    def __init__(self, user_query: str, time_constraint: Optional[str], current_date: Optional[datetime],
+                 deadline: Deadline):
+        self.user_query = user_query
+        self.time_constraint = time_constraint
+        self.current_date = current_date
+        self.deadline = deadline
+        self.future: Future = Future()
+        # Span parent et request-id de l'appelant pour les logs et la trace de l'appel
+        self.context = contextvars.copy_context()
+
+    def messages(self) -> List[Dict[str, str]]:
+        return build_search_query_messages(self.user_query, self.time_constraint, self.current_date)
+
+
+class RewriteBatcher:
+    """Regroupe les réécritures proches dans le temps, par fournisseur"""
+
+    def __init__(
+        self,
+        vllm_service: Optional[VLLMService] = None,
+        openrouter_service: Optional[OpenRouterOptimizedService] = None,
+        window_ms: float = 5,
+        max_batch: int = 8,
+        max_in_flight: int = 8
+    ):
+        self.vllm_service = vllm_service or VLLMService()
+        self.openrouter_service = openrouter_service or OpenRouterOptimizedService()
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.max_in_flight = max_in_flight
+        self._pending: Dict[str, List[RewriteRequest]] = {'vllm': [], 'openrouter': []}
+        self._condition = threading.Condition()
+        # Une tâche vLLM = une réécriture en vol : le pool borne les appels simultanés
+        self._vllm_executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='rewrite-vllm')
+        self._openrouter_executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='rewrite-openrouter')
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name='rewrite-batcher', daemon=True)
+        self._dispatcher.start()
+
+    def submit(
+        self,
+        provider: str,
+        user_query: str,
+        time_constraint: Optional[str] = None,
+        current_date: Optional[datetime] = None,
+        deadline: Optional[Deadline] = None
+    ) -> Future:
+        request = RewriteRequest(user_query, time_constraint, current_date, deadline or Deadline())
+        with self._condition:
+            self._pending[provider].append(request)
+            self._condition.notify()
+        return request.future
+
+    # -- Regroupement --------------------------------------------------------
+
+    def _dispatch_loop(self):
+        while True:
+            for provider, batch in self._next_batches():
+                REWRITE_BATCH_SIZE.observe(len(batch), provider=provider)
+                if provider == 'vllm':
+                    for request in batch:
+                        self._vllm_executor.submit(self._run, request, self._vllm_rewrite)
+                elif len(batch) == 1:
+                    self._openrouter_executor.submit(self._run, batch[0], self._openrouter_rewrite)
+                else:
+                    self._openrouter_executor.submit(batch[0].context.run, self._run_packed, batch)
+
+    def _next_batches(self):
+        """Attend une première réécriture, laisse la fenêtre se remplir, puis vide les files"""
+        with self._condition:
+            while not any(self._pending.values()):
+                self._condition.wait()
+            closes_at = time.monotonic() + self.window
+            while max(len(queue) for queue in self._pending.values()) < self.max_batch:
+                remaining = closes_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batches = []
+            for provider, queue in self._pending.items():
+                while queue:
+                    batches.append((provider, queue[:self.max_batch]))
+                    del queue[:self.max_batch]
+            return batches
+
+    # -- Appels --------------------------------------------------------------
+
+    def _run(self, request: RewriteRequest, call):
+        if not request.future.set_running_or_notify_cancel():
+            return
+        try:
+            request.future.set_result(request.context.run(call, request))
+        except BaseException as e:
+            request.future.set_exception(e)
+
+    def _vllm_rewrite(self, request: RewriteRequest) -> Dict:
+        return self.vllm_service.generate_response(messages=request.messages(), deadline=request.deadline)
+
+    def _openrouter_rewrite(self, request: RewriteRequest) -> Dict:
+        return self.openrouter_service.chat_completion(
+            request.messages(), temperature=0.3, max_tokens=REWRITE_MAX_TOKENS, timeout=15.0,
+            deadline=request.deadline
+        )
+
+    def _run_packed(self, batch: List[RewriteRequest]):
+        try:
+            self._packed_rewrite(batch)
+        except BaseException as e:
+            for request in batch:
+                if not request.future.done() and request.future.set_running_or_notify_cancel():
+                    request.future.set_exception(e)
+
+    def _packed_rewrite(self, batch: List[RewriteRequest]):
+        """Un appel OpenRouter pour tout le lot ; relance individuelle des questions manquantes"""
+        # L'échéance la plus proche borne l'appel groupé
+        deadline = min((request.deadline for request in batch), key=lambda d: d.remaining())
+        messages = build_search_query_batch_messages(
+            [(request.user_query, request.time_constraint) for request in batch], batch[0].current_date
+        )
+        try:
+            completion = self.openrouter_service.chat_completion(
+                messages, temperature=0.3, max_tokens=PACKED_MAX_TOKENS_PER_QUESTION * len(batch), timeout=15.0,
+                deadline=deadline
+            )
+        except Exception as e:
+            logger.warning("📦 Réécriture groupée en échec (%s), relance individuelle de %d questions", e, len(batch))
+            completion = {'status_code': None, 'content': ''}
+
+        answers = self._split_packed(completion['content']) if completion['status_code'] == 200 else {}
+        if completion['status_code'] == 429:
+            # Même réponse pour tous : une relance individuelle serait elle aussi limitée
+            answers = {i: None for i in range(1, len(batch) + 1)}
+        retried = 0
+        for i, request in enumerate(batch, 1):
+            if i not in answers:
+                retried += 1
+                self._openrouter_executor.submit(self._run, request, self._openrouter_rewrite)
+            elif request.future.set_running_or_notify_cancel():
+                request.future.set_result(
+                    completion if answers[i] is None else dict(completion, content=json.dumps(answers[i], ensure_ascii=False))
+                )
+
+        outcome = 'ok' if not retried else ('failed' if retried == len(batch) else 'partial')
+        REWRITE_PACKED_RESULTS.inc(outcome=outcome)
+        logger.info("📦 Réécriture groupée OpenRouter : %d questions, %d relancées", len(batch), retried)
+
+    @staticmethod
+    def _split_packed(content: str) -> Dict[int, Dict]:
+        """Objets du tableau JSON indexés par ``id`` (ceux sans requête sont ignorés)"""
+        start, end = content.find('['), content.rfind(']') + 1
+        if start < 0 or end <= start:
+            return {}
+        try:
+            items = json.loads(content[start:end])
+        except json.JSONDecodeError:
+            return {}
+        answers = {}
+        for item in items if isinstance(items, list) else []:
+            if isinstance(item, dict) and isinstance(item.get('id'), int) and item.get('search_query'):
+                answers[item.pop('id')] = item
+        return answers
+
+
+_rewrite_batcher: Optional[RewriteBatcher] = None
+_rewrite_batcher_lock = threading.Lock()
+
+
+def get_rewrite_batcher() -> RewriteBatcher:
+    """Batcher unique du processus, réglé par les settings"""
+    global _rewrite_batcher
+    if _rewrite_batcher is None:
+        with _rewrite_batcher_lock:
+            if _rewrite_batcher is None:
+                _rewrite_batcher = RewriteBatcher(
+                    window_ms=settings.REWRITE_BATCH_WINDOW_MS,
+                    max_batch=settings.REWRITE_BATCH_MAX_SIZE,
+                    max_in_flight=settings.VLLM_MAX_NUM_SEQS,
+                )
+    return _rewrite_batcher
@@ -0,0 +1,422 @@
+"""
+Moteur de scraping asynchrone pour ``MultiSearchService``
+
+- un ``httpx.AsyncClient`` partagé (connexions maintenues et bornées) tourne
+  dans une boucle asyncio dédiée, dans un thread ; le code synchrone lui
+  soumet des coroutines via ``AsyncScraper.run`` (contexte de trace et de
+  métriques propagé) ;
+- la réponse est lue en flux et la lecture s'arrête dès que la page contient
+  ``max_results`` éléments complets (détectés sur les octets bruts, avant tout
+  parsing) ou dépasse ``SCRAPER_MAX_BYTES`` ;
+- ``parse_items`` ne construit que les nœuds des éléments extraits
+  (``SoupStrainer``), avec ``lxml`` s'il est installé, sinon ``html.parser`` ;
+- avec un ``PageCache``, les requêtes sont conditionnelles (``ETag`` /
+  ``Last-Modified``) et respectent ``Cache-Control`` : une page inchangée
+  coûte un 304 (ou rien tant qu'elle est fraîche) et son analyse est
+  réutilisée, indexée par l'empreinte du corps.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import httpx
+from bs4 import BeautifulSoup, SoupStrainer
+from django.conf import settings
+
+from chat.metrics import provider_call, record_cache_lookup
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:  # lxml est optionnel
+    HTML_PARSER = 'html.parser'
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+)
+
+
+class ItemSelector:
+    """Élément à extraire d'une page : balise et classe CSS optionnelle"""
+
+    def __init__(self, tag: str, css_class: Optional[str] = None):
+        self.tag = tag
+        self.css_class = css_class
+        # Ouverture de l'élément dans le HTML brut (comptage avant parsing)
+        class_pattern = (
+            rf"""[^>]*?\sclass\s*=\s*["'](?:[^"'>]*\s)?{re.escape(css_class)}(?=[\s"'])"""
+            if css_class else ''
+        )
+        self.marker = re.compile(rf'<{re.escape(tag)}(?=[\s>/]){class_pattern}'.encode('ascii'), re.IGNORECASE)
+
+    def matches(self, name: str, attrs) -> bool:
+        if name != self.tag:
+            return False
+        if not self.css_class:
+            return True
+        classes = (attrs or {}).get('class') or []
+        if isinstance(classes, str):
+            classes = classes.split()
+        return self.css_class in classes
+
+    def __repr__(self):
+        return f"{self.tag}.{self.css_class}" if self.css_class else self.tag
+
+
+def parse_items(markup: str, selectors: Sequence[ItemSelector], limit: Optional[int] = None, parser: Optional[str] = None) -> List:
+    """Éléments de premier niveau correspondant à ``selectors``, seuls nœuds construits"""
+    strainer = SoupStrainer(lambda name, attrs=None: any(s.matches(name, attrs) for s in selectors))
+    soup = BeautifulSoup(markup, parser or HTML_PARSER, parse_only=strainer)
+    items = [tag for tag in soup.find_all(True, recursive=False) if any(s.matches(tag.name, tag.attrs) for s in selectors)]
+    return items[:limit] if limit else items
+
+
+class ScrapedPage:
+    """Réponse lue (éventuellement tronquée) par ``AsyncScraper.fetch``, ``url`` paramètres compris
+
+    ``body_hash`` identifie le corps, y compris quand il n'a pas été relu
+    (``from_cache`` : page encore fraîche, ``status_code`` 304 : inchangée).
+    """
+
+    def __init__(
+        self,
+        url: str,
+        status_code: int,
+        text: str = '',
+        bytes_read: int = 0,
+        truncated: bool = False,
+        body_hash: Optional[str] = None,
+        from_cache: bool = False,
+    ):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.bytes_read = bytes_read
+        self.truncated = truncated
+        self.body_hash = body_hash
+        self.from_cache = from_cache
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code == 200
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status_code == 304 or self.from_cache
+
+
+def _cache_control(headers) -> Dict[str, Optional[str]]:
+    directives = {}
+    for part in (headers.get('cache-control') or '').split(','):
+        name, _, value = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+class PageCache:
+    """Validateurs HTTP par URL et résultats d'analyse par (URL, empreinte du corps) (LRU)
+
+    L'analyse dépend aussi de la page (liens relatifs, nom du site) : deux
+    URL au corps identique ne partagent pas leur résultat. Une entrée n'est revalidée (``If-None-Match`` / ``If-Modified-Since``)
+    que si l'analyse de son corps est encore en mémoire : un 304 sans elle
+    obligerait à retélécharger la page.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._pages: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._parsed: 'OrderedDict[tuple, object]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def _entry(self, url: str) -> Optional[Dict]:
+        entry = self._pages.get(url)
+        if entry is None or (url, entry['body_hash']) not in self._parsed:
+            return None
+        self._pages.move_to_end(url)
+        return entry
+
+    def fresh_hash(self, url: str) -> Optional[str]:
+        """Empreinte du corps si la page peut être servie sans requête"""
+        with self._lock:
+            entry = self._entry(url)
+            if entry and time.time() < entry['expires_at']:
+                return entry['body_hash']
+        return None
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        with self._lock:
+            entry = self._entry(url)
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url: str, response_headers, body_hash: str):
+        """Enregistre les validateurs d'une réponse 200"""
+        directives = _cache_control(response_headers)
+        etag, last_modified = response_headers.get('etag'), response_headers.get('last-modified')
+        with self._lock:
+            if 'no-store' in directives or not (etag or last_modified or self._max_age(directives, response_headers)):
+                self._pages.pop(url, None)
+                return
+            self._pages[url] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'body_hash': body_hash,
+                'expires_at': self._expires_at(directives, response_headers),
+            }
+            self._pages.move_to_end(url)
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+
+    def revalidated(self, url: str, response_headers) -> Optional[str]:
+        """Réponse 304 : prolonge l'entrée et retourne l'empreinte du corps connu"""
+        directives = _cache_control(response_headers)
+        with self._lock:
+            entry = self._pages.get(url)
+            if entry is None:
+                return None
+            # Un 304 peut porter de nouveaux validateurs et une nouvelle durée
+            entry['etag'] = response_headers.get('etag') or entry['etag']
+            entry['last_modified'] = response_headers.get('last-modified') or entry['last_modified']
+            entry['expires_at'] = self._expires_at(directives, response_headers)
+            return entry['body_hash']
+
+    def get_parsed(self, url: str, body_hash: Optional[str]):
+        if not body_hash:
+            return None
+        with self._lock:
+            parsed = self._parsed.get((url, body_hash))
+            if parsed is not None:
+                self._parsed.move_to_end((url, body_hash))
+            return parsed
+
+    def set_parsed(self, url: str, body_hash: str, parsed):
+        with self._lock:
+            self._parsed[(url, body_hash)] = parsed
+            self._parsed.move_to_end((url, body_hash))
+            while len(self._parsed) > self.max_entries:
+                self._parsed.popitem(last=False)
+
+    @staticmethod
+    def _max_age(directives: Dict[str, Optional[str]], headers) -> int:
+        try:
+            max_age = int(directives.get('max-age') or 0)
+            age = int(headers.get('age') or 0)
+        except ValueError:
+            return 0
+        return max(0, max_age - age)
+
+    def _expires_at(self, directives: Dict[str, Optional[str]], headers) -> float:
+        # no-cache : toujours revalider avant usage
+        if 'no-cache' in directives:
+            return 0.0
+        return time.time() + self._max_age(directives, headers)
+
+
+class AsyncScraper:
+    """Client HTTP asynchrone partagé, servi par une boucle asyncio dans un thread dédié"""
+
+    def __init__(
+        self,
+        max_connections: int = 10,
+        timeout: float = 5.0,
+        max_bytes: int = 2 * 1024 * 1024,
+        user_agent: str = DEFAULT_USER_AGENT,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.user_agent = user_agent
+        self.transport = transport
+
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    # -- Boucle et client ----------------------------------------------------
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='async-scraper', daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Toujours appelé depuis la boucle : pas de concurrence entre threads
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={'User-Agent': self.user_agent},
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                transport=self.transport,
+            )
+        return self._client
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Exécute une coroutine sur la boucle du scraper et attend son résultat"""
+        loop = self._ensure_loop()
+        context = contextvars.copy_context()  # span courant, durées d'étapes
+        result: concurrent.futures.Future = concurrent.futures.Future()
+        tasks = []
+
+        def transfer(task: asyncio.Task):
+            if task.cancelled():
+                result.cancel()
+            elif task.exception() is not None:
+                result.set_exception(task.exception())
+            else:
+                result.set_result(task.result())
+
+        def submit():
+            task = context.run(loop.create_task, coro)
+            task.add_done_callback(transfer)
+            tasks.append(task)
+
+        loop.call_soon_threadsafe(submit)
+        try:
+            return result.result(timeout)
+        except concurrent.futures.TimeoutError:
+            loop.call_soon_threadsafe(lambda: tasks and tasks[0].cancel())
+            raise
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result(5)
+            self._client = None
+        asyncio.run_coroutine_threadsafe(loop.shutdown_asyncgens(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(5)
+        loop.close()
+
+    # -- Lecture -------------------------------------------------------------
+
+    async def fetch(
+        self,
+        url: str,
+        provider: str = 'scrape',
+        params: Optional[Dict] = None,
+        headers: Optional[Dict[str, str]] = None,
+        selectors: Sequence[ItemSelector] = (),
+        max_results: Optional[int] = None,
+        timeout: Optional[float] = None,
+        cache: Optional[PageCache] = None,
+    ) -> ScrapedPage:
+        """GET en flux ; s'arrête une fois ``max_results`` éléments d'un des ``selectors`` reçus
+
+        Avec ``cache``, une page fraîche n'est pas redemandée et les autres
+        sont revalidées par requête conditionnelle.
+        """
+        client = self._get_client()
+        request = client.build_request(
+            'GET', url, params=params,
+            headers=headers,
+            timeout=timeout if timeout is not None else self.timeout,
+        )
+        cache_key = str(request.url)
+        if cache is not None:
+            body_hash = cache.fresh_hash(cache_key)
+            if body_hash:
+                record_cache_lookup('scraped_pages', True)
+                return ScrapedPage(cache_key, 200, body_hash=body_hash, from_cache=True)
+            request.headers.update(cache.conditional_headers(cache_key))
+
+        with provider_call(provider, **{'http.url': url}) as call:
+            response = await client.send(request, stream=True)
+            try:
+                call.status_code = response.status_code
+                if response.status_code == 304 and cache is not None:
+                    body_hash = cache.revalidated(cache_key, response.headers)
+                    record_cache_lookup('scraped_pages', body_hash is not None)
+                    return ScrapedPage(cache_key, 304, body_hash=body_hash)
+                if response.status_code != 200:
+                    return ScrapedPage(cache_key, response.status_code)
+                buffer, truncated = await self._read_items(response, selectors, max_results)
+                call.span.set_attributes({'scrape.bytes_read': len(buffer), 'scrape.truncated': truncated})
+            finally:
+                await response.aclose()
+
+        body_hash = hashlib.sha256(buffer).hexdigest()
+        if cache is not None:
+            record_cache_lookup('scraped_pages', False)
+            cache.store(cache_key, response.headers, body_hash)
+        text = bytes(buffer).decode(response.charset_encoding or 'utf-8', errors='replace')
+        return ScrapedPage(cache_key, response.status_code, text, len(buffer), truncated, body_hash)
+
+    async def _read_items(self, response: httpx.Response, selectors: Sequence[ItemSelector], max_results: Optional[int]):
+        buffer = bytearray()
+        counts = [0] * len(selectors)
+        scanned = 0
+        async for chunk in response.aiter_bytes():
+            buffer.extend(chunk)
+            if len(buffer) >= self.max_bytes:
+                logger.warning("⚠️ Page tronquée à %s octets: %s", self.max_bytes, response.url)
+                return buffer[:self.max_bytes], True
+            if not max_results or not selectors:
+                continue
+            # Seules les balises entièrement reçues sont examinées
+            limit = buffer.rfind(b'>') + 1
+            for i, selector in enumerate(selectors):
+                for match in selector.marker.finditer(buffer, scanned, limit):
+                    counts[i] += 1
+                    if counts[i] > max_results:
+                        # Ouverture de l'élément max_results + 1 : les précédents sont complets
+                        return buffer[:match.start()], True
+            scanned = max(scanned, limit)
+        return buffer, False
+
+
+_scraper: Optional[AsyncScraper] = None
+_scraper_lock = threading.Lock()
+
+
+def get_scraper() -> AsyncScraper:
+    """Scraper partagé du processus"""
+    global _scraper
+    if _scraper is None:
+        with _scraper_lock:
+            if _scraper is None:
+                _scraper = AsyncScraper(
+                    max_connections=settings.SCRAPER_MAX_CONNECTIONS,
+                    timeout=settings.SCRAPER_TIMEOUT,
+                    max_bytes=settings.SCRAPER_MAX_BYTES,
+                )
+    return _scraper
+
+
+_page_cache: Optional[PageCache] = None
+
+
+def get_page_cache() -> PageCache:
+    """Cache des pages scrapées du processus"""
+    global _page_cache
+    if _page_cache is None:
+        with _scraper_lock:
+            if _page_cache is None:
+                _page_cache = PageCache(settings.SCRAPER_PAGE_CACHE_ENTRIES)
+    return _page_cache
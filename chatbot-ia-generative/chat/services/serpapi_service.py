@@ -1,22 +1,89 @@
+import contextvars
 import os
+from concurrent.futures import ThreadPoolExecutor
 from serpapi import GoogleSearch
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional
 import logging
 from datetime import datetime, timedelta
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from chat.models import SearchCache
+from chat import tracing
+from chat.metrics import CANCELLED_SEARCH_CALLS, provider_call, record_cache_lookup
+from .cancellation import CancellationToken, ChatCancelled
+from .deadline import Deadline
+from .load_policy import current_load_level
+from .shared_state import SharedStateUnavailable, get_shared_redis
 import re
 import json
 
 logger = logging.getLogger(__name__)
 
 
+class SerpAPIBudgetExceeded(Exception):
+    """Levée quand le plafond horaire de crédits SerpAPI est atteint."""
+
+
+class SerpAPICreditBudget:
+    """Plafond de crédits SerpAPI par heure, partagé par les workers via Redis.
+
+    Compteur ``INCRBY`` par heure (expiration 1 h). Redis injoignable :
+    repli sur le cache Django, donc un budget par processus le temps de la panne.
+    """
+    
+    def __init__(self, credits_per_hour: int, scope: str = 'default'):
+        self.credits_per_hour = credits_per_hour
+        self.scope = scope
+    
+    def _key(self) -> str:
+        return f"serpapi_credits:{self.scope}:{datetime.now().strftime('%Y%m%d%H')}"
+    
+    def used(self) -> int:
+        key = self._key()
+        try:
+            return int(get_shared_redis().run(lambda r: r.get(key)) or 0)
+        except SharedStateUnavailable:
+            return cache.get(key, 0)
+    
+    def remaining(self) -> int:
+        return max(0, self.credits_per_hour - self.used())
+    
+    def try_consume(self, credits: int = 1) -> bool:
+        """Réserve des crédits pour l'heure courante, False si le plafond est atteint"""
+        key = self._key()
+        try:
+            return get_shared_redis().run(lambda r: self._consume_redis(r, key, credits))
+        except SharedStateUnavailable:
+            pass
+        cache.add(key, 0, timeout=3600)
+        used = cache.incr(key, credits)
+        if used > self.credits_per_hour:
+            cache.decr(key, credits)
+            return False
+        return True
+    
+    def _consume_redis(self, client, key: str, credits: int) -> bool:
+        pipe = client.pipeline()
+        pipe.incrby(key, credits)
+        pipe.expire(key, 3600)
+        used, _ = pipe.execute()
+        if used > self.credits_per_hour:
+            client.decrby(key, credits)
+            return False
+        return True
+
+
 class SerpAPIService:
     """Service intelligent pour recherche web via SerpAPI avec optimisations avancées."""
     
-    def __init__(self):
+    # Nombre maximal d'appels SerpAPI d'une stratégie (news : 3 requêtes + 1 complémentaire)
+    MAX_CREDITS_PER_SEARCH = 4
+    
+    def __init__(self, credit_budget: Optional[SerpAPICreditBudget] = None):
         self.api_key = os.environ.get('SERPAPI_KEY', '8ba4cd7cae7dab8bab44ee1ea895b405552d5b956d2b725122084e5a081eaf9f')
-        self.max_results = settings.MAX_SEARCH_RESULTS
+        self._max_results = settings.MAX_SEARCH_RESULTS
+        self.credit_budget = credit_budget
         
         # Stratégies de recherche par type de requête
         self.search_strategies = {
@@ -26,6 +93,11 @@ class SerpAPIService:
             'academic': self._search_academic_strategy
         }
     
+    @property
+    def max_results(self) -> int:
+        """MAX_SEARCH_RESULTS, réduit en mode dégradé"""
+        return current_load_level().search_results(self._max_results)
+    
     def analyze_query_intent(self, query: str) -> Dict[str, any]:
         """Analyse l'intention de la requête pour optimiser la recherche."""
         query_lower = query.lower()
@@ -79,17 +151,35 @@ class SerpAPIService:
         
         return important_keywords[:5] if important_keywords else keywords[:5]
     
-    def search(self, query: str, search_type: str = None, use_cache: bool = True) -> List[Dict]:
+    def search(
+        self,
+        query: str,
+        search_type: str = None,
+        use_cache: bool = True,
+        max_cache_age_hours: float = 6,
+        cancel_token: Optional[CancellationToken] = None,
+        on_partial: Optional[Callable[[List[Dict]], None]] = None,
+        deadline: Optional[Deadline] = None
+    ) -> List[Dict]:
         """
         Recherche intelligente avec SerpAPI.
+        
+        ``max_cache_age_hours`` borne l'âge accepté d'une entrée en cache
+        (court pour les actualités, les résultats préchargés restent valides).
+        ``cancel_token`` interrompt la série de sous-requêtes d'une stratégie.
+        ``on_partial`` reçoit chaque lot de résultats d'une sous-requête dès sa
+        réception (génération en pipeline), avant le résultat complet.
+        ``deadline`` borne chaque appel et saute ceux qui n'ont plus le temps.
         """
-        logger.info(f"\n🔍 SERPAPI - RECHERCHE INTELLIGENTE")
+        cache_key = self._cache_key(query, search_type)
         
         # Vérifier le cache
         if use_cache:
-            cached = self._get_cached_results(query)
+            cached = self._get_cached_results(cache_key, max_cache_age_hours)
+            record_cache_lookup('serpapi', bool(cached))
+            tracing.current_span().set_attribute('serpapi.cache_hit', bool(cached))
             if cached:
-                logger.info(f"📦 Utilisation du cache pour: {query[:50]}...")
+                logger.info("📦 Utilisation du cache pour: %s...", query[:50])
                 return cached
         
         # Analyser l'intention de la requête
@@ -97,40 +187,80 @@ class SerpAPIService:
         # Override avec search_type si fourni
         if search_type:
             intent['type'] = search_type
-        logger.info(f"🧠 Analyse: Type={intent['type']}, Langue={intent['language']}, Mots-clés={intent['keywords']}")
+        intent['cancel_token'] = cancel_token
+        intent['on_partial'] = on_partial
+        intent['deadline'] = deadline
+        logger.info(
+            "🔍 SerpAPI: type=%s, langue=%s, mots-clés=%s",
+            intent['type'], intent['language'], intent['keywords']
+        )
         
         # Utiliser la stratégie appropriée
         strategy = self.search_strategies.get(intent['type'], self._search_general_strategy)
         results = strategy(intent)
         
+        # Les sous-requêtes restantes ont été sautées : ne pas cacher un résultat partiel
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        if deadline and 'search' in deadline.degraded_stages:
+            use_cache = False
+        
         # Enrichir et scorer les résultats
         if results:
             results = self._enrich_and_score_results(results, intent)
             
-            # Afficher les résultats dans la console pour debug
-            logger.info("\n" + "🌎"*40)
-            logger.info("🎯 RÉSULTATS SERPAPI")
-            logger.info("🌎"*40)
-            for i, r in enumerate(results):
-                logger.info(f"\n📌 Résultat {i+1}:")
-                logger.info(f"   📝 Titre: {r['title']}")
-                logger.info(f"   🌐 URL: {r['url']}")
-                logger.info(f"   🏢 Source: {r['source']}")
-                logger.info(f"   📅 Date: {r.get('date', 'N/A')}")
-                logger.info(f"   📊 Score: {r.get('relevance_score', 0):.1%}")
-                logger.info(f"   🏷️ Tags: {', '.join(r.get('tags', []))}")
-                logger.info(f"   💬 Contenu: {r['content'][:200]}...")
-            logger.info("🌎"*40 + "\n")
+            # Résumé en info, détail par résultat en debug
+            logger.info("🎯 %d résultats SerpAPI pour: %.50s", len(results), query)
+            if logger.isEnabledFor(logging.DEBUG):
+                # Détail par résultat : debug échantillonné (voir SamplingFilter)
+                for i, r in enumerate(results):
+                    logger.debug(
+                        "📌 Résultat %d: %s (%s) score=%.2f",
+                        i + 1, r['title'], r['url'], r.get('relevance_score', 0),
+                        extra={'sampled': True, 'source': r['source'], 'date': r.get('date')}
+                    )
             
             # Mettre en cache
             if use_cache:
-                self._cache_results(query, results)
+                self._cache_results(cache_key, results)
         
         return results
     
+    def _execute_search(
+        self,
+        params: Dict,
+        cancel_token: Optional[CancellationToken] = None,
+        deadline: Optional[Deadline] = None
+    ) -> Dict:
+        """Exécute un appel SerpAPI (1 crédit), en respectant le budget, l'échéance et l'annulation éventuels."""
+        if cancel_token and cancel_token.cancelled:
+            CANCELLED_SEARCH_CALLS.inc()
+            raise ChatCancelled(cancel_token.reason)
+        deadline = deadline or Deadline()
+        # Pas de crédit consommé pour un appel qui n'aurait pas le temps d'aboutir
+        deadline.check('search')
+        if self.credit_budget and not self.credit_budget.try_consume(1):
+            raise SerpAPIBudgetExceeded(f"Budget SerpAPI '{self.credit_budget.scope}' épuisé pour cette heure")
+        with provider_call('serpapi', **{'serpapi.q': params.get('q'), 'serpapi.tbm': params.get('tbm')}) as call:
+            search = GoogleSearch(params)
+            # Le client serpapi passe ce timeout (secondes) à requests, 60000 par défaut
+            search.timeout = deadline.timeout(settings.SERPAPI_TIMEOUT)
+            results = search.get_dict()
+            call.span.set_attribute(
+                'serpapi.results',
+                len(results.get('organic_results', [])) + len(results.get('news_results', []))
+            )
+            error = results.get('error')
+            if error:
+                # SerpAPI renvoie l'erreur dans le JSON (quota épuisé = 429 côté API)
+                rate_limited = 'run out of searches' in error.lower() or 'rate limit' in error.lower()
+                call.status_code = 429 if rate_limited else None
+                call.error_kind = 'api_error'
+        return results
+    
     def _search_news_strategy(self, intent: Dict) -> List[Dict]:
         """Stratégie optimisée pour les actualités."""
-        logger.info(f"📰 Stratégie NEWS activée")
+        logger.info("📰 Stratégie NEWS activée")
         
         # Requêtes multiples pour couvrir différents angles
         queries = [
@@ -144,70 +274,19 @@ class SerpAPIService:
         
         all_results = []
         
-        for query in queries:
-            params = {
-                "q": query,
-                "api_key": self.api_key,
-                "tbm": "nws",  # Google News
-                "tbs": "qdr:w,sbd:1",  # Dernière semaine, triés par date
-                "num": 20,  # Plus de résultats pour filtrer
-                "hl": intent['language'],
-                "gl": "fr" if intent['language'] == 'fr' else "us"
-            }
-        
-            try:
-                search = GoogleSearch(params)
-                results = search.get_dict()
-                
-                if "news_results" in results:
-                    for item in results["news_results"]:
-                        # Éviter les doublons
-                        if not any(r['url'] == item.get('link', '') for r in all_results):
-                            date_parsed = self._parse_serpapi_date(item.get('date', ''))
-                            all_results.append({
-                                'title': item.get('title', ''),
-                                'url': item.get('link', ''),
-                                'content': item.get('snippet', ''),
-                                'source': item.get('source', {}).get('name', '') if isinstance(item.get('source'), dict) else item.get('source', ''),
-                                'date': item.get('date', ''),
-                                'date_parsed': date_parsed.isoformat() if date_parsed else None,
-                                'relevance_score': self._calculate_news_relevance(item, intent)
-                            })
-            except Exception as e:
-                logger.error(f"❌ Erreur pour requête '{query[:50]}...': {str(e)}")
+        for items in self._run_sub_queries(queries, intent, self._news_sub_query):
+            for item in items:
+                # Éviter les doublons
+                if not any(r['url'] == item['url'] for r in all_results):
+                    all_results.append(item)
         
         # Si pas assez de résultats news, chercher aussi dans les résultats web récents
-        if len(all_results) < 5:
+        # (sous-requête sautée en mode dégradé)
+        if len(all_results) < 5 and not current_load_level().skip_web_fallback:
             logger.info("🔄 Recherche complémentaire dans les résultats web")
-            web_params = {
-                "q": f'{intent["original_query"]} "announced today" OR "announced yesterday" OR "launching" AI',
-                "api_key": self.api_key,
-                "num": 10,
-                "tbs": "qdr:d",  # Dernières 24h
-                "hl": intent['language']
-            }
-            
-            try:
-                search = GoogleSearch(web_params)
-                results = search.get_dict()
-                
-                if "organic_results" in results:
-                    for item in results["organic_results"]:
-                        # Vérifier si c'est vraiment une actualité récente
-                        snippet = item.get('snippet', '').lower()
-                        if any(word in snippet for word in ['today', 'yesterday', 'announced', 'launches', 'releases', 'introduces']):
-                            date_parsed = datetime.now() - timedelta(hours=12)  # Estimation récente
-                            all_results.append({
-                                'title': item.get('title', ''),
-                                'url': item.get('link', ''),
-                                'content': item.get('snippet', ''),
-                                'source': self._extract_domain(item.get('link', '')),
-                                'date': 'Recent',
-                                'date_parsed': date_parsed.isoformat(),
-                                'relevance_score': self._calculate_news_relevance(item, intent) * 0.9  # Légèrement moins pertinent
-                            })
-            except Exception as e:
-                logger.error(f"❌ Erreur recherche web complémentaire: {str(e)}")
+            web_items = self._news_web_fallback(intent)
+            self._emit_partial(intent, web_items)
+            all_results.extend(web_items)
         
         # Trier par pertinence et date
         all_results.sort(key=lambda x: (x['relevance_score'], self._parse_date_priority(x.get('date', ''))), reverse=True)
@@ -221,12 +300,113 @@ class SerpAPIService:
                 unique_results.append(result)
                 seen_titles.add(title_key)
         
-        logger.info(f"✅ {len(unique_results)} actualités uniques trouvées")
+        logger.info("✅ %s actualités uniques trouvées", len(unique_results))
         return unique_results[:self.max_results]
     
+    def _news_sub_query(self, query: str, intent: Dict) -> List[Dict]:
+        """Une requête Google News de la stratégie actualités, résultats formatés."""
+        params = {
+            "q": query,
+            "api_key": self.api_key,
+            "tbm": "nws",  # Google News
+            "tbs": "qdr:w,sbd:1",  # Dernière semaine, triés par date
+            "num": 20,  # Plus de résultats pour filtrer
+            "hl": intent['language'],
+            "gl": "fr" if intent['language'] == 'fr' else "us"
+        }
+        
+        items = []
+        try:
+            results = self._execute_search(params, intent.get('cancel_token'), intent.get('deadline'))
+            
+            for item in results.get("news_results", []):
+                date_parsed = self._parse_serpapi_date(item.get('date', ''))
+                items.append({
+                    'title': item.get('title', ''),
+                    'url': item.get('link', ''),
+                    'content': item.get('snippet', ''),
+                    'source': item.get('source', {}).get('name', '') if isinstance(item.get('source'), dict) else item.get('source', ''),
+                    'date': item.get('date', ''),
+                    'date_parsed': date_parsed.isoformat() if date_parsed else None,
+                    'relevance_score': self._calculate_news_relevance(item, intent)
+                })
+        except Exception as e:
+            logger.error("❌ Erreur pour requête '%s...': %s", query[:50], e)
+        return items
+    
+    def _news_web_fallback(self, intent: Dict) -> List[Dict]:
+        """Recherche complémentaire dans les résultats web des dernières 24h."""
+        web_params = {
+            "q": f'{intent["original_query"]} "announced today" OR "announced yesterday" OR "launching" AI',
+            "api_key": self.api_key,
+            "num": 10,
+            "tbs": "qdr:d",  # Dernières 24h
+            "hl": intent['language']
+        }
+        
+        items = []
+        try:
+            results = self._execute_search(web_params, intent.get('cancel_token'), intent.get('deadline'))
+            
+            for item in results.get("organic_results", []):
+                # Vérifier si c'est vraiment une actualité récente
+                snippet = item.get('snippet', '').lower()
+                if any(word in snippet for word in ['today', 'yesterday', 'announced', 'launches', 'releases', 'introduces']):
+                    date_parsed = datetime.now() - timedelta(hours=12)  # Estimation récente
+                    items.append({
+                        'title': item.get('title', ''),
+                        'url': item.get('link', ''),
+                        'content': item.get('snippet', ''),
+                        'source': self._extract_domain(item.get('link', '')),
+                        'date': 'Recent',
+                        'date_parsed': date_parsed.isoformat(),
+                        'relevance_score': self._calculate_news_relevance(item, intent) * 0.9  # Légèrement moins pertinent
+                    })
+        except Exception as e:
+            logger.error("❌ Erreur recherche web complémentaire: %s", e)
+        return items
+    
+    def _run_sub_queries(
+        self,
+        queries: List[str],
+        intent: Dict,
+        run_query: Callable[[str, Dict], List[Dict]]
+    ) -> List[List[Dict]]:
+        """
+        Exécute les sous-requêtes d'une stratégie, résultats dans l'ordre des requêtes.
+        
+        En mode pipeline (``intent['on_partial']``), elles partent en parallèle et
+        chaque lot est remonté dès sa réception ; sinon elles restent séquentielles.
+        """
+        if not intent.get('on_partial') or len(queries) < 2:
+            return [self._run_sub_query(run_query, query, intent) for query in queries]
+        
+        with ThreadPoolExecutor(max_workers=len(queries), thread_name_prefix='serpapi-subquery') as pool:
+            # Un contexte copié par tâche : span parent et request-id dans chaque thread
+            futures = [
+                pool.submit(contextvars.copy_context().run, self._run_sub_query, run_query, query, intent)
+                for query in queries
+            ]
+            return [future.result() for future in futures]
+    
+    def _run_sub_query(self, run_query: Callable[[str, Dict], List[Dict]], query: str, intent: Dict) -> List[Dict]:
+        items = run_query(query, intent)
+        self._emit_partial(intent, items)
+        return items
+    
+    def _emit_partial(self, intent: Dict, items: List[Dict]):
+        """Remonte un lot de résultats enrichis à l'appelant (mode pipeline)."""
+        on_partial = intent.get('on_partial')
+        if not on_partial or not items:
+            return
+        try:
+            on_partial(self._enrich_and_score_results([dict(item) for item in items], intent))
+        except Exception as e:
+            logger.error("Erreur remontée résultats partiels: %s", e)
+    
     def _search_technical_strategy(self, intent: Dict) -> List[Dict]:
         """Stratégie pour recherches techniques/tutoriels."""
-        logger.info(f"🔧 Stratégie TECHNIQUE activée")
+        logger.info("🔧 Stratégie TECHNIQUE activée")
         
         # Ajouter des sites techniques de référence
         tech_sites = "site:github.com OR site:stackoverflow.com OR site:medium.com OR site:dev.to"
@@ -240,8 +420,7 @@ class SerpAPIService:
         }
         
         try:
-            search = GoogleSearch(params)
-            results = search.get_dict()
+            results = self._execute_search(params, intent.get('cancel_token'), intent.get('deadline'))
             
             formatted_results = []
             if "organic_results" in results:
@@ -261,16 +440,16 @@ class SerpAPIService:
                 'stackoverflow.com' in x['url']
             ), reverse=True)
             
-            logger.info(f"✅ {len(formatted_results)} résultats techniques trouvés")
+            logger.info("✅ %s résultats techniques trouvés", len(formatted_results))
             return formatted_results[:self.max_results]
             
         except Exception as e:
-            logger.error(f"❌ Erreur SerpAPI Technical: {str(e)}")
+            logger.error("❌ Erreur SerpAPI Technical: %s", e)
             return []
     
     def _search_general_strategy(self, intent: Dict) -> List[Dict]:
         """Stratégie de recherche générale avec AI Overview."""
-        logger.info(f"🌐 Stratégie GÉNÉRALE activée")
+        logger.info("🌐 Stratégie GÉNÉRALE activée")
         
         params = {
             "q": intent['original_query'],
@@ -281,8 +460,7 @@ class SerpAPIService:
         }
         
         try:
-            search = GoogleSearch(params)
-            results = search.get_dict()
+            results = self._execute_search(params, intent.get('cancel_token'), intent.get('deadline'))
             
             formatted_results = []
             
@@ -313,16 +491,16 @@ class SerpAPIService:
             # Trier par pertinence
             formatted_results.sort(key=lambda x: x['relevance_score'], reverse=True)
             
-            logger.info(f"✅ {len(formatted_results)} résultats généraux trouvés")
+            logger.info("✅ %s résultats généraux trouvés", len(formatted_results))
             return formatted_results[:self.max_results]
             
         except Exception as e:
-            logger.error(f"❌ Erreur SerpAPI General: {str(e)}")
+            logger.error("❌ Erreur SerpAPI General: %s", e)
             return []
     
     def _search_academic_strategy(self, intent: Dict) -> List[Dict]:
         """Stratégie pour recherches académiques."""
-        logger.info(f"🎓 Stratégie ACADÉMIQUE activée")
+        logger.info("🎓 Stratégie ACADÉMIQUE activée")
         
         # Utiliser Google Scholar
         params = {
@@ -334,8 +512,7 @@ class SerpAPIService:
         }
         
         try:
-            search = GoogleSearch(params)
-            results = search.get_dict()
+            results = self._execute_search(params, intent.get('cancel_token'), intent.get('deadline'))
             
             formatted_results = []
             if "organic_results" in results:
@@ -348,11 +525,11 @@ class SerpAPIService:
                         'relevance_score': self._calculate_relevance(item, intent)
                     })
             
-            logger.info(f"✅ {len(formatted_results)} résultats académiques trouvés")
+            logger.info("✅ %s résultats académiques trouvés", len(formatted_results))
             return formatted_results[:self.max_results]
             
         except Exception as e:
-            logger.error(f"❌ Erreur SerpAPI Academic: {str(e)}")
+            logger.error("❌ Erreur SerpAPI Academic: %s", e)
             # Fallback vers recherche générale
             return self._search_general_strategy(intent)
     
@@ -524,25 +701,30 @@ class SerpAPIService:
         except:
             return 'Unknown'
     
-    def _get_cached_results(self, query: str) -> Optional[List[Dict]]:
+    def _cache_key(self, query: str, search_type: Optional[str] = None) -> str:
+        """Clé du cache de recherche : le type de stratégie fait partie de la clé."""
+        key = f"{search_type}:{query}" if search_type else query
+        return key[:500]
+    
+    def _get_cached_results(self, query: str, max_age_hours: float = 6) -> Optional[List[Dict]]:
         """Récupère les résultats en cache."""
         try:
             cache_entry = SearchCache.objects.filter(query=query).first()
-            if cache_entry and not cache_entry.is_expired(6):  # Cache 6h pour SerpAPI
+            if cache_entry and not cache_entry.is_expired(max_age_hours):  # Cache 6h par défaut pour SerpAPI
                 return cache_entry.results
         except Exception as e:
-            logger.error(f"Erreur cache: {e}")
+            logger.error("Erreur cache: %s", e)
         return None
     
     def _cache_results(self, query: str, results: List[Dict]):
-        """Met en cache les résultats."""
+        """Met en cache les résultats (une entrée rafraîchie redevient fraîche)."""
         try:
             SearchCache.objects.update_or_create(
                 query=query,
-                defaults={'results': results}
+                defaults={'results': results, 'created_at': timezone.now()}
             )
         except Exception as e:
-            logger.error(f"Erreur mise en cache: {e}")
+            logger.error("Erreur mise en cache: %s", e)
     
     def get_trending_topics(self) -> List[Dict]:
         """Récupère les sujets tendances en IA."""
@@ -555,8 +737,7 @@ class SerpAPIService:
         }
         
         try:
-            search = GoogleSearch(params)
-            results = search.get_dict()
+            results = self._execute_search(params)
             
             topics = []
             if "news_results" in results:
@@ -569,7 +750,7 @@ class SerpAPIService:
             return topics
             
         except Exception as e:
-            logger.error(f"Erreur trending topics: {e}")
+            logger.error("Erreur trending topics: %s", e)
             return []
     
     def _parse_serpapi_date(self, date_str: str) -> datetime:
@@ -630,6 +811,6 @@ class SerpAPIService:
                 return datetime(year, month, day)
                 
         except Exception as e:
-            logger.error(f"Erreur parsing date '{date_str}': {e}")
+            logger.error("Erreur parsing date '%s': %s", date_str, e)
             
         return None
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+État partagé entre workers (Redis)
+
+Le cache Django est un ``LocMemCache`` : propre à chaque processus. Ce qui
+doit être commun à tous les workers Daphne/Gunicorn (budget de crédits
+SerpAPI, verrou du préchargeur...) passe par Redis, déjà requis par le
+channel layer.
+
+Redis injoignable : ``SharedStateUnavailable`` est levée immédiatement
+pendant ``SHARED_STATE_REDIS_RETRY_SECONDS`` (pas de timeout réseau payé à
+chaque appel), à l'appelant de choisir son repli.
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SharedStateUnavailable(Exception):
+    """Redis injoignable (ou en attente d'un nouvel essai)"""
+
+
+class SharedRedis:
+    """Client Redis du processus, avec pause après une erreur de connexion"""
+
+    def __init__(self, url: str, socket_timeout: float, retry_seconds: float):
+        self.client = redis.Redis.from_url(
+            url, socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout, decode_responses=True
+        )
+        self._retry_seconds = retry_seconds
+        self._down_until = 0.0
+
+    def run(self, operation: Callable[[redis.Redis], Any]) -> Any:
+        """Exécute ``operation(client)`` ; ``SharedStateUnavailable`` si Redis ne répond pas"""
+        if time.monotonic() < self._down_until:
+            raise SharedStateUnavailable("Redis en pause après une erreur")
+        try:
+            return operation(self.client)
+        except redis.RedisError as e:
+            self._down_until = time.monotonic() + self._retry_seconds
+            logger.warning("⚠️ Redis injoignable pour l'état partagé (%s), nouvel essai dans %.0fs",
+                           e, self._retry_seconds)
+            raise SharedStateUnavailable(str(e)) from e
+
+
+_shared_redis: Optional[SharedRedis] = None
+_shared_redis_lock = threading.Lock()
+
+
+def get_shared_redis() -> SharedRedis:
+    global _shared_redis
+    if _shared_redis is None:
+        with _shared_redis_lock:
+            if _shared_redis is None:
+                _shared_redis = SharedRedis(
+                    settings.SHARED_STATE_REDIS_URL,
+                    socket_timeout=settings.SHARED_STATE_REDIS_TIMEOUT,
+                    retry_seconds=settings.SHARED_STATE_REDIS_RETRY_SECONDS,
+                )
+    return _shared_redis
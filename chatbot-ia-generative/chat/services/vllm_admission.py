@@ -0,0 +1,207 @@
+"""
+Contrôle d'admission côté client pour l'instance vLLM (CPU)
+
+Au plus ``VLLM_MAX_NUM_SEQS`` appels vLLM sont en vol depuis le processus ;
+les suivants attendent dans une file équitable : une file FIFO par
+conversation, servies à tour de rôle (une conversation bavarde ne peut pas
+affamer les autres). Après ``VLLM_QUEUE_TIMEOUT`` secondes d'attente (ou à
+l'échéance du tour), l'appel abandonne avec ``VLLMQueueTimeout`` et
+l'appelant bascule aussitôt vers OpenRouter au lieu d'attendre le timeout
+de 300 s du modèle local.
+
+La conversation et l'écouteur de position viennent du contexte du tour
+(``queue_context``) : le consumer WebSocket reçoit un événement de
+progression ``vllm_queue`` avec la position dans la file.
+"""
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Optional
+
+from django.conf import settings
+
+from chat.metrics import VLLM_IN_FLIGHT, VLLM_QUEUE_DEPTH, VLLM_QUEUE_TIMEOUTS, VLLM_QUEUE_WAIT
+
+from .cancellation import CancellationToken
+from .deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+_queue_key: contextvars.ContextVar = contextvars.ContextVar('vllm_queue_key', default=None)
+_position_listener: contextvars.ContextVar = contextvars.ContextVar('vllm_position_listener', default=None)
+
+
+class VLLMQueueTimeout(Exception):
+    """Levée quand un appel vLLM a attendu sa place trop longtemps."""
+
+
+@contextmanager
+def queue_context(key: Optional[str] = None, on_position: Optional[Callable[[int], None]] = None):
+    """Clé d'équité (conversation) et écouteur de position pour les appels vLLM du tour"""
+    tokens = (
+        _queue_key.set(key or uuid.uuid4().hex),  # nouvelle conversation : sa propre file
+        _position_listener.set(on_position),
+    )
+    try:
+        yield
+    finally:
+        _position_listener.reset(tokens[1])
+        _queue_key.reset(tokens[0])
+
+
+class _Waiter:
+    def __init__(self, key: str):
+        self.key = key
+        self.granted = False
+        self.position: Optional[int] = None
+
+
+class VLLMAdmissionController:
+    """Sémaphore borné avec file équitable (tourniquet entre conversations)"""
+
+    def __init__(self, capacity: int, queue_timeout: float):
+        self.capacity = capacity
+        self.queue_timeout = queue_timeout
+        self._in_flight = 0
+        # Ordre du tourniquet : la conversation servie repasse en fin de tour
+        self._queues: 'OrderedDict[str, Deque[_Waiter]]' = OrderedDict()
+        self._condition = threading.Condition()
+        self._counters = {'admitted': 0, 'queued': 0, 'timeouts': 0}
+
+    @contextmanager
+    def slot(self, deadline: Optional[Deadline] = None, cancel_token: Optional[CancellationToken] = None):
+        """Réserve une place pour un appel vLLM (attente équitable, bornée)"""
+        self._acquire(deadline or Deadline(), cancel_token)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _acquire(self, deadline: Deadline, cancel_token: Optional[CancellationToken]):
+        key = _queue_key.get() or 'default'
+        listener = _position_listener.get()
+        with self._condition:
+            if self._in_flight < self.capacity and not self._queues:
+                self._admit()
+                return
+            waiter = _Waiter(key)
+            self._queues.setdefault(key, deque()).append(waiter)
+            self._counters['queued'] += 1
+            self._update_gauges()
+
+        start = time.monotonic()
+        timeout = min(self.queue_timeout, deadline.remaining())
+        unregister = cancel_token.on_cancel(self._wake) if cancel_token else (lambda: None)
+        try:
+            while True:
+                with self._condition:
+                    if waiter.granted:
+                        break
+                    cancelled = cancel_token is not None and cancel_token.cancelled
+                    remaining = timeout - (time.monotonic() - start)
+                    if cancelled or remaining <= 0:
+                        self._withdraw(waiter)
+                        if not cancelled:
+                            self._counters['timeouts'] += 1
+                    else:
+                        position = self._position(waiter)
+                        changed = position != waiter.position
+                        waiter.position = position
+                        if not changed or listener is None:
+                            self._condition.wait(remaining)
+                            continue
+                if cancelled:
+                    cancel_token.raise_if_cancelled()
+                if remaining <= 0:
+                    VLLM_QUEUE_TIMEOUTS.inc()
+                    logger.warning("⏱️ File vLLM : %.1fs d'attente sans place (%s), abandon", timeout, key[:8])
+                    raise VLLMQueueTimeout(f"Aucune place vLLM après {timeout:.1f}s d'attente")
+                # Hors verrou : l'écouteur envoie un message au client
+                listener(position)
+        finally:
+            unregister()
+        waited = time.monotonic() - start
+        VLLM_QUEUE_WAIT.observe(waited)
+        logger.info("🎟️ Place vLLM obtenue après %.2fs d'attente", waited)
+
+    def _admit(self):
+        self._in_flight += 1
+        self._counters['admitted'] += 1
+        self._update_gauges()
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            while self._in_flight < self.capacity and self._queues:
+                key, queue = next(iter(self._queues.items()))
+                waiter = queue.popleft()
+                if queue:
+                    self._queues.move_to_end(key)
+                else:
+                    del self._queues[key]
+                waiter.granted = True
+                self._admit()
+            self._update_gauges()
+            self._condition.notify_all()
+
+    def _withdraw(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.key)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.key]
+        self._update_gauges()
+        # Les positions des suivants changent
+        self._condition.notify_all()
+
+    def _wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def _position(self, waiter: _Waiter) -> int:
+        """Rang de service (1 = prochain) selon l'ordre du tourniquet"""
+        index = self._queues[waiter.key].index(waiter)
+        position = index + 1
+        before = True
+        for key, queue in self._queues.items():
+            if key == waiter.key:
+                before = False
+                continue
+            # Les conversations placées avant dans le tour passent aussi au tour de la nôtre
+            position += min(len(queue), index + 1 if before else index)
+        return position
+
+    def _update_gauges(self):
+        VLLM_IN_FLIGHT.set(self._in_flight)
+        VLLM_QUEUE_DEPTH.set(sum(len(queue) for queue in self._queues.values()))
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            return {
+                'capacity': self.capacity,
+                'in_flight': self._in_flight,
+                'queue_depth': sum(len(queue) for queue in self._queues.values()),
+                'queued_conversations': len(self._queues),
+                **self._counters,
+            }
+
+
+_vllm_admission: Optional[VLLMAdmissionController] = None
+_vllm_admission_lock = threading.Lock()
+
+
+def get_vllm_admission() -> VLLMAdmissionController:
+    """Contrôleur unique du processus, dimensionné sur la capacité du serveur vLLM"""
+    global _vllm_admission
+    if _vllm_admission is None:
+        with _vllm_admission_lock:
+            if _vllm_admission is None:
+                _vllm_admission = VLLMAdmissionController(
+                    capacity=settings.VLLM_MAX_NUM_SEQS,
+                    queue_timeout=settings.VLLM_QUEUE_TIMEOUT,
+                )
+    return _vllm_admission
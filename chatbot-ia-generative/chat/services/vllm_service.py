@@ -1,9 +1,18 @@
 import os
 import logging
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional
+from contextlib import nullcontext
 import requests
 from django.conf import settings
 
+from chat import fast_json
+from chat.metrics import provider_call, record_cancellation
+from chat.tracing import inject_trace_headers
+from .cancellation import CancellationToken, ChatCancelled
+from .deadline import Deadline
+from .load_policy import current_load_level
+from .vllm_admission import VLLMQueueTimeout, get_vllm_admission
+
 logger = logging.getLogger(__name__)
 
 class VLLMService:
@@ -13,6 +22,7 @@ class VLLMService:
         self.base_url = getattr(settings, 'VLLM_BASE_URL', 'http://localhost:8000')
         self.model = getattr(settings, 'VLLM_MODEL', 'meta-llama/Llama-3.2-3B-Instruct')
         self.timeout = 300  # 5 minutes pour CPU
+        self.temperature = 0.7
         
     def is_available(self) -> bool:
         """Vérifie si vLLM est disponible"""
@@ -22,45 +32,93 @@ class VLLMService:
         except Exception:
             return False
     
-    def generate_response(self, prompt: str, context: Optional[str] = None) -> Dict:
-        """Génère une réponse avec vLLM en utilisant l'API compatible OpenAI"""
-        try:
-            # Construire les messages
-            messages = []
-            
-            if context:
-                messages.append({
-                    "role": "system",
-                    "content": f"Utilise ce contexte de recherche web pour répondre: {context}"
-                })
-            
-            messages.append({
-                "role": "user",
-                "content": prompt
+    def _build_messages(
+        self,
+        prompt: Optional[str],
+        context: Optional[str],
+        messages: Optional[List[Dict]]
+    ) -> List[Dict]:
+        """Construit les messages, en gardant les rôles system/user fournis tels quels"""
+        if messages:
+            return list(messages)
+        
+        built = []
+        if context:
+            built.append({
+                "role": "system",
+                "content": f"Utilise ce contexte de recherche web pour répondre: {context}"
             })
+        
+        built.append({
+            "role": "user",
+            "content": prompt
+        })
+        return built
+    
+    def generate_response(
+        self,
+        prompt: Optional[str] = None,
+        context: Optional[str] = None,
+        messages: Optional[List[Dict]] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        deadline: Optional[Deadline] = None
+    ) -> Dict:
+        """Génère une réponse avec vLLM en utilisant l'API compatible OpenAI
+        
+        ``messages`` permet d'envoyer directement des rôles system/user : le
+        message système statique reste un préfixe stable pour le cache de vLLM.
+        Avec ``on_token`` ou ``cancel_token``, la génération passe en streaming :
+        les tokens sont relayés au fil de l'eau et la connexion est fermée dès
+        l'annulation, ce qui libère la capacité du serveur vLLM.
+        ``deadline`` borne le timeout et tronque le streaming à l'échéance.
+        """
+        deadline = deadline or Deadline()
+        try:
+            messages = self._build_messages(prompt, context, messages)
             
             # Préparer la requête compatible OpenAI
             payload = {
                 "model": self.model,
                 "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 500,  # Réduit pour CPU
+                "temperature": self.temperature,
+                "max_tokens": current_load_level().max_tokens(500),  # Réduit pour CPU (et en mode dégradé)
                 "top_p": 0.9
             }
             
-            # Envoyer la requête à l'endpoint compatible OpenAI
-            url = f"{self.base_url}/v1/chat/completions"
-            logger.info(f"🚀 Envoi requête vLLM vers: {url}")
-            logger.info(f"⏱️ Mode CPU: cela peut prendre 1-2 minutes...")
-            response = requests.post(
-                url,
-                json=payload,
-                timeout=self.timeout,
-                headers={"Content-Type": "application/json"}
-            )
+            # Place dans la file équitable : au plus VLLM_MAX_NUM_SEQS appels en vol
+            with self._admission(deadline, cancel_token):
+                if on_token or cancel_token:
+                    chunks = []
+                    for token in self._iter_stream(payload, cancel_token, deadline):
+                        chunks.append(token)
+                        if on_token:
+                            on_token(token)
+                    return {
+                        "success": True,
+                        "response": "".join(chunks),
+                        "model": self.model,
+                        "provider": "vllm_local",
+                        "usage": {}
+                    }
+            
+                # Envoyer la requête à l'endpoint compatible OpenAI
+                url = f"{self.base_url}/v1/chat/completions"
+                logger.info("🚀 Envoi requête vLLM vers: %s", url)
+                logger.info("⏱️ Mode CPU: cela peut prendre 1-2 minutes...")
+                span_attributes = {'llm.model': self.model, 'llm.max_tokens': payload['max_tokens'], 'llm.stream': False}
+                with provider_call('vllm', **span_attributes) as call:
+                    response = requests.post(
+                        url,
+                        json=payload,
+                        timeout=deadline.timeout(self.timeout),
+                        headers=inject_trace_headers({"Content-Type": "application/json"})
+                    )
+                    call.status_code = response.status_code
+                    data = fast_json.loads(response.content) if response.status_code == 200 else {}
+                    call.usage = data.get('usage')
             
             if response.status_code == 200:
-                data = response.json()
                 # Extraire la réponse du format OpenAI
                 content = data['choices'][0]['message']['content']
                 return {
@@ -71,13 +129,22 @@ class VLLMService:
                     "usage": data.get('usage', {})
                 }
             else:
-                logger.error(f"Erreur vLLM: {response.status_code} - {response.text}")
+                logger.error("Erreur vLLM: %s - %s", response.status_code, response.text)
                 return {
                     "success": False,
                     "error": f"Erreur du serveur vLLM: {response.status_code}",
                     "provider": "vllm_local"
                 }
-                
+            
+        except ChatCancelled:
+            raise
+        except VLLMQueueTimeout as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "provider": "vllm_local",
+                "queue_timeout": True  # l'appelant bascule vers OpenRouter
+            }
         except requests.Timeout:
             logger.error("Timeout lors de la génération avec vLLM")
             return {
@@ -86,68 +153,105 @@ class VLLMService:
                 "provider": "vllm_local"
             }
         except Exception as e:
-            logger.error(f"Erreur lors de la génération: {e}")
+            logger.error("Erreur lors de la génération: %s", e)
             return {
                 "success": False,
                 "error": str(e),
                 "provider": "vllm_local"
             }
     
-    def generate_streaming_response(self, prompt: str, context: Optional[str] = None):
-        """Génère une réponse en streaming avec vLLM"""
-        try:
-            messages = []
+    def _admission(self, deadline: Deadline, cancel_token: Optional[CancellationToken] = None):
+        if not settings.VLLM_ADMISSION_ENABLED:
+            return nullcontext()
+        return get_vllm_admission().slot(deadline, cancel_token)
+    
+    def _iter_stream(
+        self,
+        payload: Dict,
+        cancel_token: Optional[CancellationToken] = None,
+        deadline: Optional[Deadline] = None
+    ) -> Iterator[str]:
+        """Itère sur les tokens d'une complétion SSE ; l'annulation ferme la connexion amont"""
+        deadline = deadline or Deadline()
+        span_attributes = {'llm.model': self.model, 'llm.max_tokens': payload.get('max_tokens'), 'llm.stream': True}
+        with provider_call('vllm', **span_attributes) as call:
+            response = requests.post(
+                f"{self.base_url}/v1/chat/completions",
+                json=dict(payload, stream=True, stream_options={"include_usage": True}),
+                stream=True,
+                timeout=deadline.timeout(self.timeout),
+                headers=inject_trace_headers({"Content-Type": "application/json"})
+            )
+            call.status_code = response.status_code
+            unregister = cancel_token.on_cancel(response.close) if cancel_token else (lambda: None)
             
-            if context:
-                messages.append({
-                    "role": "system",
-                    "content": f"Utilise ce contexte de recherche web pour répondre: {context}"
-                })
+            try:
+                if response.status_code != 200:
+                    raise RuntimeError(f"Erreur du serveur vLLM: {response.status_code}")
+                
+                for line in response.iter_lines():
+                    if cancel_token and cancel_token.cancelled:
+                        break
+                    if deadline.expired:
+                        # Échéance du tour : réponse tronquée plutôt que perdue
+                        deadline.degrade('llm')
+                        break
+                    # Événements SSE décodés directement depuis les octets (un par token)
+                    if not line.startswith(b'data: '):
+                        continue
+                    data_bytes = line[6:]  # Retirer "data: "
+                    if data_bytes == b'[DONE]':
+                        break
+                    try:
+                        data = fast_json.loads(data_bytes)
+                    except fast_json.JSONDecodeError:
+                        continue
+                    if data.get('usage'):
+                        call.usage = data['usage']
+                    if 'choices' in data and len(data['choices']) > 0:
+                        delta = data['choices'][0].get('delta', {})
+                        if delta.get('content'):
+                            call.completion_tokens += 1  # vLLM émet un delta par token
+                            yield delta['content']
+            except Exception:
+                # La fermeture de la connexion depuis un autre thread interrompt iter_lines
+                if not (cancel_token and cancel_token.cancelled):
+                    raise
+            finally:
+                unregister()
+                response.close()
             
-            messages.append({
-                "role": "user",
-                "content": prompt
-            })
+            if cancel_token and cancel_token.cancelled:
+                generated = call.completion_tokens
+                record_cancellation('vllm', cancel_token.reason, payload.get('max_tokens', 0), generated)
+                logger.info("🛑 Génération vLLM annulée après %s tokens", generated)
+                cancel_token.raise_if_cancelled()
+    
+    def generate_streaming_response(
+        self,
+        prompt: Optional[str] = None,
+        context: Optional[str] = None,
+        messages: Optional[List[Dict]] = None,
+        cancel_token: Optional[CancellationToken] = None
+    ):
+        """Génère une réponse en streaming avec vLLM"""
+        try:
+            messages = self._build_messages(prompt, context, messages)
             
             payload = {
                 "model": self.model,
                 "messages": messages,
                 "temperature": 0.7,
-                "max_tokens": 2000,
-                "stream": True
+                "max_tokens": 2000
             }
             
-            response = requests.post(
-                f"{self.base_url}/v1/chat/completions",
-                json=payload,
-                stream=True,
-                timeout=self.timeout,
-                headers={"Content-Type": "application/json"}
-            )
-            
-            if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:
-                        # Décoder les événements SSE
-                        line_str = line.decode('utf-8')
-                        if line_str.startswith('data: '):
-                            data_str = line_str[6:]  # Retirer "data: "
-                            if data_str == '[DONE]':
-                                break
-                            try:
-                                import json
-                                data = json.loads(data_str)
-                                if 'choices' in data and len(data['choices']) > 0:
-                                    delta = data['choices'][0].get('delta', {})
-                                    if 'content' in delta:
-                                        yield delta['content']
-                            except json.JSONDecodeError:
-                                continue
-            else:
-                yield f"Erreur: {response.status_code}"
+            with self._admission(Deadline(), cancel_token):
+                yield from self._iter_stream(payload, cancel_token)
                 
+        except ChatCancelled:
+            raise
         except Exception as e:
-            logger.error(f"Erreur streaming: {e}")
+            logger.error("Erreur streaming: %s", e)
             yield f"Erreur: {str(e)}"
     
     def list_models(self) -> List[str]:
@@ -159,5 +263,5 @@ class VLLMService:
                 return [model['id'] for model in data.get('data', [])]
             return [self.model]  # Retourner le modèle configuré par défaut
         except Exception as e:
-            logger.error(f"Erreur lors de la récupération des modèles: {e}")
+            logger.error("Erreur lors de la récupération des modèles: %s", e)
             return [self.model]
\ No newline at end of file
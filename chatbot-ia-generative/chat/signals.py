@@ -0,0 +1,29 @@
+"""
+Compteur de messages et date de mise à jour des conversations
+
+Les messages créés par un tour de chat sont comptés par
+``Conversation.touch`` : un seul UPDATE de la conversation par tour (les
+deux messages), dans ``ChatAPIView._handle_chat_turn``. Un signal
+``post_save`` coûterait un UPDATE de plus par message sur ce chemin chaud.
+
+Les suppressions, rares et hors du chemin de chat, passent par le signal
+ci-dessous (``F()`` : pas de course entre workers). Les ETags des endpoints
+de conversation (``chat.views``) en dépendent : une conversation inchangée
+répond 304 sans lire ``chat_message``.
+
+``bulk_create`` et ``update()`` ne déclenchent pas de signaux : après une
+écriture en masse, recalculer le compteur (voir la migration 0003).
+"""
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Conversation, Message
+
+
+@receiver(post_delete, sender=Message, dispatch_uid='chat_message_count_delete')
+def message_deleted(sender, instance, **kwargs):
+    Conversation.objects.filter(pk=instance.conversation_id, message_count__gt=0).update(
+        message_count=F('message_count') - 1, updated_at=timezone.now()
+    )
@@ -1,3 +1,1759 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.serializers import ListSerializer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+import httpx
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from benchmarks.fixture_replay import FixtureReplay, load_fixture
+from benchmarks.mock_llm_server import MockLLMServer
+from chat import metrics, tracing
+from chat.logging_utils import RequestIdFilter, request_id_var
+from chat.middleware import DisconnectCancellationMiddleware, negotiate_encoding
+from chat.services.answer_cache import AnswerCache, get_answer_cache, normalize_prompt
+from chat.models import ChatJob, Conversation, Message, SearchCache
+from chat.renderers import FastJSONParser, FastJSONRenderer
+from chat.serializers import ConversationSerializer, MessageSerializer
+from chat.services.embeddings import HashingEmbedder
+from chat.services.local_index import LocalSearchIndex
+from chat.services.cancellation import CancellationToken, ChatCancelled
+from chat.services.deadline import Deadline
+from chat.services.job_queue import ChatJobQueue, JobQueueFull
+from chat.services.intelligent_search import (
+    IntelligentSearchService, SpeculativeSearch, keyword_coverage
+)
+from chat.services.load_policy import OVERRIDE_CACHE_KEY, LoadPolicy
+from chat.services.model_router import SELECTED_MODEL_CACHE_KEY, ModelRouter, get_selected_model
+from chat.services.prompts import (
+    SEARCH_QUERY_BATCH_SYSTEM_PROMPT, build_chat_messages, build_final_response_messages, build_search_query_messages,
+)
+from chat.services.rewrite_batcher import RewriteBatcher
+from chat.services.multi_search import MultiSearchService
+from chat.services.openrouter_optimized import OpenRouterOptimizedService
+from chat.services.prefetch import TrendingPrefetcher, lookup_prefetched_rewrite, publish_rewrite
+from chat.services.serpapi_service import SerpAPICreditBudget, SerpAPIService
+from chat.services.shared_state import SharedRedis
+from chat.services import multi_search
+from chat.services.scraping import AsyncScraper, ItemSelector, PageCache, parse_items
+from chat.routing import websocket_urlpatterns
+from chat.throttling import ChatTurnRateThrottle, _RedisGCRA
+from chat.views import ChatAPIView
+from chat.services.vllm_admission import VLLMAdmissionController, VLLMQueueTimeout, queue_context
+from chat.services.vllm_service import VLLMService
+
+
+class MockLLMServerTestCase(SimpleTestCase):
+    """Services LLM contre un MockLLMServer local (aucun appel réseau externe)"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = MockLLMServer(ttft=0, tokens_per_second=0).start()
+        cls.fallback = MockLLMServer(ttft=0, tokens_per_second=0).start()
+        cls.settings_override = override_settings(
+            VLLM_BASE_URL=cls.server.url,
+            OPENROUTER_BASE_URL=f"{cls.server.url}/v1",
+        )
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.server.stop()
+        cls.fallback.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.reset_stats()
+        self.fallback.reset_stats()
+        self.server.rate_limit_rate = 0.0
+        self.server.error_rate = 0.0
+
+    def test_vllm_health_and_models(self):
+        service = VLLMService()
+        self.assertTrue(service.is_available())
+        self.assertEqual(service.list_models(), ['mock-llm'])
+
+    def test_vllm_completion(self):
+        response = VLLMService().generate_response(prompt="Bonjour")
+        self.assertTrue(response['success'])
+        self.assertTrue(response['response'])
+        self.assertGreater(response['usage']['completion_tokens'], 0)
+        self.assertEqual(self.server.stats()['completed'], 1)
+
+    def test_vllm_streaming_relays_tokens(self):
+        tokens = []
+        response = VLLMService().generate_response(prompt="Bonjour", on_token=tokens.append)
+        self.assertTrue(response['success'])
+        self.assertGreater(len(tokens), 1)
+        self.assertEqual(''.join(tokens), response['response'])
+        self.assertEqual(self.server.stats()['streamed'], 1)
+
+    def test_vllm_stream_cancellation(self):
+        self.server.tokens_per_second = 200
+        cancel_token = CancellationToken()
+
+        def on_token(token):
+            cancel_token.cancel('client_disconnected')
+
+        try:
+            with self.assertRaises(ChatCancelled):
+                VLLMService().generate_response(prompt="Bonjour", on_token=on_token, cancel_token=cancel_token)
+        finally:
+            self.server.tokens_per_second = 0
+
+    def test_openrouter_streaming_usage(self):
+        tokens = []
+        result = OpenRouterOptimizedService().chat_completion(
+            [{'role': 'user', 'content': 'Bonjour'}], max_tokens=5, on_token=tokens.append
+        )
+        self.assertEqual(result['status_code'], 200)
+        self.assertEqual(len(tokens), 5)
+        self.assertEqual(result['usage']['completion_tokens'], 5)
+
+    def test_openrouter_rate_limit_is_counted(self):
+        self.server.rate_limit_rate = 1.0
+        before = metrics.PROVIDER_RATE_LIMITED.value(provider='openrouter')
+        result = OpenRouterOptimizedService().chat_completion([{'role': 'user', 'content': 'Bonjour'}])
+        self.assertEqual(result['status_code'], 429)
+        self.assertEqual(metrics.PROVIDER_RATE_LIMITED.value(provider='openrouter'), before + 1)
+
+    def test_final_response_falls_back_to_openrouter_on_vllm_error(self):
+        self.server.error_rate = 1.0
+        cache.set('selected_llm_model', 'vllm')
+        try:
+            with override_settings(OPENROUTER_BASE_URL=f"{self.fallback.url}/v1"):
+                response = IntelligentSearchService()._generate_final_response(
+                    "Quelles nouveautés ?",
+                    [{'title': 'Annonce', 'url': 'https://example.com', 'snippet': 'Nouveau modèle', 'source': 'example.com'}],
+                    "AI news", None, None
+                )
+        finally:
+            cache.delete('selected_llm_model')
+        self.assertEqual(self.server.stats()['errors'], 1)
+        self.assertEqual(self.fallback.stats()['completed'], 1)
+        self.assertTrue(response)
+
+    def test_concurrency_limit_rejects_overflow(self):
+        with MockLLMServer(ttft=0.3, tokens_per_second=0, max_concurrency=1, overflow='reject') as server:
+            with override_settings(OPENROUTER_BASE_URL=f"{server.url}/v1"):
+                service = OpenRouterOptimizedService()
+                with ThreadPoolExecutor(max_workers=3) as pool:
+                    statuses = list(pool.map(
+                        lambda _: service.chat_completion([{'role': 'user', 'content': 'Bonjour'}])['status_code'],
+                        range(3)
+                    ))
+            stats = server.stats()
+        self.assertEqual(stats['max_in_flight'], 1)
+        self.assertIn(429, statuses)
+        self.assertEqual(statuses.count(200), stats['completed'])
+
+
+class AnswerCacheTestCase(SimpleTestCase):
+
+    def test_exact_match_is_normalized(self):
+        answers = AnswerCache()
+        answers.set("Qu'est-ce qu'un  LLM ?", 'openrouter:m', 0.3, "Un grand modèle de langage.")
+        hit = answers.get("qu'est-ce qu'un LLM", 'openrouter:m', 0.3)
+        self.assertEqual(hit['response'], "Un grand modèle de langage.")
+        self.assertEqual(hit['match'], 'exact')
+        self.assertEqual(normalize_prompt("  Bonjour !? "), 'bonjour')
+
+    def test_key_includes_model_and_temperature(self):
+        answers = AnswerCache(similarity_threshold=0.5)
+        answers.set("Explique l'attention", 'vllm:m', 0.7, "réponse")
+        self.assertIsNone(answers.get("Explique l'attention", 'openrouter:m', 0.7))
+        self.assertIsNone(answers.get("Explique l'attention", 'vllm:m', 0.3))
+
+    def test_semantic_match(self):
+        answers = AnswerCache(similarity_threshold=0.8)
+        answers.set("Comment fonctionne le mécanisme d'attention dans un Transformer ?", 'm', 0.3, "réponse")
+        hit = answers.get("Comment fonctionne le mécanisme d'attention d'un Transformer", 'm', 0.3)
+        self.assertEqual(hit['match'], 'semantic')
+        self.assertIsNone(answers.get("Écris une fonction Python qui trie une liste", 'm', 0.3))
+
+    def test_near_miss_questions_do_not_hit(self):
+        near_misses = [
+            ("Quelle est la différence entre une liste et un tuple en Python ?",
+             "Quelle est la différence entre une liste et un set en Python ?"),
+            ("Explique la différence entre TCP et UDP en réseau",
+             "Explique la différence entre HTTP et UDP en réseau"),
+        ]
+        # Même un seuil explicite est ignoré tant que les embeddings sont hachés
+        for threshold in ('0', '0.9'):
+            with override_settings(ANSWER_CACHE_SIMILARITY_THRESHOLD=float(threshold), EMBEDDING_BACKEND='hashing'), \
+                    mock.patch('chat.services.answer_cache._answer_cache', None):
+                answers = get_answer_cache()
+                self.assertEqual(answers.similarity_threshold, 0)
+                for cached, asked in near_misses:
+                    answers.set(cached, 'm', 0.3, "réponse")
+                    self.assertIsNone(answers.get(asked, 'm', 0.3))
+                    self.assertEqual(answers.get(cached, 'm', 0.3)['match'], 'exact')
+
+    def test_lru_eviction_and_ttl(self):
+        answers = AnswerCache(max_entries=2, similarity_threshold=0.8)
+        answers.set("a", 'm', 0.3, "A")
+        answers.set("b", 'm', 0.3, "B")
+        answers.get("a", 'm', 0.3)
+        answers.set("c", 'm', 0.3, "C")
+        self.assertIsNone(answers.get("b", 'm', 0.3))
+        self.assertIsNotNone(answers.get("a", 'm', 0.3))
+
+        answers.ttl_seconds = -1
+        self.assertIsNone(answers.get("a", 'm', 0.3))
+        self.assertEqual(len(answers), 1)
+
+
+@override_settings(ANSWER_CACHE_ENABLED=True)
+class ChatAnswerCacheTestCase(TestCase):
+
+    def setUp(self):
+        get_answer_cache().clear()
+        cache.set('selected_llm_model', 'openrouter')
+        self.addCleanup(cache.delete, 'selected_llm_model')
+        throttle = mock.patch('chat.views.ChatAPIView.throttle_classes', [])
+        throttle.start()
+        self.addCleanup(throttle.stop)
+
+    def _post(self, message, conversation_id=None):
+        data = {'message': message}
+        if conversation_id:
+            data['conversation_id'] = conversation_id
+        return self.client.post('/api/v1/chat/', data, content_type='application/json').json()
+
+    def test_first_turns_are_cached_and_followups_bypass(self):
+        with MockLLMServer(ttft=0, tokens_per_second=0) as server:
+            with override_settings(OPENROUTER_BASE_URL=f"{server.url}/v1"):
+                first = self._post("Qu'est-ce qu'un modèle de langage ?")
+                second = self._post("Qu'est-ce qu'un modèle de langage")
+                followup = self._post("Qu'est-ce qu'un modèle de langage ?", first['conversation_id'])
+            stats = server.stats()
+
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(second['message']['content'], first['message']['content'])
+        self.assertFalse(followup['cached'])
+        self.assertEqual(stats['completed'], 2)
+
+
+NEWS_RESULTS = [
+    {'title': 'Anthropic introduces new Claude model', 'url': 'https://example.com/claude',
+     'content': 'Anthropic announced a new Claude model with longer context.', 'source': 'example.com'},
+    {'title': 'Anthropic Claude model adds tool use', 'url': 'https://example.com/claude-tools',
+     'content': 'The latest Claude model from Anthropic can call tools.', 'source': 'example.com'},
+    {'title': 'Claude model release: what Anthropic announced', 'url': 'https://example.com/claude-release',
+     'content': 'A summary of the Anthropic Claude model release.', 'source': 'example.com'},
+    {'title': 'Recette de la tarte aux pommes', 'url': 'https://example.com/tarte',
+     'content': 'Pommes, pâte brisée, sucre et cannelle.', 'source': 'example.com'},
+]
+
+
+class LocalSearchIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = LocalSearchIndex(self.directory, HashingEmbedder(128))
+
+    def test_search_dedup_and_persistence(self):
+        self.assertEqual(self.index.add_documents(NEWS_RESULTS), 4)
+        self.assertEqual(self.index.add_documents(NEWS_RESULTS), 0)
+
+        hits = self.index.search("Anthropic Claude model release", k=3)
+        self.assertEqual(len(hits), 3)
+        self.assertTrue(all('claude' in hit['url'] for hit in hits))
+        self.assertEqual(hits[0]['origin'], 'local_index')
+
+        reloaded = LocalSearchIndex(self.directory, HashingEmbedder(128))
+        self.assertEqual(len(reloaded), 4)
+        self.assertEqual(reloaded.search("Anthropic Claude model release", k=1)[0]['url'], hits[0]['url'])
+
+    def test_richer_snippet_replaces_document(self):
+        self.index.add_documents([{'title': 'Claude', 'url': 'https://example.com/claude'}])
+        self.index.add_documents(NEWS_RESULTS[:1])
+        self.assertEqual(len(self.index), 1)
+        self.assertIn('longer context', self.index.search("Claude", k=5)[0]['content'])
+
+    def test_max_age_excludes_stale_documents(self):
+        self.index.add_documents(NEWS_RESULTS)
+        stale = (datetime.now() - timedelta(hours=12)).isoformat()
+        for doc in self.index._docs.values():
+            doc['indexed_at'] = stale
+        self.assertEqual(self.index.search("Anthropic Claude", k=5, max_age_hours=6), [])
+
+    def test_workers_share_files(self):
+        # Deux instances = deux workers : chacune relit ce que l'autre ajoute, sous le verrou fcntl
+        other = LocalSearchIndex(self.directory, HashingEmbedder(128))
+        batches = [
+            [{'title': f"Document {worker}-{i} sujet{worker}x{i}", 'url': f"https://example.com/{worker}/{i}",
+              'content': f"Extrait unique sujet{worker}x{i}"} for i in range(20)]
+            for worker in range(2)
+        ]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(lambda index=index, batch=batch: [index.add_documents([d]) for d in batch])
+                for index, batch in zip((self.index, other), batches)
+            ]
+        for future in futures:
+            future.result()
+        self.assertEqual(other.add_documents(batches[0][:1]), 0)
+
+        for index in (self.index, other, LocalSearchIndex(self.directory, HashingEmbedder(128))):
+            self.assertEqual(len(index), 40)
+            for doc in (batches[0][7], batches[1][13]):
+                self.assertEqual(index.search(doc['title'], k=1)[0]['url'], doc['url'])
+
+    def test_compaction_by_another_worker(self):
+        other = LocalSearchIndex(self.directory, HashingEmbedder(128))
+        short = [dict(doc, content='') for doc in NEWS_RESULTS]
+        self.index.add_documents(short)
+        self.index.add_documents(NEWS_RESULTS)  # Extraits enrichis : 4 versions masquées
+        with mock.patch.object(LocalSearchIndex, 'COMPACT_MIN_ROWS', 8):
+            other.sync()
+        self.assertEqual(other._row_count(), 4)
+
+        hits = self.index.search("Anthropic Claude model release", k=3)
+        self.assertEqual(self.index._row_count(), 4)
+        self.assertEqual(len(hits), 3)
+        self.assertTrue(all(hit['content'] for hit in hits))
+
+    def test_interrupted_write_is_repaired(self):
+        self.index.add_documents(NEWS_RESULTS[:2])
+        with open(os.path.join(self.directory, LocalSearchIndex.VECTORS_FILE), 'ab') as f:
+            f.write(b'\x01' * (8 + 4 * 128 + 100))  # vecteur complet sans document, puis enregistrement incomplet
+        with open(os.path.join(self.directory, LocalSearchIndex.DOCS_FILE), 'a', encoding='utf-8') as f:
+            f.write('{"url": "https://example.com/torn", "ti')
+
+        reloaded = LocalSearchIndex(self.directory, HashingEmbedder(128))
+        self.assertEqual(len(reloaded), 2)
+        self.assertEqual(reloaded.add_documents(NEWS_RESULTS[2:]), 2)
+        self.assertEqual(len(LocalSearchIndex(self.directory, HashingEmbedder(128))), 4)
+        self.assertEqual(reloaded.search("Recette tarte aux pommes", k=1)[0]['url'], 'https://example.com/tarte')
+
+    def test_sync_from_search_cache(self):
+        SearchCache.objects.create(query='news:claude', results=NEWS_RESULTS)
+        self.assertEqual(self.index.sync(), 4)
+        self.assertEqual(self.index.sync(), 0)
+
+    def test_sync_reindexes_refreshed_entries_outside_the_file_lock(self):
+        SearchCache.objects.create(query='news:claude', results=NEWS_RESULTS)
+        self.index.sync()
+        refreshed = [dict(NEWS_RESULTS[0], content='Anthropic a publié une mise à jour de Claude.')]
+        SearchCache.objects.update_or_create(query='news:claude', defaults={'results': refreshed})
+
+        embed = self.index.embedder.embed
+        lock_depths = []
+        with mock.patch.object(self.index.embedder, 'embed', side_effect=lambda text: lock_depths.append(
+                self.index._lock_depth) or embed(text)):
+            self.assertEqual(self.index.sync(), 1)
+        self.assertEqual(lock_depths, [0])
+        self.assertEqual(self.index.search("Claude mise à jour", k=1)[0]['content'], refreshed[0]['content'])
+
+    def test_maybe_sync_runs_in_background_once(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with mock.patch.object(self.index, 'sync', side_effect=lambda: release.wait(5)) as sync:
+            self.index.maybe_sync(60)
+            self.index.maybe_sync(60)
+            other = LocalSearchIndex(self.directory, HashingEmbedder(128))
+            other.maybe_sync(60)  # Réservée par le premier worker
+            self.assertTrue(self.index._sync_thread.is_alive())
+            release.set()
+            self.index._sync_thread.join(5)
+        self.assertEqual(sync.call_count, 1)
+        self.assertIsNone(other._sync_thread)
+
+    @override_settings(LOCAL_INDEX_ENABLED=True, LOCAL_INDEX_MIN_RESULTS=3, LOCAL_INDEX_MIN_SCORE=0.2)
+    def test_covered_query_skips_serpapi(self):
+        self.index.add_documents(NEWS_RESULTS)
+        service = IntelligentSearchService()
+        with mock.patch('chat.services.intelligent_search.get_local_index', return_value=self.index), \
+                mock.patch.object(self.index, 'maybe_sync'), \
+                mock.patch.object(service.serpapi_service, 'search') as serpapi_search:
+            results = service._perform_smart_search("Anthropic Claude model release", 'news', None, None)
+            serpapi_search.assert_not_called()
+            self.assertGreaterEqual(len(results), 3)
+
+            serpapi_search.return_value = [
+                {'title': 'Tarte Tatin', 'url': 'https://example.com/tatin', 'content': 'Pommes caramélisées'}
+            ]
+            results = service._perform_smart_search("pâtisserie tarte tatin caramel", 'general', None, None)
+            serpapi_search.assert_called_once()
+        self.assertEqual(results[0]['url'], 'https://example.com/tatin')
+        self.assertIn('https://example.com/tatin', self.index._url_ids)
+
+    @override_settings(LOCAL_INDEX_ENABLED=True, LOCAL_INDEX_MIN_RESULTS=3, LOCAL_INDEX_MIN_SCORE=0.15)
+    def test_unrelated_neighbours_do_not_replace_serpapi(self):
+        # Actualités IA du même vocabulaire : scores cosinus 0.16-0.20 avec le hachage, aucun mot-clé commun
+        news = load_fixture('serpapi_news.json')['news_results']
+        index = LocalSearchIndex(self.directory, HashingEmbedder(256))
+        index.add_documents([{'title': n['title'], 'url': n['link'], 'content': n['snippet']} for n in news])
+        query = "Apple Vision Pro latest news 2025 announced"
+        self.assertGreaterEqual(len(index.search(query, k=10, min_score=0.15)), 3)
+
+        service = IntelligentSearchService()
+        with mock.patch('chat.services.intelligent_search.get_local_index', return_value=index), \
+                mock.patch.object(index, 'maybe_sync'):
+            self.assertIsNone(service._search_local_index(query, None, None))
+            self.assertIsNone(service._search_local_index("OpenAI reasoning model inference", None, None))
+
+
+class HistorySearchTestCase(TestCase):
+
+    def setUp(self):
+        from chat.models import Conversation, Message
+
+        self.conversation = Conversation.objects.create()
+        other = Conversation.objects.create()
+        Message.objects.create(conversation=self.conversation, role='user', content="Qu'est-ce que le mécanisme d'attention ?")
+        Message.objects.create(
+            conversation=self.conversation, role='assistant',
+            content="Le mécanisme d'attention pondère chaque token selon sa pertinence pour les autres tokens."
+        )
+        for i in range(3):
+            Message.objects.create(conversation=other, role='assistant', content=f"Réponse {i} sur les modèles de diffusion.")
+        self.edited = Message.objects.create(conversation=other, role='user', content="Première version")
+
+    def _search(self, **params):
+        return self.client.get('/api/v1/search/', params)
+
+    def test_ranked_results_with_snippets(self):
+        data = self._search(q='mecanisme attention').json()
+        self.assertEqual(data['total'], 2)
+        self.assertIn('<mark>', data['results'][0]['snippet'])
+        self.assertEqual({r['conversation_id'] for r in data['results']}, {str(self.conversation.id)})
+
+    def test_pagination_and_filters(self):
+        data = self._search(q='diffusion', page_size=2).json()
+        self.assertEqual((data['total'], len(data['results']), data['has_next']), (3, 2, True))
+        data = self._search(q='diffusion', page_size=2, page=2).json()
+        self.assertEqual((len(data['results']), data['has_next']), (1, False))
+
+        data = self._search(q='attention', role='user', conversation_id=str(self.conversation.id)).json()
+        self.assertEqual(data['total'], 1)
+
+    def test_index_follows_updates_and_deletes(self):
+        self.edited.content = "Version corrigée"
+        self.edited.save()
+        self.assertEqual(self._search(q='première').json()['total'], 0)
+        self.assertEqual(self._search(q='corrigée').json()['total'], 1)
+        self.edited.delete()
+        self.assertEqual(self._search(q='corrigée').json()['total'], 0)
+
+    def test_invalid_query(self):
+        self.assertEqual(self._search(q='').status_code, 400)
+        self.assertEqual(self._search(q='"*').json()['total'], 0)
+
+
+def _card(i: int, extra_class: str = '') -> str:
+    return f'<div class="news-card{extra_class}"><a class="title" href="https://example.com/{i}">Titre {i}</a></div>'
+
+
+class AsyncScraperTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.selector = ItemSelector('div', 'news-card')
+
+    def _scraper(self, html: str, chunk_size: int = 64):
+        data = html.encode('utf-8')
+
+        async def body():
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+        scraper = AsyncScraper(transport=transport)
+        self.addCleanup(scraper.close)
+        return scraper
+
+    def test_stops_reading_after_max_results(self):
+        html = '<html><body>' + ''.join(_card(i) for i in range(20)) + '<footer>' + 'x' * 5000 + '</footer></body></html>'
+        scraper = self._scraper(html)
+        page = scraper.run(scraper.fetch('https://example.com/', selectors=(self.selector,), max_results=5))
+        self.assertTrue(page.truncated)
+        self.assertLess(page.bytes_read, len(html) // 2)
+        items = parse_items(page.text, (self.selector,))
+        self.assertEqual([item.a['href'] for item in items], [f'https://example.com/{i}' for i in range(5)])
+
+    def test_marker_ignores_similar_classes(self):
+        html = ''.join(_card(i, '-footer') for i in range(10)) + _card(1, ' featured') + _card(2)
+        scraper = self._scraper(html)
+        page = scraper.run(scraper.fetch('https://example.com/', selectors=(self.selector,), max_results=1))
+        self.assertTrue(page.truncated)
+        self.assertEqual(len(parse_items(page.text, (self.selector,))), 1)
+        self.assertEqual(len(parse_items(html, (self.selector,))), 2)
+
+    def test_multi_search_scrapers_on_fixtures(self):
+        with FixtureReplay(scale=0):
+            service = MultiSearchService()
+            google = service._google_search_scrape('ia')
+            self.assertEqual(len(google), service.max_results)
+            self.assertTrue(google[0]['url'].startswith('https://techcrunch.com/'))
+            self.assertTrue(service._bing_search_scrape('ia'))
+            self.assertEqual(len(service._direct_news_search('ia')), 4)
+
+
+class PageCacheTestCase(SimpleTestCase):
+
+    def _cache(self, url='https://example.com/', **headers):
+        cache = PageCache()
+        cache.store(url, httpx.Headers(headers), 'hash')
+        cache.set_parsed(url, 'hash', ['article'])
+        return cache
+
+    def test_validators_and_freshness(self):
+        cache = self._cache(etag='"v1"', **{'last-modified': 'Tue, 14 Jan 2025 10:00:00 GMT'})
+        self.assertIsNone(cache.fresh_hash('https://example.com/'))
+        self.assertEqual(cache.conditional_headers('https://example.com/'), {
+            'If-None-Match': '"v1"', 'If-Modified-Since': 'Tue, 14 Jan 2025 10:00:00 GMT',
+        })
+        self.assertEqual(self._cache(**{'cache-control': 'public, max-age=60'}).fresh_hash('https://example.com/'), 'hash')
+        self.assertIsNone(self._cache(**{'cache-control': 'max-age=60', 'age': '90'}).fresh_hash('https://example.com/'))
+
+    def test_no_store_and_no_cache(self):
+        self.assertEqual(len(self._cache(etag='"v1"', **{'cache-control': 'no-store'})), 0)
+        cache = self._cache(etag='"v1"', **{'cache-control': 'no-cache, max-age=60'})
+        self.assertIsNone(cache.fresh_hash('https://example.com/'))
+        self.assertIn('If-None-Match', cache.conditional_headers('https://example.com/'))
+
+    def test_no_revalidation_without_parsed_result(self):
+        cache = PageCache()
+        cache.store('https://example.com/', httpx.Headers({'etag': '"v1"'}), 'hash')
+        self.assertEqual(cache.conditional_headers('https://example.com/'), {})
+
+    def test_unchanged_news_page_is_not_reparsed(self):
+        page_cache = PageCache()
+        with FixtureReplay(scale=0), \
+                mock.patch.object(multi_search, 'get_page_cache', return_value=page_cache), \
+                mock.patch.object(multi_search, 'parse_items', wraps=multi_search.parse_items) as parse:
+            service = MultiSearchService()
+            first = service._direct_news_search('ia')
+            self.assertEqual(parse.call_count, len(multi_search.NEWS_SITES))
+            first[0]['date_parsed'] = 'modifié en aval'
+
+            second = service._direct_news_search('ia')
+            self.assertEqual(parse.call_count, len(multi_search.NEWS_SITES))
+        self.assertEqual([r['url'] for r in second], [r['url'] for r in first])
+        self.assertNotIn('date_parsed', second[0])
+
+
+@override_settings(SPECULATIVE_SEARCH_ENABLED=True, SPECULATIVE_SEARCH_MIN_JACCARD=0.3)
+class SpeculativeSearchTestCase(SimpleTestCase):
+
+    QUESTION = "Quelles sont les dernières annonces sur Claude d'Anthropic ?"
+
+    def setUp(self):
+        cache.clear()
+        self.service = IntelligentSearchService()
+        self.searches = []
+
+        def perform_search(query, search_type, *args, **kwargs):
+            self.searches.append(query)
+            return [{'title': query, 'url': f'https://example.com/{len(self.searches)}', 'content': ''}]
+
+        patches = [
+            mock.patch.object(self.service, '_perform_smart_search', side_effect=perform_search),
+            mock.patch.object(self.service, '_generate_final_response', return_value='Réponse'),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _run(self, rewritten_query: str, search_type: str = 'general'):
+        rewrite = {'search_query': rewritten_query, 'search_type': search_type, 'rewritten_by': 'openrouter'}
+        with mock.patch.object(self.service, '_rewrite_search_query', return_value=rewrite):
+            return self.service.process_user_query(self.QUESTION)
+
+    def test_keyword_coverage_of_rewrite(self):
+        # Accents, pluriels et termes de fraîcheur ignorés
+        self.assertEqual(keyword_coverage("Modèles IA annoncés 2025 news", "AI modèle"), 1.0)
+        self.assertEqual(keyword_coverage("recette tarte tatin", "EU AI Act latest news"), 0.0)
+        self.assertEqual(keyword_coverage("claude anthropic 2025 news latest", "Anthropic Claude latest news"), 1.0)
+        # Requête heuristique française : « annonces » n'est pas couvert
+        self.assertAlmostEqual(keyword_coverage("dernières annonces claude anthropic", "Anthropic Claude announcements"), 2 / 3)
+
+    def test_close_rewrite_keeps_speculative_results(self):
+        before = metrics.SPECULATIVE_SEARCHES.value(outcome='kept')
+        result = self._run("Anthropic Claude latest news 2025")
+        self.assertEqual(len(self.searches), 1)
+        self.assertIn('claude', self.searches[0])
+        self.assertEqual(result['search_query'], "Anthropic Claude latest news 2025")
+        self.assertEqual(metrics.SPECULATIVE_SEARCHES.value(outcome='kept'), before + 1)
+
+    def test_partially_covered_rewrite_discards_speculation(self):
+        before = metrics.SPECULATIVE_SEARCHES.value(outcome='discarded')
+        result = self._run("Anthropic Claude latest announcements")
+        self.assertEqual(self.searches[-1], "Anthropic Claude latest announcements")
+        self.assertEqual(result['sources'][0]['title'], "Anthropic Claude latest announcements")
+        self.assertEqual(metrics.SPECULATIVE_SEARCHES.value(outcome='discarded'), before + 1)
+
+    def test_stuck_speculation_is_bounded_by_deadline(self):
+        token = CancellationToken()
+        speculation = SpeculativeSearch("claude anthropic", 'general', Future(), token, None)
+        before = metrics.SPECULATIVE_SEARCHES.value(outcome='timeout')
+        start = time.monotonic()
+        results = self.service._take_speculative_results(speculation, "Anthropic Claude", 'general', Deadline(0.05))
+        self.assertIsNone(results)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(token.cancelled)
+        self.assertEqual(metrics.SPECULATIVE_SEARCHES.value(outcome='timeout'), before + 1)
+
+    def test_distant_rewrite_discards_speculation(self):
+        before = metrics.SPECULATIVE_SEARCHES.value(outcome='discarded')
+        result = self._run("EU AI Act general-purpose model obligations")
+        self.assertEqual(result['sources'][0]['title'], "EU AI Act general-purpose model obligations")
+        self.assertEqual(metrics.SPECULATIVE_SEARCHES.value(outcome='discarded'), before + 1)
+        # Même requête, autre stratégie SerpAPI : résultats spéculatifs inutilisables
+        cache.clear()
+        self._run("Anthropic Claude latest news 2025", search_type='news')
+        self.assertEqual(metrics.SPECULATIVE_SEARCHES.value(outcome='discarded'), before + 2)
+
+    def test_cached_rewrite_skips_speculation(self):
+        self._run("Anthropic Claude latest news 2025")
+        self.searches.clear()
+        self._run("Anthropic Claude latest news 2025")
+        self.assertEqual(len(self.searches), 1)
+
+
+class PipelinedGenerationTestCase(SimpleTestCase):
+
+    QUESTION = "Quelles sont les dernières annonces sur Claude d'Anthropic ?"
+
+    def setUp(self):
+        cache.clear()
+        self.service = IntelligentSearchService()
+        self.release_search = threading.Event()
+        self.late_sent = threading.Event()
+        self.generated_with = []
+        self.batches = []
+
+        def perform_search(query, search_type, *args, on_partial=None, **kwargs):
+            for batch in self.batches[:-1]:
+                on_partial(batch)
+            self.release_search.wait(5)
+            on_partial(self.batches[-1])
+            self.late_sent.set()
+            return [r for batch in self.batches for r in batch]
+
+        def generate(user_query, search_results, *args, **kwargs):
+            self.generated_with.extend(search_results)
+            self.release_search.set()
+            self.late_sent.wait(5)
+            return 'Réponse'
+
+        rewrite = {'search_query': 'Anthropic Claude announcements', 'search_type': 'news', 'rewritten_by': 'openrouter'}
+        patches = [
+            mock.patch.object(self.service, '_rewrite_search_query', return_value=rewrite),
+            mock.patch.object(self.service, '_perform_smart_search', side_effect=perform_search),
+            mock.patch.object(self.service, '_generate_final_response', side_effect=generate),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _results(self, prefix: str, count: int, score: float):
+        return [
+            {'title': f'{prefix} {i}', 'url': f'https://example.com/{prefix}/{i}', 'relevance_score': score}
+            for i in range(count)
+        ]
+
+    def test_generation_starts_on_top_k_and_attaches_late_sources(self):
+        self.batches = [self._results('first', 2, 0.9), self._results('second', 1, 0.8), self._results('late', 1, 0.9)]
+        before = metrics.PIPELINED_GENERATIONS.value(trigger='top_k')
+        result = self.service.process_user_query(self.QUESTION, search_budget_ms=5000)
+
+        self.assertEqual(len(self.generated_with), 3)
+        self.assertEqual(result['pipeline']['trigger'], 'top_k')
+        self.assertEqual(metrics.PIPELINED_GENERATIONS.value(trigger='top_k'), before + 1)
+        self.assertEqual([s['url'] for s in result['late_sources']], ['https://example.com/late/0'])
+        self.assertTrue(result['sources'][-1]['late'])
+        self.assertEqual(len(result['sources']), 4)
+
+    @override_settings(PIPELINED_LATE_RESULTS='drop')
+    def test_deadline_starts_generation_with_partial_results(self):
+        self.batches = [self._results('weak', 1, 0.2), self._results('late', 2, 0.9)]
+        before = metrics.PIPELINE_LATE_RESULTS.value(policy='dropped')
+        result = self.service.process_user_query(self.QUESTION, search_budget_ms=50)
+
+        self.assertEqual([r['title'] for r in self.generated_with], ['weak 0'])
+        self.assertEqual(result['pipeline']['trigger'], 'deadline')
+        self.assertEqual(result['late_sources'], [])
+        self.assertEqual(len(result['sources']), 1)
+        self.assertEqual(metrics.PIPELINE_LATE_RESULTS.value(policy='dropped'), before + 2)
+
+    def test_pipelined_news_strategy_streams_each_sub_query(self):
+        serpapi = SerpAPIService()
+
+        def execute(params, *args):
+            slug = str(abs(hash(params['q'])))
+            return {'news_results': [
+                {'title': f'{slug} {i}', 'link': f'https://news.example.com/{slug}/{i}', 'snippet': 'AI', 'date': '1 hour ago'}
+                for i in range(2)
+            ]}
+
+        partials = []
+        with mock.patch.object(serpapi, '_execute_search', side_effect=execute):
+            sequential = serpapi.search('Claude news', search_type='news', use_cache=False)
+            pipelined = serpapi.search('Claude news', search_type='news', use_cache=False, on_partial=partials.append)
+
+        self.assertEqual(len(partials), 3)
+        self.assertEqual([r['url'] for r in pipelined], [r['url'] for r in sequential])
+
+
+class DeadlineTestCase(TestCase):
+
+    def test_timeouts_are_capped_by_remaining_budget(self):
+        unbounded = Deadline()
+        self.assertEqual(unbounded.timeout(30.0), 30.0)
+        self.assertIsNone(unbounded.timeout())
+
+        deadline = Deadline(10)
+        self.assertLessEqual(deadline.timeout(30.0), 10)
+        self.assertEqual(deadline.timeout(2.0), 2.0)
+        search = deadline.reserve(8)
+        self.assertLessEqual(search.remaining(), 2)
+
+        search.degrade('search')
+        self.assertEqual(deadline.degraded_stages, ['search'])
+        speculative = deadline.reserve(0, report=False)
+        speculative.degrade('search_fallback')
+        self.assertEqual(deadline.degraded_stages, ['search'])
+        self.assertEqual(speculative.degraded_stages, ['search_fallback'])
+
+    @override_settings(
+        DEADLINE_LLM_RESERVE_SECONDS=1.5, DEADLINE_SEARCH_RESERVE_SECONDS=0.4,
+        DEADLINE_MIN_CALL_SECONDS=1, LOCAL_INDEX_ENABLED=False
+    )
+    def test_short_budget_skips_rewrite_and_search(self):
+        service = IntelligentSearchService()
+        completion = {'status_code': 200, 'content': 'Réponse', 'usage': {}}
+        with mock.patch('chat.services.serpapi_service.GoogleSearch') as google_search, \
+                mock.patch.object(service, '_rewrite_search_query') as rewrite, \
+                mock.patch.object(service.openrouter_service, 'chat_completion', return_value=completion) as llm:
+            result = service.process_user_query("Quelles sont les dernières annonces en IA ?", deadline=Deadline(2))
+
+        rewrite.assert_not_called()
+        google_search.assert_not_called()
+        self.assertEqual(result['degraded_stages'], ['rewrite', 'search', 'search_fallback'])
+        self.assertEqual(result['response'], 'Réponse')
+        self.assertLessEqual(llm.call_args.kwargs['deadline'].timeout(30.0), 2)
+
+    @override_settings(DEADLINE_MIN_CALL_SECONDS=1, LOCAL_INDEX_ENABLED=False)
+    def test_expired_budget_answers_with_sources(self):
+        service = IntelligentSearchService()
+        with mock.patch.object(service.openrouter_service, 'chat_completion') as llm:
+            result = service.process_user_query("Quelles sont les dernières annonces en IA ?", deadline=Deadline(0.5))
+
+        llm.assert_not_called()
+        self.assertIn('llm', result['degraded_stages'])
+        self.assertTrue(result['response'].startswith('⏳'))
+        self.assertIn(result['sources'][0]['url'], result['response'])
+
+    @override_settings(ANSWER_CACHE_ENABLED=True)
+    def test_truncated_answer_is_not_cached(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        get_answer_cache().clear()
+        cache.set(SELECTED_MODEL_CACHE_KEY, 'openrouter')
+        answers = []
+
+        def generate(service, *args, deadline=None, **kwargs):
+            service.last_status_code = 200
+            if not answers:
+                deadline.degrade('llm')  # Flux coupé par l'échéance
+            answers.append(None)
+            return 'Réponse complète' if len(answers) > 1 else 'Réponse tron'
+
+        with mock.patch.object(OpenRouterOptimizedService, 'generate_response', autospec=True, side_effect=generate):
+            self.assertEqual(ChatAPIView().handle_chat('Explique les LLM', deadline=Deadline(5))['message']['content'],
+                             'Réponse tron')
+            second = ChatAPIView().handle_chat('Explique les LLM')
+        self.assertEqual(second['message']['content'], 'Réponse complète')
+        self.assertFalse(second['cached'])
+        self.assertEqual(len(answers), 2)
+
+    def test_default_budget_keeps_vllm_cpu_timeout(self):
+        # vLLM sur CPU : 1-2 minutes, timeout de 300 s non tronqué par défaut
+        self.assertEqual(Deadline.from_settings().timeout(VLLMService().timeout), 300)
+        self.assertEqual(Deadline.from_settings(job=True).timeout(300), 300)
+        self.assertLessEqual(Deadline.from_settings(5000).timeout(300), 5)
+        with override_settings(CHAT_JOB_DEADLINE_SECONDS=120):
+            self.assertLessEqual(Deadline.from_settings(job=True).timeout(300), 120)
+            self.assertEqual(Deadline.from_settings().timeout(300), 300)
+
+
+@override_settings(LOAD_QUEUE_TARGET_RATIO=0.5, LOAD_VLLM_LATENCY_TARGET=30)
+class LoadPolicyTestCase(TestCase):
+
+    def setUp(self):
+        cache.delete(OVERRIDE_CACHE_KEY)
+        self.addCleanup(cache.delete, OVERRIDE_CACHE_KEY)
+        # Redis en panne par défaut : le niveau forcé passe par le cache du processus
+        patcher = mock.patch('chat.services.load_policy.get_shared_redis', return_value=_shared_redis(down=True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_steps_up_and_recovers_with_hysteresis(self):
+        signals = {'queue_ratio': 0.0}
+        policy = LoadPolicy(thresholds=(1.0, 1.5, 2.0, 3.0), recovery_ratio=0.7, cooldown=30,
+                            interval=5, signals=lambda: dict(signals))
+
+        signals['vllm_latency'] = 70  # pression 2.33 : cible short_answers
+        self.assertEqual(policy.evaluate(now=0), 1)
+        self.assertEqual(policy.evaluate(now=1), 1)  # intervalle non écoulé
+        self.assertEqual(policy.evaluate(now=5), 2)
+        self.assertEqual(policy.evaluate(now=10), 3)
+        self.assertEqual(policy.evaluate(now=15), 3)
+
+        signals['vllm_latency'] = 57  # 1.9 : sous le seuil 2.0 mais pas sous 2.0 × 0.7
+        self.assertEqual(policy.evaluate(now=60), 3)
+        signals['vllm_latency'] = 30  # 1.0 : sous 1.4, mais cooldown depuis le dernier changement
+        self.assertEqual(policy.evaluate(now=61, force=True), 2)
+        self.assertEqual(policy.evaluate(now=70), 2)
+        signals['vllm_latency'] = 0
+        self.assertEqual(policy.evaluate(now=91), 1)
+        self.assertEqual(policy.evaluate(now=121), 0)
+
+    def test_admin_override(self):
+        response = self.client.post('/api/v1/load-policy/', {'level': 2}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_user('ops', is_staff=True))
+        response = self.client.post('/api/v1/load-policy/', {'level': 9}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/v1/load-policy/', {'level': 4}, content_type='application/json')
+        self.assertEqual(response.json()['effective']['name'], 'fast_provider')
+        self.assertEqual(response.json()['effective']['fast_provider'], 'openrouter')
+
+        status = self.client.get('/api/v1/load-policy/').json()
+        self.assertEqual(status['mode'], 'manual')
+        self.client.post('/api/v1/load-policy/', {'level': None}, content_type='application/json')
+        self.assertEqual(self.client.get('/api/v1/load-policy/').json()['mode'], 'auto')
+
+    def test_override_is_shared_through_redis(self):
+        store = {}
+        client = mock.MagicMock()
+        client.get.side_effect = store.get
+        client.set.side_effect = lambda key, value: store.__setitem__(key, str(value))
+        client.delete.side_effect = lambda key: store.pop(key, None)
+        with mock.patch('chat.services.load_policy.get_shared_redis', return_value=_shared_redis(client)):
+            LoadPolicy().set_override(3)
+            other_worker = LoadPolicy()
+            self.assertEqual((other_worker.current().level, other_worker.current().manual), (3, True))
+            self.assertIsNone(cache.get(OVERRIDE_CACHE_KEY))
+
+            other_worker.set_override(None)
+            self.assertFalse(LoadPolicy().current().manual)
+
+    def test_lean_search_returns_fewer_results(self):
+        self.assertEqual(SerpAPIService().max_results, settings.MAX_SEARCH_RESULTS)
+        cache.set(OVERRIDE_CACHE_KEY, 2)
+        self.assertLess(SerpAPIService().max_results, settings.MAX_SEARCH_RESULTS)
+        self.assertLess(MultiSearchService().max_results, settings.MAX_SEARCH_RESULTS)
+
+    @override_settings(MAX_SEARCH_RESULTS=10, LOAD_REDUCED_SEARCH_RESULTS=5)
+    def test_degraded_level_skips_rewrite_and_trims_search(self):
+        cache.set(OVERRIDE_CACHE_KEY, 2)
+        service = IntelligentSearchService()
+        with mock.patch.object(service, '_rewrite_search_query') as rewrite:
+            search_data = service._generate_search_query("Dernières annonces en IA", None, None)
+
+        rewrite.assert_not_called()
+        self.assertTrue(search_data['search_query'])
+        self.assertEqual(SerpAPIService().max_results, 5)
+        self.assertEqual(MultiSearchService().max_results, 5)
+
+
+@override_settings(ROUTING_LOCAL_MAX_INPUT_TOKENS=1000, ROUTING_SEARCH_WEIGHT=0.6, ROUTING_HISTORY_WEIGHT=0.1)
+class ModelRouterTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()  # historique du throttling anonyme compris
+        cache.set(SELECTED_MODEL_CACHE_KEY, 'auto')
+        self.addCleanup(cache.delete, SELECTED_MODEL_CACHE_KEY)
+        # Redis en panne par défaut : le choix du modèle passe par le cache du processus
+        patcher = mock.patch('chat.services.model_router.get_shared_redis', return_value=_shared_redis(down=True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.vllm = mock.Mock()
+        self.vllm.is_available.return_value = True
+        self.router = ModelRouter(vllm_service=self.vllm, stats_interval=0)
+
+    def test_routes_by_complexity(self):
+        self.assertEqual(self.router.route("Bonjour, qui es-tu ?").reason, 'simple')
+        self.assertEqual(self.router.route("Bonjour, qui es-tu ?").provider, 'vllm')
+
+        synthesis = self.router.route("Dernières annonces IA", requires_search=True, context='x' * 2000)
+        self.assertEqual((synthesis.provider, synthesis.reason), ('openrouter', 'complex'))
+        self.assertEqual(self.router.route('x' * 4400).reason, 'context')
+        history = [{'role': 'user', 'content': 'question'}] * 10
+        self.assertEqual(self.router.route("Et ensuite ?", history=history).provider, 'openrouter')
+
+    def test_live_stats_and_manual_override(self):
+        self.vllm.is_available.return_value = False
+        self.assertEqual(self.router.route("Bonjour").reason, 'vllm_unavailable')
+
+        cache.set(SELECTED_MODEL_CACHE_KEY, 'vllm')
+        decision = self.router.route('x' * 8000, requires_search=True)
+        self.assertEqual((decision.provider, decision.reason), ('vllm', 'manual'))
+
+        self.assertEqual(self.client.post('/api/v1/set-model/', {'model': 'auto'}, content_type='application/json').status_code, 200)
+        self.assertEqual(self.client.get('/api/v1/set-model/').json()['model'], 'auto')
+
+    @override_settings(LLM_ROUTING_DEFAULT='vllm')
+    def test_selected_model_is_shared_through_redis(self):
+        store = {}
+        client = mock.MagicMock()
+        client.get.side_effect = store.get
+        client.set.side_effect = store.__setitem__
+        with mock.patch('chat.services.model_router.get_shared_redis', return_value=_shared_redis(client)):
+            self.assertEqual(get_selected_model(), 'vllm')  # LLM_ROUTING_DEFAULT
+            self.client.post('/api/v1/set-model/', {'model': 'openrouter'}, content_type='application/json')
+            cache.delete(SELECTED_MODEL_CACHE_KEY)  # un autre worker : rien dans son cache local
+            self.assertEqual(get_selected_model(), 'openrouter')
+            self.assertEqual(self.router.route("Bonjour").reason, 'manual')
+        self.assertEqual(store, {SELECTED_MODEL_CACHE_KEY: 'openrouter'})
+
+
+class RewriteBatcherTestCase(SimpleTestCase):
+
+    def test_openrouter_packs_questions_and_retries_missing(self):
+        openrouter = mock.Mock()
+        packed = {'status_code': 200, 'usage': {}, 'content': json.dumps([
+            {'id': 1, 'search_query': 'OpenAI latest news', 'search_type': 'news'},
+            {'id': 3, 'search_query': 'EU AI Act', 'search_type': 'news'},
+        ])}
+        single = {'status_code': 200, 'usage': {}, 'content': '{"search_query": "Anthropic Claude", "search_type": "news"}'}
+        openrouter.chat_completion.side_effect = lambda messages, **kwargs: (
+            packed if messages[0]['content'] == SEARCH_QUERY_BATCH_SYSTEM_PROMPT else single
+        )
+        batcher = RewriteBatcher(vllm_service=mock.Mock(), openrouter_service=openrouter, window_ms=50)
+
+        futures = [batcher.submit('openrouter', query) for query in ("OpenAI ?", "Anthropic ?", "AI Act ?")]
+        contents = [json.loads(future.result(timeout=5)['content'])['search_query'] for future in futures]
+
+        self.assertEqual(contents, ['OpenAI latest news', 'Anthropic Claude', 'EU AI Act'])
+        self.assertEqual(openrouter.chat_completion.call_count, 2)
+        packed_prompt = openrouter.chat_completion.call_args_list[0].args[0][1]['content']
+        self.assertIn("Question 3: AI Act ?", packed_prompt)
+
+    def test_vllm_in_flight_is_bounded(self):
+        in_flight, peak, lock = [0], [0], threading.Lock()
+
+        def generate_response(messages, deadline=None):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+            return {'success': True, 'response': '{"search_query": "q"}'}
+
+        vllm = mock.Mock()
+        vllm.generate_response.side_effect = generate_response
+        batcher = RewriteBatcher(vllm_service=vllm, openrouter_service=mock.Mock(), window_ms=5, max_in_flight=2)
+
+        futures = [batcher.submit('vllm', f"question {i}") for i in range(6)]
+        self.assertTrue(all(future.result(timeout=5)['success'] for future in futures))
+        self.assertEqual(vllm.generate_response.call_count, 6)
+        self.assertLessEqual(peak[0], 2)
+
+
+class VLLMAdmissionTestCase(TestCase):
+
+    def _queue(self, controller, key, served, positions=None):
+        """Lance un appel en attente de place et attend qu'il soit bien dans la file"""
+        depth = controller.stats()['queue_depth']
+
+        def call():
+            with queue_context(key, positions.append if positions is not None else None):
+                with controller.slot():
+                    served.append(key)
+
+        thread = threading.Thread(target=call)
+        thread.start()
+        while controller.stats()['queue_depth'] == depth:
+            time.sleep(0.001)
+        return thread
+
+    def test_conversations_are_served_round_robin(self):
+        controller = VLLMAdmissionController(capacity=1, queue_timeout=5)
+        served, positions = [], []
+        with controller.slot():
+            threads = [self._queue(controller, 'bavarde', served) for _ in range(3)]
+            threads.append(self._queue(controller, 'autre', served, positions))
+            self.assertEqual(controller.stats()['queued_conversations'], 2)
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertEqual(served, ['bavarde', 'autre', 'bavarde', 'bavarde'])
+        self.assertEqual(positions[0], 2)
+        self.assertEqual(controller.stats()['in_flight'], 0)
+
+    def test_queue_timeout_raises(self):
+        controller = VLLMAdmissionController(capacity=1, queue_timeout=0.05)
+        with controller.slot():
+            with self.assertRaises(VLLMQueueTimeout):
+                with controller.slot():
+                    pass
+        self.assertEqual(controller.stats()['timeouts'], 1)
+        self.assertEqual(controller.stats()['queue_depth'], 0)
+
+    def test_chat_falls_back_to_openrouter_when_queue_is_full(self):
+        cache.set(SELECTED_MODEL_CACHE_KEY, 'vllm')
+        self.addCleanup(cache.delete, SELECTED_MODEL_CACHE_KEY)
+        full = VLLMAdmissionController(capacity=0, queue_timeout=0.01)
+        with MockLLMServer(ttft=0, tokens_per_second=0) as server, \
+                override_settings(VLLM_BASE_URL=server.url, OPENROUTER_BASE_URL=f"{server.url}/v1"), \
+                mock.patch('chat.views.ChatAPIView.throttle_classes', []), \
+                mock.patch('chat.services.vllm_service.get_vllm_admission', return_value=full):
+            response = self.client.post(
+                '/api/v1/chat/', {'message': 'Bonjour, comment vas-tu ?'}, content_type='application/json'
+            ).json()
+            stats = server.stats()
+
+        self.assertEqual(response['routing']['fallback'], 'vllm_queue_timeout')
+        self.assertNotIn('Erreur', response['message']['content'])
+        self.assertEqual(stats['completed'], 1)
+
+
+class ChatTurnRateThrottleTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def _allow(self, message):
+        request = Request(
+            APIRequestFactory().post('/api/v1/chat/', {'message': message}, format='json'), parsers=[JSONParser()]
+        )
+        throttle = ChatTurnRateThrottle()
+        return throttle.allow_request(request, ChatAPIView()), throttle
+
+    def test_search_and_plain_turns_use_separate_budgets(self):
+        gcra = mock.Mock()
+        gcra.check.return_value = (True, 0.0)
+        with mock.patch('chat.throttling.get_gcra', return_value=gcra), \
+                mock.patch.dict(ChatTurnRateThrottle.THROTTLE_RATES, {'chat': '10/minute', 'chat_search': '4/minute'}):
+            self._allow("Bonjour !")
+            self._allow("Quelles sont les dernières news sur l'IA ?")
+
+        self.assertEqual(gcra.check.call_args_list, [
+            mock.call('throttle:chat:127.0.0.1', 6000, 60000),
+            mock.call('throttle:chat_search:127.0.0.1', 15000, 60000),
+        ])
+
+    def test_throttled_turn_gets_retry_after_from_redis(self):
+        gcra = mock.Mock()
+        gcra.check.return_value = (False, 4.2)
+        with mock.patch('chat.throttling.get_gcra', return_value=gcra):
+            response = self.client.post('/api/v1/chat/', {'message': 'Bonjour !'}, content_type='application/json')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '5')
+
+    def test_falls_back_to_local_budget_when_redis_is_down(self):
+        gcra = _RedisGCRA('redis://127.0.0.1:1/0', socket_timeout=0.1, retry_seconds=30)
+        with mock.patch('chat.throttling.get_gcra', return_value=gcra), \
+                mock.patch.dict(ChatTurnRateThrottle.THROTTLE_RATES, {'chat': '1/minute'}), \
+                mock.patch.object(gcra, '_script', wraps=gcra._script) as script:
+            first, _ = self._allow("Bonjour !")
+            second, throttle = self._allow("Bonjour !")
+
+        self.assertTrue(first)
+        self.assertFalse(second)
+        self.assertGreater(throttle.wait(), 0)
+        # Un seul essai réseau : Redis est ignoré jusqu'à la fin du délai de nouvel essai
+        self.assertEqual(script.call_count, 1)
+
+
+class FastJSONTestCase(TestCase):
+
+    def test_message_fast_path_matches_drf_fields(self):
+        conversation = Conversation.objects.create()
+        Message.objects.create(conversation=conversation, role='user', content='Quoi de neuf ?')
+        Message.objects.create(
+            conversation=conversation, role='assistant', content='Voici les nouveautés…',
+            search_results=[{'title': 'Claude', 'url': 'https://example.com'}], sources=[{'title': 'Claude'}]
+        )
+        messages = conversation.messages.all()
+
+        fast = MessageSerializer(messages, many=True).data
+        drf = ListSerializer(child=MessageSerializer(), instance=messages).data
+
+        self.assertEqual(fast, drf)
+        self.assertEqual(ConversationSerializer(conversation).data['messages'], drf)
+
+    def test_renderer_output_matches_drf(self):
+        data = {
+            'id': uuid.uuid4(), 'at': timezone.now(), 'price': Decimal('1.50'),
+            'text': 'Réponse\u2028ligne', 'items': [1, None, True, {'k': 'v'}],
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            FastJSONRenderer().render(data, 'application/json; indent=2'),
+            JSONRenderer().render(data, 'application/json; indent=2'),
+        )
+
+    def test_parser_rejects_invalid_json(self):
+        self.assertEqual(FastJSONParser().parse(io.BytesIO('{"message": "été"}'.encode())), {'message': 'été'})
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(io.BytesIO(b'{"message": '))
+
+
+class ConversationConditionalGetTestCase(TestCase):
+
+    def setUp(self):
+        # Budget anon (throttle local sans Redis) rendu aux tests suivants
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.conversation = Conversation.objects.create()
+        Message.objects.create(conversation=self.conversation, role='user', content='Quoi de neuf ?')
+        Message.objects.create(conversation=self.conversation, role='assistant', content='Réponse ' * 200)
+        self.conversation.touch(2)
+        self.url = f'/api/v1/conversations/{self.conversation.id}/'
+
+    def test_unchanged_conversation_is_not_modified_without_reading_messages(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 2)
+
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 304)
+        self.assertFalse(any('chat_message' in query['sql'] for query in queries.captured_queries))
+
+        Message.objects.create(conversation=self.conversation, role='user', content='Et ensuite ?')
+        self.conversation.touch(1)
+        third = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(len(third.json()['messages']), 3)
+
+        Message.objects.filter(role='user').first().delete()
+        fourth = self.client.get(self.url, HTTP_IF_NONE_MATCH=third['ETag'])
+        self.assertEqual(fourth.status_code, 200)
+        self.assertEqual(len(fourth.json()['messages']), 2)
+
+    def _conversation_updates(self, queries):
+        return [q for q in queries.captured_queries if q['sql'].startswith('UPDATE "chat_conversation"')]
+
+    def test_chat_turn_updates_conversation_once(self):
+        get_answer_cache().clear()
+        cache.set(SELECTED_MODEL_CACHE_KEY, 'openrouter')
+        view = ChatAPIView()
+        with mock.patch('chat.views.OpenRouterOptimizedService.generate_response', return_value='Réponse'), \
+                CaptureQueriesContext(connection) as queries:
+            view.handle_chat('Bonjour !', str(self.conversation.id))
+        self.assertEqual(len(self._conversation_updates(queries)), 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 4)
+
+        # Tour interrompu : le message utilisateur reste compté
+        with mock.patch('chat.views.OpenRouterOptimizedService.generate_response', side_effect=ChatCancelled('client')), \
+                CaptureQueriesContext(connection) as queries, self.assertRaises(ChatCancelled):
+            view.handle_chat('Et ensuite ?', str(self.conversation.id))
+        self.assertEqual(len(self._conversation_updates(queries)), 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, self.conversation.messages.count())
+
+    def test_list_etag_changes_with_new_conversation(self):
+        first = self.client.get('/api/v1/conversations/')
+        self.assertEqual(self.client.get('/api/v1/conversations/', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        Conversation.objects.create()
+        self.assertEqual(self.client.get('/api/v1/conversations/', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+    def test_gzip_negotiation_keeps_conditional_get(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='br;q=0.5, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(response.content))['id'], str(self.conversation.id))
+        self.assertTrue(response['ETag'].startswith('W/'))
+
+        again = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+        self.assertEqual(negotiate_encoding('gzip;q=0.5, br', ('br', 'gzip')), 'br')
+        self.assertEqual(negotiate_encoding('br;q=0, *', ('br', 'gzip')), 'gzip')
+        self.assertIsNone(negotiate_encoding('identity', ('br', 'gzip')))
+
+
+class PromptPrefixTestCase(SimpleTestCase):
+    """Préfixe statique identique octet pour octet d'une requête à l'autre (cache de préfixe vLLM)"""
+
+    @staticmethod
+    def _encoded(messages):
+        return [json.dumps(message, ensure_ascii=False).encode('utf-8') for message in messages]
+
+    def test_volatile_parts_stay_after_the_static_prefix(self):
+        monday, friday = datetime(2025, 6, 2, 9, 0), datetime(2025, 6, 6, 18, 30)
+        rewrites = [
+            build_search_query_messages("Quoi de neuf chez OpenAI ?", 'this_week', monday),
+            build_search_query_messages("Derniers modèles Mistral", None, friday),
+        ]
+        finals = [
+            build_final_response_messages("Quoi de neuf ?", "[1] OpenAI...", "OpenAI news", 'today', monday),
+            build_final_response_messages("Et Mistral ?", "[1] Mistral...", "Mistral models", None, friday),
+        ]
+        for first, second in (rewrites, finals):
+            self.assertEqual(self._encoded(first)[0], self._encoded(second)[0])
+            self.assertEqual([m['role'] for m in first], ['system', 'user'])
+            self.assertNotEqual(first[1]['content'], second[1]['content'])
+
+    def test_each_chat_turn_extends_the_previous_request(self):
+        history = []
+        previous = None
+        for question, answer in [("Bonjour", "Bonjour !"), ("Explique l'attention", "L'attention pondère..."), ("Merci", "")]:
+            request = self._encoded(build_chat_messages(question, history))
+            if previous is not None:
+                # Tour précédent (question + réponse) intact en tête de la nouvelle requête
+                self.assertEqual(request[:len(previous)], previous)
+            history += [{'role': 'user', 'content': question}, {'role': 'assistant', 'content': answer}]
+            previous = request + self._encoded(history[-1:])
+
+
+def _shared_redis(client=None, down=False):
+    """``SharedRedis`` sur un client factice (ou en panne) : pas de serveur Redis dans les tests"""
+    shared = SharedRedis('redis://127.0.0.1:6379/1', socket_timeout=0.1, retry_seconds=30)
+    shared.client = client or mock.MagicMock()
+    if down:
+        shared._down_until = float('inf')
+    return shared
+
+
+class SearchPrefetchTestCase(SimpleTestCase):
+    """Budget SerpAPI et verrou du préchargeur partagés via Redis"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_credit_budget_counts_in_redis(self):
+        client = mock.MagicMock()
+        client.pipeline.return_value.execute.side_effect = [[2, True], [3, True]]
+        with mock.patch('chat.services.serpapi_service.get_shared_redis', return_value=_shared_redis(client)):
+            budget = SerpAPICreditBudget(2, scope='test')
+            self.assertTrue(budget.try_consume(1))
+            self.assertFalse(budget.try_consume(1))
+        client.pipeline.return_value.incrby.assert_called_with(budget._key(), 1)
+        client.decrby.assert_called_once_with(budget._key(), 1)
+
+    def test_credit_budget_falls_back_to_process_cache(self):
+        with mock.patch('chat.services.serpapi_service.get_shared_redis', return_value=_shared_redis(down=True)):
+            budget = SerpAPICreditBudget(2, scope='test')
+            self.assertEqual([budget.try_consume(1) for _ in range(3)], [True, True, False])
+            self.assertEqual(budget.remaining(), 0)
+
+    def test_only_the_lock_holder_prefetches(self):
+        client = mock.MagicMock()
+        client.eval.side_effect = [1, 0]
+        prefetcher = TrendingPrefetcher(interval=60, credits_per_hour=10)
+        with mock.patch('chat.services.prefetch.get_shared_redis', return_value=_shared_redis(client)):
+            self.assertTrue(prefetcher.is_leader())
+            self.assertFalse(prefetcher.is_leader())
+        self.assertEqual(client.eval.call_args.args[2:], ('search_prefetch:leader', prefetcher._leader_id, 120000))
+        with mock.patch('chat.services.prefetch.get_shared_redis', return_value=_shared_redis(down=True)):
+            self.assertFalse(prefetcher.is_leader())
+
+    @override_settings(SEARCH_PREFETCH_ENABLED=True)
+    def test_prefetched_rewrite_is_shared_with_other_workers(self):
+        store = {}
+        client = mock.MagicMock()
+        client.set.side_effect = lambda key, value, ex: store.__setitem__(key, value)
+        client.get.side_effect = store.get
+        question = "Quelles sont les dernières nouveautés d'OpenAI ?"
+        search = IntelligentSearchService()
+        key = search._rewrite_cache_key(question, datetime(2025, 6, 2))
+        rewrite = {'search_query': 'OpenAI latest news', 'search_type': 'news', 'rewritten_by': 'vllm'}
+
+        with mock.patch('chat.services.prefetch.get_shared_redis', return_value=_shared_redis(client)):
+            self.assertIsNone(lookup_prefetched_rewrite(key))
+            publish_rewrite(key, rewrite, ttl=600)
+            # Autre worker : cache local vide, pas d'appel LLM
+            with mock.patch.object(search, '_rewrite_search_query', side_effect=AssertionError):
+                result = search._generate_search_query(question, None, datetime(2025, 6, 2))
+        self.assertEqual(result, rewrite)
+
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class SearchCacheTestCase(TestCase):
+
+    def test_refreshed_expired_entry_is_served_again(self):
+        serpapi = SerpAPIService()
+        key = serpapi._cache_key('Claude news', 'news')
+        SearchCache.objects.create(query=key, results=NEWS_RESULTS[:1], created_at=timezone.now() - timedelta(hours=12))
+        news = {'news_results': [{'title': 'Claude', 'link': 'https://news.example.com/claude', 'snippet': 'AI', 'date': '1 hour ago'}]}
+        with mock.patch.object(serpapi, '_execute_search', return_value=news) as execute:
+            fresh = serpapi.search('Claude news', search_type='news')
+            calls = execute.call_count
+            self.assertGreater(calls, 0)
+            self.assertEqual(serpapi.search('Claude news', search_type='news'), fresh)
+            self.assertEqual(execute.call_count, calls)
+        self.assertEqual(SearchCache.objects.get(query=key).results, fresh)
+
+
+class ChatJobQueueTestCase(TransactionTestCase):
+    """Travaux asynchrones persistés : visibles de tout worker, admission bornée"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def _wait_for(self, queue, job_id, status, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = queue.get(job_id)
+            if job and job['status'] == status:
+                return job
+            time.sleep(0.01)
+        self.fail(f"Travail {job_id} jamais passé à {status}")
+
+    def test_submit_and_poll(self):
+        queue = ChatJobQueue(max_workers=1, max_pending=2)
+        conversation = Conversation.objects.create()
+        job = queue.submit(lambda text: {'response': text.upper()}, 'bonjour', conversation_id=str(conversation.id))
+        self.assertEqual(job['status'], 'queued')
+        self._wait_for(queue, job['job_id'], 'completed')
+
+        # Polling servi depuis la base : pas besoin du worker qui a exécuté le travail
+        response = self.client.get(f"/api/v1/jobs/{job['job_id']}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['result'], {'response': 'BONJOUR'})
+        self.assertEqual(response.json()['conversation_id'], str(conversation.id))
+        self.assertEqual(self.client.get(f"/api/v1/jobs/{uuid.uuid4()}/").status_code, 404)
+
+    def test_rejects_beyond_max_pending(self):
+        queue = ChatJobQueue(max_workers=1, max_pending=1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        running = queue.submit(release.wait, 5)
+        self._wait_for(queue, running['job_id'], 'running')
+        queued = queue.submit(lambda: {})
+        self.assertEqual(queued['queue_position'], 1)
+
+        with self.assertRaises(JobQueueFull):
+            queue.submit(lambda: {})
+        self.assertEqual(queue.metrics()['rejected'], 1)
+
+        release.set()
+        self._wait_for(queue, queued['job_id'], 'completed')
+        self.assertEqual(ChatJob.objects.count(), 2)
+
+    def test_admission_counts_jobs_queued_by_other_workers(self):
+        queue = ChatJobQueue(max_workers=1, max_pending=1)
+        ChatJob.objects.create(worker='autre-machine:1:abcd1234')
+        with self.assertRaises(JobQueueFull):
+            queue.submit(lambda: {})
+        self.assertEqual(queue.metrics()['rejected'], 1)
+
+    def test_unfinished_jobs_of_dead_processes_fail_on_startup(self):
+        host = socket.gethostname()
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        workers = {
+            'dead': f"{host}:{dead.pid}:0000dead",
+            'previous': f"{host}:{os.getpid()}:00000old",
+            'legacy': '',
+            'alive': f"{host}:{os.getppid()}:0000live",
+            'remote': 'autre-machine:1:0remote',
+        }
+        jobs = {name: ChatJob.objects.create(worker=worker, status='running') for name, worker in workers.items()}
+        done = ChatJob.objects.create(worker=workers['dead'], status='completed')
+
+        self.assertEqual(ChatJobQueue(max_workers=1, max_pending=2).fail_stale_jobs(), 3)
+        statuses = {name: ChatJob.objects.get(pk=job.pk).status for name, job in jobs.items()}
+        self.assertEqual(statuses, {
+            'dead': 'failed', 'previous': 'failed', 'legacy': 'failed', 'alive': 'running', 'remote': 'running',
+        })
+        self.assertEqual(ChatJob.objects.get(pk=done.pk).status, 'completed')
+        self.assertIn('redémarrage', ChatJobQueue(max_workers=1, max_pending=2).get(str(jobs['dead'].pk))['error'])
+
+    def test_failed_and_expired_jobs(self):
+        queue = ChatJobQueue(max_workers=1, max_pending=2, result_ttl=60)
+        job = queue.submit(lambda: 1 / 0)
+        self.assertIn('division by zero', self._wait_for(queue, job['job_id'], 'failed')['error'])
+
+        ChatJob.objects.filter(pk=job['job_id']).update(created_at=timezone.now() - timedelta(minutes=5))
+        self.assertIsNone(queue.get(job['job_id']))
+        # Purge des travaux expirés à l'admission suivante
+        self._wait_for(queue, queue.submit(lambda: {})['job_id'], 'completed')
+        self.assertFalse(ChatJob.objects.filter(pk=job['job_id']).exists())
+
+    def test_deadline_starts_when_worker_picks_job_up(self):
+        queue = ChatJobQueue(max_workers=1, max_pending=2)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self._wait_for(queue, queue.submit(release.wait, 5)['job_id'], 'running')
+        remaining = []
+
+        def handle_chat(message, conversation_id, search_budget_ms=None, deadline=None):
+            remaining.append(deadline.remaining())
+            return {'response': message}
+
+        with mock.patch('chat.views.get_job_queue', return_value=queue), \
+                mock.patch('chat.views.ChatAPIView.throttle_classes', []), \
+                mock.patch.object(ChatAPIView, 'handle_chat', side_effect=handle_chat):
+            response = self.client.post(
+                '/api/v1/chat/', {'message': 'Bonjour', 'async_mode': True, 'deadline_ms': 1000},
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 202)
+            time.sleep(1.1)  # Plus que le budget demandé, passé en file
+            release.set()
+            self._wait_for(queue, response.json()['job_id'], 'completed')
+        self.assertGreater(remaining[0], 0.5)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatConsumerTestCase(TransactionTestCase):
+    """Chat sur WebSocket contre un MockLLMServer (OpenRouter)"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        cache.set(SELECTED_MODEL_CACHE_KEY, 'openrouter')
+        gcra = mock.Mock()
+        gcra.check.return_value = (True, 0.0)
+        patcher = mock.patch('chat.throttling.get_gcra', return_value=gcra)
+        self.gcra = patcher.start()()
+        self.addCleanup(patcher.stop)
+
+    def _turn(self, server, *actions):
+        """Envoie un message puis joue ``actions(communicator, events)`` ; renvoie les événements reçus"""
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), '/ws/chat/', headers=[(b'x-forwarded-for', b'203.0.113.7')]
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'type': 'message', 'message': "Explique l'attention"})
+            events = []
+            for action in actions:
+                if await action(communicator, events):
+                    return events
+            await communicator.disconnect()
+            return events
+
+        with override_settings(OPENROUTER_BASE_URL=f"{server.url}/v1"):
+            return async_to_sync(run)()
+
+    @staticmethod
+    def _until(*types):
+        async def receive(communicator, events):
+            while not events or events[-1]['type'] not in types:
+                events.append(await communicator.receive_json_from(timeout=10))
+        return receive
+
+    def test_streams_tokens_then_done(self):
+        with MockLLMServer(ttft=0, tokens_per_second=0) as server:
+            events = self._turn(server, self._until('done', 'error'))
+
+        types = [event['type'] for event in events]
+        self.assertEqual(types[0], 'conversation')
+        self.assertEqual(types[-1], 'done')
+        tokens = ''.join(event['content'] for event in events if event['type'] == 'token')
+        self.assertTrue(tokens)
+        self.assertEqual(events[-1]['message']['content'], tokens)
+
+    def test_cancel_stops_the_generation(self):
+        async def cancel(communicator, events):
+            await communicator.send_json_to({'type': 'cancel'})
+
+        with MockLLMServer(ttft=0, tokens_per_second=20) as server:
+            events = self._turn(server, self._until('token'), cancel, self._until('cancelled', 'done'))
+            time.sleep(0.2)
+            stats = server.stats()
+
+        self.assertEqual(events[-1], {'type': 'cancelled', 'reason': 'cancelled'})
+        self.assertEqual(stats['completed'], 0)
+        self.assertEqual(stats['disconnected'], 1)
+
+    def test_disconnect_releases_the_provider(self):
+        async def disconnect(communicator, events):
+            await communicator.disconnect()
+            return True
+
+        with MockLLMServer(ttft=0, tokens_per_second=20) as server:
+            self._turn(server, self._until('token'), disconnect)
+            deadline = time.monotonic() + 5
+            while server.stats()['disconnected'] == 0 and time.monotonic() < deadline:
+                time.sleep(0.02)
+            stats = server.stats()
+
+        self.assertEqual(stats['disconnected'], 1)
+        self.assertEqual(stats['completed'], 0)
+
+    def test_turns_share_the_http_throttle_budget(self):
+        self.gcra.check.return_value = (False, 4.2)
+        with MockLLMServer(ttft=0, tokens_per_second=0) as server:
+            events = self._turn(server, self._until('error'))
+            stats = server.stats()
+
+        self.assertEqual(events, [{'type': 'error', 'error': 'Request was throttled', 'retry_after': 5}])
+        self.assertEqual(self.gcra.check.call_args.args[0], 'throttle:chat:203.0.113.7')
+        self.assertEqual(stats['requests'], 0)
+
+
+class DisconnectCancellationMiddlewareTestCase(SimpleTestCase):
+    """Annulation du travail d'une requête HTTP quand le client se déconnecte (niveau ASGI)"""
+
+    def _serve(self, app, client_messages):
+        """Sert une requête ; le client envoie ``client_messages`` au fil des lectures"""
+        scopes, sent = [], []
+
+        async def run():
+            upstream = asyncio.Queue()
+            for message in client_messages:
+                upstream.put_nowait(message)
+
+            async def receive():
+                return await upstream.get()
+
+            async def send(message):
+                sent.append(message)
+
+            async def capture(scope, receive, send):
+                scopes.append(scope)
+                await app(scope, receive, send)
+
+            await asyncio.wait_for(
+                DisconnectCancellationMiddleware(capture)({'type': 'http', 'path': '/api/v1/chat/'}, receive, send),
+                timeout=2
+            )
+
+        async_to_sync(run)()
+        return scopes[0]['cancel_token'], sent
+
+    def test_disconnect_mid_response_cancels_the_token(self):
+        async def app(scope, receive, send):
+            await receive()
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b'token', 'more_body': True})
+            # Lectures suivantes (Django >= 5 écoute la déconnexion) : pas de blocage
+            self.assertEqual(await receive(), {'type': 'http.disconnect'})
+            self.assertEqual(await receive(), {'type': 'http.disconnect'})
+            self.assertTrue(scope['cancel_token'].cancelled)
+
+        token, _ = self._serve(app, [{'type': 'http.request', 'body': b'{}'}, {'type': 'http.disconnect'}])
+        self.assertTrue(token.cancelled)
+        self.assertEqual(token.reason, 'disconnected')
+
+    def test_completed_response_is_not_cancelled(self):
+        async def app(scope, receive, send):
+            await receive()
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b'ok'})
+            self.assertEqual(await receive(), {'type': 'http.disconnect'})
+
+        token, sent = self._serve(app, [{'type': 'http.request', 'body': b'{}'}, {'type': 'http.disconnect'}])
+        self.assertFalse(token.cancelled)
+        self.assertEqual(sent[-1]['body'], b'ok')
+
+
+class RequestIdTestCase(TestCase):
+    """Corrélation des logs : request-id repris ou généré, renvoyé dans X-Request-ID"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_request_id_is_echoed_or_generated(self):
+        echoed = self.client.get('/api/v1/jobs/stats/', HTTP_X_REQUEST_ID='client-42.a_b')
+        self.assertEqual(echoed['X-Request-ID'], 'client-42.a_b')
+
+        for incoming in (None, 'espaces interdits', 'x' * 65):
+            headers = {'HTTP_X_REQUEST_ID': incoming} if incoming else {}
+            generated = self.client.get('/api/v1/jobs/stats/', **headers)['X-Request-ID']
+            self.assertRegex(generated, r'^[0-9a-f]{32}$')
+
+    def test_filter_adds_the_current_request_id(self):
+        record = logging.LogRecord('chat', logging.INFO, __file__, 1, 'message', (), None)
+        reset_token = request_id_var.set('req-1')
+        try:
+            self.assertTrue(RequestIdFilter().filter(record))
+        finally:
+            request_id_var.reset(reset_token)
+        self.assertEqual(record.request_id, 'req-1')
+
+        # Hors requête : valeur par défaut ; un request_id explicite (extra=) est conservé
+        outside = logging.LogRecord('chat', logging.INFO, __file__, 1, 'message', (), None)
+        RequestIdFilter().filter(outside)
+        self.assertEqual(outside.request_id, '-')
+        explicit = logging.LogRecord('chat', logging.INFO, __file__, 1, 'message', (), None)
+        explicit.request_id = 'job-7'
+        RequestIdFilter().filter(explicit)
+        self.assertEqual(explicit.request_id, 'job-7')
+
+
+class ServerTimingAndMetricsTestCase(TestCase):
+    """En-tête Server-Timing d'un tour de chat et exposition Prometheus de /metrics"""
+
+    def setUp(self):
+        cache.clear()
+        get_answer_cache().clear()
+        self.addCleanup(cache.clear)
+        cache.set(SELECTED_MODEL_CACHE_KEY, 'openrouter')
+        throttle = mock.patch('chat.views.ChatAPIView.throttle_classes', [])
+        throttle.start()
+        self.addCleanup(throttle.stop)
+
+    def test_server_timing_lists_the_turn_stages(self):
+        with override_settings(SERVER_TIMING_HEADER=True), MockLLMServer(ttft=0, tokens_per_second=0) as server, \
+                override_settings(OPENROUTER_BASE_URL=f"{server.url}/v1"):
+            response = self.client.post('/api/v1/chat/', {'message': 'Bonjour !'}, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        stages = dict(entry.split(';dur=') for entry in response['Server-Timing'].split(', '))
+        self.assertTrue({'total', 'llm', 'db_read', 'db_write'} <= set(stages))
+        self.assertGreaterEqual(float(stages['total']), float(stages['llm']))
+
+        with override_settings(SERVER_TIMING_HEADER=False):
+            self.assertFalse(self.client.get('/api/v1/jobs/stats/').has_header('Server-Timing'))
+
+    def test_metrics_exposition_format(self):
+        metrics.THROTTLE_DECISIONS.inc(scope='chat', outcome='allowed', backend='redis')
+        metrics.STAGE_DURATION.observe(0.25, stage='llm')
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.content.decode().splitlines()
+        self.assertIn('# TYPE chat_throttle_decisions_total counter', lines)
+        self.assertIn('# TYPE chat_stage_duration_seconds histogram', lines)
+        self.assertTrue(any(
+            line.startswith('chat_throttle_decisions_total{scope="chat",outcome="allowed",backend="redis"} ')
+            for line in lines
+        ))
+        self.assertTrue(any(line.startswith('chat_stage_duration_seconds_bucket{stage="llm",le="+Inf"} ') for line in lines))
+        # Chaque échantillon : nom{labels} valeur
+        for line in lines:
+            if not line.startswith('#'):
+                self.assertRegex(line, r'^[a-z_]+(\{[^}]*\})? -?[0-9.e+-]+$')
+
+    def test_metrics_are_restricted(self):
+        # Client de test : REMOTE_ADDR 127.0.0.1, autorisé par défaut
+        with override_settings(METRICS_ALLOWED_NETWORKS=['10.0.0.0/8'], METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_X_FORWARDED_FOR='10.0.0.5').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 200)
+        with override_settings(METRICS_ALLOWED_NETWORKS=[], METRICS_TOKEN=None):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+class TracePropagationTestCase(TestCase):
+    """Propagation W3C ``traceparent`` : requête entrante -> appels LLM sortants"""
+
+    INCOMING = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+
+    def setUp(self):
+        exporter = mock.Mock()
+        patcher = mock.patch.object(tracing, '_tracer', tracing.Tracer(exporter=exporter))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_inject_uses_the_current_span(self):
+        headers = {'Content-Type': 'application/json'}
+        self.assertEqual(tracing.inject_trace_headers(headers), headers)  # hors trace : rien à propager
+
+        reset_token = tracing.set_remote_parent(self.INCOMING)
+        try:
+            with tracing.span('chat.turn'), tracing.span('llm.call') as call:
+                injected = tracing.inject_trace_headers(headers)
+        finally:
+            tracing.reset_remote_parent(reset_token)
+
+        self.assertEqual(injected['traceparent'], f"00-4bf92f3577b34da6a3ce929d0e0e4736-{call.span_id}-01")
+        self.assertEqual(call.trace_id, '4bf92f3577b34da6a3ce929d0e0e4736')
+        self.assertNotIn('traceparent', headers)
+        self.assertIsNone(tracing.set_remote_parent('00-invalide-01'))
+
+    def test_chat_turn_propagates_the_incoming_trace(self):
+        get_answer_cache().clear()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        cache.set(SELECTED_MODEL_CACHE_KEY, 'openrouter')
+        outgoing = []
+
+        def record(headers):
+            headers = tracing.inject_trace_headers(headers)
+            outgoing.append(headers.get('traceparent'))
+            return headers
+
+        with mock.patch('chat.views.ChatAPIView.throttle_classes', []), \
+                mock.patch('chat.services.openrouter_optimized.inject_trace_headers', side_effect=record), \
+                MockLLMServer(ttft=0, tokens_per_second=0) as server, \
+                override_settings(OPENROUTER_BASE_URL=f"{server.url}/v1"):
+            response = self.client.post(
+                '/api/v1/chat/', {'message': 'Bonjour !'}, content_type='application/json',
+                HTTP_TRACEPARENT=self.INCOMING
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(outgoing), 1)
+        self.assertRegex(outgoing[0], r'^00-4bf92f3577b34da6a3ce929d0e0e4736-[0-9a-f]{16}-01$')
+        self.assertNotEqual(outgoing[0], self.INCOMING)
+
+
+class BenchPipelineSmokeTestCase(SimpleTestCase):
+    """Le harnais de benchmark tourne de bout en bout (quelques tours, latence nulle)"""
+
+    def _bench(self, *args):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'bench.json')
+            completed = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.bench_pipeline', '--turns', '4', '--concurrency', '2',
+                 '--latency-scale', '0', '--output', output, *args],
+                cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=120,
+            )
+            self.assertEqual(completed.returncode, 0, completed.stderr[-2000:])
+            with open(output, encoding='utf-8') as f:
+                return json.load(f)
+
+    def test_replayed_run_reports_every_turn(self):
+        report = self._bench('--memory-turns', '2')
+        self.assertEqual((report['turns'], report['errors']), (4, 0))
+        self.assertEqual(report['latency']['count'], 4)
+        self.assertEqual(set(report['latency_by_kind']), {'chat', 'search'})
+        self.assertIn('total', report['stages_ms'])
+        self.assertEqual(report['memory']['turns'], 2)
+
+    def test_mock_llm_run_goes_through_http(self):
+        report = self._bench('--mock-llm', '--memory-turns', '0')
+        self.assertEqual(report['errors'], 0)
+        self.assertGreater(report['mock_llm']['openrouter']['completed'], 0)
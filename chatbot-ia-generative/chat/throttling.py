@@ -0,0 +1,218 @@
+"""
+Limitation de débit partagée entre workers (Redis, GCRA)
+
+Les throttles DRF par défaut comptent dans le cache du processus (LocMem) :
+chaque worker applique son propre budget et la limite effective grandit avec
+le nombre de workers. Ici l'état est dans Redis et la décision est prise par
+un script Lua (GCRA, « generic cell rate algorithm ») : un seul aller-retour,
+atomique, une seule clé par client et par budget (l'heure théorique
+d'arrivée de la prochaine requête).
+
+Budgets (``REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']``) :
+- ``anon`` : autres endpoints ;
+- ``chat`` : tours de chat simples (peu coûteux) ;
+- ``chat_search`` : tours avec recherche web (SerpAPI, scraping, synthèse).
+
+Les budgets ``chat``/``chat_search`` couvrent chaque tour, quel que soit
+le transport : ``POST /chat/`` (synchrone ou travail asynchrone) via
+``ChatTurnRateThrottle``, ``ChatConsumer`` via ``check_chat_turn``.
+``JobConsumer`` n'est pas limité : il ne fait que suivre un travail déjà
+admis (et décompté) par ``POST /chat/``, sans lancer de génération.
+
+Redis injoignable : repli sur le throttle du processus (comportement
+historique) pendant ``THROTTLE_REDIS_RETRY_SECONDS`` avant un nouvel essai,
+pour ne jamais bloquer l'API ni payer un timeout réseau à chaque requête.
+"""
+import logging
+import math
+import threading
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+import redis
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle, SimpleRateThrottle
+
+from chat.metrics import THROTTLE_DECISIONS
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] : clé du client ; ARGV : intervalle d'émission et tolérance de rafale (ms)
+# Retour : {autorisé (0/1), attente avant la prochaine requête autorisée (ms)}
+GCRA_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+local allow_at = new_tat - burst
+if now < allow_at then
+    return {0, allow_at - now}
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', new_tat - now)
+return {1, 0}
+"""
+
+
+class _RedisGCRA:
+    """Client Redis et script GCRA partagés par le processus"""
+
+    def __init__(self, url: str, socket_timeout: float, retry_seconds: float):
+        self._client = redis.Redis.from_url(
+            url, socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout
+        )
+        # EVALSHA (EVAL + chargement seulement si le script n'est pas en cache côté serveur)
+        self._script = self._client.register_script(GCRA_SCRIPT)
+        self._retry_seconds = retry_seconds
+        self._down_until = 0.0
+
+    def check(self, key: str, interval_ms: int, burst_ms: int) -> Optional[tuple]:
+        """(autorisé, attente en secondes), ou None si Redis est indisponible"""
+        if time.monotonic() < self._down_until:
+            return None
+        try:
+            allowed, wait_ms = self._script(keys=[key], args=[interval_ms, burst_ms])
+        except Exception as e:
+            self._down_until = time.monotonic() + self._retry_seconds
+            logger.warning(
+                "⚠️ Redis injoignable pour la limitation de débit (%s), repli local pendant %.0fs",
+                e, self._retry_seconds
+            )
+            return None
+        return bool(allowed), int(wait_ms) / 1000
+
+
+_gcra: Optional[_RedisGCRA] = None
+_gcra_lock = threading.Lock()
+
+
+def get_gcra() -> _RedisGCRA:
+    global _gcra
+    if _gcra is None:
+        with _gcra_lock:
+            if _gcra is None:
+                _gcra = _RedisGCRA(
+                    settings.THROTTLE_REDIS_URL,
+                    socket_timeout=settings.THROTTLE_REDIS_TIMEOUT,
+                    retry_seconds=settings.THROTTLE_REDIS_RETRY_SECONDS,
+                )
+    return _gcra
+
+
+class RedisRateThrottle(SimpleRateThrottle):
+    """Throttle DRF dont le budget est partagé par tous les workers via Redis.
+
+    ``num/période`` devient une requête toutes les ``période/num`` secondes
+    avec une rafale de ``num`` : même budget que le throttle DRF, mais
+    régulier plutôt que remis à zéro par fenêtre.
+    """
+
+    cache_format = 'throttle:%(scope)s:%(ident)s'
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            ident = f"user-{request.user.pk}"
+        else:
+            ident = self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        return self.allow_key(key)
+
+    def allow_key(self, key: str) -> bool:
+        """Décision pour une clé déjà calculée (requête HTTP ou tour WebSocket)"""
+        self.key = key
+        interval_ms = math.ceil(self.duration * 1000 / self.num_requests)
+        decision = get_gcra().check(self.key, interval_ms, interval_ms * self.num_requests)
+        if decision is None:
+            # Repli : fenêtre glissante dans le cache du processus (SimpleRateThrottle)
+            self._redis_wait = None
+            allowed = self._allow_local()
+            backend = 'local'
+        else:
+            allowed, self._redis_wait = decision
+            backend = 'redis'
+        THROTTLE_DECISIONS.inc(scope=self.scope, outcome='allowed' if allowed else 'throttled', backend=backend)
+        if not allowed:
+            logger.info("🚦 Requête limitée (%s, %s)", self.scope, backend)
+        return allowed
+
+    def _allow_local(self) -> bool:
+        self.history = self.cache.get(self.key, [])
+        self.now = self.timer()
+        while self.history and self.history[-1] <= self.now - self.duration:
+            self.history.pop()
+        if len(self.history) >= self.num_requests:
+            return self.throttle_failure()
+        return self.throttle_success()
+
+    def wait(self):
+        if getattr(self, '_redis_wait', None) is not None:
+            return self._redis_wait
+        return super().wait()
+
+
+class RedisAnonRateThrottle(RedisRateThrottle):
+    """Budget ``anon`` des endpoints sans budget dédié"""
+
+    scope = 'anon'
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            return None  # Comme AnonRateThrottle : seuls les anonymes sont limités
+        return super().get_cache_key(request, view)
+
+
+class ChatTurnRateThrottle(RedisRateThrottle):
+    """Budget par tour de chat : ``chat_search`` si le message déclenche une recherche, sinon ``chat``"""
+
+    scope = 'chat'
+
+    def use_search_budget(self):
+        self.scope = 'chat_search'
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+
+    def allow_request(self, request, view):
+        message = request.data.get('message') if hasattr(request.data, 'get') else None
+        requires_search = getattr(view, '_requires_search', None)
+        if isinstance(message, str) and requires_search and requires_search(message):
+            self.use_search_budget()
+        return super().allow_request(request, view)
+
+
+def websocket_ident(scope) -> str:
+    """Identifiant de client d'une connexion WebSocket, comme ``get_ident`` de DRF pour HTTP"""
+    user = scope.get('user')
+    if user is not None and user.is_authenticated:
+        return f"user-{user.pk}"
+    headers = dict(scope.get('headers') or [])
+    meta = {'REMOTE_ADDR': (scope.get('client') or [None])[0]}
+    if b'x-forwarded-for' in headers:
+        meta['HTTP_X_FORWARDED_FOR'] = headers[b'x-forwarded-for'].decode('latin-1')
+    return BaseThrottle().get_ident(SimpleNamespace(META=meta))
+
+
+def check_chat_turn(ident: str, requires_search: bool) -> Optional[float]:
+    """Décompte un tour de chat hors DRF (WebSocket) sur le même budget que ``POST /chat/``.
+
+    None si le tour est autorisé, sinon l'attente en secondes avant le prochain.
+    """
+    throttle = ChatTurnRateThrottle()
+    if requires_search:
+        throttle.use_search_budget()
+    if throttle.rate is None:
+        return None
+    if throttle.allow_key(throttle.cache_format % {'scope': throttle.scope, 'ident': ident}):
+        return None
+    return throttle.wait() or 0.0
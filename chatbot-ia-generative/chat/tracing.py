@@ -0,0 +1,336 @@
+"""
+Traces distribuées compatibles OpenTelemetry (sans dépendance au SDK)
+
+Un span par tour de chat, des spans enfants pour chaque étape et chaque appel
+amont. Le span courant est porté par un ``contextvars`` (suivi à travers les
+threads du pool de travaux et de ``sync_to_async``), et le contexte W3C
+``traceparent`` est lu sur les requêtes entrantes et injecté dans les appels
+vLLM / OpenRouter.
+
+Échantillonnage en fin de trace : une trace est exportée si elle a été tirée
+au sort (``TRACING_SAMPLE_RATE``), si elle est plus lente que
+``TRACING_SLOW_THRESHOLD_MS`` ou si elle contient une erreur, pour toujours
+conserver les cas de latence extrême.
+
+Export au format OTLP/JSON (``ExportTraceServiceRequest``), soit en fichier
+JSON Lines, soit en POST vers un collecteur (``/v1/traces``), depuis un
+thread dédié.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import requests
+from django.conf import settings
+
+from chat.services.cancellation import ChatCancelled
+
+logger = logging.getLogger(__name__)
+
+# Types de span OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+# Codes de statut OTLP
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+
+class Span:
+    """Span enregistré : identifiants, horodatage, attributs et statut"""
+
+    recording = True
+
+    def __init__(self, name: str, trace_id: str, parent_span_id: Optional[str], kind: int,
+                 buffer: List['Span'], sampled: bool, root: bool):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_span_id = parent_span_id
+        self.kind = kind
+        self.attributes: Dict[str, Any] = {}
+        self.events: List[Dict[str, Any]] = []
+        self.status_code = STATUS_UNSET
+        self.status_message = ''
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.sampled = sampled
+        self._buffer = buffer
+        self._root = root
+
+    def set_attribute(self, key: str, value: Any):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, attributes: Dict[str, Any]):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def set_error(self, message: str):
+        self.status_code = STATUS_ERROR
+        self.status_message = message[:500]
+
+    def record_exception(self, exc: BaseException):
+        self.set_error(str(exc))
+        self.events.append({
+            'name': 'exception',
+            'timeUnixNano': str(time.time_ns()),
+            'attributes': _encode_attributes({
+                'exception.type': type(exc).__name__,
+                'exception.message': str(exc)[:500],
+            }),
+        })
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns or time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': _encode_attributes(self.attributes),
+            'status': {'code': self.status_code},
+        }
+        if self.parent_span_id:
+            span['parentSpanId'] = self.parent_span_id
+        if self.status_message:
+            span['status']['message'] = self.status_message
+        if self.events:
+            span['events'] = self.events
+        return span
+
+
+class _NonRecordingSpan:
+    """Span inerte quand le tracing est désactivé"""
+
+    recording = False
+    trace_id = None
+    span_id = None
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def set_attributes(self, attributes: Dict[str, Any]):
+        pass
+
+    def set_error(self, message: str):
+        pass
+
+    def record_exception(self, exc: BaseException):
+        pass
+
+    def traceparent(self) -> Optional[str]:
+        return None
+
+
+NON_RECORDING_SPAN = _NonRecordingSpan()
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+# Contexte amont (traceparent entrant) : (trace_id, parent_span_id, sampled)
+_remote_parent: contextvars.ContextVar = contextvars.ContextVar('remote_parent', default=None)
+
+
+def _encode_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, (list, tuple)):
+        return {'arrayValue': {'values': [_encode_value(v) for v in value]}}
+    return {'stringValue': str(value)}
+
+
+def _encode_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{'key': key, 'value': _encode_value(value)} for key, value in attributes.items()]
+
+
+class FileSpanExporter:
+    """Une ligne OTLP/JSON par trace, dans un fichier local"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def export(self, payload: Dict[str, Any]):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(payload, ensure_ascii=False) + '\n')
+
+
+class OTLPHttpSpanExporter:
+    """POST OTLP/JSON vers un collecteur (``/v1/traces``)"""
+
+    def __init__(self, endpoint: str, timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def export(self, payload: Dict[str, Any]):
+        response = self.session.post(self.endpoint, json=payload, timeout=self.timeout)
+        if response.status_code >= 400:
+            logger.warning("Export OTLP refusé (%s): %.200s", response.status_code, response.text)
+
+
+class Tracer:
+    """Crée les spans et exporte les traces retenues depuis un thread dédié"""
+
+    def __init__(self, exporter=None, service_name: str = 'chatbot-backend',
+                 sample_rate: float = 1.0, slow_threshold_ms: float = 0, max_queue: int = 1000):
+        self.enabled = exporter is not None
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_threshold_ms = slow_threshold_ms
+        self.resource = {'attributes': _encode_attributes({'service.name': service_name})}
+        self.exported = 0
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        if self.enabled:
+            threading.Thread(target=self._export_loop, name='trace-exporter', daemon=True).start()
+
+    @contextmanager
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+        """Ouvre un span enfant du span courant (ou une nouvelle trace)"""
+        if not self.enabled:
+            yield NON_RECORDING_SPAN
+            return
+
+        parent = _current_span.get()
+        if parent is not None:
+            span = Span(name, parent.trace_id, parent.span_id, kind, parent._buffer, parent.sampled, root=False)
+        else:
+            remote = _remote_parent.get()
+            if remote:
+                trace_id, parent_span_id, sampled = remote
+            else:
+                trace_id, parent_span_id = '%032x' % random.getrandbits(128), None
+                sampled = random.random() < self.sample_rate
+            span = Span(name, trace_id, parent_span_id, kind, [], sampled, root=True)
+        span.set_attributes(attributes)
+
+        reset_token = _current_span.set(span)
+        try:
+            yield span
+        except ChatCancelled:
+            span.set_attribute('chat.cancelled', True)
+            raise
+        except Exception as e:
+            span.record_exception(e)
+            raise
+        finally:
+            _current_span.reset(reset_token)
+            self._end(span)
+
+    def _end(self, span: Span):
+        span.end_ns = time.time_ns()
+        span._buffer.append(span)
+        if not span._root:
+            return
+
+        keep = (
+            span.sampled
+            or (self.slow_threshold_ms and span.duration_ms >= self.slow_threshold_ms)
+            or any(s.status_code == STATUS_ERROR for s in span._buffer)
+        )
+        if not keep:
+            return
+        try:
+            self._queue.put_nowait(list(span._buffer))
+        except queue.Full:
+            self.dropped += 1
+
+    def _export_loop(self):
+        while True:
+            spans = self._queue.get()
+            payload = {
+                'resourceSpans': [{
+                    'resource': self.resource,
+                    'scopeSpans': [{
+                        'scope': {'name': 'chat.tracing'},
+                        'spans': [s.to_otlp() for s in spans],
+                    }],
+                }],
+            }
+            try:
+                self.exporter.export(payload)
+                self.exported += 1
+            except Exception as e:
+                self.dropped += 1
+                logger.warning("Export de trace impossible: %s", e)
+
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """Tracer unique du processus, configuré par les settings TRACING_*"""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                exporter = None
+                if getattr(settings, 'TRACING_ENABLED', False):
+                    if settings.TRACING_EXPORTER == 'otlp_http':
+                        exporter = OTLPHttpSpanExporter(settings.TRACING_OTLP_ENDPOINT)
+                    else:
+                        exporter = FileSpanExporter(settings.TRACING_FILE_PATH)
+                _tracer = Tracer(
+                    exporter=exporter,
+                    service_name=settings.TRACING_SERVICE_NAME,
+                    sample_rate=settings.TRACING_SAMPLE_RATE,
+                    slow_threshold_ms=settings.TRACING_SLOW_THRESHOLD_MS,
+                )
+    return _tracer
+
+
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+    """Raccourci : ``with tracing.span('serpapi.query', q=...) as s: ...``"""
+    return get_tracer().span(name, kind, **attributes)
+
+
+def current_span():
+    """Span courant (inerte hors trace) pour ajouter des attributs"""
+    return _current_span.get() or NON_RECORDING_SPAN
+
+
+def inject_trace_headers(headers: Dict[str, str]) -> Dict[str, str]:
+    """Ajoute ``traceparent`` aux en-têtes d'un appel sortant"""
+    traceparent = current_span().traceparent()
+    if traceparent:
+        headers = dict(headers, traceparent=traceparent)
+    return headers
+
+
+def set_remote_parent(traceparent: Optional[str]) -> Optional[contextvars.Token]:
+    """Rattache les spans de la requête à un ``traceparent`` entrant valide"""
+    match = _TRACEPARENT.match(traceparent or '')
+    if not match:
+        return None
+    trace_id, span_id, flags = match.groups()
+    return _remote_parent.set((trace_id, span_id, int(flags, 16) & 1 == 1))
+
+
+def reset_remote_parent(token: contextvars.Token):
+    _remote_parent.reset(token)
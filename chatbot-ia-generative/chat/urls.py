@@ -2,6 +2,9 @@ from django.urls import path
 from .views import ChatAPIView, ConversationListView, ConversationDetailView
 from .views_vllm import VLLMStatusView, VLLMModelsView
 from .views_model import SetModelView
+from .views_jobs import ChatJobView, ChatJobStatsView
+from .views_search import HistorySearchView
+from .views_load import LoadPolicyView
 
 app_name = 'chat'
 
@@ -9,9 +12,16 @@ urlpatterns = [
     path('chat/', ChatAPIView.as_view(), name='chat'),
     path('conversations/', ConversationListView.as_view(), name='conversations'),
     path('conversations/<uuid:conversation_id>/', ConversationDetailView.as_view(), name='conversation-detail'),
+    # Full-text search over conversation history
+    path('search/', HistorySearchView.as_view(), name='history-search'),
+    # Async chat jobs
+    path('jobs/stats/', ChatJobStatsView.as_view(), name='job-stats'),
+    path('jobs/<uuid:job_id>/', ChatJobView.as_view(), name='job-detail'),
     # vLLM endpoints
     path('vllm/status/', VLLMStatusView.as_view(), name='vllm-status'),
     path('vllm/models/', VLLMModelsView.as_view(), name='vllm-models'),
     # Model selection
     path('set-model/', SetModelView.as_view(), name='set-model'),
+    # Load shedding (degraded mode)
+    path('load-policy/', LoadPolicyView.as_view(), name='load-policy'),
 ]
\ No newline at end of file
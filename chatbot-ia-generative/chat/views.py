@@ -1,18 +1,22 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.throttling import AnonRateThrottle
 from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.core.exceptions import ValidationError
 import logging
 import httpx
 import json
 from django.conf import settings
-from typing import List, Dict
+from django.urls import reverse
+from typing import Callable, Dict, List, Optional
 from datetime import datetime, timedelta
 import re
 
-from .models import Conversation, Message, SearchCache
+from .models import Conversation, Message, SearchCache, conversation_etag
 from .serializers import (
     ConversationSerializer, 
     MessageSerializer, 
@@ -23,55 +27,134 @@ from .services.multi_search import MultiSearchService  # Backup
 from .services.openrouter_optimized import OpenRouterOptimizedService
 from .services.intelligent_search import IntelligentSearchService
 from .services.vllm_service import VLLMService
+from .services.answer_cache import get_answer_cache
+from .services.prompts import build_chat_messages
+from .services.job_queue import get_job_queue, JobQueueFull
+from .services.cancellation import CancellationToken, ChatCancelled
+from .services.deadline import Deadline
+from .services.load_policy import current_load_level
+from .services.model_router import get_model_router
+from .services.vllm_admission import queue_context
+from .metrics import timed_stage
+from .throttling import ChatTurnRateThrottle
+from . import tracing
 from django.utils import timezone
-from django.core.cache import cache
 
 logger = logging.getLogger(__name__)
 
-# Configuration simple des logs
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
-
 
 class ChatAPIView(APIView):
     """Main chat endpoint for the chatbot."""
     
-    throttle_classes = [AnonRateThrottle]
+    throttle_classes = [ChatTurnRateThrottle]
+    
+    def handle_chat(
+        self,
+        message_text: str,
+        conversation_id: str = None,
+        on_progress: Optional[Callable[[str, Dict], None]] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        search_budget_ms: Optional[int] = None,
+        deadline: Optional[Deadline] = None
+    ):
+        """Handle the chat request.
+        
+        The optional callbacks are used by the WebSocket consumer to stream
+        search progress and tokens; ``cancel_token`` aborts the upstream LLM
+        request (ChatCancelled is raised and no assistant message is saved).
+        ``search_budget_ms`` starts the final answer once that much time has
+        been spent searching (pipelined generation).
+        ``deadline`` bounds the whole turn (``CHAT_DEADLINE_SECONDS`` when not
+        given): every upstream call gets ``min(own timeout, remaining)`` and the
+        stages skipped or truncated for lack of time are listed in
+        ``degraded_stages``.
+        Each stage is timed (see ``chat.metrics.timed_stage``).
+        """
+        deadline = deadline or Deadline.from_settings()
+        # File vLLM équitable par conversation ; position relayée au client en streaming
+        on_queue_position = (lambda position: on_progress('vllm_queue', {'position': position})) if on_progress else None
+        with queue_context(conversation_id and str(conversation_id), on_queue_position), \
+                timed_stage('total', span_name='chat.turn') as turn_span:
+            result = self._handle_chat_turn(
+                message_text, conversation_id, on_progress, on_token, cancel_token, search_budget_ms, deadline
+            )
+            turn_span.set_attributes({
+                'conversation.id': result['conversation_id'],
+                'search.query': result['search_query'],
+                'search.sources': len(result['sources']),
+                'deadline.budget_s': deadline.budget_seconds or 0,
+            })
+            return result
     
-    def handle_chat(self, message_text: str, conversation_id: str = None):
-        """Handle the chat request."""
+    def _handle_chat_turn(
+        self,
+        message_text: str,
+        conversation_id: Optional[str],
+        on_progress: Optional[Callable[[str, Dict], None]],
+        on_token: Optional[Callable[[str], None]],
+        cancel_token: Optional[CancellationToken],
+        search_budget_ms: Optional[int] = None,
+        deadline: Optional[Deadline] = None
+    ):
+        deadline = deadline or Deadline()
         # Log simple pour nouvelle requête
-        logger.info(f"💬 Nouvelle requête: {message_text[:50]}...")
+        logger.info("💬 Nouvelle requête: %s...", message_text[:50])
         
         # Obtenir la date actuelle
         current_date = datetime.now()
         
         # Get or create conversation
-        if conversation_id:
-            try:
-                conversation = Conversation.objects.get(id=conversation_id)
-            except Conversation.DoesNotExist:
-                raise ValidationError("Invalid conversation ID")
-        else:
-            conversation = Conversation.objects.create()
-        
-        # Save user message
-        user_message = Message.objects.create(
-            conversation=conversation,
-            role='user',
-            content=message_text
-        )
+        with timed_stage('db_write'):
+            if conversation_id:
+                try:
+                    conversation = Conversation.objects.get(id=conversation_id)
+                except Conversation.DoesNotExist:
+                    raise ValidationError("Invalid conversation ID")
+            else:
+                conversation = Conversation.objects.create()
+            
+            # Save user message
+            Message.objects.create(
+                conversation=conversation,
+                role='user',
+                content=message_text
+            )
         
+        # Compteur et date de la conversation : un seul UPDATE par tour, réponse sauvegardée ou non
+        added = 1
+        try:
+            result = self._answer_turn(
+                conversation, message_text, current_date, on_progress, on_token, cancel_token, search_budget_ms, deadline
+            )
+            added = 2
+            return result
+        finally:
+            with timed_stage('db_write'):
+                conversation.touch(added)
+    
+    def _answer_turn(
+        self,
+        conversation: Conversation,
+        message_text: str,
+        current_date: datetime,
+        on_progress: Optional[Callable[[str, Dict], None]],
+        on_token: Optional[Callable[[str], None]],
+        cancel_token: Optional[CancellationToken],
+        search_budget_ms: Optional[int],
+        deadline: Deadline
+    ) -> Dict:
+        """Answer a turn whose user message is saved, then save the assistant message."""
         # Check if the message requires web search
         search_results = None
         sources = []
         search_query = None
+        answer_cached = False
+        pipeline = None
+        routing = None
         
         if self._requires_search(message_text):
-            logger.info(f"🔍 Recherche web activée")
+            logger.info("🔍 Recherche web activée")
             time_constraint = self._extract_time_constraint(message_text)
             
             # Utiliser le service de recherche intelligent
@@ -79,7 +162,12 @@ class ChatAPIView(APIView):
             search_result = intelligent_search.process_user_query(
                 user_query=message_text,
                 time_constraint=time_constraint,
-                current_date=current_date
+                current_date=current_date,
+                on_progress=on_progress,
+                on_token=on_token,
+                cancel_token=cancel_token,
+                search_budget_ms=search_budget_ms,
+                deadline=deadline
             )
             
             # Extraire la réponse et les sources
@@ -87,78 +175,134 @@ class ChatAPIView(APIView):
             sources = search_result.get('sources', [])
             search_query = search_result.get('search_query')
             search_results = sources  # Pour la sauvegarde dans le message
+            pipeline = search_result.get('pipeline')
+            routing = search_result.get('routing')
             
         else:
             
             # Get conversation history
             messages = []
-            for msg in conversation.messages.filter(role__in=['user', 'assistant']).order_by('created_at'):
-                messages.append({
-                    'role': msg.role,
-                    'content': msg.content
-                })
+            with timed_stage('db_read'):
+                for msg in conversation.messages.filter(role__in=['user', 'assistant']).order_by('created_at'):
+                    messages.append({
+                        'role': msg.role,
+                        'content': msg.content
+                    })
             
-            # Récupérer le modèle sélectionné
-            selected_model = cache.get('selected_llm_model', 'openrouter')
-            logger.info(f"📌 Modèle sélectionné depuis le cache: {selected_model}")
+            # Modèle sélectionné ou routé automatiquement (fournisseur rapide en mode dégradé)
+            load_level = current_load_level()
+            decision = get_model_router().route(message_text, history=messages[:-1])
+            routing = decision.as_dict()
+            selected_model = load_level.route(decision.provider)
+            logger.info("📌 Modèle sélectionné: %s (%s)", selected_model, decision.reason)
+            tracing.current_span().set_attribute('llm.provider', selected_model)
             
             if selected_model == 'vllm':
+                llm_service = VLLMService()
+                cache_model, cache_temperature = f"vllm:{llm_service.model}", llm_service.temperature
+            else:
+                llm_service = OpenRouterOptimizedService()
+                cache_model, cache_temperature = f"openrouter:{llm_service.model}", llm_service.chat_temperature
+            
+            # Premier tour sans historique : la réponse ne dépend que du prompt
+            # (pas de réponse raccourcie par le mode dégradé en cache)
+            use_answer_cache = settings.ANSWER_CACHE_ENABLED and len(messages) == 1 and not load_level.short_answers
+            cached_answer = None
+            if use_answer_cache:
+                cached_answer = get_answer_cache().get(message_text, cache_model, cache_temperature)
+                tracing.current_span().set_attribute('answer_cache.hit', cached_answer is not None)
+            
+            if cached_answer:
+                logger.info(
+                    "📦 Réponse servie depuis le cache (%s, similarité %.2f)",
+                    cached_answer['match'], cached_answer['similarity']
+                )
+                ai_response = cached_answer['response']
+                answer_cached = True
+                if on_token:
+                    on_token(ai_response)
+            elif selected_model == 'vllm':
                 # Utiliser vLLM
-                vllm_service = VLLMService()
+                vllm_service = llm_service
                 if not vllm_service.is_available():
-                    logger.error(f"❌ vLLM n'est pas disponible sur {vllm_service.base_url}")
+                    logger.error("❌ vLLM n'est pas disponible sur %s", vllm_service.base_url)
                     ai_response = "Erreur : Le service vLLM n'est pas disponible. Veuillez démarrer vLLM ou basculer sur OpenRouter."
                 else:
                     try:
                         logger.info("🤖 MODE: vLLM Local (Phi-3)")
                         
-                        # Construire le contexte de conversation
-                        conversation_context = "\n".join([
-                            f"{msg['role'].capitalize()}: {msg['content']}"
-                            for msg in messages[:-1]
-                        ])
-                        
-                        prompt = message_text
-                        if conversation_context:
-                            prompt = f"Conversation précédente:\n{conversation_context}\n\nQuestion: {message_text}"
+                        # Historique en vrais rôles user/assistant, derrière un prompt système statique
+                        chat_messages = build_chat_messages(message_text, messages[:-1])
                         
-                        response = vllm_service.generate_response(prompt=prompt)
+                        with timed_stage('llm'):
+                            response = vllm_service.generate_response(
+                                messages=chat_messages,
+                                on_token=on_token,
+                                cancel_token=cancel_token,
+                                deadline=deadline
+                            )
                         if response['success']:
                             ai_response = response['response']
+                            # Réponse tronquée par l'échéance : jamais servie à d'autres clients
+                            if use_answer_cache and 'llm' not in deadline.degraded_stages:
+                                get_answer_cache().set(message_text, cache_model, cache_temperature, ai_response)
+                        elif response.get('queue_timeout'):
+                            # File vLLM saturée : bascule immédiate plutôt qu'un long timeout
+                            logger.warning("⏱️ vLLM saturé, bascule vers OpenRouter")
+                            selected_model = 'openrouter'
+                            routing = dict(routing, provider='openrouter', fallback='vllm_queue_timeout')
+                            llm_service = OpenRouterOptimizedService()
+                            cache_model, cache_temperature = f"openrouter:{llm_service.model}", llm_service.chat_temperature
                         else:
                             raise Exception(response['error'])
+                    except ChatCancelled:
+                        raise
                     except Exception as e:
-                        logger.error(f"❌ Erreur vLLM: {str(e)}")
+                        logger.error("❌ Erreur vLLM: %s", e)
                         ai_response = f"Erreur lors de la génération de la réponse : {str(e)}"
-            else:
+            if not cached_answer and selected_model == 'openrouter':
                 # Utiliser OpenRouter
                 try:
                     logger.info("☁️ MODE: OpenRouter Cloud (Qwen)")
-                    openrouter_service = OpenRouterOptimizedService()
-                    ai_response = openrouter_service.generate_response(
-                        query=message_text,
-                        search_results=None,
-                        current_date=current_date,
-                        conversation_history=messages[:-1]
-                    )
+                    openrouter_service = llm_service
+                    with timed_stage('llm'):
+                        ai_response = openrouter_service.generate_response(
+                            query=message_text,
+                            search_results=None,
+                            current_date=current_date,
+                            conversation_history=messages[:-1],
+                            on_token=on_token,
+                            cancel_token=cancel_token,
+                            deadline=deadline
+                        )
+                    if use_answer_cache and openrouter_service.last_status_code == 200 \
+                            and 'llm' not in deadline.degraded_stages:
+                        get_answer_cache().set(message_text, cache_model, cache_temperature, ai_response)
+                except ChatCancelled:
+                    raise
                 except Exception as e:
-                    logger.error(f"❌ Erreur OpenRouter: {str(e)}")
+                    logger.error("❌ Erreur OpenRouter: %s", e)
                     ai_response = f"Erreur avec OpenRouter. Vérifiez votre clé API: {str(e)}"
         
         # Save assistant message
-        assistant_message = Message.objects.create(
-            conversation=conversation,
-            role='assistant',
-            content=ai_response,
-            search_results=search_results,
-            sources=sources
-        )
+        with timed_stage('db_write'):
+            assistant_message = Message.objects.create(
+                conversation=conversation,
+                role='assistant',
+                content=ai_response,
+                search_results=search_results,
+                sources=sources
+            )
         
         return {
             'conversation_id': str(conversation.id),
             'message': MessageSerializer(assistant_message).data,
             'sources': sources,
-            'search_query': search_query  # Inclure la requête optimisée dans la réponse
+            'search_query': search_query,  # Inclure la requête optimisée dans la réponse
+            'cached': answer_cached,  # Réponse servie par le cache de réponses
+            'pipeline': pipeline,  # Génération en pipeline : déclencheur et attente
+            'routing': routing,  # Fournisseur LLM retenu et raison (manual, simple, complex...)
+            'degraded_stages': deadline.degraded_stages  # Étapes sautées ou tronquées (échéance)
         }
     
     def post(self, request):
@@ -173,25 +317,91 @@ class ChatAPIView(APIView):
         
         message = serializer.validated_data['message']
         conversation_id = serializer.validated_data.get('conversation_id')
+        search_budget_ms = serializer.validated_data.get('search_budget_ms')
+        deadline_ms = serializer.validated_data.get('deadline_ms')
+        
+        if serializer.validated_data.get('async_mode'):
+            return self._submit_job(message, conversation_id, search_budget_ms, deadline_ms)
+        
+        # Set by DisconnectCancellationMiddleware when served over ASGI
+        cancel_token = getattr(request, 'scope', {}).get('cancel_token')
         
         try:
             # Handle the chat request
-            result = self.handle_chat(message, conversation_id)
+            result = self.handle_chat(
+                message, conversation_id, cancel_token=cancel_token,
+                search_budget_ms=search_budget_ms, deadline=Deadline.from_settings(deadline_ms)
+            )
             
             return Response(result, status=status.HTTP_200_OK)
             
+        except ChatCancelled:
+            logger.info("🛑 Requête abandonnée par le client, génération interrompue")
+            # 499 Client Closed Request : personne ne lira cette réponse
+            return Response(status=499)
         except ValidationError as e:
             return Response(
                 {'error': str(e)},
                 status=status.HTTP_400_BAD_REQUEST
             )
         except Exception as e:
-            logger.error(f"Chat error: {str(e)}")
+            logger.error("Chat error: %s", e)
             return Response(
                 {'error': 'An error occurred while processing your request'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
     
+    def _submit_job(
+        self,
+        message: str,
+        conversation_id=None,
+        search_budget_ms: Optional[int] = None,
+        deadline_ms: Optional[int] = None
+    ) -> Response:
+        """Mode travail : admet la génération dans la file et répond immédiatement (202)."""
+        if conversation_id:
+            if not Conversation.objects.filter(id=conversation_id).exists():
+                return Response(
+                    {'error': 'Invalid conversation ID'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        else:
+            conversation_id = Conversation.objects.create().id
+        conversation_id = str(conversation_id)
+        
+        job_queue = get_job_queue()
+        try:
+            job = job_queue.submit(
+                self._run_job, message, conversation_id,
+                conversation_id=conversation_id, search_budget_ms=search_budget_ms, deadline_ms=deadline_ms
+            )
+        except JobQueueFull as e:
+            logger.warning("⛔ Travail refusé: %s", e)
+            response = Response(
+                {'error': 'Le serveur est saturé, réessayez plus tard', 'queue': job_queue.metrics()},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+            response['Retry-After'] = '30'
+            return response
+        
+        return Response({
+            **job,
+            'status_url': reverse('chat:job-detail', kwargs={'job_id': job['job_id']}),
+            'websocket_url': f"/ws/jobs/{job['job_id']}/",
+            'queue': job_queue.metrics()
+        }, status=status.HTTP_202_ACCEPTED)
+    
+    def _run_job(
+        self,
+        message: str,
+        conversation_id: str,
+        search_budget_ms: Optional[int] = None,
+        deadline_ms: Optional[int] = None
+    ) -> Dict:
+        """Exécute un travail : son échéance part de la prise en charge, pas de l'admission."""
+        deadline = Deadline.from_settings(deadline_ms, job=True)
+        return self.handle_chat(message, conversation_id, search_budget_ms=search_budget_ms, deadline=deadline)
+    
     def _requires_search(self, message: str) -> bool:
         """Determine if the message requires web search."""
         
@@ -299,8 +509,7 @@ class ChatAPIView(APIView):
             # Pas de filtrage si contrainte non reconnue
             return results
         
-        logger.info(f"📅 Filtrage temporel strict: {start_date.strftime('%d/%m/%Y %H:%M')} - {end_date.strftime('%d/%m/%Y %H:%M')}")
-        logger.info(f"📅 Semaine actuelle: Semaine {current_date.isocalendar()[1]} de {current_date.year}")
+        logger.debug("📅 Filtrage temporel strict: %s - %s", start_date, end_date)
         
         for result in results:
             # Utiliser date_parsed de SerpAPI si disponible
@@ -325,24 +534,26 @@ class ChatAPIView(APIView):
                     result['date'] = result_date.strftime('%d/%m/%Y %H:%M')
                     result['relevance_score'] = result.get('relevance_score', 0.8) * 1.2  # Boost pour dates correspondantes
                     filtered.append(result)
-                    logger.info(f"✅ Résultat inclus: {result['title'][:50]}... - Date: {result['date']}")
+                    logger.debug("✅ Résultat inclus: %.50s - Date: %s", result['title'], result['date'], extra={'sampled': True})
                 else:
-                    logger.info(f"❌ Résultat exclu (hors période): {result['title'][:50]}... - Date: {result_date.strftime('%d/%m/%Y')}")
+                    logger.debug("❌ Résultat exclu (hors période): %.50s - Date: %s", result['title'], result_date, extra={'sampled': True})
                     # Ne PAS inclure les résultats hors période
             else:
                 # Si pas de date et contrainte temporelle stricte, exclure
                 if time_constraint in ['this_week', 'today', 'yesterday']:
-                    logger.info(f"❌ Résultat exclu (pas de date): {result['title'][:50]}...")
+                    logger.debug("❌ Résultat exclu (pas de date): %.50s", result['title'], extra={'sampled': True})
                 else:
                     # Pour "recent", on peut être plus flexible
                     result['relevance_score'] = result.get('relevance_score', 0.5) * 0.7
                     result['date'] = 'Date non spécifiée'
                     filtered.append(result)
-                    logger.info(f"⚠️ Résultat inclus avec score réduit: {result['title'][:50]}...")
+                    logger.debug("⚠️ Résultat inclus avec score réduit: %.50s", result['title'], extra={'sampled': True})
+        
+        logger.info("📅 Filtrage %s: %d/%d résultats conservés", time_constraint, len(filtered), len(results))
         
         # Si aucun résultat, avertir mais ne pas retourner tous les résultats
         if not filtered:
-            logger.warning(f"⚠️ Aucun résultat trouvé pour la période {time_constraint}")
+            logger.warning("⚠️ Aucun résultat trouvé pour la période %s", time_constraint)
             # Retourner seulement les 2 plus récents avec avertissement
             for r in results[:2]:
                 r['relevance_score'] = 0.3
@@ -431,18 +642,50 @@ class ChatAPIView(APIView):
         return None
 
 
+def _conversation_list_etag(request) -> str:
+    """Version de la liste : nombre de conversations, dernière mise à jour, total des messages"""
+    summary = Conversation.objects.aggregate(
+        count=Count('id'), latest=Max('updated_at'), messages=Sum('message_count')
+    )
+    if not summary['count']:
+        return 'empty'
+    return f"{summary['count']}-{conversation_etag(summary['latest'], summary['messages'])}"
+
+
+def _conversation_etag(request, conversation_id) -> Optional[str]:
+    """ETag lu sur chat_conversation seule (None : conversation inconnue, la vue répond 404)"""
+    row = Conversation.objects.filter(id=conversation_id).values_list('updated_at', 'message_count').first()
+    return conversation_etag(*row) if row else None
+
+
+# Revalidation systématique : le navigateur garde la réponse et renvoie If-None-Match
+_revalidate = cache_control(private=True, no_cache=True)
+
+
 class ConversationListView(APIView):
-    """List all conversations."""
+    """List all conversations.
+
+    Conditional GET: unchanged lists answer 304 from one aggregate query.
+    """
     
+    @method_decorator(_revalidate)
+    @method_decorator(condition(etag_func=_conversation_list_etag))
     def get(self, request):
-        conversations = Conversation.objects.all()
+        # Messages chargés en une requête, pas une par conversation
+        conversations = Conversation.objects.prefetch_related('messages')
         serializer = ConversationSerializer(conversations, many=True)
         return Response(serializer.data)
 
 
 class ConversationDetailView(APIView):
-    """Get details of a specific conversation."""
+    """Get details of a specific conversation.
+
+    Conditional GET: an unchanged conversation answers 304 without reading
+    its messages.
+    """
     
+    @method_decorator(_revalidate)
+    @method_decorator(condition(etag_func=_conversation_etag))
     def get(self, request, conversation_id):
         try:
             conversation = Conversation.objects.get(id=conversation_id)
@@ -0,0 +1,25 @@
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import status
+
+from .services.job_queue import get_job_queue
+
+
+class ChatJobView(APIView):
+    """Polling de l'état d'un travail de chat asynchrone."""
+    
+    def get(self, request, job_id):
+        job = get_job_queue().get(str(job_id))
+        if job is None:
+            return Response(
+                {'error': 'Job not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(job)
+
+
+class ChatJobStatsView(APIView):
+    """Métriques de la file : profondeur, workers occupés, rejets."""
+    
+    def get(self, request):
+        return Response(get_job_queue().metrics())
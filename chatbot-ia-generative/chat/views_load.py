@@ -0,0 +1,35 @@
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import status
+from rest_framework.permissions import AllowAny, IsAdminUser
+
+from .services.load_policy import MAX_LEVEL, get_load_policy
+
+
+class LoadPolicyView(APIView):
+    """État du mode dégradé ; un administrateur peut forcer un niveau."""
+    
+    def get_permissions(self):
+        if self.request.method == 'POST':
+            return [IsAdminUser()]
+        return [AllowAny()]
+    
+    def get(self, request):
+        return Response(get_load_policy().status())
+    
+    def post(self, request):
+        """{"level": 0-4} force un niveau, {"level": null} rend la main au mode automatique"""
+        if 'level' not in request.data:
+            return Response(
+                {'error': 'Champ "level" requis (0-%d ou null)' % MAX_LEVEL},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        level = request.data['level']
+        if level is not None and (isinstance(level, bool) or not isinstance(level, int) or not 0 <= level <= MAX_LEVEL):
+            return Response(
+                {'error': 'Niveau invalide. Choisir un entier entre 0 et %d, ou null' % MAX_LEVEL},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        policy = get_load_policy()
+        policy.set_override(level)
+        return Response(policy.status())
@@ -0,0 +1,34 @@
+import hmac
+import ipaddress
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from .metrics import JOB_QUEUE_DEPTH, JOB_QUEUE_RUNNING, render_prometheus
+from .services.job_queue import get_job_queue
+
+
+def _metrics_allowed(request) -> bool:
+    """Jeton Prometheus valide, ou adresse du client dans ``METRICS_ALLOWED_NETWORKS``"""
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get('Authorization', '')
+    if token and authorization.startswith('Bearer ') and hmac.compare_digest(
+        authorization[len('Bearer '):].encode(), token.encode()
+    ):
+        return True
+    # REMOTE_ADDR et non X-Forwarded-For, que le client peut forger
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False) for network in settings.METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    """Métriques du processus au format texte Prometheus (un scrape par worker ASGI)."""
+    if not _metrics_allowed(request):
+        return HttpResponseForbidden()
+    queue_metrics = get_job_queue().metrics()
+    JOB_QUEUE_DEPTH.set(queue_metrics['queue_depth'])
+    JOB_QUEUE_RUNNING.set(queue_metrics['running'])
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
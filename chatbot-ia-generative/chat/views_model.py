@@ -1,9 +1,10 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from django.core.cache import cache
 import logging
 
+from .services.model_router import ROUTING_MODES, get_selected_model, set_selected_model
+
 logger = logging.getLogger(__name__)
 
 class SetModelView(APIView):
@@ -13,20 +14,16 @@ class SetModelView(APIView):
         """Change le modèle actif"""
         model = request.data.get('model', 'vllm')
         
-        if model not in ['vllm', 'openrouter']:
+        if model not in ROUTING_MODES:
             return Response(
-                {'error': 'Modèle invalide. Choisir: vllm ou openrouter'},
+                {'error': 'Modèle invalide. Choisir: vllm, openrouter ou auto'},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Stocker le choix dans le cache
-        cache.set('selected_llm_model', model, timeout=None)
-        
-        logger.info(f"🔄 Changement de modèle: {model}")
+        # Stocker le choix (partagé par tous les workers)
+        set_selected_model(model)
         
-        # Vérifier que le cache a bien été mis à jour
-        verify = cache.get('selected_llm_model')
-        logger.info(f"✅ Vérification cache: {verify}")
+        logger.info("🔄 Changement de modèle: %s", model)
         
         return Response({
             'success': True,
@@ -36,7 +33,7 @@ class SetModelView(APIView):
     
     def get(self, request):
         """Récupère le modèle actuel"""
-        model = cache.get('selected_llm_model', 'openrouter')
+        model = get_selected_model()
         
         return Response({
             'model': model
@@ -0,0 +1,28 @@
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import status
+
+from .serializers import HistorySearchQuerySerializer
+from .services.history_search import HistorySearchService
+
+
+class HistorySearchView(APIView):
+    """Full-text search over past messages, ranked, with snippets and pagination."""
+    
+    def get(self, request):
+        serializer = HistorySearchQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(
+                {'error': 'Invalid request', 'details': serializer.errors},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        params = serializer.validated_data
+        
+        result = HistorySearchService().search(
+            params['q'],
+            page=params['page'],
+            page_size=params['page_size'],
+            conversation_id=params.get('conversation_id'),
+            role=params.get('role')
+        )
+        return Response(result)
@@ -3,6 +3,7 @@ from rest_framework.response import Response
 from rest_framework import status
 import logging
 
+from .services.vllm_admission import get_vllm_admission
 from .services.vllm_service import VLLMService
 
 logger = logging.getLogger(__name__)
@@ -26,6 +27,8 @@ class VLLMStatusView(APIView):
             'base_url': vllm_service.base_url,
             'current_model': vllm_service.model,
             'available_models': models,
+            # Client-side admission: in-flight calls, fair queue, fallbacks
+            'admission': get_vllm_admission().stats(),
             'info': {
                 'description': 'vLLM is a high-performance LLM serving engine',
                 'features': [
@@ -14,7 +14,13 @@ from channels.auth import AuthMiddlewareStack
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_backend.settings')
 
+# Initialiser Django avant d'importer les consumers (qui importent les modèles)
+django_asgi_app = get_asgi_application()
+
+from chat.middleware import DisconnectCancellationMiddleware  # noqa: E402
+from chat.routing import websocket_urlpatterns  # noqa: E402
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    # WebSocket support can be added later if needed
+    "http": DisconnectCancellationMiddleware(django_asgi_app),
+    "websocket": AuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
 })
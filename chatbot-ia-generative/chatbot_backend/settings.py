@@ -49,6 +49,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.middleware.RequestIdMiddleware',
+    'chat.middleware.ServerTimingMiddleware',
+    'chat.middleware.TraceContextMiddleware',
+    # brotli ou gzip selon Accept-Encoding (avant tout middleware qui lit le corps)
+    'chat.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -145,14 +150,41 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
+    # JSON via orjson quand il est installé (chat.renderers), sinon comme DRF
+    'DEFAULT_RENDERER_CLASSES': [
+        'chat.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'chat.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    # Budgets partagés entre workers via Redis (chat.throttling)
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
+        'chat.throttling.RedisAnonRateThrottle',
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '10/minute',
+        # Tours de chat : simples peu coûteux, recherches web bien plus chères
+        'chat': os.environ.get('THROTTLE_CHAT_RATE', '10/minute'),
+        'chat_search': os.environ.get('THROTTLE_CHAT_SEARCH_RATE', '4/minute'),
     }
 }
 
+# Limitation de débit : état GCRA dans Redis (base 1, la base 0 sert au channel layer)
+THROTTLE_REDIS_URL = os.environ.get(
+    'THROTTLE_REDIS_URL', f"redis://{os.environ.get('REDIS_HOST', '127.0.0.1')}:6379/1"
+)
+THROTTLE_REDIS_TIMEOUT = float(os.environ.get('THROTTLE_REDIS_TIMEOUT', '0.1'))  # secondes
+# Redis injoignable : throttle local du processus pendant ce délai avant un nouvel essai
+THROTTLE_REDIS_RETRY_SECONDS = float(os.environ.get('THROTTLE_REDIS_RETRY_SECONDS', '30'))
+
+# État partagé entre workers (budget SerpAPI, verrou du préchargeur) : le cache Django est local au processus
+SHARED_STATE_REDIS_URL = os.environ.get('SHARED_STATE_REDIS_URL', THROTTLE_REDIS_URL)
+SHARED_STATE_REDIS_TIMEOUT = float(os.environ.get('SHARED_STATE_REDIS_TIMEOUT', '0.2'))  # secondes
+SHARED_STATE_REDIS_RETRY_SECONDS = float(os.environ.get('SHARED_STATE_REDIS_RETRY_SECONDS', '30'))
+
 # Channels configuration
 CHANNEL_LAYERS = {
     'default': {
@@ -178,7 +210,7 @@ HUGGINGFACE_MODEL = os.environ.get('HUGGINGFACE_MODEL', 'Qwen/Qwen2.5-32B-Instru
 
 # OpenRouter settings (fallback)
 OPENROUTER_API_KEY = os.environ.get('OPENROUTER_API_KEY')
-OPENROUTER_BASE_URL = 'https://openrouter.ai/api/v1'
+OPENROUTER_BASE_URL = os.environ.get('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1')
 # Using Qwen model as specified in instructions
 OPENROUTER_MODEL = os.environ.get('OPENROUTER_MODEL', 'qwen/qwen-2.5-coder-32b-instruct:free')
 
@@ -186,6 +218,163 @@ OPENROUTER_MODEL = os.environ.get('OPENROUTER_MODEL', 'qwen/qwen-2.5-coder-32b-i
 MAX_SEARCH_RESULTS = 5
 SEARCH_TIMEOUT = 10
 
+# Scraping de secours (MultiSearchService) : client asynchrone partagé
+SCRAPER_MAX_CONNECTIONS = int(os.environ.get('SCRAPER_MAX_CONNECTIONS', 10))
+SCRAPER_TIMEOUT = float(os.environ.get('SCRAPER_TIMEOUT', '5'))
+# Lecture interrompue au-delà (les pages de résultats font quelques centaines de Ko)
+SCRAPER_MAX_BYTES = int(os.environ.get('SCRAPER_MAX_BYTES', 2 * 1024 * 1024))
+# Pages d'actualités : validateurs ETag / Last-Modified et articles analysés gardés en mémoire
+SCRAPER_PAGE_CACHE_ENTRIES = int(os.environ.get('SCRAPER_PAGE_CACHE_ENTRIES', 256))
+
+# Fraîcheur max d'une entrée SearchCache réutilisée pour une nouvelle question
+SEARCH_CACHE_FRESHNESS_MINUTES = int(os.environ.get('SEARCH_CACHE_FRESHNESS_MINUTES', 30))
+# Durée de vie des réécritures de requête par le LLM
+SEARCH_REWRITE_CACHE_TTL = int(os.environ.get('SEARCH_REWRITE_CACHE_TTL', 3600))
+
+# Recherche spéculative : requête heuristique lancée pendant la réécriture LLM,
+# gardée si elle couvre assez des mots-clés de la requête réécrite
+SPECULATIVE_SEARCH_ENABLED = os.environ.get('SPECULATIVE_SEARCH_ENABLED', 'False') == 'True'
+SPECULATIVE_SEARCH_MIN_COVERAGE = float(os.environ.get('SPECULATIVE_SEARCH_MIN_COVERAGE', '0.8'))
+# Budget de temps de bout en bout d'un tour de chat (0 = sans borne, surchargeable
+# par requête : deadline_ms). Chaque appel amont prend min(son timeout, temps restant).
+# Sans borne par défaut : vLLM sur CPU prend 1-2 minutes (VLLMService.timeout = 300 s)
+CHAT_DEADLINE_SECONDS = float(os.environ.get('CHAT_DEADLINE_SECONDS', '0'))
+# Même budget pour un travail asynchrone (async_mode), compté à partir de sa prise
+# en charge par un worker : l'attente en file n'est pas décomptée (0 = sans borne)
+CHAT_JOB_DEADLINE_SECONDS = float(os.environ.get('CHAT_JOB_DEADLINE_SECONDS', '0'))
+# Temps gardé pour la génération finale pendant la réécriture et la recherche
+DEADLINE_LLM_RESERVE_SECONDS = float(os.environ.get('DEADLINE_LLM_RESERVE_SECONDS', '15'))
+# Temps gardé pour la recherche pendant la réécriture
+DEADLINE_SEARCH_RESERVE_SECONDS = float(os.environ.get('DEADLINE_SEARCH_RESERVE_SECONDS', '5'))
+# En dessous, un appel amont n'est pas lancé (étape sautée)
+DEADLINE_MIN_CALL_SECONDS = float(os.environ.get('DEADLINE_MIN_CALL_SECONDS', '1'))
+# Timeout d'un appel SerpAPI (le client serpapi n'en a pas de raisonnable par défaut)
+SERPAPI_TIMEOUT = float(os.environ.get('SERPAPI_TIMEOUT', '10'))
+
+# Mode dégradé sous charge (chat.services.load_policy) : pression = max(profondeur de file /
+# (CHAT_JOB_MAX_PENDING * LOAD_QUEUE_TARGET_RATIO), latence vLLM / LOAD_VLLM_LATENCY_TARGET).
+# Chaque seuil franchi ajoute un niveau (sans réécriture, recherche allégée, réponses
+# courtes, fournisseur rapide) ; redescente sous seuil * RECOVERY_RATIO après COOLDOWN s.
+LOAD_POLICY_ENABLED = os.environ.get('LOAD_POLICY_ENABLED', 'False') == 'True'
+LOAD_POLICY_THRESHOLDS = [float(t) for t in os.environ.get('LOAD_POLICY_THRESHOLDS', '1.0,1.5,2.0,3.0').split(',')]
+LOAD_POLICY_RECOVERY_RATIO = float(os.environ.get('LOAD_POLICY_RECOVERY_RATIO', '0.7'))
+LOAD_POLICY_COOLDOWN = float(os.environ.get('LOAD_POLICY_COOLDOWN', '30'))  # secondes
+LOAD_POLICY_INTERVAL = float(os.environ.get('LOAD_POLICY_INTERVAL', '5'))  # secondes entre évaluations
+LOAD_QUEUE_TARGET_RATIO = float(os.environ.get('LOAD_QUEUE_TARGET_RATIO', '0.5'))
+LOAD_VLLM_LATENCY_TARGET = float(os.environ.get('LOAD_VLLM_LATENCY_TARGET', '30'))  # secondes (CPU)
+LOAD_REDUCED_SEARCH_RESULTS = int(os.environ.get('LOAD_REDUCED_SEARCH_RESULTS', 3))  # < MAX_SEARCH_RESULTS
+LOAD_MAX_TOKENS_FACTOR = float(os.environ.get('LOAD_MAX_TOKENS_FACTOR', '0.5'))
+
+# Routage des modèles (chat.services.model_router). Modèle par défaut tant que
+# set-model n'a rien choisi : vllm, openrouter ou auto (routage par requête :
+# prompts courts et simples vers Phi-3 local, synthèses à long contexte vers OpenRouter).
+LLM_ROUTING_DEFAULT = os.environ.get('LLM_ROUTING_DEFAULT', 'openrouter')
+# Complexité = tokens d'entrée / MAX_INPUT_TOKENS + SEARCH_WEIGHT (synthèse de recherche)
+# + HISTORY_WEIGHT par message d'historique ; < 1 → vLLM local
+ROUTING_LOCAL_MAX_INPUT_TOKENS = int(os.environ.get('ROUTING_LOCAL_MAX_INPUT_TOKENS', 1000))  # Phi-3 sur CPU : prefill lent
+ROUTING_SEARCH_WEIGHT = float(os.environ.get('ROUTING_SEARCH_WEIGHT', '0.6'))
+ROUTING_HISTORY_WEIGHT = float(os.environ.get('ROUTING_HISTORY_WEIGHT', '0.1'))
+# Requête simple malgré tout envoyée à OpenRouter si vLLM est lent ou la file chargée
+ROUTING_VLLM_MAX_LATENCY = float(os.environ.get('ROUTING_VLLM_MAX_LATENCY', '20'))  # secondes
+ROUTING_QUEUE_SPILL_RATIO = float(os.environ.get('ROUTING_QUEUE_SPILL_RATIO', '0.8'))
+ROUTING_STATS_INTERVAL = float(os.environ.get('ROUTING_STATS_INTERVAL', '5'))  # secondes entre relevés
+
+# Micro-batching des réécritures de requête (chat.services.rewrite_batcher) : les
+# réécritures arrivées dans la fenêtre partent ensemble ; vLLM en parallèle (au plus
+# VLLM_MAX_NUM_SEQS en vol, comme --max-num-seqs du serveur), OpenRouter en un seul prompt
+REWRITE_BATCHING_ENABLED = os.environ.get('REWRITE_BATCHING_ENABLED', 'False') == 'True'
+REWRITE_BATCH_WINDOW_MS = float(os.environ.get('REWRITE_BATCH_WINDOW_MS', '5'))
+REWRITE_BATCH_MAX_SIZE = int(os.environ.get('REWRITE_BATCH_MAX_SIZE', 8))
+
+# Threads des recherches en arrière-plan (spéculation, génération en pipeline)
+SEARCH_BACKGROUND_WORKERS = int(os.environ.get('SEARCH_BACKGROUND_WORKERS', 4))
+
+# Génération en pipeline : la réponse finale démarre dès que PIPELINED_TOP_K résultats
+# de score >= PIPELINED_MIN_SCORE sont arrivés, ou quand le budget de recherche est écoulé
+# (surchargeable par requête : search_budget_ms). Les résultats tardifs sont ajoutés
+# aux sources ('attach') ou ignorés ('drop').
+PIPELINED_GENERATION_ENABLED = os.environ.get('PIPELINED_GENERATION_ENABLED', 'False') == 'True'
+PIPELINED_SEARCH_BUDGET_MS = int(os.environ.get('PIPELINED_SEARCH_BUDGET_MS', 2500))
+PIPELINED_TOP_K = int(os.environ.get('PIPELINED_TOP_K', 3))
+PIPELINED_MIN_SCORE = float(os.environ.get('PIPELINED_MIN_SCORE', '0.6'))
+PIPELINED_LATE_RESULTS = os.environ.get('PIPELINED_LATE_RESULTS', 'attach')
+
+# Préchargement des recherches sur les sujets tendances (worker en arrière-plan)
+SEARCH_PREFETCH_ENABLED = os.environ.get('SEARCH_PREFETCH_ENABLED', 'False') == 'True'
+SEARCH_PREFETCH_INTERVAL = int(os.environ.get('SEARCH_PREFETCH_INTERVAL', 900))  # secondes
+SEARCH_PREFETCH_CREDITS_PER_HOUR = int(os.environ.get('SEARCH_PREFETCH_CREDITS_PER_HOUR', 20))
+SEARCH_PREFETCH_WARM_REWRITES = os.environ.get('SEARCH_PREFETCH_WARM_REWRITES', 'True') == 'True'
+# Titres tendances cherchés tels quels : rarement retrouvés par une requête réécrite (voir chat/services/prefetch.py)
+SEARCH_PREFETCH_TRENDING = os.environ.get('SEARCH_PREFETCH_TRENDING', 'False') == 'True'
+SEARCH_PREFETCH_TEMPLATES = [
+    "Quels sont les derniers développements en IA générative annoncés cette semaine ?",
+    "Quelles sont les dernières nouveautés d'OpenAI ?",
+    "Quelles sont les dernières annonces de Google en intelligence artificielle ?",
+]
+
+# Mode asynchrone du chat : pool de workers borné pour les générations longues
+CHAT_JOB_WORKERS = int(os.environ.get('CHAT_JOB_WORKERS', 2))
+CHAT_JOB_MAX_PENDING = int(os.environ.get('CHAT_JOB_MAX_PENDING', 20))
+CHAT_JOB_RESULT_TTL = int(os.environ.get('CHAT_JOB_RESULT_TTL', 3600))  # secondes
+
+# Cache de réponses des premiers tours sans recherche (clé : prompt normalisé,
+# modèle, température), avec recherche par similarité d'embedding optionnelle
+ANSWER_CACHE_ENABLED = os.environ.get('ANSWER_CACHE_ENABLED', 'True') == 'True'
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 1000))
+ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', 86400))  # secondes
+
+# Embeddings locaux : 'hashing' (sans dépendance) ou 'sentence_transformers'
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'hashing')
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+EMBEDDING_DIM = int(os.environ.get('EMBEDDING_DIM', 256))  # dimension du hachage
+
+# Similarité cosinus minimale d'une question reformulée (0 = correspondance exacte seulement).
+# Ignorée avec le hachage : « liste et tuple » contre « liste et set » y dépasse 0.9
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get('ANSWER_CACHE_SIMILARITY_THRESHOLD', '0'))
+
+# Index local des résultats de recherche déjà obtenus (consulté avant SerpAPI)
+# Désactivé par défaut avec le hachage : des documents hors sujet y dépassent le score minimal
+LOCAL_INDEX_ENABLED = os.environ.get(
+    'LOCAL_INDEX_ENABLED', str(EMBEDDING_BACKEND == 'sentence_transformers')
+) == 'True'
+LOCAL_INDEX_DIR = os.environ.get('LOCAL_INDEX_DIR', str(BASE_DIR / 'data' / 'search_index'))
+# Couverture suffisante : au moins N documents au-dessus du score cosinus minimal
+# (requête courte contre titre + extrait : scores plus bas avec le hachage)
+LOCAL_INDEX_MIN_RESULTS = int(os.environ.get('LOCAL_INDEX_MIN_RESULTS', 3))
+LOCAL_INDEX_MIN_SCORE = float(os.environ.get(
+    'LOCAL_INDEX_MIN_SCORE', '0.45' if EMBEDDING_BACKEND == 'sentence_transformers' else '0.15'
+))
+# Part minimale des mots-clés de la requête présents dans le titre ou l'extrait d'un document
+LOCAL_INDEX_MIN_KEYWORD_OVERLAP = float(os.environ.get('LOCAL_INDEX_MIN_KEYWORD_OVERLAP', '0.5'))
+# Récence : documents vus dans une recherche live depuis moins de N heures
+LOCAL_INDEX_MAX_AGE_HOURS = float(os.environ.get('LOCAL_INDEX_MAX_AGE_HOURS', '6'))
+LOCAL_INDEX_SYNC_INTERVAL = int(os.environ.get('LOCAL_INDEX_SYNC_INTERVAL', 300))  # secondes
+
+# En-tête Server-Timing avec la durée de chaque étape du tour de chat
+# (rewrite, search, date_filter, llm, db_read, db_write, total)
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', str(DEBUG)) == 'True'
+
+# Accès à /metrics : adresses autorisées (REMOTE_ADDR, réseaux CIDR séparés par des virgules)
+# ou jeton du scraper Prometheus (Authorization: Bearer <METRICS_TOKEN>)
+METRICS_ALLOWED_NETWORKS = [
+    net.strip() for net in os.environ.get('METRICS_ALLOWED_NETWORKS', '127.0.0.1/32,::1/128').split(',') if net.strip()
+]
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Compression des réponses (chat.middleware.CompressionMiddleware) : brotli si installé, sinon gzip
+# Qualité 4 : bien meilleure que gzip sur le JSON, assez rapide pour des réponses dynamiques
+RESPONSE_BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY', 4))
+
+# Traces OpenTelemetry (OTLP/JSON) : fichier local ou collecteur HTTP
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'False') == 'True'
+TRACING_EXPORTER = os.environ.get('TRACING_EXPORTER', 'file')  # 'file' ou 'otlp_http'
+TRACING_FILE_PATH = os.environ.get('TRACING_FILE_PATH', str(BASE_DIR / 'logs' / 'traces.jsonl'))
+TRACING_OTLP_ENDPOINT = os.environ.get('TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACING_SERVICE_NAME = os.environ.get('TRACING_SERVICE_NAME', 'chatbot-backend')
+TRACING_SAMPLE_RATE = float(os.environ.get('TRACING_SAMPLE_RATE', '0.1'))
+# Les tours plus lents que ce seuil sont toujours exportés (0 = désactivé)
+TRACING_SLOW_THRESHOLD_MS = float(os.environ.get('TRACING_SLOW_THRESHOLD_MS', '10000'))
+
 # Rate limiting
 RATE_LIMIT_REQUESTS = int(os.environ.get('RATE_LIMIT_REQUESTS', 10))
 RATE_LIMIT_WINDOW = int(os.environ.get('RATE_LIMIT_WINDOW', 60))
@@ -193,19 +382,43 @@ RATE_LIMIT_WINDOW = int(os.environ.get('RATE_LIMIT_WINDOW', 60))
 # vLLM Configuration (Local LLM haute performance)
 VLLM_BASE_URL = os.environ.get('VLLM_BASE_URL', 'http://localhost:8080')
 VLLM_MODEL = os.environ.get('VLLM_MODEL', 'microsoft/Phi-3-mini-4k-instruct')
+# Séquences traitées simultanément par le serveur (vllm serve --max-num-seqs)
+VLLM_MAX_NUM_SEQS = int(os.environ.get('VLLM_MAX_NUM_SEQS', 8))
+# Contrôle d'admission (chat.services.vllm_admission) : au plus VLLM_MAX_NUM_SEQS appels
+# en vol, file équitable par conversation, bascule vers OpenRouter après VLLM_QUEUE_TIMEOUT
+VLLM_ADMISSION_ENABLED = os.environ.get('VLLM_ADMISSION_ENABLED', 'True') == 'True'
+VLLM_QUEUE_TIMEOUT = float(os.environ.get('VLLM_QUEUE_TIMEOUT', '10'))  # secondes
 
 # Logging configuration pour éviter le spam
+# Logging structuré : JSON en production, texte lisible en développement.
+# Le handler console est non bloquant (QueueHandler + thread d'écriture) et les
+# logs par résultat (debug, marqués ``sampled``) sont échantillonnés.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text' if DEBUG else 'json')
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '0.1'))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        'request_id': {
+            '()': 'chat.logging_utils.RequestIdFilter',
+        },
+        'sampling': {
+            '()': 'chat.logging_utils.SamplingFilter',
+            'rate': LOG_DEBUG_SAMPLE_RATE,
+        },
+    },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
+            '()': 'chat.logging_utils.QueueListenerHandler',
+            'json_format': LOG_FORMAT == 'json',
+            'filters': ['request_id', 'sampling'],
         },
     },
     'root': {
         'handlers': ['console'],
-        'level': 'INFO',
+        'level': LOG_LEVEL,
     },
     'loggers': {
         'django.channels.server': {
@@ -218,5 +431,8 @@ LOGGING = {
             'level': 'ERROR',  # Ne montrer que les erreurs
             'propagate': False,
         },
+        'httpx': {
+            'level': 'WARNING',
+        },
     },
 }
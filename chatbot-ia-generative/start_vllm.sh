@@ -33,4 +33,5 @@ vllm serve "microsoft/Phi-3-mini-4k-instruct" \
     --max-model-len 4096 \
     --host 0.0.0.0 \
     --port 8080 \
-    --dtype float16
\ No newline at end of file
+    --dtype float16 \
+    --enable-prefix-caching
\ No newline at end of file